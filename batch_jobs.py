@@ -0,0 +1,225 @@
+# ---
+# OPENAI BATCH JOBS ---
+#
+# Bulk imports send their LLM requests through the OpenAI Batch API instead of one synchronous
+# request per receipt: half the price, no rate-limit juggling, results within the completion window.
+#
+# A batch run lives in a working directory:
+#   batch_state.json       what is prepared, uploaded, submitted and collected (rewritten atomically
+#                          after every step, so an interrupted run continues where it stopped)
+#   chunk-0001.jsonl       batch input files (one request per line, split to stay below the API limits)
+#   chunk-0001.output.jsonl / .errors.jsonl  downloaded results
+#
+# The Batch API is reached through the normal OpenAI client, so OPENAI_BASE_URL can point the whole
+# workflow at a local stand-in server (see benchmarks/fake_openai_server.py).
+import json
+import logging
+import os
+import time
+
+BATCH_ENDPOINT = "/v1/responses"
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# Batch API limits per input file: 50,000 requests and 200 MB
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+log = logging.getLogger("receipts.batch")
+
+
+def response_output_text(body):
+    """Returns the concatenated output text of a raw Responses API response body."""
+    if body.get("output_text"):
+        return body["output_text"]
+    return "".join(
+        content.get("text", "")
+        for item in body.get("output", []) if item.get("type") == "message"
+        for content in item.get("content", []) if content.get("type") == "output_text")
+
+
+class BatchRun:
+    """
+    Persistent state of a batch run in a working directory.
+    Args:
+        directory (str): Working directory of the run.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.state_path = os.path.join(directory, "batch_state.json")
+        self.state = {"chunks": [], "items": {}}
+        self._open_chunk = None
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    @property
+    def resumed(self):
+        """True if the run was loaded from an earlier, unfinished invocation."""
+        return "images" in self.state
+
+    def save(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def prepared_ids(self):
+        """IDs of all requests written to a chunk."""
+        return {custom_id for chunk in self.state["chunks"] for custom_id in chunk["custom_ids"]}
+
+    def settle(self, file_id, result, error=None):
+        """
+        Records the result of an image that needs no request of its own (e.g. a near-duplicate of an image
+        extracted in an earlier run), so a resumed run does not prepare it again. Saved with the next chunk
+        (see flush) or save().
+        """
+        self.state.setdefault("settled", {})[file_id] = {"result": result, "error": error and str(error)}
+
+    @property
+    def settled(self):
+        """File ID -> {"result", "error"} of the images recorded with settle()."""
+        return self.state.get("settled", {})
+
+    def add_request(self, custom_id, body, item, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+        """
+        Appends a request to the current batch input file, starting a new one when the file would
+        exceed the limits. A chunk is recorded in the state only when it is complete (see flush), so
+        requests of an interrupted chunk are prepared again on the next run. Not thread-safe.
+        Args:
+            custom_id (str): Request ID, unique within the run.
+            body (dict): Request body.
+            item (dict): Stored with the request and returned with its result (e.g. file metadata and OCR text).
+            max_requests (int): Max requests per chunk.
+            max_bytes (int): Max size of a chunk file.
+        """
+        line = (json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+                           ensure_ascii=False) + "\n").encode("utf-8")
+        if self._open_chunk and (len(self._open_chunk["items"]) >= max_requests
+                                 or self._open_chunk["size"] + len(line) > max_bytes):
+            self.flush()
+        if not self._open_chunk:
+            name = f"chunk-{len(self.state['chunks']) + 1:04d}"
+            self._open_chunk = {"name": name, "file": open(self._path(name + ".jsonl.tmp"), "wb"),
+                                "items": {}, "size": 0}
+        self._open_chunk["file"].write(line)
+        self._open_chunk["items"][custom_id] = item
+        self._open_chunk["size"] += len(line)
+
+    def flush(self):
+        """Completes the current batch input file and records it as a chunk."""
+        chunk = self._open_chunk
+        if not chunk:
+            return
+        self._open_chunk = None
+        chunk["file"].close()
+        path = self._path(chunk["name"] + ".jsonl")
+        os.replace(path + ".tmp", path)
+        self.state["items"].update(chunk["items"])
+        self.state["chunks"].append({"name": chunk["name"], "custom_ids": list(chunk["items"]),
+                                     "input_file_id": None, "batch_id": None, "status": "prepared",
+                                     "output_file_id": None, "error_file_id": None, "collected": False})
+        self.save()
+        log.info("Batch: wrote %s (%d requests, %.1f MB)", chunk['name'], len(chunk['items']), chunk['size'] / 1e6)
+
+    def submit(self, client, completion_window="24h"):
+        """Uploads and submits every chunk that has not been submitted yet."""
+        for chunk in self.state["chunks"]:
+            if not chunk["input_file_id"]:
+                with open(self._path(chunk["name"] + ".jsonl"), "rb") as f:
+                    chunk["input_file_id"] = client.files.create(file=f, purpose="batch").id
+                self.save()
+            if not chunk["batch_id"]:
+                batch = client.batches.create(input_file_id=chunk["input_file_id"], endpoint=BATCH_ENDPOINT,
+                                              completion_window=completion_window,
+                                              metadata={"chunk": chunk["name"]})
+                chunk["batch_id"] = batch.id
+                chunk["status"] = batch.status
+                self.save()
+                log.info("Batch: submitted %s as %s", chunk['name'], batch.id, extra={"batch_id": batch.id})
+
+    def wait(self, client, poll_interval=30, timeout=None):
+        """
+        Polls the submitted batches until all of them reached a terminal status.
+        Args:
+            client (OpenAI): OpenAI client instance.
+            poll_interval (float): Seconds between polls.
+            timeout (float, optional): Give up after this many seconds; the run can be resumed later.
+        Returns:
+            bool: True if all batches are finished.
+        """
+        start = time.monotonic()
+        while True:
+            pending = [c for c in self.state["chunks"] if c["status"] not in TERMINAL_STATUSES]
+            for chunk in pending:
+                batch = client.batches.retrieve(chunk["batch_id"])
+                counts = getattr(batch, "request_counts", None)
+                if batch.status != chunk["status"]:
+                    progress = f" ({counts.completed + counts.failed}/{counts.total})" if counts else ""
+                    log.info("Batch %s (%s): %s%s", chunk['name'], chunk['batch_id'], batch.status, progress,
+                             extra={"batch_id": chunk['batch_id'], "status": batch.status})
+                chunk["status"] = batch.status
+                chunk["output_file_id"] = batch.output_file_id
+                chunk["error_file_id"] = batch.error_file_id
+            self.save()
+            if all(c["status"] in TERMINAL_STATUSES for c in self.state["chunks"]):
+                return True
+            if timeout is not None and time.monotonic() - start > timeout:
+                return False
+            time.sleep(poll_interval)
+
+    def _download(self, client, file_id, name):
+        """Downloads a batch output file once; later runs read the local copy."""
+        path = self._path(name)
+        if not os.path.exists(path):
+            content = client.files.content(file_id).content
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def results(self, client, chunk):
+        """
+        Yields the results of a finished chunk.
+        Yields:
+            tuple: (custom_id, item, output_text or None, usage dict or None, error or None)
+        """
+        lines = []
+        if chunk["output_file_id"]:
+            lines += self._download(client, chunk["output_file_id"], chunk["name"] + ".output.jsonl")
+        if chunk["error_file_id"]:
+            lines += self._download(client, chunk["error_file_id"], chunk["name"] + ".errors.jsonl")
+        by_id = {line.get("custom_id"): line for line in lines}
+        for custom_id in chunk["custom_ids"]:
+            item = self.state["items"].get(custom_id)
+            line = by_id.get(custom_id)
+            if line is None:
+                yield custom_id, item, None, None, f"no result (batch {chunk['status']})"
+                continue
+            response = line.get("response") or {}
+            body = response.get("body") or {}
+            if line.get("error") or response.get("status_code") != 200:
+                error = line.get("error") or body.get("error") or f"HTTP {response.get('status_code')}"
+                if isinstance(error, dict):
+                    error = error.get("message") or json.dumps(error)
+                yield custom_id, item, None, None, error
+                continue
+            yield custom_id, item, response_output_text(body), body.get("usage"), None
+
+    def mark_collected(self, chunk):
+        chunk["collected"] = True
+        self.save()
+
+    def finish(self):
+        """Removes the run's files once all results are collected."""
+        for chunk in self.state["chunks"]:
+            for suffix in (".jsonl", ".output.jsonl", ".errors.jsonl"):
+                path = self._path(chunk["name"] + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
@@ -0,0 +1,181 @@
+"""
+Benchmark: product catalog startup, legacy (pandas read_csv + ProductMatchIndex build on every
+start) vs. the compiled snapshot (product_catalog.py), cold (first start: compile + load) and warm
+(memory-mapped load of an existing snapshot).
+
+Every variant runs in a fresh Python process and reports its import time, catalog load time and
+memory: RSS, and private memory (pages not shared with other processes, e.g. through the page
+cache; Linux only). The catalog is grown with synthetic names (see bench_product_matcher.py) for
+the larger scales.
+
+With --stores N, a catalog registry (catalog_registry.py) of N stores, each with a catalog of the
+largest scale, is then started in a fresh process: it reports the registry start, the first lookup
+of each store (memory-mapped load + lookup) and memory with one store loaded, all stores loaded and
+after the idle catalogs were unloaded.
+
+Usage (from the repository root):
+    python3 benchmarks/bench_catalog.py [--scales 1,10,100] [--repeat 3] [--stores 3]
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from bench_product_matcher import CSV_PATH, grow_catalog
+
+MEMORY = r"""
+import resource
+
+def memory():
+    rss = private = None
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line and not line[0].isdigit())
+        kb = lambda key: int(fields[key].split()[0])
+        rss, private = kb("Rss") / 1024, (kb("Private_Clean") + kb("Private_Dirty")) / 1024
+    except (OSError, KeyError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return rss, private
+"""
+
+# Runs in the child process: argv = mode, csv path, snapshot dir
+CHILD = MEMORY + r"""
+import json, os, sys, time
+sys.path.insert(0, sys.argv[4])
+
+mode, csv_path, snapshot_dir = sys.argv[1:4]
+start = time.perf_counter()
+if mode == "pandas":
+    import pandas as pd
+    from product_matcher import ProductMatchIndex
+else:
+    from product_catalog import load_catalog
+imported = time.perf_counter()
+if mode == "pandas":
+    df = pd.read_csv(csv_path)
+    product_dict = {str(row["name"]).strip().lower(): str(row["category"]).strip() for _, row in df.iterrows()}
+    index = ProductMatchIndex(product_dict.keys())
+else:
+    catalog = load_catalog(csv_path, snapshot_dir)
+    index = catalog.index
+loaded = time.perf_counter()
+# One lookup touches every index array, as the first real lookup would
+index.extract_one("billy bookcase")
+rss, private = memory()
+print(json.dumps({"import": imported - start, "load": loaded - imported, "rss": rss, "private": private}))
+"""
+
+
+# Runs in the child process: argv = catalog config, snapshot dir, repository dir
+REGISTRY_CHILD = MEMORY + r"""
+import gc, json, sys, time
+sys.path.insert(0, sys.argv[3])
+start = time.perf_counter()
+from catalog_registry import CatalogRegistry
+registry = CatalogRegistry(sys.argv[1], snapshot_dir=sys.argv[2], idle_seconds=3600)
+report = {"start": time.perf_counter() - start, "first_lookups": []}
+for i, store in enumerate(registry.stores()):
+    start = time.perf_counter()
+    registry.get(store).match("billy bookcase")
+    report["first_lookups"].append(time.perf_counter() - start)
+    if i == 0:
+        report["one_store"] = memory()
+report["all_stores"] = memory()
+registry.evict_idle(now=time.monotonic() + 3600)
+gc.collect()
+report["unloaded"] = memory()
+print(json.dumps(report))
+"""
+
+
+def write_catalog(names, path, rng):
+    categories = ["Bookcases & shelving units", "Chairs", "Tables & desks", "Beds", "Sofas & armchairs"]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "category"])
+        for name in names:
+            writer.writerow([name.upper(), rng.choice(categories)])
+
+
+def run_child(mode, csv_path, snapshot_dir):
+    output = subprocess.run([sys.executable, "-c", CHILD, mode, csv_path, snapshot_dir, os.path.join(BENCH_DIR, "..")],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_registry(csv_path, n_names, stores, work_dir):
+    """Runs a registry of `stores` copies of the catalog in a fresh process and prints its report."""
+    config = {"stores": {}}
+    for i in range(stores):
+        store_csv = os.path.join(work_dir, f"store{i}.csv")
+        shutil.copyfile(csv_path, store_csv)
+        config["stores"][f"STORE{i}"] = {"csv": store_csv}
+    config_path = os.path.join(work_dir, "catalogs.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    snapshot_dir = os.path.join(work_dir, "registry_snapshots")
+    # Compile the snapshots first: the report is about a registry start with existing snapshots
+    for _ in range(2):
+        output = subprocess.run([sys.executable, "-c", REGISTRY_CHILD, config_path, snapshot_dir,
+                                 os.path.join(BENCH_DIR, "..")], check=True, capture_output=True, text=True).stdout
+    report = json.loads(output.strip().splitlines()[-1])
+    print(f"\nRegistry of {stores} stores x {n_names} names: started in {report['start'] * 1000:.1f} ms, first lookup "
+          f"per store {', '.join(f'{s * 1000:.0f}' for s in report['first_lookups'])} ms")
+    print(f"{'':>9} {'loaded':>16} {'RSS MB':>8} {'private MB':>11}")
+    for label, key in (("one store", "one_store"), ("all stores", "all_stores"), ("after unload", "unloaded")):
+        rss, private = report[key]
+        print(f"{'':>9} {label:>16} {rss:>8.1f} {private if private is not None else float('nan'):>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Product catalog startup benchmark")
+    parser.add_argument("--scales", default="1,10,100", help="Comma-separated catalog growth factors")
+    parser.add_argument("--repeat", type=int, default=3, help="Processes started per variant (median reported)")
+    parser.add_argument("--stores", type=int, default=0, help="Stores of the catalog registry run (0 skips it)")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with open(CSV_PATH, "r", encoding="utf-8", newline="") as f:
+        base_names = list(dict.fromkeys(row["name"].strip().lower() for row in csv.DictReader(f)))
+    work_dir = tempfile.mkdtemp(prefix="bench_catalog_")
+    try:
+        print(f"{'names':>9} {'variant':>16} {'import s':>9} {'load s':>8} {'RSS MB':>8} {'private MB':>11}")
+        for scale in [int(s) for s in args.scales.split(",")]:
+            csv_path = os.path.join(work_dir, f"catalog_x{scale}.csv")
+            if scale == 1:
+                shutil.copyfile(CSV_PATH, csv_path)
+            else:
+                write_catalog(grow_catalog(base_names, scale, rng), csv_path, rng)
+            snapshot_dir = os.path.join(work_dir, "snapshots")
+            variants = [("pandas", "pandas"), ("snapshot (cold)", "snapshot"), ("snapshot (warm)", "snapshot")]
+            n_names = None
+            for label, mode in variants:
+                runs = []
+                for _ in range(args.repeat):
+                    if label == "snapshot (cold)":
+                        shutil.rmtree(snapshot_dir, ignore_errors=True)
+                    runs.append(run_child(mode, csv_path, snapshot_dir))
+                if n_names is None:
+                    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+                        n_names = len({row["name"].strip().lower() for row in csv.DictReader(f)})
+                median = lambda key: statistics.median(r[key] for r in runs) if runs[0][key] is not None else None
+                private = median("private")
+                print(f"{n_names:>9} {label:>16} {median('import'):>9.3f} {median('load'):>8.3f} "
+                      f"{median('rss'):>8.1f} {private if private is not None else float('nan'):>11.1f}")
+        if args.stores:
+            run_registry(csv_path, n_names, args.stores, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
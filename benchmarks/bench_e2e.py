@@ -0,0 +1,291 @@
+"""
+Benchmark: the whole extractor end to end, offline. A fake Google Drive (fake_drive_server.py, with
+synthetic receipt photos) and a fake OpenAI API (fake_openai_server.py) run in this process, with
+configurable latency and error rates. The extractor runs in a fresh child process, configured only
+through its environment (GOOGLE_DRIVE_API_URL, a service account key whose token endpoint is the fake
+Drive, OPENAI_BASE_URL), exactly as it would run against the real services:
+
+    pipeline  process_folder_ids: crawl, pooled downloads, OCR process pool, scheduled LLM requests
+    local     feed_image_to_llm_local on each receipt, one after the other (downloaded beforehand)
+
+Reports receipts/second, per-stage latencies (from the run metrics) and the peak memory of the
+extractor process and of its OCR workers, and checks them against the regression thresholds in
+e2e_thresholds.json (exit code 1 if one is exceeded).
+
+OCR uses Tesseract if it is installed. Otherwise (or with --ocr standin) a stand-in engine finds the
+text lines of the preprocessed image from its row profile and returns placeholder receipt words for
+them; throughput then excludes Tesseract's time, and the *-standin thresholds apply.
+
+--duplicate-rate makes a share of the receipts re-encoded copies of others; the run reports how many
+were collapsed onto their original by near-duplicate detection (image_dedup.py).
+
+Usage (from the repository root):
+    python3 benchmarks/bench_e2e.py [--mode pipeline|local] [--receipts 40] [--ocr auto|tesseract|standin]
+        [--drive-latency 0.02] [--drive-error-rate 0.02] [--drive-drop-rate 0.02] [--duplicate-rate 0.2] [--no-dedup]
+        [--openai-latency 0.3] [--openai-error-rate 0.02] [--openai-rpm 5000] [--openai-tpm 4000000]
+        [--report cache/bench_e2e.json]
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import ocr_engine
+
+DEFAULT_THRESHOLDS = os.path.join(BENCH_DIR, "e2e_thresholds.json")
+
+
+class StandInOcrEngine:
+    """OCR stand-in: one placeholder line per text line found in the image's row profile."""
+
+    name = "standin"
+
+    def image_to_data(self, img, lang="eng", psm=3):
+        import numpy as np
+        gray = np.asarray(img.convert("L"))
+        # Rows darker than a typical (blank) row; dark margins left by the crop darken every row alike
+        profile = (gray < 100).mean(axis=1)
+        text_rows = profile > np.median(profile) + 0.01
+        data = {column: [] for column in ocr_engine.TSV_COLUMNS}
+        top, number = None, 0
+        for y, is_text in enumerate(list(text_rows) + [False]):
+            if is_text and top is None:
+                top = y
+            elif not is_text and top is not None:
+                if number == 0:
+                    words = ["REWE"]
+                elif number == 1:
+                    words = ["01.02.2024"]
+                else:
+                    words = ["ARTIKEL", str(number), f"{number % 20},{number % 100:02d}"]
+                for word_num, word in enumerate(words, 1):
+                    for column, value in zip(ocr_engine.TSV_COLUMNS, [5, 1, 1, 1, number + 1, word_num,
+                                                                       40 * word_num, top, 40, y - top, 90, word]):
+                        data[column].append(value)
+                top, number = None, number + 1
+        return data
+
+
+# At module level, so OCR worker processes know the engine whatever their start method
+ocr_engine.ENGINES["standin"] = StandInOcrEngine
+
+
+def tesseract_available():
+    return shutil.which("tesseract") is not None
+
+
+def run_child(config):
+    """Runs the extractor against the fake services (in the child process); returns the measurements."""
+    import receipt_info_extractor as extractor
+    from category_cache import configure_category_cache
+    from logging_setup import setup_logging
+    from run_metrics import metrics
+
+    log_listener = setup_logging(config["log_level"])
+    configure_category_cache(None)
+    extractor.configure_drive_downloads(sessions=config["download_workers"])
+    ocr_options = {"engine": config["ocr"]}
+    start = time.perf_counter()
+    if config["mode"] == "pipeline":
+        from openai import AsyncOpenAI
+        from llm_scheduler import LLMScheduler
+        from image_dedup import DuplicateIndex
+        scheduler = LLMScheduler(AsyncOpenAI(max_retries=0))
+        dedup = DuplicateIndex(config["dedup_path"]) if config["dedup_path"] else None
+        try:
+            results = extractor.process_folder_ids(
+                os.environ["GOOGLE_DRIVE_FOLDER_ID"], download_workers=config["download_workers"],
+                ocr_workers=config["ocr_workers"], llm_workers=config["llm_workers"], llm_client=scheduler,
+                ocr_options=ocr_options, dedup=dedup)
+        finally:
+            scheduler.close()
+            if dedup:
+                dedup.close()
+        succeeded = sum(1 for result in results if result.error is None and result.value)
+        receipts = len(results)
+    else:
+        images, _ = extractor.crawl_folders([os.environ["GOOGLE_DRIVE_FOLDER_ID"]],
+                                            extractor.get_thread_drive_service)
+        paths = [extractor.download_drive_file(image, config["download_dir"]) for image in images]
+        metrics.reset()
+        start = time.perf_counter()
+        client = extractor.get_openai_client()
+        succeeded = sum(1 for path in paths if extractor.feed_image_to_llm_local(path, client, ocr_options=ocr_options))
+        receipts = len(paths)
+    elapsed = time.perf_counter() - start
+    log_listener.stop()
+    return {
+        "receipts": receipts, "succeeded": succeeded, "elapsed_seconds": elapsed,
+        # ru_maxrss is in KB on Linux; the children value is the largest OCR worker
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "metrics": metrics.report(),
+    }
+
+
+class QuietServer(ThreadingHTTPServer):
+    """Local HTTP server that does not print the connection resets of cut-off transfers."""
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(handler):
+    server = QuietServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check_thresholds(summary, thresholds):
+    """Returns the violated thresholds as messages."""
+    violations = []
+    if summary["receipts_per_second"] < thresholds.get("min_receipts_per_second", 0):
+        violations.append(f"receipts/s {summary['receipts_per_second']:.2f} < {thresholds['min_receipts_per_second']}")
+    if summary["failed"] > thresholds.get("max_failed", summary["failed"]):
+        violations.append(f"failed receipts {summary['failed']} > {thresholds['max_failed']}")
+    for key in ("peak_rss_mb", "peak_worker_rss_mb"):
+        if key in thresholds and summary[key] > thresholds[key]:
+            violations.append(f"{key} {summary[key]:.0f} > {thresholds[key]}")
+    for stage, limit in thresholds.get("max_p95_seconds", {}).items():
+        p95 = summary["stages"].get(stage, {}).get("p95_seconds")
+        if p95 is not None and p95 > limit:
+            violations.append(f"{stage} p95 {p95:.3f}s > {limit}s")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark")
+    parser.add_argument("--mode", choices=["pipeline", "local"], default="pipeline")
+    parser.add_argument("--receipts", type=int, default=40)
+    parser.add_argument("--folders", type=int, default=4)
+    parser.add_argument("--image-size", default="1600x2200", help="Receipt photo size WIDTHxHEIGHT")
+    parser.add_argument("--ocr", choices=["auto", "tesseract", "standin"], default="auto",
+                        help="auto: Tesseract if installed, else the stand-in")
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--ocr-workers", type=int, default=None)
+    parser.add_argument("--llm-workers", type=int, default=16)
+    parser.add_argument("--drive-latency", type=float, default=0.02, help="Seconds per Drive request")
+    parser.add_argument("--drive-error-rate", type=float, default=0.02, help="Share of downloads failing with 503")
+    parser.add_argument("--drive-drop-rate", type=float, default=0.02, help="Share of downloads cut off halfway")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="Share of receipts that are re-encoded copies")
+    parser.add_argument("--no-dedup", action="store_true", help="Process near-duplicate receipts separately")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="Seconds per LLM request")
+    parser.add_argument("--openai-error-rate", type=float, default=0.02, help="Share of LLM requests failing with 500")
+    parser.add_argument("--openai-rpm", type=int, default=5000, help="Requests per minute limit of the fake OpenAI API")
+    parser.add_argument("--openai-tpm", type=int, default=4000000, help="Tokens per minute limit of the fake OpenAI API")
+    parser.add_argument("--thresholds", default=DEFAULT_THRESHOLDS, help="Regression thresholds file ('' to skip)")
+    parser.add_argument("--report", default=None, help="Also write the results as JSON to this file")
+    parser.add_argument("--log-level", default="WARNING", help="Log level of the extractor")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open(args.child, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        result = run_child(config)
+        with open(config["result_path"], "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    from fake_drive_server import ROOT_FOLDER_ID, FakeDrive, write_service_account
+    from fake_drive_server import make_handler as drive_handler
+    from fake_openai_server import FakeOpenAI
+    from fake_openai_server import make_handler as openai_handler
+    from synthetic_receipts import parse_size
+
+    ocr = args.ocr
+    if ocr == "auto":
+        ocr = "tesseract" if tesseract_available() else "standin"
+    print(f"Generating {args.receipts} synthetic receipts ({args.image_size}), OCR: {ocr}")
+    drive = FakeDrive(args.receipts, args.folders, image_size=parse_size(args.image_size), latency=args.drive_latency,
+                      error_rate=args.drive_error_rate, drop_rate=args.drive_drop_rate,
+                      duplicate_rate=args.duplicate_rate)
+    openai_api = FakeOpenAI(latency=args.openai_latency, error_rate=args.openai_error_rate, rpm=args.openai_rpm,
+                            tpm=args.openai_tpm)
+    drive_server = start_server(drive_handler(drive))
+    openai_server = start_server(openai_handler(openai_api))
+
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    try:
+        drive_url = f"http://127.0.0.1:{drive_server.server_port}"
+        env = dict(os.environ,
+                   GOOGLE_DRIVE_API_URL=f"{drive_url}/drive/v3",
+                   GOOGLE_DRIVE_APPLICATION_CREDENTIALS_PATH=write_service_account(
+                       os.path.join(workdir, "service_account.json"), f"{drive_url}/token"),
+                   GOOGLE_DRIVE_FOLDER_ID=ROOT_FOLDER_ID,
+                   OPENAI_BASE_URL=f"http://127.0.0.1:{openai_server.server_port}/v1",
+                   OPENAI_API_KEY="fake-key")
+        config = {"mode": args.mode, "ocr": "standin" if ocr == "standin" else "auto",
+                  "download_workers": args.download_workers, "ocr_workers": args.ocr_workers,
+                  "llm_workers": args.llm_workers, "log_level": args.log_level,
+                  "download_dir": os.path.join(workdir, "downloads"),
+                  "dedup_path": None if args.no_dedup else os.path.join(workdir, "image_hashes.sqlite"),
+                  "result_path": os.path.join(workdir, "result.json")}
+        config_path = os.path.join(workdir, "config.json")
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(config, f)
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--child", config_path], env=env, check=True,
+                       cwd=workdir)
+        with open(config["result_path"], "r", encoding="utf-8") as f:
+            result = json.load(f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        drive_server.shutdown()
+        openai_server.shutdown()
+
+    stages = result["metrics"]["stages"]
+    summary = {
+        "mode": args.mode, "ocr": ocr, "receipts": result["receipts"], "failed": result["receipts"] - result["succeeded"],
+        "elapsed_seconds": result["elapsed_seconds"],
+        "receipts_per_second": result["succeeded"] / result["elapsed_seconds"] if result["elapsed_seconds"] else 0.0,
+        "peak_rss_mb": result["peak_rss_mb"], "peak_worker_rss_mb": result["peak_worker_rss_mb"],
+        "stages": stages, "counters": result["metrics"]["counters"],
+        "fake_drive": dict(drive.stats, duplicates=len(drive.duplicates)), "fake_openai": {"errors": openai_api.errors},
+    }
+    print(f"\n{args.mode}: {summary['receipts']} receipts ({summary['failed']} failed) in "
+          f"{summary['elapsed_seconds']:.1f}s = {summary['receipts_per_second']:.2f} receipts/s")
+    print(f"peak memory: extractor {summary['peak_rss_mb']:.0f} MB, largest OCR worker "
+          f"{summary['peak_worker_rss_mb']:.0f} MB")
+    print(f"injected failures: Drive {drive.stats['errors']} errors + {drive.stats['dropped']} dropped transfers, "
+          f"OpenAI {openai_api.errors} errors")
+    if drive.duplicates:
+        print(f"near-duplicates: {len(drive.duplicates)} copies on the Drive, "
+              f"{summary['counters'].get('dedup_hits', 0)} collapsed onto their original")
+    print(f"\n{'stage':<18} {'count':>6} {'errors':>6} {'p50 s':>8} {'p95 s':>8} {'max s':>8}")
+    for name, stats in stages.items():
+        print(f"{name:<18} {stats['count']:>6} {stats['errors']:>6} {stats['p50_seconds'] or 0:>8.3f} "
+              f"{stats['p95_seconds'] or 0:>8.3f} {stats['max_seconds']:>8.3f}")
+    if args.report:
+        directory = os.path.dirname(args.report)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.thresholds:
+        with open(args.thresholds, "r", encoding="utf-8") as f:
+            thresholds = json.load(f).get(f"{args.mode}-{ocr}")
+        if thresholds is None:
+            print(f"\nNo thresholds for {args.mode}-{ocr} in {args.thresholds}")
+            return
+        violations = check_thresholds(summary, thresholds)
+        if violations:
+            print("\nREGRESSION: " + "; ".join(violations))
+            sys.exit(1)
+        print(f"\nWithin the {args.mode}-{ocr} thresholds")
+
+
+if __name__ == "__main__":
+    main()
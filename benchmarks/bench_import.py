@@ -0,0 +1,45 @@
+"""
+Benchmark: time to import receipt_info_extractor in a fresh Python process (what every test run,
+helper script and spawned worker pays), and which heavy modules the import pulls in.
+
+Usage (from the repository root):
+    python3 benchmarks/bench_import.py [--repeat 5] [--module receipt_info_extractor]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HEAVY_MODULES = ["openai", "PIL", "pytesseract", "numpy", "pandas", "googleapiclient", "requests", "pydantic"]
+
+CHILD = r"""
+import json, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "loaded": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh processes started (median reported)")
+    parser.add_argument("--module", default="receipt_info_extractor", help="Module to import")
+    args = parser.parse_args()
+
+    runs = []
+    for _ in range(args.repeat):
+        output = subprocess.run([sys.executable, "-c", CHILD, args.module] + HEAVY_MODULES, cwd=REPO_DIR,
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    times = sorted(run["seconds"] for run in runs)
+    print(f"import {args.module}: median {statistics.median(times) * 1000:.0f} ms, "
+          f"min {times[0] * 1000:.0f} ms, max {times[-1] * 1000:.0f} ms ({args.repeat} processes)")
+    print(f"heavy modules loaded: {', '.join(runs[-1]['loaded']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark: store-name normalization with the compiled alias automaton (normalization.py) vs. the
+former linear substring loop over the alias map, as the alias list grows; plus date validation
+with the compiled date grammar vs. trying eight strptime formats.
+
+Usage (from the repository root):
+    python3 benchmarks/bench_normalization.py [--aliases 10,1000,10000] [--names 2000]
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from normalization import DEFAULT_RULES_PATH, NormalizationRules
+
+DATE_FORMATS = ("%d.%m.%Y", "%d-%m-%Y", "%d/%m/%Y", "%Y-%m-%d", "%Y/%m/%d", "%d.%m.%y", "%d-%m-%y", "%d/%m/%y")
+
+
+def linear_store(store, store_map):
+    """The former store normalization: substring test of every alias."""
+    store_key = store.lower().replace(",", "").replace("  ", " ").strip()
+    for k, v in store_map.items():
+        if k in store_key:
+            return v
+    return None
+
+
+def strptime_valid(date_str):
+    """The former date validation: strptime with every format, exceptions as control flow."""
+    for fmt in DATE_FORMATS:
+        try:
+            if datetime.strptime(date_str, fmt).date() <= date.today():
+                return True
+        except Exception:
+            continue
+    return False
+
+
+def random_word(rng, length):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def time_per_call(function, inputs):
+    start = time.perf_counter()
+    for value in inputs:
+        function(value)
+    return (time.perf_counter() - start) / len(inputs) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Normalization rules benchmark")
+    parser.add_argument("--aliases", default="10,1000,10000", help="Comma-separated alias list sizes")
+    parser.add_argument("--names", type=int, default=2000, help="Store names normalized per size")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with open(DEFAULT_RULES_PATH, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    print(f"{'aliases':>8} {'compile ms':>11} {'automaton us':>13} {'linear us':>10}")
+    for size in [int(s) for s in args.aliases.split(",")]:
+        stores = dict(config["stores"])
+        while sum(len(aliases) for aliases in stores.values()) < size:
+            stores[random_word(rng, 8).upper()] = [f"{random_word(rng, rng.randint(4, 10))} {random_word(rng, 5)}"]
+        start = time.perf_counter()
+        rules = NormalizationRules(dict(config, stores=stores))
+        compile_ms = (time.perf_counter() - start) * 1000
+        store_map = {alias.lower(): store for store, aliases in stores.items() for alias in aliases}
+        aliases = list(store_map)
+        names = [rng.choice([f"{rng.choice(aliases).upper()} Filiale {rng.randint(1, 99)}",
+                             f"{random_word(rng, 6)} Markt GmbH, {random_word(rng, 7)}"]) for _ in range(args.names)]
+        mismatches = [n for n in names if rules.canonical_store(n) != linear_store(n, store_map)]
+        if mismatches:
+            raise SystemExit(f"Automaton result differs from the linear scan for: {mismatches[:5]}")
+        automaton_us = time_per_call(rules.canonical_store, names)
+        linear_us = time_per_call(lambda n: linear_store(n, store_map), names)
+        print(f"{size:>8} {compile_ms:>11.1f} {automaton_us:>13.1f} {linear_us:>10.1f}")
+
+    rules = NormalizationRules(config)
+    dates = [rng.choice([f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{rng.randint(2015, 2024)}",
+                         f"{rng.randint(2015, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                         f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(15, 24)}",
+                         "not a date"]) for _ in range(args.names)]
+    assert all(rules.is_valid_date(d) == strptime_valid(d) for d in dates)
+    print(f"date validation: grammar {time_per_call(rules.is_valid_date, dates):.1f} us, "
+          f"strptime loop {time_per_call(strptime_valid, dates):.1f} us")
+
+
+if __name__ == "__main__":
+    main()
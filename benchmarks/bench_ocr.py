@@ -0,0 +1,98 @@
+"""
+Benchmark: OCR throughput of the former path (one pytesseract.image_to_data call on the whole
+receipt) vs. the OCR engine (ocr_engine.py: engine kept per process, tall receipts OCR'd as
+parallel strips), on preprocessed receipts of increasing length. Also reports how close the
+stitched text is to the single-page text.
+
+Both paths run the images in a pool of --processes worker processes, like the pipeline's OCR stage.
+Without arguments, synthetic receipts (white paper, one article per line) are generated.
+
+Usage (from the repository root):
+    python3 benchmarks/bench_ocr.py [image ...] [--lengths 1,3,6,10] [--receipts 8] [--processes 2]
+        [--engine auto] [--strip-workers 4] [--max-aspect 3]
+"""
+import argparse
+import difflib
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytesseract
+from PIL import Image, ImageDraw, ImageFont
+
+from ocr_engine import ocr_receipt
+from ocr_routing import ocr_text_from_data
+
+
+def synthetic_receipt(rng, width=1000, aspect=3):
+    """A preprocessed (grayscale, target width) receipt aspect times as tall as wide."""
+    img = Image.new("L", (width, width * aspect), 255)
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default(size=28)
+    for y in range(40, img.height - 80, 44):
+        draw.text((40, y), f"ARTIKEL {rng.randint(100, 999)} STK {rng.randint(1, 9)}   "
+                           f"{rng.randint(1, 99)},{rng.randint(0, 99):02d} EUR", fill=0, font=font)
+    return img
+
+
+def former_ocr(img):
+    data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
+    return ocr_text_from_data(data)
+
+
+def engine_ocr(img, engine, strip_workers, max_aspect):
+    data, _ = ocr_receipt(img, engine=engine, strip_workers=strip_workers, max_aspect=max_aspect)
+    return ocr_text_from_data(data)
+
+
+def run(function, images, processes):
+    """OCRs all images in a fresh worker pool; returns (seconds, texts)."""
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # Start the workers (and load the engine) before timing
+        list(pool.map(function, [Image.new("L", (200, 200), 255)] * processes))
+        start = time.perf_counter()
+        texts = list(pool.map(function, images))
+        return time.perf_counter() - start, texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR engine benchmark")
+    parser.add_argument("images", nargs="*", help="Preprocessed receipt images (default: synthetic)")
+    parser.add_argument("--lengths", default="1,3,6,10", help="Height/width ratios of the synthetic receipts")
+    parser.add_argument("--receipts", type=int, default=8, help="Synthetic receipts per length")
+    parser.add_argument("--processes", type=int, default=2, help="OCR worker processes")
+    parser.add_argument("--engine", default="auto", help="OCR engine (auto, tesserocr, tesseract)")
+    parser.add_argument("--strip-workers", type=int, default=4)
+    parser.add_argument("--max-aspect", type=float, default=3.0)
+    args = parser.parse_args()
+
+    try:
+        pytesseract.get_tesseract_version()
+    except pytesseract.TesseractNotFoundError:
+        raise SystemExit("tesseract not found: install it to run the OCR benchmark")
+
+    rng = random.Random(3)
+    if args.images:
+        groups = [(os.path.basename(path), [Image.open(path).convert("L")]) for path in args.images]
+    else:
+        groups = [(f"aspect {length}", [synthetic_receipt(rng, aspect=length) for _ in range(args.receipts)])
+                  for length in (int(s) for s in args.lengths.split(","))]
+
+    engine = partial(engine_ocr, engine=args.engine, strip_workers=args.strip_workers, max_aspect=args.max_aspect)
+    print(f"{'receipts':<16} {'n':>3} {'former img/s':>13} {'engine img/s':>13} {'speedup':>8} {'text match':>11}")
+    for name, images in groups:
+        former_s, former_texts = run(former_ocr, images, args.processes)
+        engine_s, engine_texts = run(engine, images, args.processes)
+        similarity = sum(difflib.SequenceMatcher(None, a, b).ratio()
+                         for a, b in zip(former_texts, engine_texts)) / len(images)
+        print(f"{name:<16} {len(images):>3} {len(images) / former_s:>13.2f} {len(images) / engine_s:>13.2f} "
+              f"{former_s / engine_s:>7.2f}x {similarity:>10.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Benchmark: legacy preprocessing (contrast boost of the full photo) vs. adaptive preprocessing
+(crop to receipt, grayscale, downscale, tile budget for the LLM image).
+
+Reports bytes, pixels and estimated vision tokens of the image sent to the LLM, and Tesseract time,
+per image and in total. Without arguments, synthetic receipt photos are generated.
+
+Usage (from the repository root):
+    python3 benchmarks/bench_preprocessing.py [image ...] [--target-width 1000] [--max-tiles 0]
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytesseract
+from PIL import Image, ImageDraw, ImageEnhance
+
+from image_preprocessing import estimate_image_tokens, fit_tile_budget, preprocess_receipt_image
+
+
+def synthetic_receipt_photo(rng, size=(3000, 4000)):
+    """A 12 MP 'photo' of a receipt: light paper with text lines on a darker, noisy background."""
+    img = Image.new("RGB", size, (rng.randint(40, 90),) * 3)
+    draw = ImageDraw.Draw(img)
+    width = rng.randint(800, 1100)
+    left, top = rng.randint(200, size[0] - width - 200), rng.randint(100, 600)
+    bottom = rng.randint(size[1] - 800, size[1] - 100)
+    draw.rectangle((left, top, left + width, bottom), fill=(235, 233, 228))
+    for y in range(top + 60, bottom - 60, 48):
+        draw.text((left + 40, y), f"ARTIKEL {rng.randint(100, 999)}   {rng.randint(1, 99)},{rng.randint(0, 99):02d}",
+                  fill=(20, 20, 20))
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def run_ocr(img):
+    start = time.perf_counter()
+    try:
+        pytesseract.image_to_string(img)
+    except pytesseract.TesseractNotFoundError:
+        return None
+    return time.perf_counter() - start
+
+
+def jpeg_size(img):
+    buffer = io.BytesIO()
+    (img if img.mode in ("RGB", "L") else img.convert("RGB")).save(buffer, format="JPEG")
+    return len(buffer.getvalue())
+
+
+def measure(image_bytes, target_width, max_tiles):
+    img = Image.open(io.BytesIO(image_bytes))
+    img.load()
+    legacy = ImageEnhance.Contrast(img).enhance(2.0)
+    adaptive, _ = preprocess_receipt_image(img, target_width=target_width)
+    legacy_ocr = run_ocr(legacy)
+    adaptive_ocr = run_ocr(adaptive)
+    llm_img = fit_tile_budget(adaptive, max_tiles=max_tiles)
+    return {
+        "legacy": (jpeg_size(legacy), legacy.width * legacy.height, estimate_image_tokens(*legacy.size), legacy_ocr),
+        "adaptive": (jpeg_size(llm_img), llm_img.width * llm_img.height, estimate_image_tokens(*llm_img.size),
+                     adaptive_ocr),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocessing benchmark")
+    parser.add_argument("images", nargs="*", help="Receipt photos (default: synthetic)")
+    parser.add_argument("--synthetic", type=int, default=5, help="Synthetic photos if no images are given")
+    parser.add_argument("--target-width", type=int, default=1000)
+    parser.add_argument("--max-tiles", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    if args.images:
+        inputs = []
+        for path in args.images:
+            with open(path, "rb") as f:
+                inputs.append((os.path.basename(path), f.read()))
+    else:
+        inputs = [(f"synthetic-{i}", synthetic_receipt_photo(rng)) for i in range(args.synthetic)]
+
+    totals = {"legacy": [0, 0, 0, 0.0], "adaptive": [0, 0, 0, 0.0]}
+    ocr_available = True
+    print(f"{'image':<20} {'mode':<9} {'KB':>7} {'MP':>6} {'est. tokens':>12} {'OCR s':>7}")
+    for name, image_bytes in inputs:
+        for mode, (size, pixels, tokens, ocr_s) in measure(image_bytes, args.target_width, args.max_tiles).items():
+            ocr_available = ocr_available and ocr_s is not None
+            print(f"{name:<20} {mode:<9} {size / 1024:>7.0f} {pixels / 1e6:>6.2f} {tokens:>12} "
+                  f"{'n/a' if ocr_s is None else f'{ocr_s:.2f}':>7}")
+            for i, value in enumerate((size, pixels, tokens, ocr_s or 0.0)):
+                totals[mode][i] += value
+    print()
+    for mode, (size, pixels, tokens, ocr_s) in totals.items():
+        print(f"{'TOTAL':<20} {mode:<9} {size / 1024:>7.0f} {pixels / 1e6:>6.2f} {tokens:>12} "
+              f"{f'{ocr_s:.2f}' if ocr_available else 'n/a':>7}")
+    if not ocr_available:
+        print("\n(tesseract not found: OCR times not measured)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark: per-lookup latency of ProductMatchIndex vs. fuzzywuzzy's linear extractOne scan.
+
+The IKEA catalog is grown 10x and 100x with synthetic product names (recombined syllables of
+real names), and every lookup is checked to return the same (name, score) as extractOne.
+
+Usage (from the repository root):
+    python3 benchmarks/bench_product_matcher.py [--queries 50] [--scales 1,10,100]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pandas as pd
+from fuzzywuzzy import process
+
+from product_matcher import ProductMatchIndex
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "products", "ikea_products.csv")
+
+
+def load_names(csv_path=CSV_PATH):
+    df = pd.read_csv(csv_path)
+    return list(dict.fromkeys(str(name).strip().lower() for name in df["name"]))
+
+
+def grow_catalog(names, scale, rng):
+    """Returns the catalog plus synthetic names until it holds len(names) * scale entries."""
+    syllables = sorted({name[i:i + 3] for name in names for i in range(0, max(len(name) - 2, 1), 3)})
+    grown = list(names)
+    seen = set(grown)
+    target = len(names) * scale
+    while len(grown) < target:
+        word = "".join(rng.choice(syllables) for _ in range(rng.randint(2, 3)))
+        if rng.random() < 0.3:
+            word += " / " + rng.choice(names)
+        if word not in seen:
+            seen.add(word)
+            grown.append(word)
+    return grown
+
+
+def make_queries(names, count, rng):
+    """Receipt-like queries: exact names, OCR typos, single tokens and noise lines."""
+    queries = []
+    for _ in range(count):
+        name = rng.choice(names)
+        kind = rng.random()
+        if kind < 0.3:
+            queries.append(name.upper())
+        elif kind < 0.6:
+            chars = list(name)
+            chars[rng.randrange(len(chars))] = rng.choice("abcdefghijklmnopqrstuvwxyz ")
+            queries.append("".join(chars).upper())
+        elif kind < 0.8:
+            queries.append(rng.choice(name.split() or [name]).upper())
+        else:
+            queries.append(rng.choice(["MWST 19%", "SUMME EUR", "Kartenzahlung", "Pfand 0,25", "IKEA FAMILY"]))
+    return queries
+
+
+def time_lookups(lookup, queries):
+    timings, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(lookup(query.lower()))
+        timings.append(time.perf_counter() - start)
+    return timings, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ProductMatchIndex benchmark")
+    parser.add_argument("--queries", type=int, default=50, help="Lookups per catalog size")
+    parser.add_argument("--linear-queries", type=int, default=5,
+                        help="Lookups timed with the linear scan at the largest scale")
+    parser.add_argument("--scales", default="1,10,100", help="Comma-separated catalog growth factors")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    base_names = load_names()
+    scales = [int(s) for s in args.scales.split(",")]
+    print(f"{'names':>9} {'build s':>8} {'index p50 ms':>13} {'index p95 ms':>13} "
+          f"{'linear p50 ms':>14} {'speedup':>8}")
+    for scale in scales:
+        names = grow_catalog(base_names, scale, rng)
+        queries = make_queries(base_names, args.queries, rng)
+
+        start = time.perf_counter()
+        index = ProductMatchIndex(names)
+        build_s = time.perf_counter() - start
+
+        index_times, index_results = time_lookups(index.extract_one, queries)
+        # The linear scan is what we are replacing; keep it affordable on large catalogs
+        n_linear = args.queries if scale == 1 else min(args.queries, args.linear_queries)
+        linear_times, linear_results = time_lookups(
+            lambda q: process.extractOne(q, names), queries[:n_linear])
+        mismatches = [q for q, a, b in zip(queries, linear_results, index_results) if a != b]
+        if mismatches:
+            raise SystemExit(f"Index result differs from extractOne for: {mismatches}")
+
+        index_p50 = statistics.median(index_times) * 1000
+        index_p95 = sorted(index_times)[int(0.95 * (len(index_times) - 1))] * 1000
+        linear_p50 = statistics.median(linear_times) * 1000
+        print(f"{len(names):>9} {build_s:>8.2f} {index_p50:>13.2f} {index_p95:>13.2f} "
+              f"{linear_p50:>14.2f} {linear_p50 / index_p50:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
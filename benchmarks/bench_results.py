@@ -0,0 +1,141 @@
+"""
+Benchmark: results store (results_store.py) - bulk append throughput and query latency.
+
+Synthetic receipts (random stores, dates over five years, 1-8 items from a fixed category list) are
+written through ResultsStore:
+
+    per-row   batch_size=1, i.e. one transaction (and sync) per receipt
+    batched   the default writer: one transaction per batch_size receipts
+
+Both writers run on the same sample of the receipts; then the batched writer fills the full store.
+
+Finally typical queries run against the full store (hundreds of thousands of line items) and, for
+comparison, against the same receipts as JSON lines (what a run used to print), filtered in Python.
+
+Usage (from the repository root):
+    python3 benchmarks/bench_results.py [--receipts 100000] [--per-row 2000] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from results_store import ResultsStore
+
+STORES = ["IKEA", "REWE", "EDEKA", "ALDI", "LIDL", "DM", "ROSSMANN", "BAUHAUS", "OBI", "KAUFLAND"]
+CATEGORIES = ["Lebensmittel", "Getränke", "Drogerie", "Haushalt", "Möbel", "Deko", "Textilien", "Werkzeug",
+              "Garten", "Elektronik", "Sonstiges"]
+
+
+def synthetic_receipts(count, seed=0):
+    rng = random.Random(seed)
+    first = date(2020, 1, 1)
+    receipts = []
+    for i in range(count):
+        result = {"date": (first + timedelta(days=rng.randrange(5 * 365))).isoformat(), "store": rng.choice(STORES),
+                  "items": [{"category": rng.choice(CATEGORIES), "name": f"Artikel {rng.randrange(5000)}",
+                             "price": round(rng.uniform(0.3, 80), 2)} for _ in range(rng.randint(1, 8))]}
+        source = {"id": f"file{i:07d}", "name": f"receipt_{i}.jpg", "md5Checksum": f"{i:032x}"}
+        stats = {"input_tokens": rng.randint(800, 2500), "output_tokens": rng.randint(60, 400),
+                 "ocr_seconds": rng.uniform(0.2, 2), "llm_seconds": rng.uniform(0.5, 4), "route": "vision"}
+        receipts.append((source, result, stats))
+    return receipts
+
+
+def append(path, receipts, batch_size):
+    store = ResultsStore(path, batch_size=batch_size)
+    start = time.perf_counter()
+    for source, result, stats in receipts:
+        store.put(source, result, "llm", stats)
+    store.close()
+    return time.perf_counter() - start
+
+
+def jsonl_items(path, date_from=None, date_to=None, store=None, category=None):
+    """The items of a JSON-lines dump matching the filters (what filtering printed results amounts to)."""
+    matches = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            receipt = json.loads(line)
+            if (store and receipt["store"] != store or date_from and receipt["date"] < date_from
+                    or date_to and receipt["date"] > date_to):
+                continue
+            matches.extend(item for item in receipt["items"] if not category or item["category"] == category)
+    return matches
+
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Results store: bulk append and query latency")
+    parser.add_argument("--receipts", type=int, default=100000, help="Receipts written (about 4.5 items each)")
+    parser.add_argument("--per-row", type=int, default=2000, help="Receipts of the per-row vs batched comparison")
+    parser.add_argument("--batch-size", type=int, default=500, help="Receipts per transaction of the batched writer")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per query (median reported)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_results_")
+    try:
+        receipts = synthetic_receipts(args.receipts)
+        items = sum(len(result["items"]) for _, result, _ in receipts)
+        print(f"{args.receipts} receipts, {items} items")
+
+        sample = receipts[:args.per_row]
+        path = os.path.join(workdir, "results.sqlite")
+        print(f"\n{'writer':<10} {'receipts':>9} {'seconds':>8} {'receipts/s':>11}")
+        for name, store_path, written, batch_size in (
+                ("per-row", os.path.join(workdir, "per_row.sqlite"), sample, 1),
+                ("batched", os.path.join(workdir, "batched.sqlite"), sample, args.batch_size),
+                ("batched", path, receipts, args.batch_size)):
+            seconds = append(store_path, written, batch_size)
+            print(f"{name:<10} {len(written):>9} {seconds:>8.2f} {len(written) / seconds:>11.0f}")
+        print(f"database: {os.path.getsize(path) / 1e6:.1f} MB")
+
+        jsonl_path = os.path.join(workdir, "results.jsonl")
+        with open(jsonl_path, "w", encoding="utf-8") as f:
+            for _, result, _ in receipts:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+        store = ResultsStore(path)
+        queries = [
+            ("items of one store in one month", lambda: store.items(date_from="2023-03-01", date_to="2023-03-31",
+                                                                   store="IKEA"),
+             lambda: jsonl_items(jsonl_path, "2023-03-01", "2023-03-31", store="IKEA")),
+            ("items of one category in a quarter", lambda: store.items(date_from="2022-01-01", date_to="2022-03-31",
+                                                                      category="Möbel"),
+             lambda: jsonl_items(jsonl_path, "2022-01-01", "2022-03-31", category="Möbel")),
+            ("spending per category in a year", lambda: store.spending("category", date_from="2023-01-01",
+                                                                       date_to="2023-12-31"),
+             lambda: jsonl_items(jsonl_path, "2023-01-01", "2023-12-31")),
+            ("spending per month at one store", lambda: store.spending("month", store="REWE"),
+             lambda: jsonl_items(jsonl_path, store="REWE")),
+            ("spending per store, one category", lambda: store.spending("store", category="Drogerie"),
+             lambda: jsonl_items(jsonl_path, category="Drogerie")),
+        ]
+        print(f"\n{'query':<36} {'rows':>7} {'store ms':>9} {'jsonl ms':>9}")
+        for name, query, scan in queries:
+            store_ms, rows = timed(query, args.repeat)
+            scan_ms, _ = timed(scan, 1)
+            print(f"{name:<36} {len(rows):>7} {store_ms:>9.2f} {scan_ms:>9.1f}")
+        store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
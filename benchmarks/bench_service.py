@@ -0,0 +1,168 @@
+"""
+Benchmark: latency of single receipts, one-shot CLI runs vs the warm extraction service.
+
+A fake Google Drive and a fake OpenAI API run in this process (see bench_e2e.py), with one synthetic
+receipt per Drive folder. For each receipt:
+
+    cold   receipt_info_extractor.py is started on the receipt's folder and runs to completion
+           (interpreter start, imports, credentials, clients, OCR worker processes, crawl, extraction)
+    warm   the receipt is submitted as a job to one running extractor --serve process and the job is
+           awaited (POST /jobs, then GET /jobs/<id>?wait=...)
+
+Both use the same stages, worker counts and the stand-in OCR engine (Tesseract is not needed), and
+no extraction cache, so every receipt is really processed. Reports p50/p95/max seconds per receipt.
+
+Usage (from the repository root):
+    python3 benchmarks/bench_service.py [--receipts 10] [--openai-latency 0.3] [--drive-latency 0.02]
+        [--report cache/bench_service.json]
+"""
+import argparse
+import json
+import os
+import runpy
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+# Importing bench_e2e also registers the "standin" OCR engine
+from bench_e2e import start_server
+
+
+def run_cli(argv):
+    """Runs the extractor CLI in this process, with the stand-in OCR engine registered."""
+    sys.argv = [os.path.join(REPO_DIR, "receipt_info_extractor.py")] + argv
+    runpy.run_path(sys.argv[0], run_name="__main__")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def request(url, payload=None, timeout=120):
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return {"count": len(ordered), "p50_seconds": statistics.median(ordered),
+            "p95_seconds": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+            "max_seconds": ordered[-1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-receipt latency: one-shot CLI vs extraction service")
+    parser.add_argument("--receipts", type=int, default=10)
+    parser.add_argument("--image-size", default="1600x2200", help="Receipt photo size WIDTHxHEIGHT")
+    parser.add_argument("--ocr-workers", type=int, default=None)
+    parser.add_argument("--drive-latency", type=float, default=0.02, help="Seconds per Drive request")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="Seconds per LLM request")
+    parser.add_argument("--report", default=None, help="Also write the results as JSON to this file")
+    parser.add_argument("--cli", nargs=argparse.REMAINDER, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cli is not None:
+        return run_cli(args.cli)
+
+    from fake_drive_server import FakeDrive, write_service_account
+    from fake_drive_server import make_handler as drive_handler
+    from fake_openai_server import FakeOpenAI
+    from fake_openai_server import make_handler as openai_handler
+    from synthetic_receipts import parse_size
+
+    print(f"Generating {args.receipts} synthetic receipts ({args.image_size})")
+    drive = FakeDrive(args.receipts, args.receipts, image_size=parse_size(args.image_size), latency=args.drive_latency)
+    openai_api = FakeOpenAI(latency=args.openai_latency, rpm=5000, tpm=4000000)
+    drive_server = start_server(drive_handler(drive))
+    openai_server = start_server(openai_handler(openai_api))
+    file_ids = sorted(file_id for file_id in drive.contents)
+    folder_ids = [drive.files[file_id]["parents"][0] for file_id in file_ids]
+
+    workdir = tempfile.mkdtemp(prefix="bench_service_")
+    drive_url = f"http://127.0.0.1:{drive_server.server_port}"
+    env = dict(os.environ,
+               GOOGLE_DRIVE_API_URL=f"{drive_url}/drive/v3",
+               GOOGLE_DRIVE_APPLICATION_CREDENTIALS_PATH=write_service_account(
+                   os.path.join(workdir, "service_account.json"), f"{drive_url}/token"),
+               OPENAI_BASE_URL=f"http://127.0.0.1:{openai_server.server_port}/v1",
+               OPENAI_API_KEY="fake-key")
+    common = ["--ocr-engine", "standin", "--no-cache", "--no-category-cache", "--crawl-state", "",
+              "--run-report", "", "--log-level", "WARNING", "--rpm", "5000", "--tpm", "4000000",
+              "--dedup-path", os.path.join(workdir, "image_hashes.sqlite"),
+              "--results-path", os.path.join(workdir, "results.sqlite")]
+    if args.ocr_workers:
+        common += ["--ocr-workers", str(args.ocr_workers)]
+    command = [sys.executable, os.path.abspath(__file__), "--cli"]
+
+    cold = []
+    for folder_id in folder_ids:
+        start = time.perf_counter()
+        subprocess.run(command + common, env=dict(env, GOOGLE_DRIVE_FOLDER_ID=folder_id), check=True, cwd=workdir)
+        cold.append(time.perf_counter() - start)
+        print(f"cold {folder_id}: {cold[-1]:.2f}s")
+
+    port = free_port()
+    service_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    service = subprocess.Popen(command + common + ["--serve", "--service-port", str(port)],
+                               env=dict(env, GOOGLE_DRIVE_FOLDER_ID=""), cwd=workdir)
+    warm, failed = [], 0
+    try:
+        while True:
+            try:
+                request(f"{service_url}/health", timeout=1)
+                break
+            except OSError:
+                if service.poll() is not None:
+                    raise RuntimeError("extraction service exited during startup")
+                time.sleep(0.05)
+        startup = time.perf_counter() - start
+        print(f"service ready after {startup:.2f}s")
+        for file_id in file_ids:
+            start = time.perf_counter()
+            job = request(f"{service_url}/jobs", {"file_ids": [file_id]})
+            job = request(f"{service_url}/jobs/{job['id']}?wait=120")
+            warm.append(time.perf_counter() - start)
+            failed += job["failed"] + (job["status"] != "done")
+            print(f"warm {file_id}: {warm[-1]:.2f}s ({job['status']})")
+    finally:
+        service.send_signal(signal.SIGTERM)
+        service.wait(timeout=60)
+        drive_server.shutdown()
+        openai_server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = {"receipts": len(file_ids), "cold": percentiles(cold), "warm": percentiles(warm),
+               "service_startup_seconds": startup, "warm_failed": failed}
+    print(f"\n{'':<6} {'count':>6} {'p50 s':>8} {'p95 s':>8} {'max s':>8}")
+    for name in ("cold", "warm"):
+        stats = summary[name]
+        print(f"{name:<6} {stats['count']:>6} {stats['p50_seconds']:>8.3f} {stats['p95_seconds']:>8.3f} "
+              f"{stats['max_seconds']:>8.3f}")
+    print(f"\nwarm p50 is {summary['cold']['p50_seconds'] / summary['warm']['p50_seconds']:.1f}x faster "
+          f"(service startup {startup:.2f}s, paid once); {failed} warm receipts failed")
+    if args.report:
+        directory = os.path.dirname(args.report)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Local stand-in for the parts of the Google Drive API the extractor uses: the OAuth token endpoint
+of the service account, folder listings (files.list with pagination), file metadata, media downloads
+with HTTP range requests, and the changes feed of incremental crawls.
+
+The folder tree holds synthetic receipt photos (see synthetic_receipts.py). --latency adds response
+time, --error-rate makes a share of the downloads fail with 503, and --drop-rate cuts a share of them
+off halfway through the body, to exercise retries and resumed transfers. --duplicate-rate makes a share
+of the receipts copies of an earlier one (re-encoded at another size and quality, like an image sent
+through a messenger), to exercise near-duplicate detection.
+
+write_service_account() writes a service account key whose token_uri points at this server, so the
+extractor authenticates exactly as against Google, without network access.
+
+Usage (from the repository root):
+    python3 benchmarks/fake_drive_server.py [--port 8090] [--receipts 40] [--folders 4] [--latency 0.02]
+    GOOGLE_DRIVE_API_URL=http://127.0.0.1:8090/drive/v3 \\
+    GOOGLE_DRIVE_APPLICATION_CREDENTIALS_PATH=cache/fake_service_account.json \\
+    GOOGLE_DRIVE_FOLDER_ID=root python3 receipt_info_extractor.py
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image
+
+from synthetic_receipts import receipt_photo
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+ROOT_FOLDER_ID = "root"
+
+
+class FakeDrive:
+    """
+    In-memory folder tree of synthetic receipts.
+    Args:
+        receipts (int): Receipt images.
+        folders (int): Subfolders of the root folder the receipts are spread over.
+        image_size (tuple): Photo size in pixels.
+        latency (float): Seconds added to every request.
+        error_rate (float): Share of media requests answered with 503.
+        drop_rate (float): Share of media requests cut off after half of the body.
+        duplicate_rate (float): Share of the receipts that are re-encoded copies of an earlier receipt.
+        seed (int): Random seed (images and failures).
+    """
+
+    def __init__(self, receipts=40, folders=4, image_size=(1600, 2200), latency=0.0, error_rate=0.0, drop_rate=0.0,
+                 duplicate_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"list": 0, "media": 0, "media_bytes": 0, "errors": 0, "dropped": 0, "tokens": 0}
+        modified = datetime(2024, 1, 1, tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
+        self.files = {}
+        self.contents = {}
+        self.lines = {}
+        # File ID of a copy -> file ID of the receipt it copies
+        self.duplicates = {}
+        folder_ids = [f"folder{i}" for i in range(max(1, folders))]
+        for folder_id in folder_ids:
+            self.files[folder_id] = {"id": folder_id, "name": folder_id, "mimeType": FOLDER_MIME_TYPE,
+                                     "parents": [ROOT_FOLDER_ID], "modifiedTime": modified, "trashed": False}
+        for i in range(receipts):
+            file_id = f"receipt{i:05d}"
+            if i and duplicate_rate and self.rng.random() < duplicate_rate:
+                original = f"receipt{self.rng.randrange(i):05d}"
+                original = self.duplicates.get(original, original)
+                data, lines = reencode(self.contents[original], self.rng), self.lines[original]
+                self.duplicates[file_id] = original
+            else:
+                data, lines = receipt_photo(self.rng, size=image_size)
+            self.files[file_id] = {"id": file_id, "name": f"receipt_{i}.jpg", "mimeType": "image/jpeg",
+                                   "md5Checksum": hashlib.md5(data).hexdigest(),
+                                   "parents": [folder_ids[i % len(folder_ids)]], "modifiedTime": modified,
+                                   "trashed": False}
+            self.contents[file_id] = data
+            self.lines[file_id] = lines
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def chance(self, rate):
+        with self.lock:
+            return self.rng.random() < rate
+
+    def list_children(self, query):
+        """Files whose parents contain the folder of a "'<id>' in parents" query."""
+        folder_id = query.split("'")[1] if query.count("'") >= 2 else ROOT_FOLDER_ID
+        return [f for f in self.files.values() if folder_id in f["parents"]]
+
+
+def reencode(data, rng):
+    """A copy of a JPEG at 50-90% of its size and another quality."""
+    img = Image.open(io.BytesIO(data))
+    scale = rng.uniform(0.5, 0.9)
+    img = img.resize((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=rng.randint(60, 90))
+    return buffer.getvalue()
+
+
+def write_service_account(path, token_uri):
+    """Writes a service account key (fresh RSA key) whose token endpoint is token_uri."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption()).decode("ascii")
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"type": "service_account", "project_id": "fake-project", "private_key_id": "fake",
+                   "private_key": pem, "client_email": "receipts@fake-project.iam.gserviceaccount.com",
+                   "client_id": "1", "token_uri": token_uri}, f)
+    return path
+
+
+def make_handler(drive):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, payload, status=200, content_type="application/json", headers=None):
+            data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if urlparse(self.path).path == "/token":
+                drive.count("tokens")
+                return self._send({"access_token": f"fake-{time.time()}", "expires_in": 3600, "token_type": "Bearer"})
+            self._send({"error": {"message": "unsupported"}}, status=404)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            parts = url.path.strip("/").split("/")
+            time.sleep(drive.latency)
+            if parts[:3] == ["drive", "v3", "files"] and len(parts) == 3:
+                return self._list(params)
+            if parts[:3] == ["drive", "v3", "files"] and len(parts) == 4 and params.get("alt") == "media":
+                return self._media(parts[3])
+            if parts[:3] == ["drive", "v3", "files"] and len(parts) == 4:
+                if parts[3] not in drive.files:
+                    return self._send({"error": {"message": "File not found"}}, status=404)
+                return self._send(drive.files[parts[3]])
+            if parts[:3] == ["drive", "v3", "changes"]:
+                # No changes ever: incremental runs after the first crawl find nothing new
+                if len(parts) == 4 and parts[3] == "startPageToken":
+                    return self._send({"startPageToken": "1"})
+                return self._send({"changes": [], "newStartPageToken": "1"})
+            self._send({"error": {"message": "unsupported"}}, status=404)
+
+        def _list(self, params):
+            drive.count("list")
+            files = drive.list_children(params.get("q", ""))
+            start = int(params.get("pageToken") or 0)
+            page_size = int(params.get("pageSize") or 100)
+            page = {"files": files[start:start + page_size]}
+            if start + page_size < len(files):
+                page["nextPageToken"] = str(start + page_size)
+            self._send(page)
+
+        def _media(self, file_id):
+            if file_id not in drive.contents:
+                return self._send({"error": {"message": "File not found"}}, status=404)
+            drive.count("media")
+            if drive.chance(drive.error_rate):
+                drive.count("errors")
+                return self._send({"error": {"message": "backendError"}}, status=503)
+            data = drive.contents[file_id]
+            start, end = 0, len(data) - 1
+            range_header = self.headers.get("Range", "")
+            if range_header.startswith("bytes="):
+                first, _, last = range_header[6:].partition("-")
+                start, end = int(first), min(int(last) if last else len(data) - 1, len(data) - 1)
+                if start >= len(data):
+                    return self._send(b"", status=416, headers={"Content-Range": f"bytes */{len(data)}"})
+            body = data[start:end + 1]
+            headers = {"Content-Range": f"bytes {start}-{end}/{len(data)}"} if range_header else {}
+            if drive.chance(drive.drop_rate) and len(body) > 1:
+                drive.count("dropped")
+                self.send_response(206 if range_header else 200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2])
+                self.close_connection = True
+                return
+            drive.count("media_bytes", len(body))
+            self._send(body, status=206 if range_header else 200, content_type="image/jpeg", headers=headers)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Google Drive API")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--receipts", type=int, default=40, help="Synthetic receipt images")
+    parser.add_argument("--folders", type=int, default=4, help="Subfolders of the root folder")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of downloads failing with 503")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Share of downloads cut off halfway")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="Share of receipts that are re-encoded copies")
+    parser.add_argument("--service-account", default=None,
+                        help="Also write a service account key using this server's token endpoint to this path")
+    args = parser.parse_args()
+    drive = FakeDrive(args.receipts, args.folders, latency=args.latency, error_rate=args.error_rate,
+                      drop_rate=args.drop_rate, duplicate_rate=args.duplicate_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(drive))
+    if args.service_account:
+        write_service_account(args.service_account, f"http://127.0.0.1:{args.port}/token")
+    print(f"Fake Drive API on http://127.0.0.1:{args.port}/drive/v3 (root folder id: {ROOT_FOLDER_ID})")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Local stand-in for the parts of the OpenAI API the extractor uses: Responses, Files and Batches.
+
+Receipts are "extracted" deterministically from the OCR text in the request (first line = store,
+lines ending in a price = items), so runs are free, offline and repeatable. Batches move from
+validating to in_progress to completed within --batch-seconds; --fail-rate makes a share of the
+requests fail, to exercise the error paths. --rpm/--tpm enforce per-minute rate limits on /v1/responses
+(429 with retry-after, x-ratelimit-* headers like the real API), --latency adds response time and
+--error-rate answers a share of the /v1/responses requests with 500.
+
+Usage (from the repository root):
+    python3 benchmarks/fake_openai_server.py [--port 8089] [--batch-seconds 2] [--fail-rate 0]
+    OPENAI_BASE_URL=http://localhost:8089/v1 python3 receipt_info_extractor.py --batch --batch-poll-interval 1
+"""
+import argparse
+import base64
+import collections
+import email.parser
+import io
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PIL import Image
+
+from image_preprocessing import estimate_image_tokens
+
+PRICE_LINE = re.compile(r"^(?P<name>.*?[A-Za-z].*?)\s+(?P<price>-?\d+[.,]\d{2})(\s*[A-Z*]{0,2})?$")
+DATE = re.compile(r"\b(\d{1,2})\.(\d{1,2})\.(\d{2,4})\b")
+
+
+def fake_extraction(body):
+    """Builds a ReceiptInfo JSON from the OCR text of a Responses request; returns (json text, input tokens)."""
+    text, input_tokens = "", 0
+    for message in body.get("input", []):
+        for content in message.get("content", []):
+            if content.get("type") == "input_text":
+                text += content["text"]
+                input_tokens += len(content["text"]) // 4
+            elif content.get("type") == "input_image":
+                data = base64.b64decode(content["image_url"].split(",", 1)[1])
+                input_tokens += estimate_image_tokens(*Image.open(io.BytesIO(data)).size, model=body.get("model"))
+    ocr_text = re.split(r"Here is the OCR text[^\n]*\n", text, maxsplit=1)[-1]
+    lines = [line.strip() for line in ocr_text.splitlines() if line.strip()]
+    items = []
+    for line in lines:
+        match = PRICE_LINE.match(line)
+        if match:
+            items.append({"category": "General", "name": match.group("name"),
+                          "price": float(match.group("price").replace(",", "."))})
+    date = ""
+    match = DATE.search(ocr_text)
+    if match:
+        day, month, year = match.groups()
+        date = f"{int(year) + 2000 if len(year) == 2 else int(year):04d}-{int(month):02d}-{int(day):02d}"
+    result = {"date": date, "store": lines[0] if lines else "", "items": items}
+    return json.dumps(result, ensure_ascii=False), input_tokens
+
+
+def response_body(body, ids, extraction=None):
+    output_text, input_tokens = extraction or fake_extraction(body)
+    output_tokens = len(output_text) // 4
+    return {
+        "id": f"resp_{next(ids)}", "object": "response", "created_at": int(time.time()), "status": "completed",
+        "model": body.get("model"),
+        "output": [{"type": "message", "id": f"msg_{next(ids)}", "role": "assistant", "status": "completed",
+                    "content": [{"type": "output_text", "text": output_text, "annotations": []}]}],
+        "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                  "total_tokens": input_tokens + output_tokens},
+    }
+
+
+class FakeOpenAI:
+    """In-memory files and batches."""
+
+    def __init__(self, batch_seconds=2.0, fail_rate=0.0, seed=0, rpm=None, tpm=None, latency=0.0, error_rate=0.0):
+        self.batch_seconds = batch_seconds
+        self.fail_rate = fail_rate
+        self.error_rate = error_rate
+        self.errors = 0
+        self.rpm = rpm
+        self.tpm = tpm
+        self.latency = latency
+        # (time, tokens) of the responses requests of the last minute
+        self.window = collections.deque()
+        self.rate_limited = 0
+        self.rng = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+
+    def check_rate(self, tokens):
+        """Admits a responses request against the per-minute limits; returns (admitted, headers)."""
+        with self.lock:
+            now = time.time()
+            while self.window and now - self.window[0][0] >= 60:
+                self.window.popleft()
+            used_requests = len(self.window)
+            used_tokens = sum(t for _, t in self.window)
+            admitted = ((not self.rpm or used_requests + 1 <= self.rpm)
+                        and (not self.tpm or used_tokens + tokens <= self.tpm))
+            if admitted:
+                self.window.append((now, tokens))
+                used_requests, used_tokens = used_requests + 1, used_tokens + tokens
+            else:
+                self.rate_limited += 1
+            headers = {}
+            if self.rpm:
+                headers["x-ratelimit-limit-requests"] = str(self.rpm)
+                headers["x-ratelimit-remaining-requests"] = str(max(0, self.rpm - used_requests))
+            if self.tpm:
+                headers["x-ratelimit-limit-tokens"] = str(self.tpm)
+                headers["x-ratelimit-remaining-tokens"] = str(max(0, self.tpm - used_tokens))
+            if not admitted:
+                oldest = self.window[0][0] if self.window else now
+                headers["retry-after"] = f"{max(0.1, 60 - (now - oldest)):.1f}"
+            return admitted, headers
+
+    def add_file(self, content, filename, purpose):
+        with self.lock:
+            file_id = f"file-{next(self.ids)}"
+            self.files[file_id] = {"id": file_id, "object": "file", "bytes": len(content),
+                                   "created_at": int(time.time()), "filename": filename, "purpose": purpose,
+                                   "status": "processed", "content": content}
+        return {k: v for k, v in self.files[file_id].items() if k != "content"}
+
+    def create_batch(self, request):
+        with self.lock:
+            batch_id = f"batch_{next(self.ids)}"
+            lines = self.files[request["input_file_id"]]["content"].decode("utf-8").splitlines()
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": request["endpoint"],
+                "input_file_id": request["input_file_id"], "completion_window": request["completion_window"],
+                "status": "validating", "created_at": int(time.time()), "output_file_id": None,
+                "error_file_id": None, "metadata": request.get("metadata"),
+                "request_counts": {"total": len([l for l in lines if l.strip()]), "completed": 0, "failed": 0},
+            }
+        return self.get_batch(batch_id)
+
+    def get_batch(self, batch_id):
+        with self.lock:
+            batch = self.batches[batch_id]
+            age = time.time() - batch["created_at"]
+            if batch["status"] == "validating" and age >= self.batch_seconds / 2:
+                batch["status"] = "in_progress"
+            if batch["status"] == "in_progress" and age >= self.batch_seconds:
+                self._complete(batch)
+            return dict(batch)
+
+    def _complete(self, batch):
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if self.rng.random() < self.fail_rate:
+                errors.append({"id": f"req_{next(self.ids)}", "custom_id": request["custom_id"],
+                               "response": {"status_code": 500, "body": {"error": {"message": "fake failure"}}},
+                               "error": None})
+            else:
+                outputs.append({"id": f"req_{next(self.ids)}", "custom_id": request["custom_id"],
+                                "response": {"status_code": 200, "body": response_body(request["body"], self.ids)},
+                                "error": None})
+        for kind, lines in (("output_file_id", outputs), ("error_file_id", errors)):
+            if lines:
+                content = "".join(json.dumps(l, ensure_ascii=False) + "\n" for l in lines).encode("utf-8")
+                file_id = f"file-{next(self.ids)}"
+                self.files[file_id] = {"id": file_id, "object": "file", "bytes": len(content),
+                                       "created_at": int(time.time()), "filename": f"{batch['id']}_{kind}.jsonl",
+                                       "purpose": "batch_output", "status": "processed", "content": content}
+                batch[kind] = file_id
+        batch["status"] = "completed"
+        batch["request_counts"].update(completed=len(outputs), failed=len(errors))
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, payload, status=200, content_type="application/json", headers=None):
+            data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_GET(self):
+            parts = self.path.split("?")[0].strip("/").split("/")
+            try:
+                if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+                    return self._send(api.get_batch(parts[2]))
+                if parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+                    return self._send(api.files[parts[2]]["content"], content_type="application/octet-stream")
+            except KeyError:
+                return self._send({"error": {"message": "not found"}}, status=404)
+            self._send({"error": {"message": "unsupported"}}, status=404)
+
+        def do_POST(self):
+            path = self.path.split("?")[0].rstrip("/")
+            body = self._body()
+            if path == "/v1/responses":
+                request = json.loads(body)
+                extraction = fake_extraction(request)
+                admitted, headers = api.check_rate(extraction[1] + len(extraction[0]) // 4)
+                if not admitted:
+                    return self._send({"error": {"message": "Rate limit reached", "type": "requests",
+                                                 "code": "rate_limit_exceeded"}}, status=429, headers=headers)
+                time.sleep(api.latency)
+                with api.lock:
+                    failed = api.rng.random() < api.error_rate
+                    api.errors += failed
+                if failed:
+                    return self._send({"error": {"message": "fake server error", "type": "server_error"}}, status=500)
+                return self._send(response_body(request, api.ids, extraction), headers=headers)
+            if path == "/v1/batches":
+                return self._send(api.create_batch(json.loads(body)))
+            if path == "/v1/files":
+                message = email.parser.BytesParser().parsebytes(
+                    b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body)
+                fields = {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+                return self._send(api.add_file(fields["file"].get_payload(decode=True),
+                                               fields["file"].get_filename() or "upload.jsonl",
+                                               fields["purpose"].get_payload(decode=True).decode()))
+            self._send({"error": {"message": "unsupported"}}, status=404)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI Responses/Files/Batches API")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--batch-seconds", type=float, default=2.0, help="Time until a batch completes")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of batch requests that fail")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute limit of /v1/responses")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute limit of /v1/responses")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per /v1/responses request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of /v1/responses requests failing with 500")
+    args = parser.parse_args()
+    api = FakeOpenAI(args.batch_seconds, args.fail_rate, rpm=args.rpm, tpm=args.tpm, latency=args.latency,
+                     error_rate=args.error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(api))
+    print(f"Fake OpenAI API on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Synthetic receipt photos for the benchmarks: a light paper strip with a store header, a purchase
+date, article lines with prices and a total, on a darker, noisy background (like a phone photo).
+
+The text is returned with the image, so a run can be checked against what was printed.
+
+Usage (from the repository root), to write sample images:
+    python3 benchmarks/synthetic_receipts.py out_dir [--count 10] [--size 1600x2200]
+"""
+import argparse
+import io
+import os
+import random
+
+from PIL import Image, ImageDraw, ImageFont
+
+STORES = ["REWE", "ESSO Tankstelle", "EDEKA", "ALDI SUED", "dm-drogerie markt"]
+ARTICLES = ["Milch 1,5%", "Vollkornbrot", "Bananen", "Kaffee Bohnen", "Butter", "Joghurt Natur", "Aepfel Elstar",
+            "Mineralwasser", "Nudeln", "Tomaten", "Kaese Gouda", "Shampoo", "Zahnpasta", "Superbenzin", "Schokolade"]
+
+
+def receipt_lines(rng, min_items=4, max_items=25):
+    """Text lines of a random receipt: store, address, date, articles with prices, total."""
+    items = [(rng.choice(ARTICLES), rng.randint(19, 1999) / 100) for _ in range(rng.randint(min_items, max_items))]
+    lines = [rng.choice(STORES), f"Hauptstr. {rng.randint(1, 200)}, {rng.randint(10000, 99999)} Stadt",
+             f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{rng.randint(2019, 2024)} "
+             f"{rng.randint(7, 21):02d}:{rng.randint(0, 59):02d}"]
+    lines += [f"{name}  {price:.2f}".replace(".", ",") + " A" for name, price in items]
+    lines.append(f"SUMME  {sum(price for _, price in items):.2f}".replace(".", ","))
+    return lines
+
+
+def receipt_photo(rng, lines=None, size=(1600, 2200), quality=85):
+    """
+    Renders a receipt photo.
+    Args:
+        rng (random.Random): Random source (layout, noise, contents if lines is None).
+        lines (list, optional): Text lines (default: receipt_lines(rng)).
+        size (tuple): Photo size in pixels.
+        quality (int): JPEG quality.
+    Returns:
+        tuple: (jpeg_bytes, lines)
+    """
+    lines = lines or receipt_lines(rng)
+    shade = rng.randint(30, 60)
+    noise = Image.effect_noise((size[0] // 4, size[1] // 4), rng.randint(20, 40))
+    img = noise.resize(size).point(lambda v: v // 3 + shade).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    font_size = max(12, size[0] // 48)
+    font = ImageFont.load_default(size=font_size)
+    line_height = int(font_size * 1.6)
+    width = int(size[0] * rng.uniform(0.45, 0.6))
+    left = rng.randint(size[0] // 20, size[0] - width - size[0] // 20)
+    top = rng.randint(size[1] // 40, size[1] // 10)
+    bottom = max(size[1] * 2 // 3, min(size[1] - size[1] // 40, top + line_height * (len(lines) + 4)))
+    draw.rectangle((left, top, left + width, bottom), fill=(236, 234, 228))
+    y = top + 2 * line_height
+    for line in lines:
+        if y > bottom - line_height:
+            break
+        draw.text((left + font_size, y), line, fill=(25, 25, 25), font=font)
+        y += line_height
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue(), lines
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes synthetic receipt photos")
+    parser.add_argument("out_dir")
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--size", default="1600x2200", help="Photo size WIDTHxHEIGHT")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    rng = random.Random(args.seed)
+    for i in range(args.count):
+        data, _ = receipt_photo(rng, size=parse_size(args.size))
+        with open(os.path.join(args.out_dir, f"receipt_{i:04d}.jpg"), "wb") as f:
+            f.write(data)
+    print(f"Wrote {args.count} receipts to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+# ---
+# CATALOG REGISTRY ---
+#
+# Product catalogs per store. products/catalogs.json maps canonical store names (as returned by
+# normalization.py, e.g. "IKEA") to a product sheet and the min fuzzy match score for its items:
+#
+#     {"stores": {"IKEA": {"csv": "ikea_products.csv", "threshold": 95}}}
+#
+# Relative paths are resolved against the directory of the config file. Nothing is loaded up front:
+# a store's catalog is loaded from its compiled snapshot (memory-mapped, see product_catalog.py) on
+# the first lookup for that store, reloaded when its product sheet changes, and dropped again after
+# idle_seconds without a lookup, so large catalogs of stores that are rarely seen cost no memory.
+# A dropped catalog is unmapped once no lookup holds it any more; the next lookup maps it again,
+# which is cheap while its pages are still in the page cache.
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from product_catalog import DEFAULT_SNAPSHOT_DIR, REPO_DIR, load_catalog, source_version
+from run_metrics import metrics
+
+DEFAULT_CATALOGS_PATH = os.path.join(REPO_DIR, "products", "catalogs.json")
+DEFAULT_THRESHOLD = 95
+DEFAULT_IDLE_SECONDS = 600
+
+log = logging.getLogger("receipts.catalog")
+
+
+def store_key(store):
+    """Registry key of a store name (case- and whitespace-insensitive)."""
+    return " ".join(str(store or "").split()).upper()
+
+
+class CatalogRegistry:
+    """
+    Lazily loaded product catalogs of the stores, shared by all threads of a process.
+    Args:
+        config_path (str): Catalog config (see module comment).
+        snapshot_dir (str): Directory holding the compiled snapshots.
+        idle_seconds (float): Seconds without a lookup after which a catalog is dropped (None = never).
+    """
+
+    def __init__(self, config_path=DEFAULT_CATALOGS_PATH, snapshot_dir=DEFAULT_SNAPSHOT_DIR,
+                 idle_seconds=DEFAULT_IDLE_SECONDS):
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(config_path))
+        self._entries = {}
+        for store, entry in config.get("stores", {}).items():
+            self._entries[store_key(store)] = {
+                "store": store, "csv": os.path.join(base_dir, entry["csv"]),
+                "threshold": int(entry.get("threshold", DEFAULT_THRESHOLD))}
+        self.snapshot_dir = snapshot_dir
+        self.idle_seconds = idle_seconds
+        # Store key -> [(mtime_ns, size) of the CSV, catalog, time of the last lookup]
+        self._loaded = {}
+        # Store key -> ((mtime_ns, size) of the CSV, catalog version), see catalog_version
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._loads = 0
+        self._evictions = 0
+        self._closed = threading.Event()
+        self._reaper = None
+
+    def stores(self):
+        """Store names that have a catalog."""
+        return [entry["store"] for entry in self._entries.values()]
+
+    def has_catalog(self, store):
+        return store_key(store) in self._entries
+
+    def threshold(self, store):
+        """Min match score of the store's catalog (DEFAULT_THRESHOLD for stores without one)."""
+        entry = self._entries.get(store_key(store))
+        return entry["threshold"] if entry else DEFAULT_THRESHOLD
+
+    def version(self):
+        """
+        Returns a short hash of the stores, their thresholds and the contents of their product sheets
+        (without loading any catalog); changes whenever a lookup could return other categories.
+        """
+        parts = []
+        for key, entry in sorted(self._entries.items()):
+            try:
+                source = source_version(entry["csv"], self.snapshot_dir)
+            except OSError:
+                source = None
+            parts.append([key, entry["threshold"], source])
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()[:16]
+
+    def catalog_version(self, store):
+        """
+        Returns the name and version a store's catalog reports once loaded (they key its entries in the
+        category cache), without loading it: the version comes from the snapshot metadata, or the CSV's
+        hash before the first compile. Remembered per CSV mtime and size.
+        Args:
+            store (str): Store name.
+        Returns:
+            tuple or None: (name, version), or None if the store has no catalog.
+        """
+        key = store_key(store)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stat = os.stat(entry["csv"])
+        stat_version = (stat.st_mtime_ns, stat.st_size)
+        known = self._versions.get(key)
+        if known is None or known[0] != stat_version:
+            known = self._versions[key] = (stat_version, source_version(entry["csv"], self.snapshot_dir))
+        return entry["store"], known[1]
+
+    def get(self, store):
+        """
+        Returns the catalog of a store, loading it on first use. Each call costs one stat of the CSV;
+        the catalog is reloaded when the CSV changed.
+        Args:
+            store (str): Store name.
+        Returns:
+            ProductCatalog or None: None if the store has no catalog.
+        """
+        key = store_key(store)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stat = os.stat(entry["csv"])
+        version = (stat.st_mtime_ns, stat.st_size)
+        loaded = self._loaded.get(key)
+        if loaded and loaded[0] == version:
+            loaded[2] = time.monotonic()
+            return loaded[1]
+        with self._lock:
+            loaded = self._loaded.get(key)
+            if loaded and loaded[0] == version:
+                loaded[2] = time.monotonic()
+                return loaded[1]
+            start = time.perf_counter()
+            catalog = load_catalog(entry["csv"], self.snapshot_dir, name=entry["store"])
+            self._loaded[key] = [version, catalog, time.monotonic()]
+            self._loads += 1
+            seconds = time.perf_counter() - start
+            metrics.record("catalog_load", seconds)
+            log.info("Loaded %s product catalog (%d products) in %.1f ms", entry["store"], len(catalog),
+                     seconds * 1000)
+            self._start_reaper()
+            return catalog
+
+    def evict_idle(self, now=None):
+        """
+        Drops the catalogs not looked up for idle_seconds.
+        Returns:
+            list: Names of the stores whose catalogs were dropped.
+        """
+        if self.idle_seconds is None:
+            return []
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            idle = [key for key, (_, _, last_used) in self._loaded.items() if now - last_used >= self.idle_seconds]
+            for key in idle:
+                del self._loaded[key]
+            self._evictions += len(idle)
+        stores = [self._entries[key]["store"] for key in idle]
+        if stores:
+            log.info("Dropped idle product catalogs: %s", ", ".join(stores))
+        return stores
+
+    def _start_reaper(self):
+        # Called with the lock held; one daemon thread per registry checks for idle catalogs
+        if self.idle_seconds is None or self._reaper is not None:
+            return
+        interval = max(1.0, self.idle_seconds / 4)
+
+        def reap():
+            while not self._closed.wait(interval):
+                self.evict_idle()
+
+        self._reaper = threading.Thread(target=reap, name="catalog-reaper", daemon=True)
+        self._reaper.start()
+
+    def stats(self):
+        with self._lock:
+            return {"stores": self.stores(), "loaded": [self._entries[key]["store"] for key in self._loaded],
+                    "loads": self._loads, "evictions": self._evictions}
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._loaded.clear()
+
+
+# Registry shared by the lookups of this process (see get_catalog_registry)
+_shared = {"registry": None}
+_shared_lock = threading.Lock()
+
+
+def configure_catalogs(config_path=DEFAULT_CATALOGS_PATH, **options):
+    """
+    Sets up the process-wide catalog registry (closing a previously configured one).
+    Args:
+        config_path (str): Catalog config.
+        **options: snapshot_dir and idle_seconds (see CatalogRegistry).
+    Returns:
+        CatalogRegistry: The registry.
+    """
+    with _shared_lock:
+        if _shared["registry"]:
+            _shared["registry"].close()
+        _shared["registry"] = CatalogRegistry(config_path, **options)
+        return _shared["registry"]
+
+
+def get_catalog_registry():
+    """Returns the process-wide catalog registry, set up from the default config on first use."""
+    if _shared["registry"] is None:
+        with _shared_lock:
+            if _shared["registry"] is None:
+                _shared["registry"] = CatalogRegistry()
+    return _shared["registry"]
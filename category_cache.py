@@ -0,0 +1,232 @@
+# ---
+# CATEGORY CACHE ---
+#
+# Persistent cache of fuzzy catalog matches: normalized item name -> (matched name, category, score).
+#
+# Receipts of the same store repeat the same product lines, and each of them used to be matched
+# against the whole catalog again (by the category service for every candidate substring, and by
+# the extractor's local fallback). The match of a name only depends on its normalized form (see
+# product_matcher.normalize_query) and the catalog, so results are cached independently of the
+# score threshold; callers compare the cached score with their own threshold.
+#
+# The cache is one SQLite file (cache/categories.sqlite, WAL mode) shared by the extractor and the
+# category service. Entries are keyed by catalog (the store, see catalog_registry.py) and name, and
+# record the catalog version (a hash of the product sheet); entries of another version are never
+# returned and are purged on the first lookup against a new version of that catalog. Entries expire
+# after a TTL, and the least recently used ones (over all catalogs) are evicted beyond max_entries.
+# Writes do not count the table: each process keeps an estimate (the count at open plus the names it
+# wrote) and recounts once that passes max_entries or after RECOUNT_WRITES names, which also picks
+# up what the other processes wrote.
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from product_matcher import normalize_query
+from run_metrics import metrics
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "categories.sqlite")
+# Bumped when the table layout changes; a cache of another layout is dropped (it only holds recomputable matches)
+SCHEMA_VERSION = 2
+# Names written between two exact counts of the table
+RECOUNT_WRITES = 10000
+
+log = logging.getLogger("receipts.categories")
+
+
+class CategoryCache:
+    """
+    SQLite-backed cache of catalog matches, safe to share between threads and processes.
+    Args:
+        path (str): SQLite database file.
+        max_entries (int): Max cached names.
+        ttl (float): Seconds an entry stays valid (None = no expiry).
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=200000, ttl=30 * 24 * 3600):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Catalog name -> version purged for (see get_many)
+        self._catalog_versions = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS matches")
+                self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS matches ("
+                " catalog TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " catalog_version TEXT NOT NULL,"
+                " matched_name TEXT NOT NULL,"
+                " category TEXT,"
+                " score INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_access REAL NOT NULL,"
+                " PRIMARY KEY (catalog, name))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_matches_last_access ON matches (last_access)")
+            self._count = self._conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+        self._unchecked = 0
+
+    def purge(self, catalog_version, catalog=""):
+        """Deletes the entries of other versions of the catalog and the expired ones."""
+        with self._lock, self._conn:
+            stale = self._conn.execute("DELETE FROM matches WHERE catalog = ? AND catalog_version != ?",
+                                       (catalog, catalog_version)).rowcount
+            if self.ttl is not None:
+                stale += self._conn.execute("DELETE FROM matches WHERE created < ?",
+                                            (time.time() - self.ttl,)).rowcount
+            self._count = max(0, self._count - stale)
+        if stale:
+            log.info("Category cache: dropped %d entries of an older catalog or past the TTL", stale)
+
+    def get_many(self, names, catalog_version, catalog=""):
+        """
+        Returns the cached matches of the given normalized names.
+        Args:
+            names (iterable): Normalized names.
+            catalog_version (str): Version of the catalog.
+            catalog (str): Catalog name.
+        Returns:
+            dict: Normalized name -> (matched_name, category, score), for the cached names only.
+        """
+        names = list(dict.fromkeys(names))
+        if not names:
+            return {}
+        if self._catalog_versions.get(catalog) != catalog_version:
+            # First lookup against this catalog version: drop what was cached for other versions
+            self.purge(catalog_version, catalog)
+            self._catalog_versions[catalog] = catalog_version
+        found = {}
+        oldest = time.time() - self.ttl if self.ttl is not None else 0
+        with self._lock, self._conn:
+            # Chunked to stay below SQLite's host parameter limit
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT name, matched_name, category, score FROM matches WHERE catalog = ?"
+                    f" AND catalog_version = ? AND created >= ? AND name IN ({','.join('?' * len(chunk))})",
+                    [catalog, catalog_version, oldest] + chunk).fetchall()
+                found.update((name, (matched_name, category, score)) for name, matched_name, category, score in rows)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE matches SET last_access = ? WHERE catalog = ? AND name = ?",
+                                       [(now, catalog, name) for name in found])
+            self.hits += len(found)
+            self.misses += len(names) - len(found)
+        metrics.count("category_cache_hits", len(found))
+        metrics.count("category_cache_misses", len(names) - len(found))
+        return found
+
+    def put_many(self, matches, catalog_version, catalog=""):
+        """
+        Stores matches and evicts the least recently used entries if over max_entries.
+        Args:
+            matches (dict): Normalized name -> (matched_name, category, score).
+            catalog_version (str): Version of the catalog the matches were made against.
+            catalog (str): Catalog name.
+        """
+        if not matches:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO matches (catalog, name, catalog_version, matched_name, category, score,"
+                " created, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(catalog, name, catalog_version, m[0], m[1], int(m[2]), now, now) for name, m in matches.items()])
+            # Replaced names are counted too: the estimate only errs towards an early recount
+            self._count += len(matches)
+            self._unchecked += len(matches)
+            if self._count <= self.max_entries and self._unchecked < RECOUNT_WRITES:
+                return
+            count = self._conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+            self._unchecked = 0
+            if count > self.max_entries:
+                # Down to 90% of max_entries, so the next eviction is many writes away
+                evicted = count - int(self.max_entries * 0.9)
+                self._conn.execute(
+                    "DELETE FROM matches WHERE rowid IN (SELECT rowid FROM matches ORDER BY last_access LIMIT ?)",
+                    (evicted,))
+                count -= evicted
+                log.debug("Category cache: evicted %d least recently used entries", evicted)
+            self._count = count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else None}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def match_names(catalog, names, cache=None, looked_up=None):
+    """
+    Fuzzy-matches item names against a catalog, serving repeated names from the cache.
+    Args:
+        catalog (ProductCatalog): Catalog to match against.
+        names (iterable): Item names (any case and punctuation).
+        cache (CategoryCache, optional): Cache of earlier matches.
+        looked_up (dict, optional): Normalized name -> cached match (None if it was not cached) of names
+            already looked up in the cache for this catalog version; they are not looked up (or counted)
+            again. Updated in place with the matches computed here.
+    Returns:
+        dict: Item name -> (matched_name, category, score), or None if the catalog is empty.
+    """
+    normalized = {name: normalize_query(name) for name in names}
+    known = looked_up or {}
+    matches = {key: known[key] for key in normalized.values() if known.get(key) is not None}
+    if cache:
+        matches.update(cache.get_many([key for key in normalized.values() if key not in known],
+                                      catalog.version, catalog.name or ""))
+    computed = {}
+    for key in dict.fromkeys(normalized.values()):
+        if key not in matches:
+            computed[key] = matches[key] = catalog.match(key)
+    if cache:
+        cache.put_many({key: match for key, match in computed.items() if match is not None}, catalog.version,
+                       catalog.name or "")
+    if looked_up is not None:
+        looked_up.update(computed)
+    return {name: matches[key] for name, key in normalized.items()}
+
+
+# Cache shared by the lookups of this process (see get_category_cache)
+_shared = {"configured": False, "cache": None}
+_shared_lock = threading.Lock()
+
+
+def configure_category_cache(path=DEFAULT_CACHE_PATH, **options):
+    """
+    Opens the process-wide category cache (closing a previously opened one).
+    Args:
+        path (str, optional): SQLite database file; None disables the cache.
+        **options: max_entries and ttl (see CategoryCache).
+    Returns:
+        CategoryCache or None: The opened cache.
+    """
+    with _shared_lock:
+        if _shared["cache"]:
+            _shared["cache"].close()
+        _shared["cache"] = CategoryCache(path, **options) if path else None
+        _shared["configured"] = True
+        return _shared["cache"]
+
+
+def get_category_cache():
+    """Returns the process-wide category cache, opening the default one on first use (None if disabled)."""
+    if not _shared["configured"]:
+        with _shared_lock:
+            if not _shared["configured"]:
+                _shared["cache"] = CategoryCache(DEFAULT_CACHE_PATH)
+                _shared["configured"] = True
+    return _shared["cache"]
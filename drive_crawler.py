@@ -0,0 +1,267 @@
+# ---
+# GOOGLE DRIVE CRAWLER ---
+#
+# Collects receipt images below a set of root folders.
+#   - Every folder listing follows `nextPageToken`, so folders with more than 1000 entries are complete.
+#   - Folders of the same tree level are listed concurrently (one Drive service object per thread,
+#     the client is not thread-safe).
+#   - The crawl state is persisted: the known folders (with their parent, so a folder moved out of
+#     the tree is dropped together with its subfolders) plus a Drive changes page token taken
+#     before the crawl. Later runs only read the changes feed since that token and return new or
+#     modified images, so crawl time scales with what changed, not with the size of the archive.
+#   - Folders whose listing failed are not marked as crawled but kept in the state and listed again
+#     on the next run; the changes feed alone would never return the images they already hold.
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from run_metrics import metrics
+
+log = logging.getLogger("receipts.drive")
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+IMAGE_MIME_TYPES = ['image/jpeg', 'image/png', 'image/gif', 'image/bmp', 'image/webp']
+FILE_FIELDS = "id, name, mimeType, md5Checksum, parents, modifiedTime, trashed"
+
+
+def list_folder(service, folder_id, page_size=1000):
+    """
+    Lists all non-trashed files and subfolders of a folder, following pagination.
+    Args:
+        service: Drive API service object.
+        folder_id (str): Folder ID.
+        page_size (int): Files per request (Drive allows up to 1000).
+    Returns:
+        list: File metadata dicts.
+    """
+    query = f"'{folder_id}' in parents and trashed = false"
+    files = []
+    page_token = None
+    while True:
+        with metrics.span("drive_list"):
+            results = service.files().list(
+                q=query,
+                fields=f"nextPageToken, files({FILE_FIELDS})",
+                pageSize=page_size,
+                pageToken=page_token
+            ).execute()
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+
+def crawl_folders(root_folder_ids, get_service, workers=8, known_folders=None, failed_folders=None):
+    """
+    Breadth-first crawl of all folders below the roots; each tree level is listed concurrently.
+    A folder whose listing fails is left out of the visited folders (its subfolders are unknown).
+    Args:
+        root_folder_ids (list): Folder IDs to start from.
+        get_service (callable): Returns a Drive service object usable by the calling thread.
+        workers (int): Folders listed concurrently.
+        known_folders (dict, optional): Folders that are already crawled and are skipped.
+        failed_folders (dict, optional): Filled in place with the folders whose listing failed,
+            mapped to their parent folder ID.
+    Returns:
+        tuple: (all_images, visited_folders)
+            all_images (list): Image file metadata dicts, in BFS order.
+            visited_folders (dict): All visited folder IDs, mapped to their parent folder ID
+                (None for the roots).
+    """
+    visited_folders = dict(known_folders or {})
+    failed = set()
+    all_images = []
+    level = {fid: None for fid in root_folder_ids if fid not in visited_folders}
+
+    def list_one(folder_id):
+        log.info("Processing folder: %s", folder_id, extra={"folder_id": folder_id})
+        try:
+            return list_folder(get_service(), folder_id)
+        except Exception as e:
+            log.warning("Error listing items in folder '%s': %s", folder_id, e, extra={"folder_id": folder_id})
+            failed.add(folder_id)
+            return []
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while level:
+            visited_folders.update(level)
+            next_level = {}
+            for folder_id, files in zip(level, executor.map(list_one, level)):
+                for f in files:
+                    if f.get('mimeType') == FOLDER_MIME_TYPE:
+                        if f['id'] not in visited_folders and f['id'] not in next_level:
+                            next_level[f['id']] = folder_id
+                            log.debug("Found subfolder: %s (%s)", f['name'], f['id'])
+                    elif f.get('mimeType') in IMAGE_MIME_TYPES:
+                        all_images.append(f)
+                        log.debug("Found image: %s (%s)", f['name'], f['id'])
+            level = next_level
+    for folder_id in failed:
+        parent = visited_folders.pop(folder_id, None)
+        if failed_folders is not None:
+            failed_folders[folder_id] = parent
+    return all_images, visited_folders
+
+
+def drop_folder(folders, folder_id):
+    """
+    Removes a folder and all its subfolders from a folder -> parent mapping.
+    Returns:
+        int: Number of folders removed.
+    """
+    if folder_id not in folders:
+        return 0
+    children = {}
+    for child, parent in folders.items():
+        children.setdefault(parent, []).append(child)
+    stack, dropped = [folder_id], 0
+    while stack:
+        current = stack.pop()
+        if current in folders:
+            del folders[current]
+            dropped += 1
+            stack.extend(children.get(current, ()))
+    return dropped
+
+
+def load_crawl_state(path, root_folder_ids):
+    """
+    Loads the persisted crawl state, or returns None if missing or written for other root folders.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except Exception as e:
+        log.warning("Could not read Drive crawl state '%s': %s", path, e)
+        return None
+    if sorted(state.get('root_folder_ids', [])) != sorted(root_folder_ids):
+        log.info("Drive crawl state was written for other root folders; doing a full crawl")
+        return None
+    if not state.get('page_token') or not isinstance(state.get('folders'), dict):
+        # States written before the folder parents were recorded cannot track folders moving out
+        return None
+    return state
+
+
+def save_crawl_state(path, state):
+    """Atomically writes the crawl state."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def read_changes(service, page_token, known_folders, failed_folders=None, page_size=1000):
+    """
+    Reads the Drive changes feed since page_token and keeps changes below the known folders.
+    Args:
+        service: Drive API service object.
+        page_token (str): Changes page token from the previous run.
+        known_folders (dict): Folder ID -> parent folder ID of the crawled tree; updated in place with
+            moved and removed folders (a folder moved out of the tree is dropped with its subfolders).
+        failed_folders (dict, optional): Folders whose listing failed, mapped to their parent; removed
+            and moved-out folders are dropped in place.
+        page_size (int): Changes per request.
+    Returns:
+        tuple: (changed_images, new_folders, new_page_token)
+            new_folders (dict): Folders moved or added into the tree, mapped to their parent.
+    """
+    changed_images = {}
+    new_folders = {}
+    while page_token:
+        with metrics.span("drive_changes"):
+            results = service.changes().list(
+                pageToken=page_token,
+                fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}))",
+                pageSize=page_size,
+                includeRemoved=True
+            ).execute()
+        for change in results.get('changes', []):
+            f = change.get('file')
+            if failed_folders is not None:
+                failed_folders.pop(change.get('fileId'), None)
+            if change.get('removed') or not f or f.get('trashed'):
+                drop_folder(known_folders, change.get('fileId'))
+                new_folders.pop(change.get('fileId'), None)
+                changed_images.pop(change.get('fileId'), None)
+                continue
+            parents = [parent for parent in f.get('parents', []) if parent in known_folders]
+            if f.get('mimeType') == FOLDER_MIME_TYPE:
+                if f['id'] in known_folders and known_folders[f['id']] is not None:
+                    if parents:
+                        known_folders[f['id']] = parents[0]
+                    else:
+                        dropped = drop_folder(known_folders, f['id'])
+                        log.debug("Folder moved out of the tree: %s (%s), %d folders dropped", f['name'], f['id'],
+                                  dropped)
+                elif parents and f['id'] not in known_folders:
+                    new_folders[f['id']] = parents[0]
+                    log.debug("Found new subfolder: %s (%s)", f['name'], f['id'])
+            elif parents and f.get('mimeType') in IMAGE_MIME_TYPES:
+                changed_images[f['id']] = f
+                log.debug("Found new or modified image: %s (%s)", f['name'], f['id'])
+        if 'newStartPageToken' in results:
+            return list(changed_images.values()), new_folders, results['newStartPageToken']
+        page_token = results.get('nextPageToken')
+    return list(changed_images.values()), new_folders, page_token
+
+
+def incremental_crawl(root_folder_ids, get_service, state_path, workers=8, full=False):
+    """
+    Returns the images to process: all images on the first run (or with full=True), afterwards
+    only images added or modified since the previous run, plus images that failed last time and the
+    contents of folders whose listing failed last time.
+    The returned state is not saved here: call save_crawl_state once the images are processed,
+    so an interrupted run re-reads the same changes.
+    Args:
+        root_folder_ids (list): Root folder IDs.
+        get_service (callable): Returns a Drive service object usable by the calling thread.
+        state_path (str): JSON file holding the crawl state.
+        workers (int): Folders listed concurrently.
+        full (bool): Ignore the saved state and crawl everything.
+    Returns:
+        tuple: (images, state)
+    """
+    state = None if full else load_crawl_state(state_path, root_folder_ids)
+    service = get_service()
+    failed = {}
+    if state is None:
+        # Take the token before crawling, so changes made during the crawl are picked up next run
+        start_token = service.changes().getStartPageToken().execute().get('startPageToken')
+        images, folders = crawl_folders(root_folder_ids, get_service, workers=workers, failed_folders=failed)
+        log.info("Full Drive crawl: %d folders, %d images, %d folders failed", len(folders), len(images),
+                 len(failed), extra={"folders": len(folders), "images": len(images), "failed_folders": len(failed)})
+        return images, {'root_folder_ids': list(root_folder_ids), 'page_token': start_token, 'folders': folders,
+                        'failed_folders': failed, 'pending': []}
+
+    known_folders = dict(state['folders'])
+    retry = dict(state.get('failed_folders', {}))
+    changed, new_folders, new_token = read_changes(service, state.get('page_token'), known_folders,
+                                                   failed_folders=retry)
+    # Folders moved into the tree bring their existing contents, which the changes feed does not list;
+    # folders that failed last time are listed again (a failed folder that changed meanwhile is either
+    # among the new folders or gone, and one below a folder that left the tree is skipped)
+    retry = {fid: parent for fid, parent in retry.items()
+             if parent in known_folders or parent is None and fid in root_folder_ids}
+    to_list = dict(retry, **new_folders)
+    moved_in, folders = crawl_folders(list(to_list), get_service, workers=workers, known_folders=known_folders,
+                                      failed_folders=failed)
+    for fid, parent in to_list.items():
+        if fid in folders:
+            folders[fid] = parent
+        elif fid in failed:
+            failed[fid] = parent
+    images = {f['id']: f for f in state.get('pending', [])}
+    images.update((f['id'], f) for f in changed + moved_in)
+    log.info("Incremental Drive crawl: %d changed images, %d new folders, %d folders retried (%d failed), "
+             "%d pending from last run", len(changed), len(new_folders), len(retry), len(failed),
+             len(state.get('pending', [])))
+    return list(images.values()), {'root_folder_ids': list(root_folder_ids), 'page_token': new_token,
+                                   'folders': folders,
+                                   'failed_folders': failed, 'pending': []}
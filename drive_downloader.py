@@ -0,0 +1,307 @@
+# ---
+# DRIVE DOWNLOADER ---
+#
+# Downloads Drive files over a pool of authorized HTTP sessions (google-auth AuthorizedSession on
+# requests). The googleapiclient service object is not thread-safe and was built once per download
+# thread; the sessions here are reused by any thread, each one keeps its connection alive, and all
+# share the service account credentials (the token is refreshed once for all of them).
+#
+# Files are fetched with HTTP range requests of chunk_size bytes. A transfer that breaks off (dropped
+# connection, timeout, 429/5xx) is retried with jittered exponential backoff and resumed from the
+# last byte received instead of starting over; the retry budget is reset whenever a retry made
+# progress. The result is checked against the Drive md5Checksum.
+#
+# Files written to disk (--persist-images) are stored under their Drive file ID, so two receipts
+# with the same name no longer overwrite each other. A file already present with the expected MD5 is
+# not downloaded again, and a partial download (<path>.part) left by an interrupted run is resumed.
+import hashlib
+import io
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from extraction_cache import file_md5
+from run_metrics import metrics
+
+log = logging.getLogger("receipts.download")
+
+DRIVE_API_URL = "https://www.googleapis.com/drive/v3"
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# 403 responses that are rate limits, not missing permissions
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+class DownloadError(Exception):
+    """A download failed for good (non-retryable HTTP status, retries exhausted or MD5 mismatch)."""
+
+
+class _Restart(Exception):
+    """The partial download is unusable; the transfer starts over (counts as a retry)."""
+
+
+class SessionPool:
+    """
+    Pool of authorized HTTP sessions; each session is used by one thread at a time.
+    Args:
+        credentials (google.auth.credentials.Credentials): Credentials shared by all sessions.
+        size (int): Max sessions (concurrent downloads).
+    """
+
+    def __init__(self, credentials, size=8):
+        self.credentials = credentials
+        self.size = max(1, int(size))
+        self._idle = queue.LifoQueue()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def _new_session(self):
+        import requests
+        from google.auth.transport.requests import AuthorizedSession
+        session = AuthorizedSession(self.credentials)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @contextmanager
+    def session(self):
+        """Borrows a session (created on demand up to size, else waits for an idle one)."""
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            session = None
+            with self._lock:
+                if len(self._sessions) < self.size:
+                    session = self._new_session()
+                    self._sessions.append(session)
+            if session is None:
+                session = self._idle.get()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+            self._idle = queue.LifoQueue()
+
+
+def local_file_path(file_metadata, destination_folder):
+    """Local path of a Drive file: <destination_folder>/<file ID><extension of its name>."""
+    extension = os.path.splitext(file_metadata.get('name', ''))[1].lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,5}", extension):
+        extension = ""
+    return os.path.join(destination_folder, file_metadata['id'] + extension)
+
+
+class DriveDownloader:
+    """
+    Concurrent, resumable Drive downloads.
+    Args:
+        credentials (google.auth.credentials.Credentials): Drive credentials.
+        sessions (int): HTTP sessions, i.e. max concurrent downloads.
+        chunk_size (int): Bytes per range request.
+        max_retries (int): Retries of a transfer that makes no progress.
+        base_delay (float): Backoff base delay in seconds.
+        max_delay (float): Max backoff delay in seconds.
+        timeout (tuple): (connect, read) timeouts of a request in seconds.
+        api_url (str): Drive API base URL.
+    """
+
+    def __init__(self, credentials, sessions=8, chunk_size=DEFAULT_CHUNK_SIZE, max_retries=5, base_delay=1.0,
+                 max_delay=30.0, timeout=(10, 60), api_url=DRIVE_API_URL):
+        self.sessions = SessionPool(credentials, size=sessions)
+        self.chunk_size = max(256 * 1024, int(chunk_size))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.api_url = api_url.rstrip("/")
+        self._lock = threading.Lock()
+        self._stats = {"downloads": 0, "bytes": 0, "retries": 0, "resumed": 0, "skipped": 0, "failed": 0}
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+        if key in ("retries", "resumed", "skipped"):
+            metrics.count(f"download_{key}", value)
+
+    def _backoff(self, attempt, response=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return delay
+
+    @staticmethod
+    def _is_retryable(response):
+        if response.status_code in RETRYABLE_STATUS:
+            return True
+        return response.status_code == 403 and any(reason in response.text for reason in RATE_LIMIT_REASONS)
+
+    def _read_chunk(self, file_id, response, sink):
+        """
+        Writes the body of one range response to sink.
+        Returns:
+            int or None: File size from the response headers (None if unknown).
+        """
+        offset = sink.tell()
+        if response.status_code == 416:
+            # Nothing to read at offset: the file is complete (or the local part is longer than the file)
+            size = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if size.isdigit() and int(size) == offset:
+                return offset
+            sink.seek(0)
+            sink.truncate()
+            raise _Restart("requested range not satisfiable")
+        if response.status_code not in (200, 206):
+            if not self._is_retryable(response):
+                raise DownloadError(f"Drive file {file_id}: HTTP {response.status_code} {response.text[:200]}")
+            response.raise_for_status()
+        if response.status_code == 200:
+            # The server ignored the range: the whole file from byte 0
+            sink.seek(0)
+            sink.truncate()
+            size = response.headers.get("Content-Length", "")
+        else:
+            content_range = response.headers.get("Content-Range", "")
+            start = content_range.partition(" ")[2].partition("-")[0]
+            if not start.isdigit() or int(start) != offset:
+                raise DownloadError(f"Drive file {file_id}: unexpected Content-Range {content_range!r}")
+            size = content_range.rpartition("/")[2]
+        for block in response.iter_content(64 * 1024):
+            sink.write(block)
+        if size.isdigit():
+            return int(size)
+        # Size unknown: done once a response is shorter than a chunk
+        return sink.tell() if response.status_code == 200 or sink.tell() - offset < self.chunk_size else None
+
+    def _fetch(self, file_id, sink):
+        """
+        Downloads a file into sink, continuing from the bytes already in it and resuming after failures.
+        Args:
+            file_id (str): Drive file ID.
+            sink: Seekable binary file object, positioned at its end.
+        Returns:
+            int: File size.
+        """
+        import requests
+        url = f"{self.api_url}/files/{file_id}"
+        total, attempt = None, 0
+        while total is None or sink.tell() < total:
+            offset = sink.tell()
+            response = None
+            try:
+                with self.sessions.session() as session:
+                    response = session.get(url, params={"alt": "media"}, stream=True, timeout=self.timeout,
+                                           headers={"Range": f"bytes={offset}-{offset + self.chunk_size - 1}"})
+                    with response:
+                        total = self._read_chunk(file_id, response, sink)
+                continue
+            except (_Restart, requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                error = str(e) if isinstance(e, _Restart) else type(e).__name__
+            if sink.tell() > offset:
+                # The transfer broke off after some progress: resume from there with a fresh retry budget
+                attempt = 0
+                self._count("resumed")
+            if attempt >= self.max_retries:
+                raise DownloadError(f"Drive file {file_id}: giving up after {self.max_retries} retries ({error})")
+            delay = self._backoff(attempt, response)
+            attempt += 1
+            self._count("retries")
+            log.warning("Download of %s failed (%s) at byte %d, retry %d/%d in %.1fs", file_id, error, sink.tell(),
+                        attempt, self.max_retries, delay, extra={"file_id": file_id, "error": error})
+            time.sleep(delay)
+        return sink.tell()
+
+    def _check_md5(self, file_metadata, md5):
+        expected = file_metadata.get('md5Checksum')
+        if expected and md5 != expected:
+            self._count("failed")
+            raise DownloadError(f"Drive file {file_metadata['id']}: MD5 {md5} does not match md5Checksum {expected}")
+
+    def download(self, file_metadata):
+        """
+        Downloads a file into memory.
+        Args:
+            file_metadata (dict): Drive metadata with 'id' (and 'md5Checksum' to verify the contents).
+        Returns:
+            bytes: File contents.
+        """
+        buffer = io.BytesIO()
+        with metrics.span("download") as span:
+            try:
+                self._fetch(file_metadata['id'], buffer)
+            except DownloadError:
+                self._count("failed")
+                raise
+            data = buffer.getvalue()
+            span.bytes = len(data)
+        self._check_md5(file_metadata, hashlib.md5(data).hexdigest())
+        self._count("downloads")
+        self._count("bytes", len(data))
+        return data
+
+    def download_to_file(self, file_metadata, destination_folder="downloads"):
+        """
+        Downloads a file to <destination_folder>/<file ID><extension>, unless it is already there with
+        the expected MD5; resumes a partial download of an earlier run.
+        Args:
+            file_metadata (dict): Drive metadata with 'id', 'name' and optionally 'md5Checksum'.
+            destination_folder (str): Local folder.
+        Returns:
+            str: Local file path.
+        """
+        os.makedirs(destination_folder, exist_ok=True)
+        local_path = local_file_path(file_metadata, destination_folder)
+        expected = file_metadata.get('md5Checksum')
+        if expected and os.path.exists(local_path) and file_md5(local_path) == expected:
+            log.debug("Already downloaded: %s", local_path, extra={"file_id": file_metadata['id']})
+            self._count("skipped")
+            return local_path
+        part_path = local_path + ".part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            log.debug("Resuming %s at byte %d", part_path, offset, extra={"file_id": file_metadata['id']})
+            self._count("resumed")
+        with metrics.span("download") as span:
+            with open(part_path, "ab" if offset else "wb") as f:
+                try:
+                    size = self._fetch(file_metadata['id'], f)
+                except DownloadError:
+                    self._count("failed")
+                    raise
+            span.bytes = size
+        md5 = file_md5(part_path)
+        if expected and md5 != expected:
+            os.remove(part_path)
+        self._check_md5(file_metadata, md5)
+        os.replace(part_path, local_path)
+        self._count("downloads")
+        self._count("bytes", size)
+        return local_path
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def print_summary(self):
+        stats = self.stats()
+        if stats["downloads"] or stats["skipped"] or stats["failed"]:
+            log.info("Drive downloads: %d files, %.1f MB, %d skipped (already local), %d retries, %d resumed, "
+                     "%d failed", stats["downloads"], stats["bytes"] / 1e6, stats["skipped"], stats["retries"],
+                     stats["resumed"], stats["failed"], extra={"downloads": stats})
+
+    def close(self):
+        self.sessions.close()
@@ -0,0 +1,151 @@
+# ---
+# EXTRACTION CACHE ---
+#
+# Persistent, content-addressed cache of post-processed receipt extractions.
+#
+# Entries are keyed by the MD5 of the image bytes. That is exactly what Google Drive reports as
+# `md5Checksum`, so a receipt that was extracted before can be served straight from the Drive
+# listing, without downloading, OCR or an LLM call.
+#
+# Every entry also records the extraction version: a hash of the prompt, the JSON schema, the model,
+# the post-processing version and the options that change a result (preprocessing, OCR routing, the
+# product catalogs). Entries written with a different version are never returned and are purged when
+# the cache is opened. The cache is bounded by entry count and total size, tracked as running totals;
+# once over a limit, the least recently used entries are evicted down to 90% of it.
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger("receipts.cache")
+
+
+def file_md5(path, chunk_size=1024 * 1024):
+    """Returns the hex MD5 of a file's contents (same value as Drive's md5Checksum)."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def extraction_version(prompt, schema, model, postprocess_version, options=None):
+    """
+    Returns a short hash identifying everything that shapes an extraction result.
+    Args:
+        prompt (list): LLM prompts (the vision and the text-only prompt).
+        schema (dict): JSON schema sent to the LLM.
+        model (str): LLM model name.
+        postprocess_version (int): Version of the date/store/category post-processing rules.
+        options (dict, optional): Other settings the result depends on (preprocessing, OCR routing,
+            catalog version).
+    Returns:
+        str: Hex digest.
+    """
+    payload = json.dumps([prompt, schema, model, postprocess_version, options], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class ExtractionCache:
+    """
+    SQLite-backed extraction cache, safe to share between worker threads.
+    Args:
+        path (str): SQLite database file.
+        version (str): Current extraction version (see extraction_version).
+        max_entries (int): Max cached receipts.
+        max_bytes (int): Max total size of the cached JSON results.
+    """
+
+    def __init__(self, path, version, max_entries=100000, max_bytes=512 * 1024 * 1024):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.version = version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS extractions ("
+                " content_hash TEXT PRIMARY KEY,"
+                " version TEXT NOT NULL,"
+                " result TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_access REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_extractions_last_access ON extractions (last_access)")
+            stale = self._conn.execute("DELETE FROM extractions WHERE version != ?", (version,)).rowcount
+            self._count, self._bytes = self._totals()
+        if stale:
+            log.info("Extraction cache: dropped %d entries from an older prompt/schema/model version", stale)
+
+    def get(self, content_hash):
+        """Returns the cached result for an image hash, or None."""
+        if not content_hash:
+            return None
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT result FROM extractions WHERE content_hash = ? AND version = ?",
+                (content_hash, self.version)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE extractions SET last_access = ? WHERE content_hash = ?", (time.time(), content_hash))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, content_hash, result):
+        """Stores the post-processed result for an image hash and evicts old entries if over the limits."""
+        if not content_hash or result is None:
+            return
+        payload = json.dumps(result, ensure_ascii=False)
+        size = len(payload.encode('utf-8'))
+        now = time.time()
+        with self._lock, self._conn:
+            replaced = self._conn.execute("SELECT size FROM extractions WHERE content_hash = ?",
+                                          (content_hash,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (content_hash, version, result, size, created, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (content_hash, self.version, payload, size, now, now))
+            self._count += 0 if replaced else 1
+            self._bytes += size - (replaced[0] if replaced else 0)
+            if self._count > self.max_entries or self._bytes > self.max_bytes:
+                self._evict()
+
+    def _totals(self):
+        return self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions").fetchone()
+
+    def _evict(self):
+        # The running totals miss writes of other processes sharing the file: recount before evicting
+        count, total = self._totals()
+        # Down to 90% of the limits, so the next eviction (and recount) is many writes away
+        max_entries, max_bytes = int(self.max_entries * 0.9), int(self.max_bytes * 0.9)
+        evicted = 0
+        while count > max_entries or total > max_bytes:
+            rows = self._conn.execute("SELECT content_hash, size FROM extractions ORDER BY last_access LIMIT ?",
+                                      (max(count - max_entries, 100),)).fetchall()
+            if not rows:
+                break
+            for content_hash, size in rows:
+                if count <= max_entries and total <= max_bytes:
+                    break
+                self._conn.execute("DELETE FROM extractions WHERE content_hash = ?", (content_hash,))
+                count -= 1
+                total -= size
+                evicted += 1
+        self._count, self._bytes = count, total
+        if evicted:
+            log.info("Extraction cache: evicted %d least recently used entries", evicted)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
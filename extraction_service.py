@@ -0,0 +1,480 @@
+# ---
+# EXTRACTION SERVICE ---
+#
+# Long-running mode of the extractor (receipt_info_extractor.py --serve). A one-shot run pays the
+# startup cost every time: credentials, the Drive discovery client, the OpenAI client, the OCR
+# worker processes, catalogs and rules. The service builds all of that once and keeps one pipeline
+# (download -> enhance/OCR -> LLM, see pipeline.py) running; extraction jobs submitted over a local
+# HTTP API are fed into it and their results collected asynchronously.
+#
+# A job is a set of receipts: uploaded image bytes, Drive file IDs, or Drive folders (crawled when
+# the job starts). Receipts of all jobs share the pipeline, so a job of one new receipt does not wait
+# for a large folder job to finish. Receipts whose content hash is in the extraction cache are
+# answered from it. Every extracted receipt is also written to the results store, if one is
+# configured (see results_store.py). Optionally the service watches the configured folders: every watch_interval
+# seconds it reads the Drive changes feed (incremental crawl, see drive_crawler.py) and submits the
+# new receipts as a job, so receipts are processed shortly after they arrive.
+#
+# HTTP API (JSON; bound to 127.0.0.1 by default):
+#   POST /jobs                 {"file_ids": [...]} or {"folder_ids": [...]}   -> 202 job
+#   POST /jobs/image?name=...  raw image bytes                                  -> 202 job
+#   GET  /jobs[?status=...]    job summaries, newest first
+#   GET  /jobs/<id>[?wait=30]  job with its results (wait: block until it finished, max seconds)
+#   GET  /health               uptime, job counts, items queued in the pipeline
+#   GET  /metrics, /metrics.json   run metrics (see run_metrics.py)
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from run_metrics import metrics
+
+log = logging.getLogger("receipts.service")
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+MAX_WAIT_SECONDS = 300
+
+
+class Job:
+    """
+    One extraction job and its results.
+    Args:
+        kind (str): "image", "files" or "folders".
+        request (dict): What was requested (JSON-serializable, shown in the job status).
+    """
+
+    def __init__(self, kind, request):
+        self.id = uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.request = request
+        self.status = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.results = []
+        self.remaining = 0
+        # Called with the results once all receipts finished (e.g. to save the crawl state)
+        self.on_finished = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def summary(self):
+        with self.lock:
+            failed = sum(1 for r in self.results if r is not None and r.error is not None)
+            completed = sum(1 for r in self.results if r is not None)
+            return {"id": self.id, "kind": self.kind, "status": self.status, "request": self.request,
+                    "error": self.error, "created": self.created, "started": self.started,
+                    "finished": self.finished, "receipts": len(self.results), "completed": completed,
+                    "failed": failed}
+
+    def to_dict(self):
+        data = self.summary()
+        with self.lock:
+            data["results"] = [None if r is None else {
+                "file_id": r.source.get("id"), "name": r.source.get("name"), "stage": r.stage,
+                "receipt": r.value, "error": None if r.error is None else str(r.error)} for r in self.results]
+        return data
+
+
+class ExtractionService:
+    """
+    Keeps the clients and the pipeline warm and runs extraction jobs through it.
+    Args:
+        cache (ExtractionCache, optional): Extraction cache (receipts with a cached content hash are not processed).
+        llm_client (LLMScheduler or OpenAI, optional): Client for the LLM requests (default: the blocking client).
+        download_workers (int): Concurrent Drive downloads.
+        ocr_workers (int, optional): Processes for enhancement and OCR (default: CPU count).
+        llm_workers (int): Concurrent LLM requests.
+        queue_size (int, optional): Max items waiting per stage (default: 2 * workers of that stage).
+        list_workers (int): Folders listed concurrently when a folder job is crawled.
+        job_workers (int): Jobs prepared (file metadata read, folders crawled) concurrently.
+        max_jobs (int): Finished jobs kept for status queries; the oldest are dropped first.
+        dedup (DuplicateIndex, optional): Near-duplicates of other images (of any job or earlier runs) reuse their extraction.
+        results_store (ResultsStore, optional): Every extracted receipt is written to it.
+        **stage_options: adaptive_preprocessing, target_width, max_tiles, min_ocr_confidence,
+            min_ocr_words and ocr_options (see receipt_info_extractor.process_folder_ids).
+    """
+
+    def __init__(self, cache=None, llm_client=None, download_workers=8, ocr_workers=None, llm_workers=16,
+                 queue_size=None, list_workers=8, job_workers=2, max_jobs=1000, dedup=None, results_store=None,
+                 **stage_options):
+        self.cache = cache
+        self.llm_client = llm_client
+        self.download_workers = download_workers
+        self.ocr_workers = ocr_workers
+        self.llm_workers = llm_workers
+        self.queue_size = queue_size
+        self.list_workers = list_workers
+        self.job_workers = job_workers
+        self.max_jobs = max_jobs
+        self.dedup = dedup
+        self.results_store = results_store
+        self.stage_options = stage_options
+        self.started = None
+        # Set up by start() (they import the image libraries)
+        self.preprocessing_report = None
+        self.routing_report = None
+        self._jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._pipeline = None
+        self._planner = None
+        self._server = None
+        self._watch_stop = threading.Event()
+        self._watch_thread = None
+
+    def start(self):
+        """Loads the heavy modules, starts the pipeline (OCR worker processes) and builds the clients."""
+        from pipeline import Pipeline
+        start = time.perf_counter()
+        self._pipeline = Pipeline(self._stages())
+        self._planner = ThreadPoolExecutor(max_workers=self.job_workers, thread_name_prefix="job")
+        self.warm_up()
+        self.started = time.time()
+        log.info("Extraction service ready in %.1fs", time.perf_counter() - start)
+
+    def _stages(self):
+        """Builds the pipeline stages (download, dedup, OCR, LLM) and the reports they feed."""
+        import receipt_info_extractor as extractor
+        from image_preprocessing import PreprocessingReport
+        from pipeline import PipelineStage
+
+        options = self.stage_options
+        self.preprocessing_report = PreprocessingReport()
+        self.routing_report = extractor.RoutingReport()
+        reports = (self.preprocessing_report, self.routing_report)
+        if self.results_store:
+            reports += (self.results_store,)
+        self._extract = partial(extractor.llm_stage, cache=self.cache, reports=reports,
+                                min_ocr_confidence=options.get("min_ocr_confidence", 85),
+                                min_ocr_words=options.get("min_ocr_words", 8), llm_client=self.llm_client)
+        stages = [
+            PipelineStage("download", self._fetch_stage, workers=self.download_workers, queue_size=self.queue_size),
+            PipelineStage("ocr", partial(extractor.ocr_stage, adaptive=options.get("adaptive_preprocessing", True),
+                                         target_width=options.get("target_width", 1000),
+                                         max_tiles=options.get("max_tiles", 0),
+                                         ocr_options=options.get("ocr_options")),
+                          workers=self.ocr_workers or extractor.os.cpu_count() or 1, queue_size=self.queue_size,
+                          use_processes=True, preload=extractor.ocr_stage_preload(options.get("ocr_options"))),
+            PipelineStage("llm", partial(self._extract, dedup=self.dedup), workers=self.llm_workers,
+                          queue_size=self.queue_size),
+        ]
+        if self.dedup:
+            stages.insert(1, PipelineStage("dedup", partial(extractor.dedup_stage, dedup=self.dedup, cache=self.cache),
+                                           workers=self.ocr_workers or extractor.os.cpu_count() or 1,
+                                           queue_size=self.queue_size))
+        return stages
+
+    def warm_up(self):
+        """Builds what the first job would otherwise wait for; a client that cannot be built is built on first use."""
+        import receipt_info_extractor as extractor
+        from catalog_registry import get_catalog_registry
+        from normalization import get_rules
+        get_rules()
+        extractor.get_receipt_schema()
+        get_catalog_registry()
+        for name, build in (("Drive", extractor.get_thread_drive_service), ("Drive downloads",
+                                                                           extractor.get_drive_downloader),
+                            ("OpenAI", extractor.get_openai_client if self.llm_client is None else lambda: None)):
+            try:
+                build()
+            except Exception as e:
+                log.warning("Could not set up the %s client yet: %s", name, e)
+
+    @staticmethod
+    def _fetch_stage(item):
+        import receipt_info_extractor as extractor
+        if "content" in item:
+            return item["content"], None
+        return extractor.download_stage(item)
+
+    # --- Jobs ---
+
+    def _add_job(self, job, prepare):
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+            # Drop the oldest finished jobs beyond max_jobs
+            for job_id in [job_id for job_id, old in self._jobs.items() if old.done.is_set()]:
+                if len(self._jobs) <= self.max_jobs:
+                    break
+                del self._jobs[job_id]
+        metrics.count("service_jobs")
+        self._planner.submit(self._run_job, job, prepare)
+        log.info("Job %s queued (%s)", job.id, job.kind, extra={"job": job.id})
+        return job
+
+    def _run_job(self, job, prepare):
+        import receipt_info_extractor as extractor
+        job.started = time.time()
+        try:
+            images, on_finished = prepare()
+            results, pending = extractor.lookup_cached(images, self.cache)
+        except Exception as e:
+            log.warning("Job %s failed: %s", job.id, e, extra={"job": job.id})
+            self._finish_job(job, error=e)
+            return
+        if self.results_store:
+            self.results_store.put_results(results)
+        with job.lock:
+            job.results = results
+            job.remaining = len(pending)
+            job.on_finished = on_finished
+            job.status = RUNNING
+        if not pending:
+            self._finish_job(job)
+        for i in pending:
+            # Blocks while the pipeline is saturated (backpressure across all jobs)
+            self._pipeline.submit(images[i], partial(self._finish_item, job), key=f"{job.id}/{i}")
+
+    def _finish_item(self, job, key, result):
+        if self.dedup:
+            from image_dedup import Duplicate
+            if isinstance(result.value, Duplicate):
+                # Finished once the image it was matched to is (possibly in another job)
+                result.value.future.add_done_callback(lambda _: self._resolve_duplicate(job, key, result))
+                return
+            self.dedup.settle(result.source.get("md5Checksum"), result.value, result.error)
+            if result.error is not None and result.stage in ("download", "dedup", "ocr"):
+                # A candidate that failed before the LLM stage is never picked up there
+                self.dedup.candidate(result.source.get("md5Checksum"))
+        if self.results_store:
+            self.results_store.put_results([result])
+        index = int(key.rpartition("/")[2])
+        with job.lock:
+            job.results[index] = result
+            job.remaining -= 1
+            finished = job.remaining == 0
+        if finished:
+            self._finish_job(job)
+
+    def _resolve_duplicate(self, job, key, result):
+        import receipt_info_extractor as extractor
+        from pipeline import PipelineResult
+        resolved = extractor.resolve_duplicate(result, self.cache, self.dedup)
+        if resolved is not None:
+            return self._finish_item(job, key, resolved)
+
+        def extract():
+            # Rejected candidate: extracted on its own
+            try:
+                value, error = self._extract(result.value.preprocessed), None
+            except Exception as e:
+                log.warning("Extraction of %s failed: %s", result.source.get("name"), e, extra={"job": job.id})
+                value, error = None, e
+            self._finish_item(job, key, PipelineResult(result.source, value, error, "llm"))
+
+        try:
+            self._planner.submit(extract)
+        except RuntimeError:
+            # Shutting down (no new planner tasks): extract in this thread
+            extract()
+
+    def _finish_job(self, job, error=None):
+        with job.lock:
+            job.status = FAILED if error is not None else DONE
+            job.error = None if error is None else str(error)
+            job.finished = time.time()
+            on_finished = job.on_finished
+        if on_finished:
+            try:
+                on_finished(job.results)
+            except Exception as e:
+                log.warning("Job %s: could not record the results: %s", job.id, e, extra={"job": job.id})
+        metrics.record("service_job", job.finished - job.created, error=error is not None)
+        summary = job.summary()
+        log.info("Job %s %s: %d receipts (%d failed) in %.2fs", job.id, job.status, summary["receipts"],
+                 summary["failed"], job.finished - job.created, extra={"job": job.id})
+        job.done.set()
+
+    def submit_image(self, content, name="upload.jpg"):
+        """Queues a job for one uploaded image; returns the Job."""
+        content_hash = hashlib.md5(content).hexdigest()
+        item = {"id": f"upload-{content_hash}", "name": name, "md5Checksum": content_hash, "content": content}
+        job = Job("image", {"name": name, "bytes": len(content)})
+        return self._add_job(job, lambda: ([item], None))
+
+    def submit_files(self, file_ids):
+        """Queues a job for Drive files; returns the Job."""
+        file_ids = _id_list(file_ids)
+        job = Job("files", {"file_ids": file_ids})
+        return self._add_job(job, lambda: ([_file_metadata(file_id) for file_id in file_ids], None))
+
+    def submit_folders(self, folder_ids, crawl_state_path=None, full_crawl=False):
+        """
+        Queues a job for all images below Drive folders; returns the Job.
+        With crawl_state_path, only images added or modified since the previous job on the same
+        folders are processed, and the watermark is advanced when the job finished.
+        """
+        import receipt_info_extractor as extractor
+        folder_ids = _id_list(folder_ids)
+        job = Job("folders", {"folder_ids": folder_ids, "incremental": bool(crawl_state_path)})
+
+        def prepare():
+            images, crawl_state, _, _ = extractor.collect_images(
+                ",".join(folder_ids), crawl_state_path=crawl_state_path, full_crawl=full_crawl,
+                list_workers=self.list_workers)
+            if crawl_state is None:
+                return images, None
+            return images, lambda results: extractor.report_failures(results, crawl_state, crawl_state_path)
+
+        return self._add_job(job, prepare)
+
+    def get(self, job_id):
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self, status=None):
+        """Job summaries, newest first."""
+        with self._jobs_lock:
+            jobs = list(self._jobs.values())
+        return [job.summary() for job in reversed(jobs) if status is None or job.status == status]
+
+    def health(self):
+        with self._jobs_lock:
+            jobs = list(self._jobs.values())
+        counts = {}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"status": "ok", "uptime_seconds": time.time() - self.started if self.started else None,
+                "jobs": counts, "pipeline_queued": self._pipeline.pending() if self._pipeline else 0}
+
+    # --- Folder watch ---
+
+    def watch(self, folder_ids, interval, crawl_state_path):
+        """
+        Every interval seconds, submits an incremental job for the folders (skipped while the previous one runs).
+        """
+        folder_ids = _id_list(folder_ids)
+
+        def loop():
+            job = None
+            while not self._watch_stop.is_set():
+                if job is None or job.done.is_set():
+                    job = self.submit_folders(folder_ids, crawl_state_path=crawl_state_path)
+                self._watch_stop.wait(interval)
+
+        self._watch_thread = threading.Thread(target=loop, name="folder-watch", daemon=True)
+        self._watch_thread.start()
+        log.info("Watching %s for new receipts every %ds", ", ".join(folder_ids), interval)
+
+    # --- HTTP API ---
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serves the HTTP API until the process is interrupted (or close() is called from another thread)."""
+        self._server = ThreadingHTTPServer((host, port), make_handler(self))
+        log.info("Extraction service listening on http://%s:%d", host, self._server.server_port)
+        self._server.serve_forever()
+
+    def close(self):
+        """Stops the folder watch and the HTTP server, finishes the queued receipts and stops the pipeline."""
+        self._watch_stop.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._planner:
+            self._planner.shutdown(wait=True)
+        if self._pipeline:
+            self._pipeline.close()
+        for report in (self.preprocessing_report, self.routing_report):
+            if report is not None:
+                report.print_summary()
+
+
+def _id_list(ids):
+    if isinstance(ids, str):
+        ids = ids.split(",")
+    ids = [str(i).strip() for i in ids if str(i).strip()]
+    if not ids:
+        raise ValueError("no IDs given")
+    return ids
+
+
+def _file_metadata(file_id):
+    import receipt_info_extractor as extractor
+    from drive_crawler import FILE_FIELDS
+    with metrics.span("drive_get"):
+        return extractor.get_thread_drive_service().files().get(fileId=file_id, fields=FILE_FIELDS).execute()
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            log.debug("%s %s", self.address_string(), format % args)
+
+        def _send(self, payload, status=200, content_type="application/json"):
+            if isinstance(payload, str):
+                data = payload.encode("utf-8")
+            else:
+                data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _error(self, status, message):
+            self._send({"error": message}, status=status)
+
+        def _accepted(self, job):
+            self._send(dict(job.summary(), url=f"/jobs/{job.id}"), status=202)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            parts = url.path.strip("/").split("/")
+            if url.path in ("/", "/health"):
+                return self._send(service.health())
+            if url.path == "/metrics":
+                return self._send(metrics.prometheus(), content_type="text/plain; version=0.0.4")
+            if url.path == "/metrics.json":
+                return self._send(metrics.report())
+            if parts == ["jobs"]:
+                return self._send({"jobs": service.jobs(params.get("status"))})
+            if len(parts) == 2 and parts[0] == "jobs":
+                job = service.get(parts[1])
+                if job is None:
+                    return self._error(404, f"unknown job {parts[1]}")
+                try:
+                    wait = min(float(params.get("wait", 0)), MAX_WAIT_SECONDS)
+                except ValueError:
+                    return self._error(400, "wait must be a number of seconds")
+                if wait > 0:
+                    job.done.wait(wait)
+                return self._send(job.to_dict())
+            self._error(404, "not found")
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_UPLOAD_BYTES:
+                self.close_connection = True
+                return self._error(413, f"request larger than {MAX_UPLOAD_BYTES} bytes")
+            body = self.rfile.read(length)
+            if url.path == "/jobs/image":
+                if not body:
+                    return self._error(400, "empty image")
+                name = parse_qs(url.query).get("name", ["upload.jpg"])[0]
+                return self._accepted(service.submit_image(body, name))
+            if url.path == "/jobs":
+                try:
+                    request = json.loads(body or b"{}")
+                    if request.get("file_ids"):
+                        return self._accepted(service.submit_files(request["file_ids"]))
+                    if request.get("folder_ids"):
+                        return self._accepted(service.submit_folders(request["folder_ids"]))
+                except (ValueError, AttributeError) as e:
+                    return self._error(400, f"invalid job: {e}")
+                return self._error(400, "expected file_ids or folder_ids")
+            self._error(404, "not found")
+
+    return Handler
@@ -0,0 +1,235 @@
+# ---
+# ADAPTIVE RECEIPT IMAGE PREPROCESSING ---
+#
+# Phone photos of receipts are large (12+ MP) and mostly background. Before OCR and the LLM request
+# the image is
+#   1. rotated according to its EXIF orientation,
+#   2. converted to grayscale,
+#   3. cropped to the receipt (bright paper on a darker background, found with an Otsu threshold
+#      and row/column projection profiles on a thumbnail),
+#   4. downscaled so the receipt is target_width pixels wide (~300 DPI for an 80 mm receipt),
+#   5. contrast-enhanced.
+# Each image gets a stats dict with bytes and pixels before/after, the Tesseract time and the
+# estimated vision tokens before/after; the LLM call adds the actual input tokens.
+import logging
+import math
+import threading
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageOps
+
+log = logging.getLogger("receipts.preprocessing")
+
+# Vision token cost per model: (base tokens, tokens per 512px tile), high detail
+IMAGE_TOKEN_COSTS = {
+    "gpt-4o-mini": (2833, 5667),
+    "gpt-4o": (85, 170),
+}
+
+
+def estimate_image_tokens(width, height, model="gpt-4o-mini"):
+    """
+    Estimates the input tokens of an image using OpenAI's tiling rules: fit into 2048x2048,
+    scale the shortest side down to 768, then count 512px tiles.
+    """
+    base, per_tile = IMAGE_TOKEN_COSTS.get(model, IMAGE_TOKEN_COSTS["gpt-4o-mini"])
+    if not width or not height:
+        return 0
+    width, height = _api_image_size(width, height)
+    return base + per_tile * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def _otsu_threshold(values):
+    histogram = np.bincount(values.ravel(), minlength=256).astype(np.float64)
+    total = histogram.sum()
+    levels = np.arange(256)
+    weight_bg = np.cumsum(histogram)
+    weight_fg = total - weight_bg
+    sum_bg = np.cumsum(histogram * levels)
+    mean_bg = np.divide(sum_bg, weight_bg, out=np.zeros(256), where=weight_bg > 0)
+    mean_fg = np.divide(sum_bg[-1] - sum_bg, weight_fg, out=np.zeros(256), where=weight_fg > 0)
+    between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(between))
+
+
+def _largest_run(mask):
+    """Returns (start, end) of the longest run of True values, or None."""
+    best, start = None, None
+    for i, value in enumerate(np.append(mask, False)):
+        if value and start is None:
+            start = i
+        elif not value and start is not None:
+            if best is None or i - start > best[1] - best[0]:
+                best = (start, i)
+            start = None
+    return best
+
+
+def find_receipt_box(gray, min_fill=0.5, margin=0.02, thumbnail_size=400, min_contrast=30):
+    """
+    Finds the bounding box of the receipt (bright paper) in a grayscale image.
+    Args:
+        gray (PIL.Image): Grayscale image.
+        min_fill (float): Fraction of bright pixels a row/column needs to count as receipt.
+        margin (float): Margin added around the box, as a fraction of the image size.
+        thumbnail_size (int): Size of the thumbnail the analysis runs on.
+        min_contrast (int): Min difference of the mean gray level inside and outside the box.
+    Returns:
+        tuple or None: (left, top, right, bottom) in image coordinates, or None if no clear receipt region was found.
+    """
+    thumb = gray.copy()
+    thumb.thumbnail((thumbnail_size, thumbnail_size))
+    values = np.asarray(thumb, dtype=np.uint8)
+    bright = values > _otsu_threshold(values)
+    # The receipt may be narrow or short relative to the photo: measure the fill of rows only inside
+    # the receipt's columns (and vice versa), alternating until the box is stable
+    rows, cols = (0, bright.shape[0]), (0, bright.shape[1])
+    for _ in range(3):
+        cols = _largest_run(bright[rows[0]:rows[1]].mean(axis=0) >= min_fill)
+        if cols is None:
+            return None
+        rows = _largest_run(bright[:, cols[0]:cols[1]].mean(axis=1) >= min_fill)
+        if rows is None:
+            return None
+    inside = np.zeros(values.shape, dtype=bool)
+    inside[rows[0]:rows[1], cols[0]:cols[1]] = True
+    if inside.all() or values[inside].mean() - values[~inside].mean() < min_contrast:
+        # No paper clearly brighter than its surroundings (e.g. receipt on a white table)
+        return None
+    scale_x = gray.width / thumb.width
+    scale_y = gray.height / thumb.height
+    pad_x, pad_y = margin * gray.width, margin * gray.height
+    box = (
+        max(0, int(cols[0] * scale_x - pad_x)),
+        max(0, int(rows[0] * scale_y - pad_y)),
+        min(gray.width, int(math.ceil(cols[1] * scale_x + pad_x))),
+        min(gray.height, int(math.ceil(rows[1] * scale_y + pad_y))),
+    )
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    # Nearly the whole image (receipt fills the photo / bright background) or implausibly small: keep as is
+    if area > 0.9 * gray.width * gray.height or area < 0.05 * gray.width * gray.height:
+        return None
+    return box
+
+
+def _api_image_size(width, height):
+    """Size an image is scaled to by the OpenAI API before tiling (fit 2048x2048, shortest side 768)."""
+    scale = min(1.0, 2048 / max(width, height))
+    shortest = min(width, height) * scale
+    if shortest > 768:
+        scale *= 768 / shortest
+    return width * scale, height * scale
+
+
+def fit_tile_budget(img, max_tiles=0):
+    """
+    Downscales an image for the LLM request to what the API keeps after its own rescaling, so no
+    detail the model would see is lost. A tile budget (max_tiles 512px tiles) goes further and
+    scales long receipts below that size, trading small print for tokens; it is off by default.
+    Args:
+        img (PIL.Image): Preprocessed image.
+        max_tiles (int): Max vision tiles (0 = no tile limit).
+    Returns:
+        PIL.Image: The image, resized if needed.
+    """
+    width, height = _api_image_size(img.width, img.height)
+    scale = width / img.width
+    if max_tiles and math.ceil(width / 512) * math.ceil(height / 512) > max_tiles:
+        # Best layout of at most max_tiles tiles (columns x rows) for this aspect ratio
+        scale *= max(min(1.0, cols * 512 / width, (max_tiles // cols) * 512 / height)
+                     for cols in range(1, max_tiles + 1))
+    if scale >= 1.0:
+        return img
+    size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+    return img.resize(size, Image.LANCZOS)
+
+
+def preprocess_receipt_image(img, crop=True, grayscale=True, target_width=1000, contrast=2.0):
+    """
+    Applies the adaptive preprocessing steps to a decoded image.
+    Args:
+        img (PIL.Image): Decoded image.
+        crop (bool): Crop to the receipt region.
+        grayscale (bool): Convert to grayscale.
+        target_width (int): Downscale so the (cropped) image is at most this wide; 0 disables.
+        contrast (float): Contrast enhancement factor.
+    Returns:
+        tuple: (processed PIL.Image, stats dict with crop_box and pixel counts)
+    """
+    stats = {"original_size": img.size, "original_pixels": img.width * img.height, "crop_box": None}
+    img = ImageOps.exif_transpose(img)
+    if grayscale:
+        img = img.convert('L')
+    if crop:
+        box = find_receipt_box(img if img.mode == 'L' else img.convert('L'))
+        if box:
+            img = img.crop(box)
+            stats["crop_box"] = box
+    if target_width and img.width > target_width:
+        height = max(1, round(img.height * target_width / img.width))
+        img = img.resize((target_width, height), Image.LANCZOS)
+    img = ImageEnhance.Contrast(img).enhance(contrast)
+    stats["processed_size"] = img.size
+    stats["processed_pixels"] = img.width * img.height
+    return img, stats
+
+
+def format_stats(stats):
+    """One-line summary of an image's preprocessing stats."""
+    line = (f"{stats['original_bytes'] / 1024:.0f} KB -> {stats['processed_bytes'] / 1024:.0f} KB, "
+            f"{stats['original_pixels'] / 1e6:.2f} MP -> {stats['processed_pixels'] / 1e6:.2f} MP, "
+            f"est. image tokens {stats['est_image_tokens_before']} -> {stats['est_image_tokens_after']}, "
+            f"OCR {stats['ocr_seconds']:.2f}s")
+    if stats.get("ocr_strips", 1) > 1:
+        line += f" in {stats['ocr_strips']} strips"
+    if stats.get("input_tokens") is not None:
+        line += f", input tokens {stats['input_tokens']}"
+        if stats.get("est_input_tokens_before") is not None:
+            line += f" (est. {stats['est_input_tokens_before']} without preprocessing)"
+    return line
+
+
+class PreprocessingReport:
+    """Thread-safe aggregation of per-image preprocessing stats for a run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = []
+
+    def add(self, stats):
+        with self._lock:
+            self.images.append(stats)
+
+    def summary(self):
+        """Returns the run totals as a dict (empty if no image was preprocessed)."""
+        with self._lock:
+            images = list(self.images)
+        if not images:
+            return {}
+        total = lambda key: sum(s.get(key) or 0 for s in images)
+        return {
+            "images": len(images),
+            "cropped": sum(1 for s in images if s.get("crop_box")),
+            "original_bytes": total("original_bytes"),
+            "processed_bytes": total("processed_bytes"),
+            "original_pixels": total("original_pixels"),
+            "processed_pixels": total("processed_pixels"),
+            "est_image_tokens_before": total("est_image_tokens_before"),
+            "est_image_tokens_after": total("est_image_tokens_after"),
+            "input_tokens": total("input_tokens"),
+            "est_input_tokens_before": total("est_input_tokens_before"),
+            "ocr_seconds": total("ocr_seconds"),
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        log.info("Preprocessing: %d images (%d cropped), %.1f MB -> %.1f MB, %.1f MP -> %.1f MP, "
+                 "est. image tokens %d -> %d, actual input tokens %d (est. %d without preprocessing), "
+                 "OCR %.1fs total",
+                 summary['images'], summary['cropped'], summary['original_bytes'] / 1e6,
+                 summary['processed_bytes'] / 1e6, summary['original_pixels'] / 1e6,
+                 summary['processed_pixels'] / 1e6, summary['est_image_tokens_before'],
+                 summary['est_image_tokens_after'], summary['input_tokens'], summary['est_input_tokens_before'],
+                 summary['ocr_seconds'], extra={"preprocessing": summary})
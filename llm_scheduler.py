@@ -0,0 +1,322 @@
+# ---
+# RATE-LIMIT-AWARE LLM SCHEDULER ---
+#
+# All LLM requests of a run go through one asyncio event loop (in a background thread) that keeps
+# two token buckets in line with the account's rate limits:
+#   - requests per minute,
+#   - tokens per minute: each request reserves its estimated tokens up front; the reservation is
+#     corrected with the actual `response.usage` once the response arrives.
+# The limits are taken from the x-ratelimit-* response headers unless set explicitly, so throughput
+# climbs to the account limit and stays there instead of running into 429s.
+#
+# Failed requests (429, timeouts, connection errors, 5xx) are retried with full-jitter exponential
+# backoff; a 429 also pauses the whole scheduler for the server's retry-after time. An attempt that
+# gets no response releases its reservation, as does a caller that gives up (timeout, shutdown) and
+# cancels its request.
+#
+# The scheduler is a drop-in for the blocking client: `scheduler.responses.create(**request)` can be
+# called from any worker thread.
+import asyncio
+import base64
+import io
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import openai
+from PIL import Image
+
+from image_preprocessing import estimate_image_tokens
+
+# Used until the API reports the account's limits (gpt-4o-mini, usage tier 1)
+DEFAULT_RPM = 500
+DEFAULT_TPM = 200000
+# Tokens reserved for the response until the actual usage is known
+OUTPUT_TOKEN_ALLOWANCE = 1000
+
+log = logging.getLogger("receipts.llm")
+
+
+def estimate_request_tokens(request, output_allowance=OUTPUT_TOKEN_ALLOWANCE):
+    """
+    Estimates the tokens of a Responses API request: ~4 characters per text token, images by
+    OpenAI's tiling rules, plus an allowance for the output.
+    """
+    tokens = output_allowance
+    for message in request.get("input", []):
+        content = message.get("content", [])
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            if part.get("type") == "input_text":
+                tokens += len(part.get("text", "")) // 4
+            elif part.get("type") == "input_image":
+                try:
+                    data = base64.b64decode(part["image_url"].split(",", 1)[1])
+                    tokens += estimate_image_tokens(*Image.open(io.BytesIO(data)).size, model=request.get("model"))
+                except Exception:
+                    tokens += estimate_image_tokens(2048, 2048, model=request.get("model"))
+    return tokens
+
+
+def _parse_duration(value):
+    """Parses rate-limit reset durations like '1s', '6m0s', '250ms' into seconds."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"([\d.]+)(ms|s|m|h)", value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `per_minute` per minute, holding at most one minute's worth.
+    Reservations may be corrected afterwards (adjust), which can leave the bucket in debt.
+    Not thread-safe; only used from the scheduler's event loop.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = float(per_minute)
+        self.tokens = self.per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def set_limit(self, per_minute):
+        self._refill()
+        self.per_minute = float(per_minute)
+        self.tokens = min(self.tokens, self.per_minute)
+
+    def sync_remaining(self, remaining):
+        """Lowers the bucket to what the server reports as remaining."""
+        self._refill()
+        self.tokens = min(self.tokens, float(remaining))
+
+    def wait_time(self, amount):
+        """Seconds until `amount` tokens are available (0 if available now)."""
+        self._refill()
+        amount = min(amount, self.per_minute)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) * 60 / self.per_minute
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.per_minute)
+
+    def adjust(self, delta):
+        self._refill()
+        self.tokens = min(self.per_minute, self.tokens - delta)
+
+
+class _ScheduledResponses:
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+
+    def create(self, **request):
+        return self._scheduler.create(request)
+
+
+class LLMScheduler:
+    """
+    Schedules Responses API requests within the account's rate limits.
+    Args:
+        client (openai.AsyncOpenAI): Async client; create it with max_retries=0, retries are done here.
+        rpm (int, optional): Requests per minute (default: from the response headers).
+        tpm (int, optional): Tokens per minute (default: from the response headers).
+        max_retries (int): Retries per request.
+        request_timeout (float): Timeout of one attempt in seconds.
+        base_delay (float): Backoff base delay in seconds.
+        max_delay (float): Max backoff delay in seconds.
+    """
+
+    RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                        openai.InternalServerError, openai.ConflictError, asyncio.TimeoutError)
+
+    def __init__(self, client, rpm=None, tpm=None, max_retries=6, request_timeout=120, base_delay=1.0,
+                 max_delay=60.0):
+        self.client = client
+        self.fixed_rpm, self.fixed_tpm = rpm, tpm
+        self.requests_bucket = TokenBucket(rpm or DEFAULT_RPM)
+        self.tokens_bucket = TokenBucket(tpm or DEFAULT_TPM)
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.responses = _ScheduledResponses(self)
+        self.stats = {"requests": 0, "succeeded": 0, "failed": 0, "retries": 0, "rate_limited": 0, "timeouts": 0,
+                      "cancelled": 0, "input_tokens": 0, "output_tokens": 0, "throttled_seconds": 0.0}
+        self._paused_until = 0.0
+        self._admission = asyncio.Lock()
+        self._loop = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._started = None
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="llm-scheduler", daemon=True)
+                self._thread.start()
+                self._started = time.monotonic()
+        return self._loop
+
+    async def _acquire(self, estimated_tokens):
+        # One waiter at a time: requests are admitted in arrival order, large ones are not starved
+        async with self._admission:
+            start = time.monotonic()
+            while True:
+                wait = max(self._paused_until - time.monotonic(), self.requests_bucket.wait_time(1),
+                           self.tokens_bucket.wait_time(estimated_tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests_bucket.take(1)
+            self.tokens_bucket.take(estimated_tokens)
+            self.stats["throttled_seconds"] += time.monotonic() - start
+
+    def _update_limits(self, headers):
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        if limit_requests and not self.fixed_rpm and float(limit_requests) != self.requests_bucket.per_minute:
+            self.requests_bucket.set_limit(float(limit_requests))
+            log.info("LLM scheduler: account limit %s requests/min", limit_requests)
+        if limit_tokens and not self.fixed_tpm and float(limit_tokens) != self.tokens_bucket.per_minute:
+            self.tokens_bucket.set_limit(float(limit_tokens))
+            log.info("LLM scheduler: account limit %s tokens/min", limit_tokens)
+        if headers.get("x-ratelimit-remaining-requests"):
+            self.requests_bucket.sync_remaining(float(headers["x-ratelimit-remaining-requests"]))
+        if headers.get("x-ratelimit-remaining-tokens"):
+            self.tokens_bucket.sync_remaining(float(headers["x-ratelimit-remaining-tokens"]))
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = (_parse_duration(response.headers.get("retry-after"))
+                           or _parse_duration(response.headers.get("x-ratelimit-reset-tokens")))
+            if retry_after:
+                delay = max(delay, retry_after)
+        return delay
+
+    async def _create(self, request, estimated_tokens):
+        self.stats["requests"] += 1
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(estimated_tokens)
+            raw = None
+            try:
+                raw = await asyncio.wait_for(self.client.responses.with_raw_response.create(**request),
+                                             self.request_timeout)
+            except asyncio.CancelledError:
+                self.stats["cancelled"] += 1
+                raise
+            except self.RETRYABLE_ERRORS as e:
+                if isinstance(e, openai.RateLimitError):
+                    if getattr(e, "code", None) == "insufficient_quota":
+                        self.stats["failed"] += 1
+                        raise
+                    self.stats["rate_limited"] += 1
+                elif isinstance(e, (asyncio.TimeoutError, openai.APITimeoutError)):
+                    self.stats["timeouts"] += 1
+                if attempt == self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                if isinstance(e, openai.RateLimitError):
+                    # The account is over its limit: hold back all requests, not only this one
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.stats["retries"] += 1
+                log.warning("LLM request failed (%s), retry %d/%d in %.1fs", type(e).__name__, attempt + 1,
+                            self.max_retries, delay, extra={"error": type(e).__name__, "attempt": attempt + 1})
+            except Exception:
+                self.stats["failed"] += 1
+                raise
+            finally:
+                # An attempt without a response gives its reservation back, whether it is retried,
+                # re-raised or cancelled; otherwise sustained 429s drain the bucket with phantom tokens
+                if raw is None:
+                    self.tokens_bucket.adjust(-estimated_tokens)
+            if raw is None:
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    self.stats["cancelled"] += 1
+                    raise
+                continue
+            self._update_limits(raw.headers)
+            response = raw.parse()
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                self.stats["input_tokens"] += usage.input_tokens or 0
+                self.stats["output_tokens"] += usage.output_tokens or 0
+                self.tokens_bucket.adjust((usage.input_tokens or 0) + (usage.output_tokens or 0) - estimated_tokens)
+            self.stats["succeeded"] += 1
+            return response
+
+    def create(self, request, timeout=None):
+        """
+        Sends a Responses API request through the scheduler; blocks the calling thread until it is done.
+        Args:
+            request (dict): Keyword arguments of client.responses.create.
+            timeout (float, optional): Max seconds to wait, including throttling and retries.
+        Returns:
+            Response: Parsed response.
+        """
+        loop = self._ensure_started()
+        future = asyncio.run_coroutine_threadsafe(self._create(request, estimate_request_tokens(request)), loop)
+        try:
+            return future.result(timeout)
+        except (FutureTimeoutError, KeyboardInterrupt):
+            future.cancel()
+            raise
+
+    def summary(self):
+        """Returns the request/retry/token counters and the achieved throughput."""
+        summary = dict(self.stats)
+        elapsed = time.monotonic() - self._started if self._started else 0
+        if elapsed:
+            summary["requests_per_minute"] = summary["succeeded"] * 60 / elapsed
+            summary["tokens_per_minute"] = (summary["input_tokens"] + summary["output_tokens"]) * 60 / elapsed
+        summary["rpm_limit"] = self.requests_bucket.per_minute
+        summary["tpm_limit"] = self.tokens_bucket.per_minute
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary["requests"]:
+            return
+        log.info("LLM scheduler: %d/%d requests succeeded, %d retries (%d rate limited, %d timeouts), "
+                 "%.0f req/min of %.0f, %.0f tokens/min of %.0f, throttled %.1fs",
+                 summary['succeeded'], summary['requests'], summary['retries'], summary['rate_limited'],
+                 summary['timeouts'], summary.get('requests_per_minute', 0), summary['rpm_limit'],
+                 summary.get('tokens_per_minute', 0), summary['tpm_limit'], summary['throttled_seconds'],
+                 extra={"scheduler": summary})
+
+    def close(self):
+        """Cancels outstanding requests and stops the event loop."""
+        if self._loop is None:
+            return
+
+        async def cancel_all():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.client.close()
+
+        try:
+            asyncio.run_coroutine_threadsafe(cancel_all(), self._loop).result(10)
+        except Exception as e:
+            log.warning("LLM scheduler shutdown: %s", e)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+        self._loop = None
@@ -0,0 +1,164 @@
+# ---
+# STRUCTURED LOGGING ---
+#
+# All modules log through the standard `logging` module, to loggers named after their stage
+# ("receipts.drive", "receipts.download", "receipts.llm", "receipts.mcp", "receipts.catalog", ...).
+#
+#   - Worker threads only put records on an in-memory queue (no lock, no I/O); a single listener
+#     thread formats them and writes to the console and, optionally, to a rotating JSON-lines file.
+#   - Disabled levels cost one cached level check: hot-path debug calls use lazy %-style arguments.
+#   - Per-stage sampling keeps only a fraction of the DEBUG/INFO records of chatty stages
+#     (warnings and errors are never sampled).
+#   - File records are JSON objects with timestamp, level, logger, thread, message and any
+#     structured fields passed with `extra=`.
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from datetime import datetime
+
+ROOT_LOGGER = "receipts"
+# Standard LogRecord attributes; everything else on a record came in through `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Human-readable console lines: `[INFO] message` (WARNING is shown as WARN)."""
+
+    def format(self, record):
+        level = "WARN" if record.levelno == logging.WARNING else record.levelname
+        line = f"[{level}] {record.getMessage()}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps every n-th record below WARNING per sampled logger (n = 1 / rate).
+    Args:
+        rates (dict): Logger name (or name prefix, e.g. "receipts.catalog") -> fraction of records kept.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.intervals = {name: max(1, round(1 / rate)) if rate > 0 else 0 for name, rate in rates.items()}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.intervals:
+            return True
+        name = record.name
+        while name and name not in self.intervals:
+            name = name.rpartition(".")[0]
+        if not name:
+            return True
+        interval = self.intervals[name]
+        if not interval:
+            return False
+        with self._lock:
+            count = self._counters.get(name, 0)
+            self._counters[name] = count + 1
+        return count % interval == 0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler without the per-handler lock: SimpleQueue.put is thread-safe on its own."""
+
+    def handle(self, record):
+        rv = self.filter(record)
+        if isinstance(rv, logging.LogRecord):
+            record = rv
+        if rv:
+            self.emit(record)
+        return rv
+
+
+def setup_logging(level="INFO", log_file=None, json_console=False, max_bytes=10 * 1024 * 1024, backups=5,
+                  sample_rates=None):
+    """
+    Configures the "receipts" loggers: queue handler in the calling process, listener thread writing
+    to the console and optionally a rotating JSON-lines file.
+    Args:
+        level (str): Log level (DEBUG, INFO, WARNING, ...).
+        log_file (str, optional): JSON-lines log file (rotated at max_bytes, keeping `backups` old files).
+        json_console (bool): Write JSON records to the console too.
+        max_bytes (int): Size at which the log file is rotated.
+        backups (int): Rotated log files kept.
+        sample_rates (dict, optional): Stage ("catalog", "mcp", ...) or logger name -> fraction of
+            DEBUG/INFO records kept.
+    Returns:
+        QueueListener: Call .stop() at exit to flush the queue.
+    """
+    handlers = []
+    console = logging.StreamHandler()
+    console.setFormatter(JsonFormatter() if json_console else ConsoleFormatter())
+    handlers.append(console)
+    if log_file:
+        directory = os.path.dirname(log_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups,
+                                                            encoding="utf-8")
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    if sample_rates:
+        queue_handler.addFilter(SamplingFilter({
+            name if name.startswith(ROOT_LOGGER) else f"{ROOT_LOGGER}.{name}": rate
+            for name, rate in sample_rates.items()}))
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def setup_worker_logging(level=logging.INFO):
+    """
+    Logging for worker processes: the parent's queue has no listener there, so records go straight
+    to stderr.
+    Args:
+        level (int): The parent's log level.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(ConsoleFormatter())
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    root.propagate = False
+
+
+def parse_sample_rates(specs):
+    """Parses ["catalog=0.1", "mcp=0.05"] into {"catalog": 0.1, "mcp": 0.05}."""
+    rates = {}
+    for spec in specs or ():
+        name, _, rate = spec.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
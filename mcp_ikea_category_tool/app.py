@@ -1,15 +1,17 @@
 from fastapi import FastAPI, Query
 from pydantic import BaseModel
-import pandas as pd
-from fuzzywuzzy import process
-from typing import Optional
+from typing import Dict, List, Optional
+
+# Shared with the extractor: modules of the repository root, which must be on the import path (see README.md)
+from catalog_registry import get_catalog_registry
+from category_cache import get_category_cache, match_names
 
 app = FastAPI()
 
-# Load IKEA product data at startup
-df = pd.read_csv('../products/ikea_products.csv')
-product_dict = {str(row['name']).strip().lower(): str(row['category']).strip() for _, row in df.iterrows()}
-product_names = list(product_dict.keys())
+# Lookups are routed to the catalog of the requested store (products/catalogs.json). A store's catalog
+# is loaded from its compiled snapshot on the first lookup and unloaded when idle (see catalog_registry.py);
+# matches are cached in the category cache shared with the extractor (see category_cache.py)
+DEFAULT_STORE = "IKEA"
 
 class CategoryResponse(BaseModel):
     item_name: str
@@ -18,17 +20,74 @@ class CategoryResponse(BaseModel):
     score: Optional[int]
     found: bool
 
+def category_response(item_name: str, match, threshold: int) -> CategoryResponse:
+    if match and match[2] >= threshold:
+        return CategoryResponse(item_name=item_name, matched_name=match[0], category=match[1], score=match[2], found=True)
+    return CategoryResponse(item_name=item_name, matched_name=match[0] if match else None, category=None, score=match[2] if match else None, found=False)
+
+def match_categories(item_names: List[str], threshold: int, store: str = DEFAULT_STORE) -> Dict[str, CategoryResponse]:
+    names = [name for name in item_names if name]
+    # Stores without a catalog find nothing
+    catalog = get_catalog_registry().get(store) if names else None
+    matches = match_names(catalog, names, get_category_cache()) if catalog is not None else {}
+    return {name: category_response(name, matches.get(name), threshold) for name in item_names}
+
+def match_category(item_name: str, threshold: int, store: str = DEFAULT_STORE) -> CategoryResponse:
+    return match_categories([item_name], threshold, store)[item_name]
+
 @app.get("/lookup", response_model=CategoryResponse)
-def lookup_category(item_name: str = Query(..., description="Item name to look up"), threshold: int = 85):
-    if not item_name:
-        return CategoryResponse(item_name=item_name, matched_name=None, category=None, score=None, found=False)
-    match = process.extractOne(item_name.lower(), product_names)
-    if match and match[1] >= threshold:
-        matched_name = match[0]
-        category = product_dict[matched_name]
-        return CategoryResponse(item_name=item_name, matched_name=matched_name, category=category, score=match[1], found=True)
-    return CategoryResponse(item_name=item_name, matched_name=match[0] if match else None, category=None, score=match[1] if match else None, found=False)
+def lookup_category(item_name: str = Query(..., description="Item name to look up"), threshold: int = 85,
+                    store: str = Query(DEFAULT_STORE, description="Store whose catalog is searched")):
+    return match_category(item_name, threshold, store)
+
+class BatchLookupItem(BaseModel):
+    item_name: str
+    candidates: List[str] = []
+
+class BatchLookupRequest(BaseModel):
+    items: List[BatchLookupItem]
+    threshold: int = 85
+    store: str = DEFAULT_STORE
+
+class BatchLookupResult(BaseModel):
+    item_name: str
+    input: Optional[str]
+    matched_name: Optional[str]
+    category: Optional[str]
+    score: Optional[int]
+    found: bool
+
+class BatchLookupResponse(BaseModel):
+    results: List[BatchLookupResult]
+
+@app.post("/lookup/batch", response_model=BatchLookupResponse)
+def lookup_category_batch(request: BatchLookupRequest):
+    """
+    Looks up all candidates of all items (e.g. a whole receipt) in the catalog of the store in one request.
+    For each item, returns the found match with the highest score over its candidates
+    (the item name itself is used if no candidates are given).
+    Identical candidates across items are only matched once, and candidates matched before are
+    served from the category cache.
+    """
+    matches = match_categories([candidate for item in request.items for candidate in item.candidates or [item.item_name]],
+                               request.threshold, request.store)
+    results = []
+    for item in request.items:
+        best = BatchLookupResult(item_name=item.item_name, input=None, matched_name=None, category=None, score=None, found=False)
+        for candidate in item.candidates or [item.item_name]:
+            match = matches[candidate]
+            if match.found and match.score > (best.score if best.found else -1):
+                best = BatchLookupResult(item_name=item.item_name, input=candidate, matched_name=match.matched_name, category=match.category, score=match.score, found=True)
+        results.append(best)
+    return BatchLookupResponse(results=results)
+
+@app.get("/stats")
+def stats():
+    """Hits, misses and hit rate of the category cache since the service started, and the loaded catalogs."""
+    cache = get_category_cache()
+    return {"category_cache": cache.stats() if cache else None, "catalogs": get_catalog_registry().stats()}
 
 @app.get("/")
 def root():
-    return {"message": "IKEA Category MCP Tool. Use /lookup?item_name=..."}
+    return {"message": "Store Category MCP Tool. Use /lookup?item_name=...&store=IKEA or POST /lookup/batch",
+            "stores": get_catalog_registry().stores()}
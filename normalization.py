@@ -0,0 +1,241 @@
+# ---
+# NORMALIZATION RULES ---
+#
+# Post-processing rules for extracted receipts (store names, categories, dates), loaded once from
+# normalization_rules.json and compiled:
+#   - store aliases  -> one Aho-Corasick automaton; a store name is scanned once, whatever the
+#                       number of aliases (the alias listed first wins, as before)
+#   - dates          -> one regex for the accepted date formats (strptime-style directives, same
+#                       semantics as datetime.strptime without raising exceptions) and one regex
+#                       finding dates in OCR text (earlier patterns win)
+#   - categories     -> dict lookup plus singularization suffix rules
+#   - OCR profiles   -> Tesseract language and page segmentation mode, by default and per store
+#                       (used by ocr_engine.py)
+#
+# New stores, categories or date formats only need a change to the rules file. Its hash is part of
+# the extraction version, so the extraction cache is invalidated when the rules change.
+import calendar
+import functools
+import hashlib
+import json
+import os
+import re
+from datetime import date
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "normalization_rules.json")
+
+# Sub-patterns datetime.strptime uses for the supported directives
+_DIRECTIVES = {
+    "d": r"3[01]|[12]\d|0[1-9]|[1-9]| [1-9]",
+    "m": r"1[0-2]|0[1-9]|[1-9]",
+    "Y": r"\d\d\d\d",
+    "y": r"\d\d",
+}
+
+
+class AliasAutomaton:
+    """
+    Aho-Corasick automaton over a list of aliases.
+    Args:
+        aliases (list): Alias strings; their position is their priority (lower wins).
+    """
+
+    def __init__(self, aliases):
+        self._goto = [{}]
+        self._fail = [0]
+        # Best (lowest) alias priority ending at each state, including via failure links
+        self._best = [None]
+        for priority, alias in enumerate(aliases):
+            state = 0
+            for char in alias:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._best.append(None)
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            if self._best[state] is None:
+                self._best[state] = priority
+        # Breadth-first construction of the failure links
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, child in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0) if state else 0
+                inherited = self._best[self._fail[child]]
+                if inherited is not None and (self._best[child] is None or inherited < self._best[child]):
+                    self._best[child] = inherited
+                queue.append(child)
+
+    def best_match(self, text):
+        """Returns the priority of the best alias occurring in text, or None."""
+        goto, fail, best_at = self._goto, self._fail, self._best
+        state, best = 0, None
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            found = best_at[state]
+            if found is not None and (best is None or found < best):
+                best = found
+                if best == 0:
+                    break
+        return best
+
+
+def _compile_date_format(fmt, prefix):
+    """Translates a strptime-style format into a regex with named groups <prefix>_<directive>."""
+    pattern, i = "", 0
+    while i < len(fmt):
+        if fmt[i] == "%" and i + 1 < len(fmt):
+            directive = fmt[i + 1]
+            if directive not in _DIRECTIVES:
+                raise ValueError(f"Unsupported date directive %{directive} in {fmt!r}")
+            pattern += f"(?P<{prefix}_{directive}>{_DIRECTIVES[directive]})"
+            i += 2
+        else:
+            pattern += re.escape(fmt[i])
+            i += 1
+    return pattern
+
+
+class NormalizationRules:
+    """
+    Compiled post-processing rules.
+    Args:
+        config (dict): Rules (see normalization_rules.json).
+    """
+
+    def __init__(self, config):
+        self.version = hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        self._stores, aliases = [], []
+        for store, store_aliases in config.get("stores", {}).items():
+            for alias in store_aliases:
+                aliases.append(alias.lower())
+                self._stores.append(store)
+        self._store_automaton = AliasAutomaton(aliases)
+
+        categories = config.get("categories", {})
+        self._category_map = {k.lower().strip(): v for k, v in categories.get("map", {}).items()}
+        self._suffixes = [(rule["suffix"].lower(), rule.get("replace", ""), (rule.get("unless") or "").lower())
+                          for rule in categories.get("singular_suffixes", [])]
+        self.default_category = categories.get("default", "General")
+
+        dates = config.get("dates", {})
+        self._date_formats = dates.get("valid_formats", [])
+        self._format_patterns = [re.compile(_compile_date_format(fmt, f"f{i}"))
+                                 for i, fmt in enumerate(self._date_formats)]
+        self._date_grammar = re.compile("|".join(f"(?P<f{i}>{_compile_date_format(fmt, f'f{i}')})"
+                                                 for i, fmt in enumerate(self._date_formats)) or r"(?!)")
+        # Zero-width lookahead, so overlapping candidates of lower-priority patterns are all seen
+        text_patterns = dates.get("text_patterns", [])
+        self._text_date_finder = re.compile(
+            "(?=" + "|".join(f"(?P<p{i}>{pattern})" for i, pattern in enumerate(text_patterns)) + ")"
+            if text_patterns else r"(?!)")
+        self._n_text_patterns = len(text_patterns)
+
+        ocr = config.get("ocr", {})
+        self._ocr_default = dict({"lang": "eng", "psm": 3}, **ocr.get("default", {}))
+        self._ocr_stores = {store: dict(self._ocr_default, **profile) for store, profile in ocr.get("stores", {}).items()}
+        self.has_store_ocr_profiles = bool(self._ocr_stores)
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_RULES_PATH):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def canonical_store(self, store):
+        """Returns the canonical name of a store (e.g. "IKEA" for "IKEA Deutschland GmbH & Co. KG"), or None."""
+        key = store.lower().replace(",", "").replace("  ", " ").strip()
+        priority = self._store_automaton.best_match(key)
+        return self._stores[priority] if priority is not None else None
+
+    def ocr_profile(self, store=None):
+        """Returns the OCR settings (lang, psm) for a canonical store name (the default ones for None or unknown stores)."""
+        return dict(self._ocr_stores.get(store, self._ocr_default))
+
+    def normalize_category(self, category):
+        """Maps known categories, singularizes the rest; empty categories become the default category."""
+        mapped = self._category_map.get(category.lower().strip())
+        if mapped is None:
+            mapped = category
+            lowered = category.lower()
+            for suffix, replace, unless in self._suffixes:
+                if lowered.endswith(suffix) and not (unless and lowered.endswith(unless)):
+                    mapped = category[:len(category) - len(suffix)] + replace
+                    break
+        return mapped or self.default_category
+
+    def _parse_date(self, match, prefix):
+        groups = {key.rpartition("_")[2]: value for key, value in match.groupdict().items()
+                  if value is not None and key.startswith(prefix + "_")}
+        year = int(groups["Y"]) if "Y" in groups else int(groups.get("y", "1900"))
+        if "y" in groups:
+            # strptime's pivot: 69-99 -> 1900s, 00-68 -> 2000s
+            year += 1900 if year >= 69 else 2000
+        month, day = int(groups.get("m", 1)), int(groups.get("d", 1))
+        if year < 1 or not 1 <= day <= calendar.monthrange(year, month)[1]:
+            return None
+        return date(year, month, day)
+
+    def parse_date(self, date_str, today=None):
+        """Parses a date string in one of the accepted formats; None if it is none of them or in the future."""
+        if not isinstance(date_str, str):
+            return None
+        today = today or date.today()
+        match = self._date_grammar.fullmatch(date_str)
+        if match is None:
+            return None
+        first = int(match.lastgroup[1:])
+        parsed = self._parse_date(match, match.lastgroup)
+        if parsed is not None and parsed <= today:
+            return parsed
+        # Rare: the first matching format gave an invalid or future date; try the remaining ones
+        for i in range(first + 1, len(self._format_patterns)):
+            match = self._format_patterns[i].fullmatch(date_str)
+            if match:
+                parsed = self._parse_date(match, f"f{i}")
+                if parsed is not None and parsed <= today:
+                    return parsed
+        return None
+
+    def is_valid_date(self, date_str, today=None):
+        """Checks if a date string is in one of the accepted formats and not in the future."""
+        return self.parse_date(date_str, today) is not None
+
+    def find_date(self, text):
+        """Returns the first date string in text (earlier patterns take precedence), or None."""
+        best_pattern, best_value = self._n_text_patterns, None
+        for match in self._text_date_finder.finditer(text or ""):
+            pattern = int(match.lastgroup[1:])
+            if pattern < best_pattern:
+                best_pattern, best_value = pattern, match.group(match.lastgroup)
+                if pattern == 0:
+                    break
+        return best_value
+
+    def normalize_receipt(self, result, ocr_text):
+        """
+        Normalizes the date and store of a parsed receipt in place (categories: see normalize_category).
+        Args:
+            result (dict): Receipt info returned by the LLM.
+            ocr_text (str): OCR text of the image (date fallback).
+        Returns:
+            dict: The same receipt info.
+        """
+        date_str = result.get("date")
+        if not date_str or not self.is_valid_date(date_str):
+            # Try to extract date from OCR text
+            result["date"] = self.find_date(ocr_text)
+        store = self.canonical_store(result.get("store", ""))
+        if store:
+            result["store"] = store
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def get_rules(path=DEFAULT_RULES_PATH):
+    """Returns the compiled rules of a rules file (loaded once per process)."""
+    return NormalizationRules.from_file(path)
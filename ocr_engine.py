@@ -0,0 +1,256 @@
+# ---
+# OCR ENGINE ---
+#
+# One OCR entry point for the pipeline (ocr_receipt), on top of interchangeable engines:
+#   - "tesserocr": the Tesseract library loaded in-process (optional tesserocr package). Every OCR
+#                  worker process keeps one initialized API per thread and language/PSM, so the
+#                  language model is loaded once per worker instead of once per image.
+#   - "tesseract": the tesseract command line through pytesseract (one short-lived process per call).
+#   - "auto":      tesserocr if it is installed, else the command line.
+# The OCR stage already runs in a pool of long-lived worker processes (see pipeline.py); the engine
+# of each process is created on first use and kept for the whole run.
+#
+# Very tall receipts are OCR'd as overlapping horizontal strips in parallel threads and stitched
+# back in order. Each strip only keeps the words whose vertical center lies in its own part of the
+# image; the overlap guarantees that every text line lies completely within the strip that keeps it.
+# The stitched result has the layout of pytesseract.image_to_data output, so the OCR text and the
+# confidence stats (see ocr_routing.py) are built exactly as for a single page.
+#
+# Language and page segmentation mode come from the "ocr" section of the normalization rules: a
+# default profile and optional per-store profiles. If store profiles are configured, the store is
+# detected from the header of the default OCR pass, and the image is OCR'd again only if its store
+# has a different profile.
+import functools
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("receipts.ocr")
+
+# Columns of Tesseract's TSV output (the keys of pytesseract.image_to_data(..., output_type=Output.DICT))
+TSV_COLUMNS = ["level", "page_num", "block_num", "par_num", "line_num", "word_num", "left", "top", "width",
+               "height", "conf", "text"]
+
+# block_num offset per strip, so blocks of different strips never merge into one paragraph
+STRIP_BLOCK_OFFSET = 1000
+
+
+def tsv_to_dict(tsv):
+    """
+    Parses Tesseract TSV rows (without header) like pytesseract's Output.DICT: numeric columns as int,
+    except the word confidence, which keeps its fractional part (float).
+    Args:
+        tsv (str): TSV text, one row per line.
+    Returns:
+        dict: Column name -> list of values.
+    """
+    data = {column: [] for column in TSV_COLUMNS}
+    for row in tsv.splitlines():
+        if not row:
+            continue
+        cells = row.split("\t")
+        cells += [""] * (len(TSV_COLUMNS) - len(cells))
+        for column, value in zip(TSV_COLUMNS[:-1], cells):
+            data[column].append(float(value) if column == "conf" else int(float(value)))
+        data["text"].append("\t".join(cells[len(TSV_COLUMNS) - 1:]))
+    return data
+
+
+class TesseractCliEngine:
+    """Runs the tesseract command line through pytesseract (one process per call)."""
+
+    name = "tesseract"
+
+    def image_to_data(self, img, lang="eng", psm=3):
+        import pytesseract
+        return pytesseract.image_to_data(img, lang=lang, config=f"--psm {psm}",
+                                         output_type=pytesseract.Output.DICT)
+
+
+class TesserocrEngine:
+    """Runs Tesseract in-process through tesserocr; one initialized API per thread and (lang, psm)."""
+
+    name = "tesserocr"
+
+    def __init__(self):
+        import tesserocr
+        if not tesserocr.get_languages()[1]:
+            raise RuntimeError("tesserocr found no Tesseract language data (set TESSDATA_PREFIX)")
+        self._tesserocr = tesserocr
+        self._local = threading.local()
+
+    def _api(self, lang, psm):
+        apis = getattr(self._local, "apis", None)
+        if apis is None:
+            apis = self._local.apis = {}
+        api = apis.get((lang, psm))
+        if api is None:
+            log.debug("Initializing Tesseract (lang=%s, psm=%d) in this worker", lang, psm)
+            api = apis[(lang, psm)] = self._tesserocr.PyTessBaseAPI(lang=lang, psm=self._tesserocr.PSM(psm))
+        return api
+
+    def image_to_data(self, img, lang="eng", psm=3):
+        api = self._api(lang, psm)
+        api.SetImage(img)
+        try:
+            return tsv_to_dict(api.GetTSVText(0))
+        finally:
+            api.Clear()
+
+
+ENGINES = {"tesseract": TesseractCliEngine, "tesserocr": TesserocrEngine}
+
+
+@functools.lru_cache(maxsize=None)
+def get_ocr_engine(name="auto"):
+    """
+    Returns the OCR engine of this process (created once per process and name).
+    Args:
+        name (str): "auto", "tesserocr" or "tesseract".
+    Returns:
+        TesseractCliEngine or TesserocrEngine: The engine.
+    """
+    # Parallelism comes from the worker pool and the strips; Tesseract's own OpenMP threads would
+    # oversubscribe the CPUs. Must be set before the library is loaded.
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    if name == "auto":
+        try:
+            engine = TesserocrEngine()
+        except (ImportError, RuntimeError) as e:
+            log.debug("tesserocr not usable (%s); using the tesseract command line", e)
+            engine = TesseractCliEngine()
+    elif name in ENGINES:
+        engine = ENGINES[name]()
+    else:
+        raise ValueError(f"Unknown OCR engine {name!r} (expected auto, {', '.join(ENGINES)})")
+    log.debug("OCR engine: %s", engine.name)
+    return engine
+
+
+def split_strips(width, height, max_aspect=3.0, overlap=80):
+    """
+    Splits a tall image into overlapping horizontal strips of about its width in height.
+    Args:
+        width (int): Image width.
+        height (int): Image height.
+        max_aspect (float): Images up to max_aspect times as tall as wide are not split (0 never splits).
+        overlap (int): Pixels a strip extends into its neighbours (more than the tallest text line).
+    Returns:
+        list: (top, bottom, own_top, own_bottom) per strip, top to bottom; the strip image spans
+            top..bottom, its words are kept if their center lies in own_top..own_bottom.
+    """
+    if not max_aspect or width <= 0 or height <= max_aspect * width:
+        return [(0, height, 0, height)]
+    count = math.ceil(height / width)
+    bounds = [round(height * i / count) for i in range(count + 1)]
+    return [(max(0, own_top - overlap), min(height, own_bottom + overlap), own_top, own_bottom)
+            for own_top, own_bottom in zip(bounds, bounds[1:])]
+
+
+def stitch_strips(strip_results):
+    """
+    Merges the OCR data of strips into one image_to_data result in page coordinates.
+    Args:
+        strip_results (list): (strip, data) pairs in top-to-bottom order (see split_strips).
+    Returns:
+        dict: Column name -> list of values, like pytesseract.image_to_data(..., output_type=Output.DICT).
+    """
+    merged = {column: [] for column in TSV_COLUMNS}
+    for index, ((top, _, own_top, own_bottom), data) in enumerate(strip_results):
+        for i in range(len(data.get("text", []))):
+            center = top + data["top"][i] + data["height"][i] / 2
+            if not own_top <= center < own_bottom:
+                continue
+            for column in TSV_COLUMNS:
+                value = data[column][i]
+                if column == "top":
+                    value += top
+                elif column == "block_num":
+                    value += index * STRIP_BLOCK_OFFSET
+                merged[column].append(value)
+    return merged
+
+
+_strip_pool = {"executor": None, "workers": 0}
+_strip_pool_lock = threading.Lock()
+
+
+def _strip_executor(workers):
+    """Thread pool of this process for strip OCR (resized if the worker count changes)."""
+    with _strip_pool_lock:
+        if _strip_pool["workers"] != workers:
+            if _strip_pool["executor"]:
+                _strip_pool["executor"].shutdown(wait=False)
+            _strip_pool["executor"] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-strip")
+            _strip_pool["workers"] = workers
+        return _strip_pool["executor"]
+
+
+def ocr_image(img, engine, lang="eng", psm=3, strip_workers=4, max_aspect=3.0, overlap=80):
+    """
+    OCRs an image, as parallel strips if it is very tall.
+    Args:
+        img (PIL.Image.Image): Preprocessed image.
+        engine: OCR engine (see get_ocr_engine).
+        lang (str): Tesseract language(s), e.g. "eng" or "deu+eng".
+        psm (int): Tesseract page segmentation mode.
+        strip_workers (int): Strips OCR'd concurrently.
+        max_aspect (float): Height/width ratio above which the image is split (0 never splits).
+        overlap (int): Strip overlap in pixels.
+    Returns:
+        tuple: (data, strips): image_to_data-style dict and the number of strips OCR'd.
+    """
+    strips = split_strips(img.width, img.height, max_aspect=max_aspect, overlap=overlap)
+    if len(strips) == 1:
+        return engine.image_to_data(img, lang=lang, psm=psm), 1
+
+    def ocr_strip(strip):
+        return strip, engine.image_to_data(img.crop((0, strip[0], img.width, strip[1])), lang=lang, psm=psm)
+
+    if strip_workers > 1:
+        strip_results = list(_strip_executor(strip_workers).map(ocr_strip, strips))
+    else:
+        strip_results = [ocr_strip(strip) for strip in strips]
+    return stitch_strips(strip_results), len(strips)
+
+
+def detect_store(text, rules, header_lines=5):
+    """Returns the canonical store named in the first non-empty lines of OCR text, or None."""
+    lines = [line for line in text.splitlines() if line.strip()][:header_lines]
+    return rules.canonical_store(" ".join(lines)) if lines else None
+
+
+def ocr_receipt(img, engine="auto", strip_workers=4, max_aspect=3.0, overlap=80, rules=None):
+    """
+    OCRs a receipt with the OCR profile of its store.
+    Args:
+        img (PIL.Image.Image): Preprocessed receipt image.
+        engine (str): OCR engine name (see get_ocr_engine).
+        strip_workers (int): Strips of a tall receipt OCR'd concurrently.
+        max_aspect (float): Height/width ratio above which a receipt is OCR'd in strips (0 never splits).
+        overlap (int): Strip overlap in pixels.
+        rules (NormalizationRules, optional): Rules with the OCR profiles (default: normalization_rules.json).
+    Returns:
+        tuple: (data, info): image_to_data-style dict, and a dict with ocr_engine, ocr_strips, ocr_store
+            (store detected for the profile choice, or None) and ocr_passes.
+    """
+    from ocr_routing import ocr_text_from_data
+    if rules is None:
+        from normalization import get_rules
+        rules = get_rules()
+    ocr = get_ocr_engine(engine)
+    options = {"strip_workers": strip_workers, "max_aspect": max_aspect, "overlap": overlap}
+    profile = rules.ocr_profile()
+    data, strips = ocr_image(img, ocr, **profile, **options)
+    info = {"ocr_engine": ocr.name, "ocr_strips": strips, "ocr_store": None, "ocr_passes": 1}
+    if rules.has_store_ocr_profiles:
+        store = detect_store(ocr_text_from_data(data), rules)
+        store_profile = rules.ocr_profile(store)
+        info["ocr_store"] = store
+        if store_profile != profile:
+            log.debug("OCR again with the %s profile %s", store, store_profile)
+            data, strips = ocr_image(img, ocr, **store_profile, **options)
+            info.update(ocr_strips=strips, ocr_passes=2)
+    return data, info
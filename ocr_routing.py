@@ -0,0 +1,134 @@
+# ---
+# OCR CONFIDENCE ROUTING ---
+#
+# Clean thermal-printer receipts OCR almost perfectly; for those, the OCR text alone is enough for
+# the LLM and the image (thousands of vision tokens) can be left out. The router looks at
+# Tesseract's per-word confidences:
+#   - "text":   mean word confidence >= min_confidence and enough words -> text-only LLM request
+#   - "vision": everything else -> image + OCR text request (as before)
+# A text-only result without items is escalated to the vision request. Escalated receipts pay for
+# both requests and are reported as their own route ("escalated"), not mixed into the vision numbers.
+import logging
+import threading
+
+log = logging.getLogger("receipts.routing")
+
+ROUTE_TEXT = "text"
+ROUTE_VISION = "vision"
+ROUTE_ESCALATED = "escalated"
+ROUTES = (ROUTE_TEXT, ROUTE_VISION, ROUTE_ESCALATED)
+
+
+def ocr_text_from_data(data):
+    """
+    Rebuilds the OCR text from pytesseract.image_to_data output the way Tesseract's text renderer
+    (image_to_string) lays it out: words joined by spaces, a newline after every line and another one
+    after every paragraph. Only the trailing page separator (form feed) is left out.
+    Args:
+        data (dict): pytesseract.image_to_data(..., output_type=Output.DICT) result.
+    Returns:
+        str: OCR text.
+    """
+    paragraphs = []
+    lines = {}
+    for i, word in enumerate(data.get('text', [])):
+        word = (word or '').strip()
+        if not word:
+            continue
+        paragraph = (data['block_num'][i], data['par_num'][i])
+        line = paragraph + (data['line_num'][i],)
+        if paragraph not in lines:
+            lines[paragraph] = {}
+            paragraphs.append(paragraph)
+        lines[paragraph].setdefault(line, []).append(word)
+    return "".join("".join(" ".join(words) + "\n" for words in lines[paragraph].values()) + "\n"
+                   for paragraph in paragraphs)
+
+
+def ocr_confidence(data):
+    """
+    Summarizes the per-word confidences of pytesseract.image_to_data output.
+    Returns:
+        dict: ocr_words (recognized words), ocr_confidence (mean word confidence 0-100, 0 if no words),
+            ocr_low_confidence_words (words below 60).
+    """
+    confidences = [float(conf) for word, conf in zip(data.get('text', []), data.get('conf', []))
+                   if (word or '').strip() and float(conf) >= 0]
+    if not confidences:
+        return {"ocr_words": 0, "ocr_confidence": 0.0, "ocr_low_confidence_words": 0}
+    return {
+        "ocr_words": len(confidences),
+        "ocr_confidence": sum(confidences) / len(confidences),
+        "ocr_low_confidence_words": sum(1 for c in confidences if c < 60),
+    }
+
+
+def choose_route(stats, min_confidence=85, min_words=8):
+    """
+    Picks the extraction path for a receipt from its OCR confidence stats.
+    Args:
+        stats (dict): Image stats with ocr_confidence and ocr_words.
+        min_confidence (float): Min mean word confidence for the text-only path (0 disables routing).
+        min_words (int): Min recognized words for the text-only path.
+    Returns:
+        str: ROUTE_TEXT or ROUTE_VISION.
+    """
+    if not min_confidence:
+        return ROUTE_VISION
+    if stats.get("ocr_words", 0) >= min_words and stats.get("ocr_confidence", 0) >= min_confidence:
+        return ROUTE_TEXT
+    return ROUTE_VISION
+
+
+class RoutingReport:
+    """Thread-safe per-run summary of the text/vision split with latency and token savings."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.receipts = []
+
+    def add(self, stats):
+        with self._lock:
+            self.receipts.append(stats)
+
+    def summary(self):
+        with self._lock:
+            receipts = list(self.receipts)
+        if not receipts:
+            return {}
+        by_route = {route: [s for s in receipts if s.get("route") == route] for route in ROUTES}
+        text, vision, escalated = (by_route[route] for route in ROUTES)
+        mean = lambda items, key: (sum(s.get(key) or 0 for s in items) / len(items)) if items else None
+        summary = {
+            "receipts": len(receipts),
+            "text_only": len(text),
+            "vision": len(vision),
+            "escalated": len(escalated),
+            # Tokens the images of text-only receipts would have cost
+            "est_image_tokens_saved": sum(s.get("est_image_tokens_after") or 0 for s in text),
+        }
+        for route in ROUTES:
+            summary[f"avg_llm_seconds_{route}"] = mean(by_route[route], "llm_seconds")
+            summary[f"avg_input_tokens_{route}"] = mean(by_route[route], "input_tokens")
+        if text and vision:
+            # Time the text-only receipts saved, minus the wasted text-only requests of escalated ones
+            summary["est_seconds_saved"] = len(text) * (
+                summary["avg_llm_seconds_vision"] - summary["avg_llm_seconds_text"])
+            if escalated:
+                summary["est_seconds_saved"] -= len(escalated) * (
+                    summary["avg_llm_seconds_escalated"] - summary["avg_llm_seconds_vision"])
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        line = (f"Routing: {summary['text_only']} text-only, {summary['vision']} vision, "
+                f"{summary['escalated']} escalated, est. image tokens saved {summary['est_image_tokens_saved']}")
+        for route in ROUTES:
+            if summary[f"avg_llm_seconds_{route}"] is not None:
+                line += (f", {route}: avg {summary[f'avg_llm_seconds_{route}']:.2f}s / "
+                         f"{summary[f'avg_input_tokens_{route}']:.0f} input tokens")
+        if "est_seconds_saved" in summary:
+            line += f", est. LLM time saved {summary['est_seconds_saved']:.1f}s"
+        log.info(line, extra={"routing": summary})
@@ -0,0 +1,215 @@
+# ---
+# BOUNDED WORKER PIPELINE ---
+#
+# Runs items through a sequence of stages (e.g. download -> enhance/OCR -> LLM), each with its own
+# worker count and bounded input queue. Stages overlap: while one receipt waits for the LLM,
+# the next ones are already being downloaded and OCR'd. A full queue blocks the upstream stage
+# (backpressure), so memory stays bounded no matter how many items are fed in.
+#
+# Results are returned in input order, one per item, so they always map back to their source.
+# Pipeline keeps the stages running for items submitted over time (the extraction service, see
+# extraction_service.py); run_pipeline runs one list of items through them.
+import importlib
+import logging
+import multiprocessing
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from logging_setup import ROOT_LOGGER, setup_worker_logging
+
+log = logging.getLogger("receipts.pipeline")
+
+# source: the input item, value: output of the last stage, error: exception of the failing stage (or None)
+PipelineResult = namedtuple("PipelineResult", ["source", "value", "error", "stage"])
+
+# Returned by a stage to finish an item early: the remaining stages are skipped and value is its result
+Finished = namedtuple("Finished", ["value"])
+
+_DONE = object()
+
+
+class PipelineStage:
+    """
+    One pipeline stage.
+    Args:
+        name (str): Stage name (used in warnings and results).
+        func (callable): Function applied to the output of the previous stage.
+        workers (int): Number of items processed concurrently in this stage.
+        queue_size (int, optional): Max items waiting for this stage (default: 2 * workers).
+        use_processes (bool): Run func in a process pool (for CPU-bound work); func and
+            its argument/return values must be picklable.
+        preload (list, optional): Modules the worker processes import before their first item
+            (func's own module always is).
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=None, use_processes=False, preload=()):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.queue_size = queue_size or 2 * self.workers
+        self.use_processes = use_processes
+        self.preload = list(preload)
+
+
+class Pipeline:
+    """
+    Long-running pipeline: stage workers (and process pools) start once, items are submitted one at
+    a time and each result is handed to the item's callback by the worker that finished it.
+    Args:
+        stages (list): List of PipelineStage.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self._queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+        self._executors = [_start_process_pool(stage) if stage.use_processes else None for stage in stages]
+        self._pool_lock = threading.Lock()
+        self._threads = []
+        for position, stage in enumerate(stages):
+            stage_threads = [
+                threading.Thread(target=self._worker, args=(position,), name=f"{stage.name}-{i}", daemon=True)
+                for i in range(stage.workers)
+            ]
+            for t in stage_threads:
+                t.start()
+            self._threads.append(stage_threads)
+
+    def submit(self, item, callback, key=None):
+        """
+        Queues an item; blocks while the first stage is saturated (backpressure).
+        Args:
+            item: Input of the first stage.
+            callback (callable): Called as callback(key, PipelineResult) when the item finished or failed.
+            key (optional): Identifies the item in the callback and in warnings.
+        """
+        self._queues[0].put((key, item, item, callback))
+
+    def pending(self):
+        """Items waiting in the stage queues."""
+        return sum(q.qsize() for q in self._queues)
+
+    def _run(self, position, value):
+        stage = self.stages[position]
+        executor = self._executors[position]
+        if executor is None:
+            return stage.func(value)
+        try:
+            return executor.submit(stage.func, value).result()
+        except BrokenProcessPool:
+            # A worker process died (e.g. killed for memory): replace the pool once, then retry the item
+            with self._pool_lock:
+                if self._executors[position] is executor:
+                    log.warning("Process pool of stage '%s' broke; starting a new one", stage.name)
+                    executor.shutdown(wait=False)
+                    self._executors[position] = _start_process_pool(stage)
+                executor = self._executors[position]
+            return executor.submit(stage.func, value).result()
+
+    def _worker(self, position):
+        stage = self.stages[position]
+        in_queue = self._queues[position]
+        while True:
+            entry = in_queue.get()
+            if entry is _DONE:
+                break
+            key, source, value, callback = entry
+            try:
+                value = self._run(position, value)
+            except BaseException as e:
+                # Also BaseException (e.g. SystemExit from a library): the worker must stay alive, or the
+                # item never reports back and close() blocks on a stage without workers
+                log.warning("Pipeline stage '%s' failed for item %s: %s", stage.name, key, str(e) or type(e).__name__,
+                            extra={"stage": stage.name, "item": key})
+                _deliver(callback, key, PipelineResult(source, None, e, stage.name))
+                continue
+            if isinstance(value, Finished):
+                _deliver(callback, key, PipelineResult(source, value.value, None, stage.name))
+            elif position + 1 < len(self.stages):
+                self._queues[position + 1].put((key, source, value, callback))
+            else:
+                _deliver(callback, key, PipelineResult(source, value, None, stage.name))
+
+    def close(self):
+        """Finishes the queued items, then stops the workers and process pools."""
+        try:
+            # Shut stages down in order: once all workers of a stage exit, nothing more reaches the next one
+            for position, stage_threads in enumerate(self._threads):
+                for _ in stage_threads:
+                    self._queues[position].put(_DONE)
+                for t in stage_threads:
+                    t.join()
+        finally:
+            for executor in self._executors:
+                if executor is not None:
+                    executor.shutdown()
+
+
+def run_pipeline(items, stages, on_result=None):
+    """
+    Runs all items through the stages concurrently and returns one PipelineResult per item, in input order.
+    An item whose stage raises an exception skips the remaining stages; the exception is kept in its result.
+    Args:
+        items (list): Input items (e.g. Drive file metadata dicts).
+        stages (list): List of PipelineStage.
+        on_result (callable, optional): Called with each PipelineResult as soon as its item finished
+            (from the worker thread that finished it, so in completion order).
+    Returns:
+        list: PipelineResult for each item, in the same order as items.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    def finish(index, result):
+        results[index] = result
+        if on_result is not None:
+            try:
+                on_result(result)
+            except Exception as e:
+                log.warning("Result callback failed for item %s: %s", index, e)
+
+    pipeline = Pipeline(stages)
+    try:
+        for index, item in enumerate(items):
+            pipeline.submit(item, finish, key=index)
+    finally:
+        pipeline.close()
+    return results
+
+
+def _deliver(callback, key, result):
+    try:
+        callback(key, result)
+    except Exception as e:
+        log.warning("Result callback failed for item %s: %s", key, e)
+
+
+def _start_process_pool(stage):
+    # Pools are started (and replaced after a crash) while logging, scheduler and stage threads run;
+    # forking then could copy a lock some thread holds, so workers come from a forkserver (spawned
+    # where there is none) and import what the stage needs themselves
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    func = stage.func
+    while isinstance(func, partial):
+        func = func.func
+    module = getattr(func, "__module__", None)
+    modules = ([module] if module and module != "__main__" else []) + stage.preload
+    executor = ProcessPoolExecutor(max_workers=stage.workers, mp_context=multiprocessing.get_context(start_method),
+                                   initializer=_init_worker,
+                                   initargs=(logging.getLogger(ROOT_LOGGER).getEffectiveLevel(), modules))
+    # Workers are spawned on demand; submitting one task per worker starts all of them now
+    for future in [executor.submit(int) for _ in range(stage.workers)]:
+        future.result()
+    return executor
+
+
+def _init_worker(level, modules):
+    # No listener for the parent's log queue here: records go to stderr directly
+    setup_worker_logging(level)
+    for module in modules:
+        importlib.import_module(module)
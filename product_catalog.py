@@ -0,0 +1,248 @@
+# ---
+# COMPILED PRODUCT CATALOG ---
+#
+# A product sheet (e.g. products/ikea_products.csv) is compiled once into a snapshot directory
+# (cache/catalog/<csv name>-<path hash>/): the saved ProductMatchIndex arrays plus one category code per product
+# and the distinct category names. Loading a snapshot needs neither pandas nor the index build; the
+# arrays are memory-mapped, so the extractor, its worker processes and the category service share
+# them through the page cache. The catalogs of the stores are managed by catalog_registry.py.
+#
+# A snapshot is valid as long as the CSV's mtime and size match the ones recorded at compile time.
+# If they differ, the CSV's SHA-256 decides: same content (e.g. a fresh checkout) only refreshes the
+# recorded mtime, changed content recompiles the snapshot. Snapshots are written to a temporary
+# directory and swapped in with a rename, so a concurrent reader never sees a half-written one.
+#
+# The extractor and the category service often start together and find the same stale snapshot.
+# A lock file next to the snapshot directory (<directory>.lock, flock) serializes them: compiling
+# holds it exclusively, loading holds it shared, so the swap never happens while a reader opens the
+# files. A process that waited for another one's compile finds the snapshot up to date and uses it.
+import csv
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from product_matcher import ProductMatchIndex
+
+FORMAT_VERSION = 2
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CSV_PATH = os.path.join(REPO_DIR, "products", "ikea_products.csv")
+DEFAULT_SNAPSHOT_DIR = os.path.join(REPO_DIR, "cache", "catalog")
+
+log = logging.getLogger("receipts.catalog")
+
+
+class ProductCatalog:
+    """
+    Product names with their categories and the fuzzy match index over the names.
+    Args:
+        index (ProductMatchIndex): Index over the (lowercased) product names.
+        category_codes (numpy.ndarray): Position in category_names of each product's category, in index order.
+        category_names (list): Distinct category names.
+        version (str, optional): Identifies the catalog contents (prefix of the CSV's SHA-256).
+        name (str, optional): Catalog name (the store), keys its entries in the category cache.
+    """
+
+    def __init__(self, index, category_codes, category_names, version=None, name=None):
+        self.index = index
+        self.category_codes = category_codes
+        self.category_names = category_names
+        self.version = version
+        self.name = name
+
+    def __len__(self):
+        return len(self.index)
+
+    def category_of(self, row):
+        """Returns the category of the product at a position of the index."""
+        return self.category_names[int(self.category_codes[row])]
+
+    def match(self, item_name):
+        """
+        Fuzzy-matches an item name against the product names.
+        Returns:
+            tuple or None: (matched_name, category, score), or None if the catalog is empty.
+        """
+        match = self.index.extract_one_row(item_name.lower())
+        if match is None:
+            return None
+        return self.index.names[match[0]], self.category_of(match[0]), match[1]
+
+
+def read_products_csv(csv_path):
+    """
+    Reads the product sheet with the csv module. Assumes columns: 'name', 'category'.
+    Returns:
+        dict: Lowercased product name -> category (the last row wins for duplicate names).
+    """
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        return {str(row["name"]).strip().lower(): str(row["category"]).strip() for row in csv.DictReader(f)}
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def snapshot_path(csv_path, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    Returns the snapshot directory of a product sheet: its name plus a hash of its absolute path,
+    so sheets with the same file name in different directories do not share a snapshot.
+    """
+    path_hash = hashlib.sha256(os.path.abspath(csv_path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(snapshot_dir, f"{os.path.splitext(os.path.basename(csv_path))[0]}-{path_hash}")
+
+
+def _write_meta(directory, meta):
+    tmp_path = os.path.join(directory, "meta.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, "meta.json"))
+
+
+@contextmanager
+def _snapshot_lock(directory, exclusive):
+    """Holds the lock file of a snapshot directory: exclusively to compile it, shared to read it."""
+    os.makedirs(os.path.dirname(os.path.abspath(directory)), exist_ok=True)
+    # One open file per holder: flock locks of separate opens also exclude each other within a process
+    with open(f"{directory}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def compile_catalog(csv_path, directory):
+    """
+    Compiles a product sheet into a snapshot directory (replacing an existing snapshot).
+    Args:
+        csv_path (str): Product sheet CSV.
+        directory (str): Snapshot directory.
+    Returns:
+        dict: Snapshot metadata.
+    """
+    with _snapshot_lock(directory, exclusive=True):
+        return _compile(csv_path, directory)
+
+
+def _compile(csv_path, directory):
+    start = time.perf_counter()
+    stat = os.stat(csv_path)
+    sha256 = file_sha256(csv_path)
+    product_dict = read_products_csv(csv_path)
+    index = ProductMatchIndex(product_dict.keys())
+
+    tmp_dir = f"{directory}.tmp-{os.getpid()}-{threading.get_ident()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    index.save(tmp_dir)
+    category_names = list(dict.fromkeys(product_dict.values()))
+    codes = {category: i for i, category in enumerate(category_names)}
+    np.save(os.path.join(tmp_dir, "category_codes.npy"),
+            np.array([codes[category] for category in product_dict.values()], dtype=np.int32))
+    with open(os.path.join(tmp_dir, "categories.json"), "w", encoding="utf-8") as f:
+        json.dump(category_names, f, ensure_ascii=False)
+    meta = {"format": FORMAT_VERSION, "source": os.path.abspath(csv_path), "source_mtime_ns": stat.st_mtime_ns,
+            "source_size": stat.st_size, "source_sha256": sha256, "products": len(product_dict)}
+    _write_meta(tmp_dir, meta)
+
+    # Swap the directories; readers holding the old arrays keep their (unlinked) mappings
+    old_dir = f"{directory}.old-{os.getpid()}-{threading.get_ident()}"
+    if os.path.exists(directory):
+        os.replace(directory, old_dir)
+    os.replace(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    log.info("Compiled product catalog %s (%d products) in %.2fs", directory, len(product_dict),
+             time.perf_counter() - start)
+    return meta
+
+
+def _read_meta(directory):
+    try:
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _current_meta(csv_path, directory):
+    """Returns the metadata of the snapshot if it is up to date (by the CSV's mtime and size), else None."""
+    stat = os.stat(csv_path)
+    meta = _read_meta(directory)
+    if (meta and meta.get("format") == FORMAT_VERSION
+            and (meta["source_mtime_ns"], meta["source_size"]) == (stat.st_mtime_ns, stat.st_size)):
+        return meta
+    return None
+
+
+def ensure_snapshot(csv_path, directory):
+    """
+    Returns the metadata of an up-to-date snapshot of csv_path, compiling it if it is missing or stale.
+    """
+    meta = _current_meta(csv_path, directory)
+    if meta is not None:
+        return meta
+    with _snapshot_lock(directory, exclusive=True):
+        # Checked again: another process may have compiled it while this one waited for the lock
+        meta = _current_meta(csv_path, directory)
+        if meta is not None:
+            return meta
+        meta = _read_meta(directory)
+        if meta is None or meta.get("format") != FORMAT_VERSION:
+            return _compile(csv_path, directory)
+        stat = os.stat(csv_path)
+        if meta["source_size"] == stat.st_size and meta["source_sha256"] == file_sha256(csv_path):
+            meta.update(source_mtime_ns=stat.st_mtime_ns)
+            _write_meta(directory, meta)
+            log.debug("Product sheet %s touched but unchanged; snapshot kept", csv_path)
+            return meta
+        log.info("Product sheet %s changed; recompiling the catalog snapshot", csv_path)
+        return _compile(csv_path, directory)
+
+
+def source_version(csv_path, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    Returns the version of a product sheet as ProductCatalog.version reports it once loaded (prefix of
+    the CSV's SHA-256). Taken from the snapshot while that is up to date, so the CSV is only read after
+    it changed.
+    """
+    stat = os.stat(csv_path)
+    meta = _read_meta(snapshot_path(csv_path, snapshot_dir))
+    if meta and (meta.get("source_mtime_ns"), meta.get("source_size")) == (stat.st_mtime_ns, stat.st_size):
+        return meta["source_sha256"][:16]
+    return file_sha256(csv_path)[:16]
+
+
+def load_catalog(csv_path=DEFAULT_CSV_PATH, snapshot_dir=DEFAULT_SNAPSHOT_DIR, mmap=True, name=None):
+    """
+    Loads the compiled catalog of a product sheet, (re)compiling the snapshot first if needed.
+    Args:
+        csv_path (str): Product sheet CSV.
+        snapshot_dir (str): Directory holding the snapshots.
+        mmap (bool): Memory-map the index arrays.
+        name (str, optional): Catalog name (default: the CSV file name without extension).
+    Returns:
+        ProductCatalog: The loaded catalog.
+    """
+    directory = snapshot_path(csv_path, snapshot_dir)
+    ensure_snapshot(csv_path, directory)
+    # The files are opened under the shared lock, so a concurrent compile cannot swap them out midway
+    with _snapshot_lock(directory, exclusive=False):
+        meta = _read_meta(directory)
+        index = ProductMatchIndex.load(directory, mmap=mmap)
+        codes = np.load(os.path.join(directory, "category_codes.npy"), mmap_mode="r" if mmap else None)
+        with open(os.path.join(directory, "categories.json"), "r", encoding="utf-8") as f:
+            category_names = json.load(f)
+    return ProductCatalog(index, codes, category_names, version=meta["source_sha256"][:16],
+                          name=name or os.path.splitext(os.path.basename(csv_path))[0])
+
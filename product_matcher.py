@@ -0,0 +1,331 @@
+# ---
+# PRODUCT MATCH INDEX ---
+#
+# Prebuilt index for fuzzy-matching receipt item names against a product catalog.
+#
+# `fuzzywuzzy.process.extractOne(query, names)` scores every catalog name with `fuzz.WRatio`.
+# ProductMatchIndex returns exactly the same (name, score) pair, but only runs the scorer on a
+# shortlist. For every catalog name it keeps
+#   - a character count profile (unigram n-grams) of the processed, token-sorted and
+#     token-set strings that WRatio compares internally,
+#   - a token inverted index (token -> names containing it).
+# From these, a cheap upper bound of WRatio is computed for all names at once (numpy), and
+# names are scored in order of decreasing bound until no remaining name can beat the best
+# score found so far. Ties are resolved like extractOne (first name in catalog order wins).
+#
+# An index can be saved to a directory (.npy arrays only, plus the short character vocabulary) and
+# loaded back memory-mapped, so processes share the arrays through the page cache instead of
+# rebuilding them. The names are stored as one UTF-8 blob with offsets (StringTable) and decoded
+# only when accessed, and the inverted index is keyed by 64-bit token hashes found by binary search,
+# so loading a catalog of hundreds of thousands of names creates no Python object per name or token.
+import hashlib
+import json
+import os
+
+import numpy as np
+from fuzzywuzzy import fuzz, utils
+
+
+def _process_query(query):
+    """Processes a query the same way process.extractOne does with the default processor/scorer."""
+    return utils.full_process(utils.full_process(query), force_ascii=True)
+
+
+def normalize_query(query):
+    """
+    Returns the form of query that extract_one actually matches: queries with the same normalized
+    form have the same result, so it can key a cache of results.
+    """
+    return _process_query(query)
+
+
+def _process_choice(choice):
+    """Processes a catalog name the same way process.extractOne does with the default scorer."""
+    return utils.full_process(choice, force_ascii=True)
+
+
+def _profile(processed):
+    """
+    Returns the string features the WRatio upper bound is computed from.
+    Args:
+        processed (str): Processed string (see _process_query/_process_choice).
+    Returns:
+        tuple: (chars, dedup_chars, length, spaces, n_tokens, n_distinct, tokens)
+    """
+    tokens = processed.split()
+    distinct = set(tokens)
+    return (
+        "".join(tokens),
+        "".join(distinct),
+        len(processed),
+        processed.count(" "),
+        len(tokens),
+        len(distinct),
+        distinct,
+    )
+
+
+def _ratio_bound(common, len1, len2):
+    """Upper bound of fuzz.ratio (2 * LCS / (len1 + len2)) given the common character count."""
+    shortest = np.minimum(len1, len2)
+    common = np.minimum(common, shortest)
+    total = len1 + len2
+    return np.divide(2.0 * common, total, out=np.zeros(np.shape(total)), where=total > 0)
+
+
+def _partial_bound(common, len1, len2):
+    """Upper bound of fuzz.partial_ratio given the common character count."""
+    shortest = np.minimum(len1, len2)
+    common = np.minimum(common, shortest)
+    total = shortest + common
+    return np.divide(2.0 * common, total, out=np.zeros(np.shape(total)), where=total > 0)
+
+
+def token_key(token):
+    """64-bit hash of a token, the key of its postings (a collision only loosens the bound)."""
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class StringTable:
+    """
+    Read-only sequence of strings stored as one UTF-8 byte array plus offsets; strings are decoded on access.
+    Args:
+        offsets (numpy.ndarray): Start of each string in data, followed by the end of the last one.
+        data (numpy.ndarray): UTF-8 bytes (uint8) of all strings.
+    """
+
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.cumsum([0] + [len(b) for b in encoded], dtype=np.int64)
+        return cls(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def save(self, directory, name):
+        np.save(os.path.join(directory, name + "_offsets.npy"), np.asarray(self._offsets, dtype=np.int64))
+        np.save(os.path.join(directory, name + "_data.npy"), np.asarray(self._data, dtype=np.uint8))
+
+    @classmethod
+    def load(cls, directory, name, mmap_mode="r"):
+        return cls(np.load(os.path.join(directory, name + "_offsets.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, name + "_data.npy"), mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("string index out of range")
+        return self._data[self._offsets[i]:self._offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def _pack_postings(postings):
+    """
+    Packs token -> rows into arrays sorted by token key: (keys, offsets, rows); rows of colliding keys are merged.
+    """
+    by_key = {}
+    for token, rows in postings.items():
+        by_key.setdefault(token_key(token), []).append(rows)
+    keys = np.array(sorted(by_key), dtype=np.uint64)
+    merged = [np.unique(np.concatenate(by_key[int(key)])) for key in keys]
+    offsets = np.cumsum([0] + [len(rows) for rows in merged], dtype=np.int64)
+    rows = np.concatenate(merged).astype(np.int64) if merged else np.zeros(0, dtype=np.int64)
+    return keys, offsets, rows
+
+
+class ProductMatchIndex:
+    """
+    Exact, index-backed replacement for `process.extractOne(query, names)`.
+    Args:
+        names (list): Catalog names to match against (order matters for ties, as in extractOne).
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        processed = [_process_choice(name) for name in self.names]
+        profiles = [_profile(p) for p in processed]
+
+        vocab = sorted({c for profile in profiles for c in profile[0]})
+        self._vocab = {c: i for i, c in enumerate(vocab)}
+        n = len(self.names)
+        self._counts = np.zeros((n, len(vocab)), dtype=np.uint16)
+        self._dedup_counts = np.zeros((n, len(vocab)), dtype=np.uint16)
+        postings = {}
+        for row, profile in enumerate(profiles):
+            chars, dedup_chars, _, _, _, _, tokens = profile
+            for c in chars:
+                col = self._vocab[c]
+                self._counts[row, col] = min(65535, int(self._counts[row, col]) + 1)
+            for c in dedup_chars:
+                col = self._vocab[c]
+                self._dedup_counts[row, col] = min(65535, int(self._dedup_counts[row, col]) + 1)
+            for token in tokens:
+                postings.setdefault(token, []).append(row)
+        self._posting_keys, self._posting_offsets, self._posting_rows = _pack_postings(postings)
+
+        self._processed = processed
+        self._length = np.array([p[2] for p in profiles], dtype=np.int64)
+        self._spaces = np.array([p[3] for p in profiles], dtype=np.int64)
+        self._tokens = np.array([p[4] for p in profiles], dtype=np.int64)
+        self._distinct = np.array([p[5] for p in profiles], dtype=np.int64)
+        chars_total = self._length - self._spaces
+        dedup_total = np.array([len(p[1]) for p in profiles], dtype=np.int64)
+        # Lengths of the token-sorted and token-set strings built inside fuzz.WRatio
+        self._sorted_length = chars_total + np.maximum(self._tokens - 1, 0)
+        self._set_length = dedup_total + np.maximum(self._distinct - 1, 0)
+
+    def __len__(self):
+        return len(self.names)
+
+    _ARRAYS = ("counts", "dedup_counts", "length", "spaces", "tokens", "distinct", "sorted_length", "set_length",
+               "posting_keys", "posting_offsets", "posting_rows")
+
+    def save(self, directory):
+        """
+        Saves the index to a directory (see load).
+        Args:
+            directory (str): Target directory, created if missing.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in self._ARRAYS:
+            np.save(os.path.join(directory, name + ".npy"), np.ascontiguousarray(getattr(self, "_" + name)))
+        for name, strings in (("names", self.names), ("processed", self._processed)):
+            table = strings if isinstance(strings, StringTable) else StringTable.from_strings(strings)
+            table.save(directory, name)
+        with open(os.path.join(directory, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(list(self._vocab), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Loads an index saved with save, without recomputing any profile.
+        Args:
+            directory (str): Directory written by save.
+            mmap (bool): Memory-map the arrays (read-only) instead of reading them into memory.
+        Returns:
+            ProductMatchIndex: The loaded index.
+        """
+        mmap_mode = "r" if mmap else None
+        index = cls.__new__(cls)
+        index.names = StringTable.load(directory, "names", mmap_mode)
+        index._processed = StringTable.load(directory, "processed", mmap_mode)
+        with open(os.path.join(directory, "vocab.json"), "r", encoding="utf-8") as f:
+            index._vocab = {c: i for i, c in enumerate(json.load(f))}
+        for name in cls._ARRAYS:
+            setattr(index, "_" + name, np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode))
+        return index
+
+    def _token_rows(self, token):
+        """Rows of the names containing token (or a token with the same key), or None."""
+        key = np.uint64(token_key(token))
+        i = int(np.searchsorted(self._posting_keys, key))
+        if i == len(self._posting_keys) or self._posting_keys[i] != key:
+            return None
+        return self._posting_rows[self._posting_offsets[i]:self._posting_offsets[i + 1]]
+
+    def upper_bounds(self, processed_query):
+        """
+        Computes an upper bound of fuzz.WRatio(processed_query, name) for every catalog name.
+        Args:
+            processed_query (str): Query processed with _process_query.
+        Returns:
+            numpy.ndarray: Float upper bounds (already rounded up), one per catalog name.
+        """
+        chars, dedup_chars, q_len, q_spaces, q_tokens, q_distinct, q_token_set = _profile(processed_query)
+        n = len(self.names)
+
+        common = np.zeros(n, dtype=np.int64)
+        dedup_common = np.zeros(n, dtype=np.int64)
+        for c, count in _char_counts(chars).items():
+            col = self._vocab.get(c)
+            if col is not None:
+                common += np.minimum(self._counts[:, col], count)
+        for c, count in _char_counts(dedup_chars).items():
+            col = self._vocab.get(c)
+            if col is not None:
+                dedup_common += np.minimum(self._dedup_counts[:, col], count)
+
+        shared_token = np.zeros(n, dtype=bool)
+        for token in q_token_set:
+            rows = self._token_rows(token)
+            if rows is not None:
+                shared_token[rows] = True
+
+        q_sorted_len = (q_len - q_spaces) + max(q_tokens - 1, 0)
+        q_set_len = len(dedup_chars) + max(q_distinct - 1, 0)
+        common_full = common + np.minimum(self._spaces, q_spaces)
+        common_sorted = common + np.minimum(np.maximum(self._tokens - 1, 0), max(q_tokens - 1, 0))
+        common_set = dedup_common + np.minimum(np.maximum(self._distinct - 1, 0), max(q_distinct - 1, 0))
+
+        base = _ratio_bound(common_full, q_len, self._length)
+        tsor = _ratio_bound(common_sorted, q_sorted_len, self._sorted_length)
+        tset = np.where(shared_token, 1.0, _ratio_bound(common_set, q_set_len, self._set_length))
+        partial = _partial_bound(common_full, q_len, self._length)
+        ptsor = _partial_bound(common_sorted, q_sorted_len, self._sorted_length)
+        ptset = np.where(shared_token, 1.0, _partial_bound(common_set, q_set_len, self._set_length))
+
+        shortest = np.maximum(np.minimum(self._length, q_len), 1)
+        len_ratio = np.maximum(self._length, q_len) / shortest
+        partial_scale = np.where(len_ratio > 8, 0.6, 0.9)
+        unpartial = np.maximum(base, 0.95 * np.maximum(tsor, tset))
+        with_partial = np.maximum(
+            base, partial_scale * np.maximum(partial, 0.95 * np.maximum(ptsor, ptset)))
+        bound = np.where(len_ratio < 1.5, unpartial, with_partial)
+        bound = np.where(self._length > 0, bound, 0.0)
+        # +1 covers the integer rounding done inside WRatio and its components
+        return 100.0 * bound + 1.0
+
+    def extract_one(self, query):
+        """
+        Returns the best (name, score) for query, identical to process.extractOne(query, names).
+        Args:
+            query (str): Item name to look up.
+        Returns:
+            tuple or None: (matched_name, score), or None if the catalog is empty.
+        """
+        match = self.extract_one_row(query)
+        if match is None:
+            return None
+        return self.names[match[0]], match[1]
+
+    def extract_one_row(self, query):
+        """
+        Like extract_one, but returns the position of the matched name in the catalog.
+        Returns:
+            tuple or None: (row, score), or None if the catalog is empty.
+        """
+        if not len(self.names):
+            return None
+        processed_query = _process_query(query)
+        if not processed_query:
+            # WRatio scores every name 0; extractOne then returns the first one
+            return 0, 0
+
+        bounds = self.upper_bounds(processed_query)
+        order = np.argsort(-bounds, kind="stable")
+        best_row, best_score = None, -1
+        for row in order:
+            if bounds[row] < best_score:
+                break
+            score = fuzz.WRatio(processed_query, self._processed[row], full_process=False)
+            if score > best_score or (score == best_score and row < best_row):
+                best_row, best_score = row, score
+        return int(best_row), best_score
+
+
+def _char_counts(chars):
+    counts = {}
+    for c in chars:
+        counts[c] = counts.get(c, 0) + 1
+    return counts
@@ -1,298 +1,676 @@
-import requests
-import pandas as pd
-from fuzzywuzzy import process
-# --- IKEA Product Sheet Integration ---
-def load_ikea_products(csv_path='products/ikea_products.csv'):
+# Heavy modules (openai, PIL, pytesseract, numpy, googleapiclient, requests, pydantic) and the API clients are
+# only loaded on first use, so importing this module for its helpers (and starting worker processes) stays cheap.
+import logging
+import threading
+from run_metrics import metrics
+
+# Loggers per stage (see logging_setup.py); per-item debug lines use lazy %-arguments
+log = logging.getLogger("receipts")
+catalog_log = logging.getLogger("receipts.catalog")
+mcp_log = logging.getLogger("receipts.mcp")
+llm_log = logging.getLogger("receipts.llm")
+download_log = logging.getLogger("receipts.download")
+dedup_log = logging.getLogger("receipts.dedup")
+
+# --- Store product catalogs ---
+def load_store_catalog(store):
     """
-    Loads IKEA product data from a CSV and returns a lookup dict and list of product names.
-    Assumes columns: 'name', 'category'.
+    Returns the product catalog of a store: names, categories and the fuzzy match index over the names.
+    Catalogs are listed in products/catalogs.json and loaded on first use from their compiled,
+    memory-mapped snapshots (see catalog_registry.py and product_catalog.py).
+    Args:
+        store (str): Canonical store name (e.g. 'IKEA').
+    Returns:
+        ProductCatalog or None: None if the store has no catalog or it could not be loaded.
     """
+    from catalog_registry import get_catalog_registry
     try:
-        df = pd.read_csv(csv_path)
-        product_dict = {str(row['name']).strip().lower(): str(row['category']).strip() for _, row in df.iterrows()}
-        return product_dict, list(product_dict.keys())
+        return get_catalog_registry().get(store)
     except Exception as e:
-        print(f"[WARN] Could not load IKEA product sheet: {e}")
-        return {{}}, []
+        catalog_log.warning("Could not load the %s product catalog: %s", store, e)
+        return None
 
-def get_ikea_category(item_name, product_dict, product_names, threshold=95):
+def get_catalog_category(item_name, catalog, threshold=95, looked_up=None):
     """
-    Fuzzy-matches item_name to IKEA product names and returns the category if found.
+    Fuzzy-matches item_name to the product names of a store catalog and returns the category if found.
+    Uses the prebuilt ProductMatchIndex (same result as process.extractOne over all names);
+    names matched before are served from the shared category cache (see category_cache.py).
+    looked_up holds the cache lookups mcp_lookup_categories already made, per catalog version; only
+    those of this catalog's version are reused (see match_names).
     """
-    if not item_name:
+    if not item_name or catalog is None:
         return None
-    match = process.extractOne(item_name.lower(), product_names)
-    if match and match[1] >= threshold:
-        matched_name = match[0]
-        matched_score = match[1]
-        matched_category = product_dict[matched_name]
-        print(f"[DEBUG] IKEA match: input='{item_name}' matched='{matched_name}' (score={matched_score}), category='{matched_category}'")
+    from category_cache import get_category_cache, match_names
+    with metrics.span("fuzzy_fallback"):
+        match = match_names(catalog, [item_name], get_category_cache(),
+                            (looked_up or {}).get(catalog.version))[item_name]
+    if match and match[2] >= threshold:
+        matched_name, matched_category, matched_score = match
+        catalog_log.debug("%s match: input='%s' matched='%s' (score=%s), category='%s'", catalog.name, item_name,
+                          matched_name, matched_score, matched_category)
         return matched_category
-    print(f"[DEBUG] IKEA match: input='{item_name}' no good match found (best score={match[1] if match else 'N/A'})")
+    catalog_log.debug("%s match: input='%s' no good match found (best score=%s)", catalog.name, item_name,
+                      match[2] if match else 'N/A')
     return None
-import sys
+
+# --- MCP Category Tool client ---
+MCP_BATCH_LOOKUP_URL = "http://localhost:8000/lookup/batch"
+
+# Persistent keep-alive session, so all lookups reuse pooled connections to the category service
+_mcp_session = None
+_clients_lock = threading.Lock()
+
+def get_mcp_session():
+    """Returns the shared requests session for the category service (created on first use)."""
+    global _mcp_session
+    if _mcp_session is None:
+        import requests
+        with _clients_lock:
+            if _mcp_session is None:
+                _mcp_session = requests.Session()
+    return _mcp_session
+
+def mcp_lookup_candidates(item_name):
+    """
+    Returns the candidates tried for an item: the full item name, then all space- and hyphen-separated substrings.
+    """
+    candidates = [item_name.strip()]
+    for part in item_name.replace('-', ' ').split():
+        if part.strip():
+            candidates.append(part.strip())
+    return list(dict.fromkeys(candidates))
+
+def mcp_cached_results(items, threshold, store, looked_up=None):
+    """
+    Resolves /lookup/batch items from the shared category cache, the way the service would.
+    The catalog itself is not loaded: only its name and version key the cache.
+    Args:
+        items (list): Batch lookup items ({"item_name", "candidates"}).
+        threshold (int): Minimum fuzzy match score.
+        store (str): Store whose catalog the items are matched against.
+        looked_up (dict, optional): Filled with catalog version -> {normalized candidate: cached match, or
+            None if not cached}, so the local fallback does not look them up again.
+    Returns:
+        list: Per item, a result like the service returns, or None if a candidate is not cached.
+    """
+    from catalog_registry import get_catalog_registry
+    from category_cache import get_category_cache
+    from product_matcher import normalize_query
+    cache = get_category_cache()
+    try:
+        catalog = get_catalog_registry().catalog_version(store) if cache else None
+    except OSError as e:
+        catalog_log.warning("Could not read the %s product catalog version: %s", store, e)
+        catalog = None
+    if catalog is None:
+        return [None] * len(items)
+    name, version = catalog
+    keys = {candidate: normalize_query(candidate) for item in items for candidate in item["candidates"]}
+    cached = cache.get_many(keys.values(), version, name)
+    if looked_up is not None:
+        looked_up.setdefault(version, {}).update((key, cached.get(key)) for key in keys.values())
+    results = []
+    for item in items:
+        if not all(keys[candidate] in cached for candidate in item["candidates"]):
+            results.append(None)
+            continue
+        best = {"item_name": item["item_name"], "input": None, "matched_name": None, "category": None,
+                "score": None, "found": False}
+        for candidate in item["candidates"]:
+            matched_name, category, score = cached[keys[candidate]]
+            if score >= threshold and score > (best["score"] if best["found"] else -1):
+                best = {"item_name": item["item_name"], "input": candidate, "matched_name": matched_name,
+                        "category": category, "score": score, "found": True}
+        results.append(best)
+    return results
+
+def mcp_lookup_categories(item_names, store, threshold=95, looked_up=None):
+    """
+    Looks up the category of all items of a receipt in the store's catalog with a single MCP
+    /lookup/batch request. Every item is tried with its full name and all substrings (see
+    mcp_lookup_candidates); the best category found (highest score above threshold) is returned per item.
+    Items whose candidates are all in the shared category cache are resolved without a request.
+    Args:
+        item_names (list): Item names as returned by the LLM.
+        store (str): Canonical store name; the service routes the lookup to that store's catalog.
+        threshold (int): Minimum fuzzy match score.
+        looked_up (dict, optional): Filled with the category cache lookups made (see mcp_cached_results).
+    Returns:
+        list: Category (or None) for each item name, in the same order.
+    """
+    items = [{"item_name": name, "candidates": mcp_lookup_candidates(name)} for name in item_names if name]
+    if not items:
+        return [None] * len(item_names)
+    # Items whose candidates were all matched before are resolved from the category cache
+    cached_results = mcp_cached_results(items, threshold, store, looked_up)
+    to_send = [item for item, cached in zip(items, cached_results) if cached is None]
+    sent_results = []
+    if to_send:
+        try:
+            with metrics.span("mcp_lookup") as span:
+                resp = get_mcp_session().post(MCP_BATCH_LOOKUP_URL,
+                                              json={"store": store, "items": to_send, "threshold": threshold},
+                                              timeout=5)
+                resp.raise_for_status()
+                span.bytes = len(resp.content)
+            sent_results = resp.json()["results"]
+        except Exception as e:
+            mcp_log.warning("MCP batch lookup failed for %d %s items: %s", len(to_send), store, e)
+            return [None] * len(item_names)
+    sent_results = iter(sent_results)
+    results = iter([cached if cached is not None else next(sent_results) for cached in cached_results])
+    categories = []
+    for name in item_names:
+        if not name:
+            categories.append(None)
+            continue
+        best = next(results)
+        if best.get("found"):
+            mcp_log.debug("MCP best match: input='%s' tried='%s' matched='%s', category='%s', score=%s", name,
+                          best['input'], best['matched_name'], best['category'], best['score'])
+            categories.append(best["category"])
+        else:
+            mcp_log.debug("MCP no good match for '%s' (tried %d candidates)", name, len(mcp_lookup_candidates(name)))
+            categories.append(None)
+    return categories
 from datetime import datetime
 import argparse
 
-# --- Debug Output Logging Setup ---
-def setup_debug_logging():
-    """
-    [DEBUG] Redirects stdout and stderr to both terminal and a timestamped log file.
-    Returns the log file object and the log file path.
-    Only used if debug mode is enabled.
-    """
-    now = datetime.now()
-    log_dir = os.path.join(os.path.dirname(__file__), 'output')
-    os.makedirs(log_dir, exist_ok=True)
-    log_filename = f"output_{now.strftime('%Y%m%d_%H_%M_%S')}.txt"
-    log_path = os.path.join(log_dir, log_filename)
-    class Tee:
-        def __init__(self, *files):
-            self.files = files
-        def write(self, obj):
-            for f in self.files:
-                f.write(obj)
-                f.flush()
-        def flush(self):
-            for f in self.files:
-                f.flush()
-    log_file = open(log_path, 'w', encoding='utf-8')
-    sys.stdout = Tee(sys.__stdout__, log_file)
-    sys.stderr = Tee(sys.__stderr__, log_file)
-    return log_file, log_path
-from PIL import Image, ImageEnhance
-import pytesseract
-import re
+from logging_setup import parse_sample_rates, setup_logging
 import os
-from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from openai import OpenAI
 import base64
-from receipt_schema import receiptInfo_schema  # Assuming this is the correct import path
+import functools
+import hashlib
+import io
+import json
+import re
+import sys
+import time
+from functools import partial
+from pipeline import Finished, PipelineStage, PipelineResult, run_pipeline
+from extraction_cache import ExtractionCache, extraction_version, file_md5
+from ocr_routing import ROUTE_ESCALATED, ROUTE_TEXT, RoutingReport, choose_route, ocr_confidence, ocr_text_from_data
+from batch_jobs import MAX_BATCH_BYTES, BatchRun
+from drive_crawler import crawl_folders, incremental_crawl, save_crawl_state
 
-load_dotenv()
+SCOPES = ['https://www.googleapis.com/auth/drive']
 
-client = OpenAI()
+@functools.lru_cache(maxsize=None)
+def load_env():
+    """Loads .env into the environment (once)."""
+    from dotenv import load_dotenv
+    load_dotenv()
 
-# Path to your service account JSON file and required scopes
-SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_DRIVE_APPLICATION_CREDENTIALS_PATH", 'service_account_dummy.json')
-SCOPES = ['https://www.googleapis.com/auth/drive']
+_openai_client = None
 
-# Folder ID can be provided as an environment variable or directly in the code
-folder_id_input = os.getenv("GOOGLE_DRIVE_FOLDER_ID")  # or: folder_id = 'your_folder_id'
+def get_openai_client():
+    """Returns the shared blocking OpenAI client (created on first use, after loading .env)."""
+    global _openai_client
+    if _openai_client is None:
+        load_env()
+        from openai import OpenAI
+        with _clients_lock:
+            if _openai_client is None:
+                _openai_client = OpenAI()
+    return _openai_client
 
-# Load credentials from service account file
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+@functools.lru_cache(maxsize=None)
+def get_drive_credentials():
+    """Loads the service account credentials (once); the key file comes from GOOGLE_DRIVE_APPLICATION_CREDENTIALS_PATH."""
+    load_env()
+    from google.oauth2 import service_account
+    # Path to your service account JSON file
+    service_account_file = os.getenv("GOOGLE_DRIVE_APPLICATION_CREDENTIALS_PATH", 'service_account_dummy.json')
+    return service_account.Credentials.from_service_account_file(service_account_file, scopes=SCOPES)
 
-# Build the Google Drive API service object
-drive_service = build('drive', 'v3', credentials=credentials)
+def get_drive_api_url():
+    """Drive API base URL: GOOGLE_DRIVE_API_URL if set (e.g. a local stand-in, see benchmarks/bench_e2e.py), else None."""
+    load_env()
+    return os.getenv("GOOGLE_DRIVE_API_URL") or None
 
-def feed_image_to_llm_local(image_path, client):
-    # Load IKEA product data once (could be moved to global scope for efficiency)
-    ikea_product_dict, ikea_product_names = load_ikea_products()
+def build_drive_service():
+    """Builds a new Google Drive API service object."""
+    from googleapiclient.discovery import build
+    api_url = get_drive_api_url()
+    client_options = {"api_endpoint": api_url.rstrip("/") + "/"} if api_url else None
+    return build('drive', 'v3', credentials=get_drive_credentials(), client_options=client_options)
 
-    def mcp_lookup_ikea_category(item_name, threshold=95):
-        """
-        Try the full item name and all substrings (split by space and hyphen) for MCP lookup.
-        Return the best category found (highest score above threshold).
-        """
-        url = "http://localhost:8000/lookup"
-        candidates = set()
-        if not item_name:
-            return None
-        # Add full name, then all space- and hyphen-separated substrings
-        candidates.add(item_name.strip())
-        for part in item_name.replace('-', ' ').split():
-            if part.strip():
-                candidates.add(part.strip())
-        best = {"score": -1, "category": None, "matched_name": None, "input": None}
-        for candidate in candidates:
-            params = {"item_name": candidate, "threshold": threshold}
-            try:
-                resp = requests.get(url, params=params, timeout=2)
-                if resp.status_code == 200:
-                    data = resp.json()
-                    if data.get("found") and data.get("score", 0) > best["score"]:
-                        best = {"score": data["score"], "category": data["category"], "matched_name": data["matched_name"], "input": candidate}
-            except Exception as e:
-                print(f"[WARN] MCP lookup failed for '{candidate}': {e}")
-        if best["category"]:
-            print(f"[DEBUG] MCP best match: input='{item_name}' tried='{best['input']}' matched='{best['matched_name']}', category='{best['category']}', score={best['score']}")
-            return best["category"]
-        print(f"[DEBUG] MCP no good match for '{item_name}' (tried substrings: {candidates})")
-        return None
+# The Drive client (httplib2) is not thread-safe, so crawl workers each build their own service object
+_thread_local = threading.local()
+
+def get_thread_drive_service():
     """
-    Encodes a local image and sends it to the OpenAI LLM for receipt information extraction.
-    Prints the extracted JSON and token usage if available.
+    Returns a Drive API service object owned by the calling thread (built on first use).
+    """
+    service = getattr(_thread_local, 'drive_service', None)
+    if service is None:
+        service = build_drive_service()
+        _thread_local.drive_service = service
+    return service
+
+_drive_downloader = None
+_drive_download_options = {}
+
+def configure_drive_downloads(**options):
+    """Sets the DriveDownloader options (sessions, chunk_size, max_retries, ...) used by get_drive_downloader."""
+    global _drive_downloader
+    with _clients_lock:
+        _drive_download_options.update(options)
+        if _drive_downloader is not None:
+            _drive_downloader.close()
+            _drive_downloader = None
+
+def get_drive_downloader():
+    """Returns the shared Drive downloader with its pool of HTTP sessions (created on first use)."""
+    global _drive_downloader
+    if _drive_downloader is None:
+        from drive_downloader import DriveDownloader
+        credentials = get_drive_credentials()
+        options = dict(_drive_download_options)
+        api_url = get_drive_api_url()
+        if api_url:
+            options.setdefault("api_url", api_url)
+        with _clients_lock:
+            if _drive_downloader is None:
+                _drive_downloader = DriveDownloader(credentials, **options)
+    return _drive_downloader
+
+# Step 1: Enhance image contrast (in memory)
+def enhance_contrast(img, factor=2.0):
+    from PIL import ImageEnhance
+    enhancer = ImageEnhance.Contrast(img)
+    return enhancer.enhance(factor)
+
+# Step 2: OCR extraction (text plus per-word confidences for routing)
+def extract_text_with_ocr(img, ocr_options=None):
+    """
+    OCRs the image with the OCR engine and the profile of its store (see ocr_engine.py).
+    Args:
+        img (PIL.Image.Image): Preprocessed image.
+        ocr_options (dict, optional): Keyword arguments of ocr_engine.ocr_receipt (engine, strip_workers, max_aspect).
+    Returns:
+        tuple: (ocr_text, stats): the OCR text, its confidence stats (see ocr_routing.py) and the OCR engine info.
+    """
+    from ocr_engine import ocr_receipt
+    data, info = ocr_receipt(img, **(ocr_options or {}))
+    return ocr_text_from_data(data), dict(ocr_confidence(data), **info)
+
+# Step 3: Improved prompt for LLM
+improved_prompt = (
+    "Extract the purchase date, store name, and all items from this receipt image. "
+    "The date may appear in formats like DD.MM.YYYY, MM/DD/YYYY, or YYYY-MM-DD. "
+    "If multiple dates are present, choose the one most likely to be the purchase date. "
+    "Return the result as JSON according to the provided schema. "
+    "If the date is missing or ambiguous, return null for the date field. "
+    "Always use singular English nouns for categories (e.g., 'Fruit', 'Snack', 'Bag'). "
+    "Normalize the store name to its most common, simple form (e.g., 'IKEA', 'REWE', 'ESSO'). "
+    "Assign the most specific category possible; use 'General' only if no other category fits. "
+    "If the store is known for a specific product type, prefer relevant categories (e.g., 'Furniture' for IKEA, 'Food' for REWE)."
+)
+
+# Prompt for the text-only path (high-confidence OCR, no image sent)
+text_only_prompt = improved_prompt.replace("from this receipt image", "from this receipt's OCR text")
+
+LLM_MODEL = "gpt-4o-mini"
+# Bump when the date/store/category post-processing changes, so cached extractions are invalidated
+POSTPROCESS_VERSION = 1
+
+@functools.lru_cache(maxsize=None)
+def get_receipt_schema():
+    """JSON schema of ReceiptInfo (see receipt_schema.py; loads pydantic on first use)."""
+    from receipt_schema import receiptInfo_schema
+    return receiptInfo_schema
+
+@functools.lru_cache(maxsize=None)
+def get_extraction_version(adaptive=True, target_width=1000, max_tiles=0, ocr_max_aspect=3.0, min_ocr_confidence=85,
+                           min_ocr_words=8, batch=False):
+    """
+    Version of the prompts, schema, model and post-processing (incl. the normalization rules), the
+    preprocessing and OCR routing options and the store catalogs (they decide the item categories);
+    keys the extraction cache. Call it after configure_catalogs.
+    Batch mode (process_folder_ids_batch) does not route by OCR confidence, so its results get their
+    own version, without the routing options.
+    """
+    from catalog_registry import get_catalog_registry
+    from normalization import get_rules
+    try:
+        catalogs = get_catalog_registry().version()
+    except OSError:
+        catalogs = None
+    options = {"mode": "batch" if batch else "routed", "adaptive": adaptive, "target_width": target_width,
+               "max_tiles": max_tiles, "ocr_max_aspect": ocr_max_aspect, "catalogs": catalogs}
+    if not batch:
+        options.update(min_ocr_confidence=min_ocr_confidence, min_ocr_words=min_ocr_words)
+    return extraction_version([improved_prompt, text_only_prompt], get_receipt_schema(), LLM_MODEL,
+                              [POSTPROCESS_VERSION, get_rules().version], options)
+
+def encode_image(image_bytes):
+    """Base64-encodes the (JPEG) image bytes."""
+    return base64.b64encode(image_bytes).decode("utf-8")
+
+def preprocess_image_bytes(image_bytes, persist_path=None, adaptive=True, target_width=1000, max_tiles=0,
+                           ocr_options=None):
+    """
+    Step 4: Decodes the image once, preprocesses it, extracts the OCR text and encodes the
+    enhanced image as JPEG for the LLM. Everything stays in memory.
+    With adaptive preprocessing the image is cropped to the receipt, converted to grayscale and
+    downscaled to target_width before the contrast boost, and the image sent to the LLM is scaled to
+    what the API keeps of it (and to at most max_tiles vision tiles if set, see image_preprocessing.py);
+    otherwise only the contrast of the full image is enhanced.
+    CPU-bound; runs in the OCR worker pool when processing folders.
+    Args:
+        image_bytes (bytes): Downloaded image file contents.
+        persist_path (str, optional): [DEBUG] If given, the enhanced image is also written to
+            persist_path + '.enhanced.jpg'.
+        adaptive (bool): Use adaptive preprocessing.
+        target_width (int): Max receipt width in pixels for adaptive preprocessing (0 disables downscaling).
+        max_tiles (int): Max vision tiles of the LLM image for adaptive preprocessing (0 = no limit).
+        ocr_options (dict, optional): OCR engine options (see extract_text_with_ocr).
+    Returns:
+        tuple: (enhanced_jpeg_bytes, ocr_text, stats)
+    """
+    from PIL import Image
+    from image_preprocessing import estimate_image_tokens, fit_tile_budget, preprocess_receipt_image
+    enhance_start = time.perf_counter()
+    img = Image.open(io.BytesIO(image_bytes))
+    img.load()
+    if adaptive:
+        enhanced_img, stats = preprocess_receipt_image(img, target_width=target_width)
+    else:
+        enhanced_img = enhance_contrast(img)
+        stats = {"original_size": img.size, "original_pixels": img.width * img.height, "crop_box": None,
+                 "processed_size": img.size, "processed_pixels": img.width * img.height}
+    ocr_start = time.perf_counter()
+    ocr_text, confidence = extract_text_with_ocr(enhanced_img, ocr_options=ocr_options)
+    stats["ocr_seconds"] = time.perf_counter() - ocr_start
+    stats.update(confidence)
+    # Enhance time excludes OCR: decoding, preprocessing, tile fitting and JPEG encoding
+    if adaptive:
+        enhanced_img = fit_tile_budget(enhanced_img, max_tiles=max_tiles)
+        stats["processed_size"] = enhanced_img.size
+        stats["processed_pixels"] = enhanced_img.width * enhanced_img.height
+    if enhanced_img.mode not in ('RGB', 'L'):
+        enhanced_img = enhanced_img.convert('RGB')
+    buffer = io.BytesIO()
+    enhanced_img.save(buffer, format='JPEG')
+    enhanced_jpeg = buffer.getvalue()
+    if persist_path:
+        with open(persist_path + ".enhanced.jpg", 'wb') as f:
+            f.write(enhanced_jpeg)
+    stats["enhance_seconds"] = time.perf_counter() - enhance_start - stats["ocr_seconds"]
+    stats["original_bytes"] = len(image_bytes)
+    stats["processed_bytes"] = len(enhanced_jpeg)
+    stats["est_image_tokens_before"] = estimate_image_tokens(*stats["original_size"], model=LLM_MODEL)
+    stats["est_image_tokens_after"] = estimate_image_tokens(*stats["processed_size"], model=LLM_MODEL)
+    return enhanced_jpeg, ocr_text, stats
+
+def record_image_metrics(stats):
+    """Records the enhance and OCR timings of an image (measured in the OCR worker process) in the run metrics."""
+    metrics.record("enhance", stats.get("enhance_seconds", 0.0), nbytes=stats.get("original_bytes", 0))
+    metrics.record("ocr", stats.get("ocr_seconds", 0.0))
+
+def preprocess_image(image_path, persist=False, adaptive=True, target_width=1000, max_tiles=0, ocr_options=None):
+    """
+    Reads a local image file once and preprocesses it in memory (see preprocess_image_bytes).
     Args:
         image_path (str): Path to the image file.
-        client (OpenAI): OpenAI client instance.
+        persist (bool): [DEBUG] Also write the enhanced image next to the original.
+        adaptive (bool): Use adaptive preprocessing.
+        target_width (int): Max receipt width in pixels for adaptive preprocessing.
+        max_tiles (int): Max vision tiles of the LLM image for adaptive preprocessing.
+        ocr_options (dict, optional): OCR engine options (see extract_text_with_ocr).
+    Returns:
+        tuple: (enhanced_jpeg_bytes, ocr_text, stats)
     """
-    # Step 1: Enhance image contrast
-    def enhance_contrast(image_path, factor=2.0):
-        img = Image.open(image_path)
-        enhancer = ImageEnhance.Contrast(img)
-        enhanced_img = enhancer.enhance(factor)
-        enhanced_path = image_path + ".enhanced.jpg"
-        enhanced_img.save(enhanced_path)
-        return enhanced_path
-
-    # Step 2: OCR extraction
-    def extract_text_with_ocr(image_path):
-        return pytesseract.image_to_string(Image.open(image_path))
-
-    # Step 3: Improved prompt for LLM
-    improved_prompt = (
-        "Extract the purchase date, store name, and all items from this receipt image. "
-        "The date may appear in formats like DD.MM.YYYY, MM/DD/YYYY, or YYYY-MM-DD. "
-        "If multiple dates are present, choose the one most likely to be the purchase date. "
-        "Return the result as JSON according to the provided schema. "
-        "If the date is missing or ambiguous, return null for the date field. "
-        "Always use singular English nouns for categories (e.g., 'Fruit', 'Snack', 'Bag'). "
-        "Normalize the store name to its most common, simple form (e.g., 'IKEA', 'REWE', 'ESSO'). "
-        "Assign the most specific category possible; use 'General' only if no other category fits. "
-        "If the store is known for a specific product type, prefer relevant categories (e.g., 'Furniture' for IKEA, 'Food' for REWE)."
-    )
-
-    # Step 4: Enhance image and extract OCR text
-    enhanced_path = enhance_contrast(image_path)
-    ocr_text = extract_text_with_ocr(enhanced_path)
-
-    def encode_image(image_path):
-        """Reads and base64-encodes the image file."""
-        with open(image_path, 'rb') as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
-
-    base64_image = encode_image(enhanced_path)
+    with open(image_path, 'rb') as image_file:
+        return preprocess_image_bytes(image_file.read(), persist_path=image_path if persist else None,
+                                      adaptive=adaptive, target_width=target_width, max_tiles=max_tiles,
+                                      ocr_options=ocr_options)
 
+def build_llm_request(enhanced_jpeg, ocr_text, include_image=True):
+    """
+    Builds the body of the Responses API request for a receipt: prompt + OCR text and, optionally, the image.
+    The same body is sent synchronously (extract_receipt_info) or written to a batch input file (--batch).
+    Args:
+        enhanced_jpeg (bytes): Enhanced image, JPEG-encoded.
+        ocr_text (str): OCR text of the image.
+        include_image (bool): Send the image; if False, a cheaper text-only request is made.
+    Returns:
+        dict: Request body (model, input, text format).
+    """
+    if include_image:
+        base64_image = encode_image(enhanced_jpeg)
+        content = [
+            {
+                "type": "input_text",
+                "text": improved_prompt + "\n\nHere is the OCR text for reference:\n" + ocr_text
+            },
+            {
+                "type": "input_image",
+                "image_url": f"data:image/jpeg;base64,{base64_image}"
+            }
+        ]
+    else:
+        content = [
+            {
+                "type": "input_text",
+                "text": text_only_prompt + "\n\nHere is the OCR text of the receipt:\n" + ocr_text
+            }
+        ]
     input_messages=[
         {
             "role":"user",
-            "content": [
-                {
-                    "type": "input_text",
-                    "text": improved_prompt + "\n\nHere is the OCR text for reference:\n" + ocr_text
-                },
-                {
-                    "type": "input_image",
-                    "image_url": f"data:image/jpeg;base64,{base64_image}"
-                }
-            ]
+            "content": content
         }
     ]
-
-    response = client.responses.create(
-        model="gpt-4o-mini",
-        input=input_messages,
-        text={
-        "format": {
-            "type": "json_schema",
-            "name": "ReceiptInfo",
-            "schema": receiptInfo_schema, 
-            "strict": True
+    return {
+        "model": LLM_MODEL,
+        "input": input_messages,
+        "text": {
+            "format": {
+                "type": "json_schema",
+                "name": "ReceiptInfo",
+                "schema": get_receipt_schema(),
+                "strict": True
             }
         }
-    )
+    }
 
-    # Step 5: Post-process the date field in the output
-    import json
-    try:
-        result = json.loads(response.output_text)
-        # --- Post-process date ---
-        date_str = result.get("date")
-        if not date_str or not is_valid_date(date_str):
-            # Try to extract date from OCR text
-            extracted_date = extract_date_from_text(ocr_text)
-            if extracted_date:
-                result["date"] = extracted_date
-            else:
-                result["date"] = None
-
-        # --- Post-process store name normalization ---
-        store_map = {
-            "ikea": "IKEA",
-            "ikea deutschland gmbh & co. kg": "IKEA",
-            "ikea deutschland gmbh&co kg/nl furth": "IKEA",
-            "rewe": "REWE",
-            "esso tankstelle": "ESSO",
-            # Add more mappings as needed
-        }
-        store = result.get("store", "")
-        store_key = store.lower().replace(",", "").replace("  ", " ").strip()
-        for k, v in store_map.items():
-            if k in store_key:
-                result["store"] = v
-                break
-
-        # --- Post-process categories: singularize and map known categories ---
-        def singularize(word):
-            if word.lower().endswith('ies'):
-                return word[:-3] + 'y'
-            elif word.lower().endswith('s') and not word.lower().endswith('ss'):
-                return word[:-1]
-            return word
-
-        category_map = {
-            "fruits": "Fruit",
-            "fruit": "Fruit",
-            "vegetables": "Vegetable",
-            "snacks": "Snack",
-            "food": "Food",
-            "furniture": "Furniture",
-            "plant": "Plant",
-            "bag": "Bag",
-            # Add more as needed
-        }
-        for item in result.get("items", []):
-            cat = item.get("category", "")
-            cat_key = cat.lower().strip()
-            # If store is IKEA, try MCP tool first, then fallback to local product sheet
-            if result.get("store", "").upper() == "IKEA":
-                mcp_cat = mcp_lookup_ikea_category(item.get("name", ""))
-                if mcp_cat:
-                    item["category"] = mcp_cat
-                    continue
-                # fallback to local fuzzy match if MCP fails
-                ikea_cat = get_ikea_category(item.get("name", ""), ikea_product_dict, ikea_product_names)
-                if ikea_cat:
-                    item["category"] = ikea_cat
-                    continue
-            if cat_key in category_map:
-                item["category"] = category_map[cat_key]
-            else:
-                item["category"] = singularize(cat)
-            # Optionally, assign 'General' if category is empty or unknown
-            if not item["category"]:
-                item["category"] = "General"
+def postprocess_receipt_infos(outputs):
+    """
+    Parses the LLM outputs of many receipts and post-processes the extracted JSON (date, store name
+    and categories) with the compiled normalization rules (see normalization.py). The items of all
+    receipts of a store with a product catalog (see catalog_registry.py) are looked up with a single
+    MCP request per store.
+    Logs the post-processed JSON.
+    Args:
+        outputs (list): (output_text, ocr_text) per receipt: JSON text returned by the LLM and the
+            OCR text of the image (date fallback).
+    Returns:
+        list: Post-processed receipt info per receipt, or None if its LLM output could not be processed.
+    """
+    from normalization import get_rules
+    rules = get_rules()
+    results = []
+    for output_text, ocr_text in outputs:
+        try:
+            result = rules.normalize_receipt(json.loads(output_text), ocr_text)
+        except Exception as e:
+            result = None
+            log.warning("Could not post-process date/store/category: %s\n%s", e, output_text)
+        results.append(result)
 
-        print(json.dumps(result, indent=2, ensure_ascii=False))
-    except Exception as e:
-        print(response.output_text)
-        print(f"[Warning] Could not post-process date/store/category: {e}")
+    # Items of stores with a product catalog: try the MCP tool first (one request per store for all
+    # items), then the local catalog
+    from catalog_registry import get_catalog_registry, store_key
+    registry = get_catalog_registry()
+    store_items = {}
+    for result in results:
+        if result is not None and registry.has_catalog(result.get("store")):
+            store_items.setdefault(store_key(result.get("store")), []).extend(result.get("items", []))
+    catalog_categories = {}
+    for store, items in store_items.items():
+        threshold = registry.threshold(store)
+        # Category cache lookups of the MCP step, reused by the local fallback
+        looked_up = {}
+        mcp_categories = mcp_lookup_categories([item.get("name", "") for item in items], store, threshold, looked_up)
+        # Loaded on first use per store (memory-mapped snapshot), dropped again when idle
+        catalog = load_store_catalog(store) if not all(mcp_categories) else None
+        for item, mcp_cat in zip(items, mcp_categories):
+            # fallback to local fuzzy match if MCP fails
+            catalog_categories[id(item)] = mcp_cat or get_catalog_category(item.get("name", ""), catalog, threshold,
+                                                                           looked_up)
+
+    for i, ((output_text, _), result) in enumerate(zip(outputs, results)):
+        if result is None:
+            continue
+        try:
+            for item in result.get("items", []):
+                category = catalog_categories.get(id(item))
+                item["category"] = category if category else rules.normalize_category(item.get("category", ""))
+            log.info("Receipt info:\n%s", json.dumps(result, indent=2, ensure_ascii=False))
+        except Exception as e:
+            results[i] = None
+            log.warning("Could not post-process date/store/category: %s\n%s", e, output_text)
+    return results
+
+def postprocess_receipt_info(output_text, ocr_text):
+    """
+    Parses the LLM output of one receipt and post-processes the extracted JSON (see postprocess_receipt_infos).
+    Args:
+        output_text (str): JSON text returned by the LLM.
+        ocr_text (str): OCR text of the image (date fallback).
+    Returns:
+        dict or None: Post-processed receipt info, or None if the LLM output could not be processed.
+    """
+    return postprocess_receipt_infos([(output_text, ocr_text)])[0]
+
+def extract_receipt_info(enhanced_jpeg, ocr_text, client, stats=None, include_image=True):
+    """
+    Sends the enhanced image and its OCR text to the OpenAI LLM and post-processes the extracted JSON
+    (date, store name and categories).
+    Prints the extracted JSON and token usage if available.
+    Args:
+        enhanced_jpeg (bytes): Enhanced image, JPEG-encoded.
+        ocr_text (str): OCR text of the image.
+        client (OpenAI): OpenAI client instance.
+        stats (dict, optional): Preprocessing stats of the image; LLM time, input/output tokens and the estimated
+            input tokens without preprocessing are added.
+        include_image (bool): Send the image; if False, a cheaper text-only request is made.
+    Returns:
+        dict or None: Post-processed receipt info, or None if the LLM output could not be processed.
+    """
+    llm_start = time.perf_counter()
+    with metrics.span("llm") as span:
+        span.bytes = len(enhanced_jpeg) if include_image else 0
+        response = client.responses.create(**build_llm_request(enhanced_jpeg, ocr_text, include_image=include_image))
+    llm_seconds = time.perf_counter() - llm_start
+
+    # Step 5: Post-process the date, store and category fields in the output
+    with metrics.span("postprocess"):
+        result = postprocess_receipt_info(response.output_text, ocr_text)
 
     # Print token usage if available
     if hasattr(response, "usage"):
-        print("Token usage:", response.usage)
+        llm_log.debug("Token usage: %s", response.usage)
+    if stats is not None:
+        # Accumulated, so an escalated receipt counts both requests
+        input_tokens = getattr(getattr(response, "usage", None), "input_tokens", None)
+        output_tokens = getattr(getattr(response, "usage", None), "output_tokens", None)
+        metrics.count("llm_requests")
+        metrics.count("llm_input_tokens", input_tokens)
+        metrics.count("llm_output_tokens", output_tokens)
+        if input_tokens is not None:
+            stats["input_tokens"] = (stats.get("input_tokens") or 0) + input_tokens
+            # The same request with the unpreprocessed image, estimated: only its image tokens differ
+            unpreprocessed = input_tokens
+            if include_image:
+                unpreprocessed += stats.get("est_image_tokens_before", 0) - stats.get("est_image_tokens_after", 0)
+            stats["est_input_tokens_before"] = (stats.get("est_input_tokens_before") or 0) + unpreprocessed
+        if output_tokens is not None:
+            stats["output_tokens"] = (stats.get("output_tokens") or 0) + output_tokens
+        stats["llm_seconds"] = stats.get("llm_seconds", 0.0) + llm_seconds
+        from image_preprocessing import format_stats
+        log.info("Image stats: %s", format_stats(stats), extra={"image_stats": stats})
+    return result
+
+def extract_receipt_info_routed(enhanced_jpeg, ocr_text, client, stats, min_confidence=85, min_words=8):
+    """
+    Routes a receipt by its OCR confidence: high-confidence receipts get a text-only LLM request,
+    all others (and text-only results without items) the image + text request.
+    Args:
+        enhanced_jpeg (bytes): Enhanced image, JPEG-encoded.
+        ocr_text (str): OCR text of the image.
+        client (OpenAI): OpenAI client instance.
+        stats (dict): Image stats with the OCR confidence; route, LLM time and tokens are added.
+        min_confidence (float): Min mean OCR word confidence for the text-only path (0 always sends the image).
+        min_words (int): Min recognized words for the text-only path.
+    Returns:
+        dict or None: Post-processed receipt info.
+    """
+    stats["route"] = choose_route(stats, min_confidence=min_confidence, min_words=min_words)
+    if stats["route"] == ROUTE_TEXT:
+        llm_log.info("OCR confidence %.0f over %d words: text-only extraction", stats['ocr_confidence'],
+                     stats['ocr_words'])
+        result = extract_receipt_info(enhanced_jpeg, ocr_text, client, stats=stats, include_image=False)
+        if result and result.get("items"):
+            return result
+        llm_log.info("Text-only extraction found no items; escalating to image + text")
+        stats["route"] = ROUTE_ESCALATED
+    return extract_receipt_info(enhanced_jpeg, ocr_text, client, stats=stats)
+
+def feed_image_to_llm_local(image_path, client, cache=None, persist=False, adaptive=True, target_width=1000,
+                            max_tiles=0, min_ocr_confidence=85, min_ocr_words=8, ocr_options=None,
+                            results_store=None):
+    """
+    Encodes a local image and sends it to the OpenAI LLM for receipt information extraction.
+    Prints the extracted JSON and token usage if available.
+    If a cache is given, unchanged images (same content hash) are served from it without OCR or LLM call.
+    Args:
+        image_path (str): Path to the image file.
+        client (OpenAI): OpenAI client instance.
+        cache (ExtractionCache, optional): Extraction cache.
+        persist (bool): [DEBUG] Also write the enhanced image next to the original.
+        adaptive (bool): Crop, grayscale and downscale the image before OCR (see image_preprocessing.py).
+        target_width (int): Max receipt width in pixels for adaptive preprocessing.
+        max_tiles (int): Max vision tiles of the LLM image for adaptive preprocessing.
+        min_ocr_confidence (float): Min mean OCR word confidence for a text-only request (0 always sends the image).
+        min_ocr_words (int): Min recognized words for a text-only request.
+        ocr_options (dict, optional): OCR engine options (see extract_text_with_ocr).
+        results_store (ResultsStore, optional): Results store the receipt is written to (file ID: the image path).
+    Returns:
+        dict or None: Post-processed receipt info.
+    """
+    content_hash = file_md5(image_path) if cache or results_store else None
+    source = {"id": image_path, "name": os.path.basename(image_path), "md5Checksum": content_hash}
+    if cache:
+        cached = cache.get(content_hash)
+        if cached is not None:
+            log.info("Extraction cache hit for %s:\n%s", image_path, json.dumps(cached, indent=2, ensure_ascii=False))
+            if results_store:
+                results_store.put(source, cached, "cache")
+            return cached
+    enhanced_jpeg, ocr_text, stats = preprocess_image(image_path, persist=persist, adaptive=adaptive,
+                                                      target_width=target_width, max_tiles=max_tiles,
+                                                      ocr_options=ocr_options)
+    record_image_metrics(stats)
+    result = extract_receipt_info_routed(enhanced_jpeg, ocr_text, client, stats, min_confidence=min_ocr_confidence,
+                                         min_words=min_ocr_words)
+    if cache:
+        cache.put(content_hash, result)
+    if results_store:
+        results_store.put(source, result, "llm", stats)
+    return result
 
 # ---
 # Helper: Extract date from text using regex
 def extract_date_from_text(text):
     """
-    Extracts a date string from text using regex for common date formats.
+    Extracts a date string from text using the date patterns of the normalization rules.
     Returns the first valid date found, or None.
     """
-    date_patterns = [
-        r"\b\d{2}[./-]\d{2}[./-]\d{4}\b",   # DD.MM.YYYY or DD-MM-YYYY or DD/MM/YYYY
-        r"\b\d{4}[./-]\d{2}[./-]\d{2}\b",   # YYYY-MM-DD or YYYY/MM/DD
-        r"\b\d{2}[./-]\d{2}[./-]\d{2}\b",   # DD.MM.YY
-    ]
-    for pattern in date_patterns:
-        match = re.search(pattern, text)
-        if match:
-            return match.group(0)
-    return None
+    from normalization import get_rules
+    return get_rules().find_date(text)
 
 # ---
 # Helper: Validate date string
@@ -300,47 +678,32 @@ def is_valid_date(date_str):
     """
     Checks if a date string is in a valid format and not in the future.
     """
-    from datetime import datetime, date
-    try:
-        # Try parsing with common formats
-        for fmt in ("%d.%m.%Y", "%d-%m-%Y", "%d/%m/%Y", "%Y-%m-%d", "%Y/%m/%d", "%d.%m.%y", "%d-%m-%y", "%d/%m/%y"):
-            try:
-                dt = datetime.strptime(date_str, fmt)
-                if dt.date() <= date.today():
-                    return True
-            except Exception:
-                continue
-        return False
-    except Exception:
-        return False
+    from normalization import get_rules
+    return get_rules().is_valid_date(date_str)
 
 # Download a file from Google Drive given its metadata (expects dict with 'id' and 'name')
 def download_drive_file(file_metadata, destination_folder="downloads"):
     """
     Downloads a file from Google Drive using its file metadata dict (with 'id' and 'name').
-    Saves the file to the specified destination folder (default: 'downloads').
-    Returns the local file path.
+    Saves the file as <file ID><extension> in the destination folder (default: 'downloads'); a file
+    already there with the Drive md5Checksum is not downloaded again (see drive_downloader.py).
     Args:
-        file_metadata (dict): Metadata dict with 'id' and 'name'.
+        file_metadata (dict): Metadata dict with 'id', 'name' and optionally 'md5Checksum'.
         destination_folder (str): Local folder to save the file.
     Returns:
         str: Local file path of the downloaded file.
     """
-    if not os.path.exists(destination_folder):
-        os.makedirs(destination_folder)
-    file_id = file_metadata['id']
-    file_name = file_metadata['name']
-    request = drive_service.files().get_media(fileId=file_id)
-    local_path = os.path.join(destination_folder, file_name)
-    from googleapiclient.http import MediaIoBaseDownload
-    import io
-    fh = io.FileIO(local_path, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-    fh.close()
-    return local_path
+    return get_drive_downloader().download_to_file(file_metadata, destination_folder)
+
+def download_drive_file_to_memory(file_metadata):
+    """
+    Downloads a file from Google Drive straight into memory (no file is written).
+    Args:
+        file_metadata (dict): Metadata dict with 'id' (and optionally 'md5Checksum' to verify the contents).
+    Returns:
+        bytes: File contents.
+    """
+    return get_drive_downloader().download(file_metadata)
 
 def process_images_from_folder(images, folder_id=None):
     """
@@ -352,109 +715,743 @@ def process_images_from_folder(images, folder_id=None):
     """
     if not images:
         if folder_id:
-            print(f"No images found in folder {folder_id}.")
+            log.info("No images found in folder %s.", folder_id)
         else:
-            print("No images found in the folder.")
+            log.info("No images found in the folder.")
         return
     first_image = images[0]
-    print(f"Downloading: {first_image['name']}")
+    download_log.info("Downloading: %s", first_image['name'])
     local_path = download_drive_file(first_image)
-    print(f"Saved to: {local_path}")
-    print("Sending image to LLM...")
-    feed_image_to_llm_local(local_path, client)
+    download_log.info("Saved to: %s", local_path)
+    llm_log.info("Sending image to LLM...")
+    feed_image_to_llm_local(local_path, get_openai_client())
 
 # Breadth-first search: collect all image files in all folders and subfolders.
 # Returns a list of image file dicts and a list of all visited folder IDs.
-from collections import deque
-def bfs_collect_images_and_folders(root_folder_ids):
+def bfs_collect_images_and_folders(root_folder_ids, workers=8):
     """
     Performs a breadth-first search to collect all image files in all folders and subfolders.
-    Returns a list of image file dicts and a set of all visited folder IDs.
+    Follows pagination and lists the folders of each tree level concurrently.
+    Returns a list of image file dicts and all visited folder IDs.
     Args:
         root_folder_ids (list): List of root folder IDs to start traversal from.
+        workers (int): Folders listed concurrently.
     Returns:
         tuple: (all_images, visited_folders)
             all_images (list): List of image file metadata dicts.
-            visited_folders (set): Set of all visited folder IDs.
-    """
-    queue = deque(root_folder_ids)
-    all_images = []
-    visited_folders = set()
-    while queue:
-        folder_id = queue.popleft()
-        if folder_id in visited_folders:
-            continue
-        visited_folders.add(folder_id)
-        print(f"Processing folder: {folder_id}")
-        # Query for both files and subfolders in one call
-        query = f"'{folder_id}' in parents and trashed = false"
+            visited_folders (dict): All visited folder IDs, mapped to their parent folder ID.
+    """
+    return crawl_folders(root_folder_ids, get_thread_drive_service, workers=workers)
+
+# Pipeline stage functions (one per stage, so each can run with its own concurrency)
+def download_stage(image, persist=False):
+    download_log.debug("Downloading: %s", image['name'], extra={"file_id": image['id']})
+    if persist:
+        # [DEBUG] Keep the original and enhanced images in downloads/
+        local_path = download_drive_file(image)
+        download_log.debug("Saved to: %s", local_path)
+        with open(local_path, 'rb') as f:
+            image_bytes = f.read()
+    else:
+        image_bytes, local_path = download_drive_file_to_memory(image), None
+    if not image.get('md5Checksum'):
+        # Files without a Drive checksum are keyed by the hash of their bytes (duplicate index, caches)
+        image['md5Checksum'] = hashlib.md5(image_bytes).hexdigest()
+    return image_bytes, local_path
+
+def dedup_stage(downloaded, dedup, cache=None):
+    """
+    Finishes copies of images being processed (same bytes) early; near-duplicate candidates and all other
+    images pass through (see image_dedup.py).
+    """
+    from image_dedup import perceptual_hash
+    image_bytes = downloaded[0]
+    with metrics.span("dedup"):
+        image_hash = perceptual_hash(image_bytes)
+        duplicate = image_hash and dedup.check(image_hash, hashlib.md5(image_bytes).hexdigest(), cache)
+    if not duplicate or duplicate.image_hash is not None:
+        return downloaded
+    metrics.count("dedup_hits")
+    return Finished(duplicate)
+
+# A price on a receipt: digits with two decimals (1,19 / 12.49)
+PRICE_PATTERN = re.compile(r"(?<![\d.,])(\d+)[.,](\d{2})(?![\d])")
+# Share of the matched extraction's item prices that must appear in a candidate's OCR text
+DUPLICATE_MIN_PRICE_SHARE = 0.8
+
+def confirm_duplicate(result, ocr_text):
+    """
+    Checks that the extraction of the image a near-duplicate candidate was matched to fits the candidate's own
+    OCR text: the dates agree (where both are known) and most of its item prices appear in the text. Receipts
+    of one store with the same layout can hash alike, but differ in their dates and prices.
+    Args:
+        result (dict or None): Extraction of the matched image.
+        ocr_text (str): OCR text of the candidate.
+    Returns:
+        bool: True if the extraction can be reused for the candidate.
+    """
+    if not result or not result.get("items"):
+        return False
+    from normalization import get_rules
+    rules = get_rules()
+    ocr_date = rules.parse_date(rules.find_date(ocr_text))
+    result_date = rules.parse_date(result.get("date"))
+    if ocr_date and result_date and ocr_date != result_date:
+        return False
+    amounts = {int(whole) * 100 + int(cents) for whole, cents in PRICE_PATTERN.findall(ocr_text or "")}
+    found = 0
+    for item in result["items"]:
         try:
-            results = drive_service.files().list(
-                q=query,
-                fields="nextPageToken, files(id, name, mimeType)",
-                pageSize=1000
-            ).execute()
-            files = results.get('files', [])
-            for f in files:
-                if f.get('mimeType') == 'application/vnd.google-apps.folder':
-                    queue.append(f['id'])
-                    print(f"  Found subfolder: {f['name']} ({f['id']})")
-                elif f.get('mimeType') in [
-                    'image/jpeg', 'image/png', 'image/gif', 'image/bmp', 'image/webp']:
-                    all_images.append(f)
-                    print(f"  Found image: {f['name']} ({f['id']})")
-        except Exception as e:
-            print(f"  Error listing items in folder '{folder_id}': {e}")
-    return all_images, visited_folders
+            found += round(abs(float(item.get("price"))) * 100) in amounts
+        except (TypeError, ValueError):
+            pass
+    return found >= DUPLICATE_MIN_PRICE_SHARE * len(result["items"])
 
-# Process folder IDs
-def process_folder_ids(folder_id_input):
+def resolve_duplicate(result, cache=None, dedup=None):
     """
-    Entry point for processing all images in the specified Google Drive folder(s).
-    Traverses all folders and subfolders, collects images, and processes them.
+    Replaces the result of a duplicate by the result of the image it was matched to (which must have finished).
+    A near-duplicate candidate only reuses it if confirm_duplicate accepts it for the candidate's OCR text.
     Args:
-        folder_id_input (str): Comma-separated string of root folder IDs or a single folder ID.
+        result (PipelineResult): Result whose value is an image_dedup.Duplicate.
+        cache (ExtractionCache, optional): The result is also cached under the duplicate's own content hash.
+        dedup (DuplicateIndex, optional): Counts confirmed and rejected candidates and indexes rejected ones.
+    Returns:
+        PipelineResult or None: Result with the extraction (or error) of the matched image, stage "dedup";
+            None if the candidate was rejected and has to be extracted on its own (its value's preprocessed).
     """
-    if not folder_id_input:
-        print("No GOOGLE_DRIVE_FOLDER_ID found in environment variables.")
-        return
+    duplicate = result.value
+    value, error = duplicate.future.result()
+    if duplicate.preprocessed is not None:
+        if error is not None or not confirm_duplicate(value, duplicate.preprocessed[2]):
+            dedup_log.info("%s (%s) looks like image %s (distance %d), but its OCR text does not match that"
+                           " extraction: extracting it on its own", result.source['name'], result.source['id'],
+                           duplicate.leader, duplicate.distance, extra={"file_id": result.source['id']})
+            metrics.count("dedup_rejected")
+            if dedup:
+                dedup.reject(duplicate)
+            return None
+        metrics.count("dedup_hits")
+        if dedup:
+            dedup.confirm(duplicate)
+    dedup_log.info("%s (%s) is a near-duplicate of image %s (distance %d): reusing its extraction",
+                   result.source['name'], result.source['id'], duplicate.leader, duplicate.distance,
+                   extra={"file_id": result.source['id']})
+    if error is not None:
+        error = RuntimeError(f"duplicated image {duplicate.leader} failed: {error}")
+    elif cache and duplicate.content_hash != duplicate.leader:
+        cache.put(duplicate.content_hash, value)
+    return PipelineResult(result.source, value, error, "dedup")
+
+def resolve_duplicates(results, dedup, cache=None):
+    """
+    Hands the results of a finished run to the duplicate index and fills in the results of the duplicates.
+    Returns:
+        list: Indices of the rejected candidates, which still have to be extracted (their value is the Duplicate).
+    """
+    from image_dedup import Duplicate
+    for result in results:
+        if result is not None and not isinstance(result.value, Duplicate):
+            dedup.settle(result.source.get('md5Checksum'), result.value, result.error)
+    dedup.release()
+    rejected = []
+    for i, result in enumerate(results):
+        if result is not None and isinstance(result.value, Duplicate):
+            resolved = resolve_duplicate(result, cache, dedup)
+            if resolved is None:
+                rejected.append(i)
+            else:
+                results[i] = resolved
+    return rejected
+
+def ocr_stage_preload(ocr_options=None):
+    """
+    Modules the OCR worker processes import before their first receipt: the image libraries and the
+    module defining the selected engine (an engine registered by another module, e.g. a benchmark's
+    stand-in, only exists in a worker that imported it).
+    """
+    from ocr_engine import ENGINES
+    modules = ["PIL.Image", "ocr_engine", "image_preprocessing"]
+    engine = ENGINES.get((ocr_options or {}).get("engine"))
+    if engine is not None and engine.__module__ not in modules:
+        modules.append(engine.__module__)
+    return modules
+
+def ocr_stage(downloaded, adaptive=True, target_width=1000, max_tiles=0, ocr_options=None):
+    image_bytes, persist_path = downloaded
+    # Hash of the downloaded bytes, i.e. the Drive md5Checksum
+    content_hash = hashlib.md5(image_bytes).hexdigest()
+    return (content_hash,) + preprocess_image_bytes(image_bytes, persist_path=persist_path, adaptive=adaptive,
+                                                    target_width=target_width, max_tiles=max_tiles,
+                                                    ocr_options=ocr_options)
+
+def llm_stage(preprocessed, cache=None, reports=(), min_ocr_confidence=85, min_ocr_words=8, llm_client=None,
+              dedup=None):
+    content_hash, enhanced_jpeg, ocr_text, stats = preprocessed
+    duplicate = dedup.candidate(content_hash) if dedup else None
+    if duplicate is not None:
+        # Near-duplicate candidate: confirmed or rejected once the image it was matched to has finished
+        return Finished(duplicate._replace(preprocessed=preprocessed))
+    record_image_metrics(stats)
+    llm_log.debug("Sending receipt to LLM (%d bytes image, %d chars OCR text)", len(enhanced_jpeg), len(ocr_text))
+    result = extract_receipt_info_routed(enhanced_jpeg, ocr_text, llm_client or get_openai_client(), stats,
+                                         min_confidence=min_ocr_confidence, min_words=min_ocr_words)
+    # The results store finds the tokens and timings of the image by its content hash
+    stats["content_hash"] = content_hash
+    for report in reports:
+        report.add(stats)
+    if cache:
+        cache.put(content_hash, result)
+    return result
 
-    print(f"Raw folder ID input: '{folder_id_input}'")
+def collect_images(folder_id_input, cache=None, crawl_state_path=None, full_crawl=False, list_workers=8):
+    """
+    Lists the images below the root folder(s) and serves cached extractions.
+    Args:
+        folder_id_input (str): Comma-separated string of root folder IDs or a single folder ID.
+        cache (ExtractionCache, optional): Images whose Drive md5Checksum is cached are served from it.
+        crawl_state_path (str, optional): Drive crawl state file for incremental runs.
+        full_crawl (bool): Ignore the crawl state and list all folders again.
+        list_workers (int): Folders listed concurrently.
+    Returns:
+        tuple: (all_images, crawl_state, results, pending)
+            results (list): PipelineResult for cache hits, None for the other images.
+            pending (list): Indices of the images that still need to be processed.
+    """
+    log.info("Raw folder ID input: '%s'", folder_id_input)
 
     # Prepare root folder IDs
     if ',' in folder_id_input:
         root_folder_ids = [fid.strip() for fid in folder_id_input.split(',')]
-        print(f"Processing {len(root_folder_ids)} folder IDs: {root_folder_ids}")
+        log.info("Processing %d folder IDs: %s", len(root_folder_ids), root_folder_ids)
     else:
         root_folder_ids = [folder_id_input.strip()]
 
-    all_images, all_folders = bfs_collect_images_and_folders(root_folder_ids)
-    print(f"\nTotal images found: {len(all_images)}")
-    for img in all_images:
-        process_images_from_folder([img], img.get('parents', [None])[0])
+    crawl_state = None
+    if crawl_state_path:
+        all_images, crawl_state = incremental_crawl(root_folder_ids, get_thread_drive_service, crawl_state_path,
+                                                    workers=list_workers, full=full_crawl)
+    else:
+        all_images, all_folders = bfs_collect_images_and_folders(root_folder_ids, workers=list_workers)
+    log.info("Total images found: %d", len(all_images))
+    results, pending = lookup_cached(all_images, cache)
+    return all_images, crawl_state, results, pending
+
+def lookup_cached(all_images, cache=None):
+    """
+    Serves images whose Drive md5Checksum is in the extraction cache.
+    Returns:
+        tuple: (results, pending) - PipelineResult per cache hit (None otherwise) and the indices of the other images.
+    """
+    results = [None] * len(all_images)
+    pending = []
+    for i, img in enumerate(all_images):
+        cached = cache.get(img.get('md5Checksum')) if cache else None
+        if cached is not None:
+            log.info("Extraction cache hit: %s (%s)", img['name'], img['id'], extra={"file_id": img['id']})
+            log.debug("Receipt info:\n%s", json.dumps(cached, indent=2, ensure_ascii=False))
+            results[i] = PipelineResult(img, cached, None, "cache")
+        else:
+            pending.append(i)
+    if cache:
+        log.info("Extraction cache: %d hits, %d images to process", len(all_images) - len(pending), len(pending))
+    return results, pending
+
+def report_failures(results, crawl_state=None, crawl_state_path=None):
+    """Prints the failed images and saves the crawl state, keeping failed images pending for the next run."""
+    failed = [r for r in results if r.error is not None]
+    log.info("Processed %d of %d images (%d failed)", len(results) - len(failed), len(results), len(failed))
+    for r in failed:
+        log.warning("%s (%s) failed in stage '%s': %s", r.source['name'], r.source['id'], r.stage, r.error,
+                    extra={"file_id": r.source['id'], "stage": r.stage})
+    if crawl_state is not None:
+        # Advance the watermark only now; failed images are retried on the next run
+        crawl_state['pending'] = [r.source for r in failed]
+        save_crawl_state(crawl_state_path, crawl_state)
+
+# Process folder IDs
+def process_folder_ids(folder_id_input, download_workers=4, ocr_workers=None, llm_workers=4, queue_size=None, cache=None,
+                       crawl_state_path=None, full_crawl=False, list_workers=8, persist_images=False,
+                       adaptive_preprocessing=True, target_width=1000, max_tiles=0, min_ocr_confidence=85,
+                       min_ocr_words=8, llm_client=None, ocr_options=None, dedup=None, results_store=None):
+    """
+    Entry point for processing all images in the specified Google Drive folder(s).
+    Traverses all folders and subfolders, collects images, and processes them in a pipeline:
+    parallel downloads -> enhancement and OCR in a process pool -> concurrent LLM calls.
+    Each stage has its own worker count and a bounded input queue (backpressure).
+    Args:
+        folder_id_input (str): Comma-separated string of root folder IDs or a single folder ID.
+        download_workers (int): Concurrent Drive downloads.
+        ocr_workers (int, optional): Processes for enhancement and OCR (default: CPU count).
+        llm_workers (int): Concurrent LLM requests (the rate limits are enforced by llm_client's scheduler).
+        queue_size (int, optional): Max items waiting per stage (default: 2 * workers of that stage).
+        cache (ExtractionCache, optional): Images whose Drive md5Checksum is cached skip the pipeline entirely.
+        crawl_state_path (str, optional): Drive crawl state file. If given, only images added or modified
+            since the previous run (plus images that failed then) are processed.
+        full_crawl (bool): Ignore the crawl state and list all folders again.
+        list_workers (int): Folders listed concurrently.
+        persist_images (bool): [DEBUG] Write downloaded and enhanced images to downloads/.
+            By default images are only held in memory.
+        adaptive_preprocessing (bool): Crop, grayscale and downscale images before OCR and the LLM request.
+        target_width (int): Max receipt width in pixels for adaptive preprocessing.
+        max_tiles (int): Max vision tiles of the image sent to the LLM for adaptive preprocessing.
+        min_ocr_confidence (float): Min mean OCR word confidence for a text-only LLM request (0 always sends the image).
+        min_ocr_words (int): Min recognized words for a text-only LLM request.
+        llm_client (LLMScheduler or OpenAI, optional): Client for the LLM requests (default: the blocking client).
+        ocr_options (dict, optional): OCR engine options (see extract_text_with_ocr).
+        dedup (DuplicateIndex, optional): Near-duplicates of other images skip OCR and the LLM and reuse their extraction.
+        results_store (ResultsStore, optional): Each extracted receipt is written to it as soon as it finished.
+    Returns:
+        list: PipelineResult (source image metadata, receipt info, error, stage) per image, in Drive listing order.
+    """
+    if not folder_id_input:
+        log.warning("No GOOGLE_DRIVE_FOLDER_ID found in environment variables.")
+        return []
+
+    all_images, crawl_state, results, pending = collect_images(folder_id_input, cache=cache,
+                                                               crawl_state_path=crawl_state_path,
+                                                               full_crawl=full_crawl, list_workers=list_workers)
+    if results_store:
+        results_store.put_results(results)
+
+    from image_preprocessing import PreprocessingReport
+    report = PreprocessingReport()
+    routing_report = RoutingReport()
+    reports = (report, routing_report, results_store) if results_store else (report, routing_report)
+    stages = [
+        PipelineStage("download", partial(download_stage, persist=persist_images), workers=download_workers, queue_size=queue_size),
+        PipelineStage("ocr", partial(ocr_stage, adaptive=adaptive_preprocessing, target_width=target_width,
+                                     max_tiles=max_tiles, ocr_options=ocr_options),
+                      workers=ocr_workers or os.cpu_count() or 1,
+                      queue_size=queue_size, use_processes=True, preload=ocr_stage_preload(ocr_options)),
+        PipelineStage("llm", partial(llm_stage, cache=cache, reports=reports,
+                                     min_ocr_confidence=min_ocr_confidence, min_ocr_words=min_ocr_words,
+                                     llm_client=llm_client, dedup=dedup),
+                      workers=llm_workers, queue_size=queue_size),
+    ]
+    if dedup:
+        from image_dedup import Duplicate
+        stages.insert(1, PipelineStage("dedup", partial(dedup_stage, dedup=dedup, cache=cache),
+                                       workers=ocr_workers or os.cpu_count() or 1, queue_size=queue_size))
+
+    def store_result(result):
+        # Duplicates are stored once resolved, below
+        if not (dedup and isinstance(result.value, Duplicate)):
+            results_store.put_results([result])
+
+    on_result = store_result if results_store else None
+    for i, result in zip(pending, run_pipeline([all_images[i] for i in pending], stages, on_result=on_result)):
+        results[i] = result
+    if dedup:
+        duplicates = [i for i in pending if isinstance(results[i].value, Duplicate)]
+        rejected = resolve_duplicates(results, dedup, cache)
+        if rejected:
+            # Candidates whose OCR text did not match the extraction they were matched to: extracted on their own
+            extract = PipelineStage("llm", partial(llm_stage, cache=cache, reports=reports,
+                                                   min_ocr_confidence=min_ocr_confidence,
+                                                   min_ocr_words=min_ocr_words, llm_client=llm_client),
+                                    workers=llm_workers, queue_size=queue_size)
+            for i, result in zip(rejected, run_pipeline([results[i].value.preprocessed for i in rejected], [extract])):
+                results[i] = PipelineResult(all_images[i], result.value, result.error, result.stage)
+        if results_store:
+            results_store.put_results([results[i] for i in duplicates])
+    report.print_summary()
+    routing_report.print_summary()
+    report_failures(results, crawl_state, crawl_state_path)
+    return results
+
+def process_folder_ids_batch(folder_id_input, batch_dir, cache=None, crawl_state_path=None, full_crawl=False,
+                             list_workers=8, download_workers=4, ocr_workers=None, queue_size=None,
+                             adaptive_preprocessing=True, target_width=1000, max_tiles=0, poll_interval=30,
+                             max_batch_bytes=MAX_BATCH_BYTES, ocr_options=None, dedup=None, results_store=None):
+    """
+    Bulk mode: downloads and OCRs all images, writes their LLM requests (prompt + OCR text + image) to
+    JSONL files, submits them to the OpenAI Batch API, waits for completion and post-processes the results.
+    All progress is kept in batch_dir; if the run is interrupted, calling it again resumes it
+    (no re-crawl, prepared requests are not rebuilt, submitted batches are polled instead of resubmitted).
+    Args:
+        folder_id_input (str): Comma-separated string of root folder IDs or a single folder ID.
+        batch_dir (str): Working directory of the batch run.
+        cache (ExtractionCache, optional): Cached images are skipped; batch results are added to the cache.
+        crawl_state_path (str, optional): Drive crawl state file for incremental runs.
+        full_crawl (bool): Ignore the crawl state and list all folders again.
+        list_workers (int): Folders listed concurrently.
+        download_workers (int): Concurrent Drive downloads.
+        ocr_workers (int, optional): Processes for enhancement and OCR (default: CPU count).
+        queue_size (int, optional): Max items waiting per stage.
+        adaptive_preprocessing (bool): Crop, grayscale and downscale images before OCR and the LLM request.
+        target_width (int): Max receipt width in pixels for adaptive preprocessing.
+        max_tiles (int): Max vision tiles of the image sent to the LLM for adaptive preprocessing.
+        poll_interval (float): Seconds between batch status polls.
+        max_batch_bytes (int): Max size of one batch input file.
+        ocr_options (dict, optional): OCR engine options (see extract_text_with_ocr).
+        dedup (DuplicateIndex, optional): Copies of other images (same bytes) share their batch request; near-duplicates
+            of images extracted in earlier runs reuse that extraction if their OCR text confirms it.
+        results_store (ResultsStore, optional): The extracted receipts are written to it once the batches are collected.
+    Returns:
+        list: PipelineResult (source image metadata, receipt info, error, stage) per image, in Drive listing order.
+    """
+    run = BatchRun(batch_dir)
+    if run.resumed:
+        log.info("Batch: resuming the unfinished run in %s", batch_dir)
+        all_images, crawl_state = run.state["images"], run.state["crawl_state"]
+        results, pending = lookup_cached(all_images, cache)
+    else:
+        if not folder_id_input:
+            log.warning("No GOOGLE_DRIVE_FOLDER_ID found in environment variables.")
+            return []
+        all_images, crawl_state, results, pending = collect_images(folder_id_input, cache=cache,
+                                                                   crawl_state_path=crawl_state_path,
+                                                                   full_crawl=full_crawl, list_workers=list_workers)
+        run.state["images"], run.state["crawl_state"] = all_images, crawl_state
+        run.save()
+
+    # Requests are keyed by the image content hash (the Drive md5Checksum): identical images share one request
+    content_hashes = {all_images[i]['id']: all_images[i].get('md5Checksum') for i in pending}
+    written = run.prepared_ids()
+    to_prepare = [all_images[i] for i in pending
+                  if content_hashes[all_images[i]['id']] not in written and all_images[i]['id'] not in run.settled]
+    preparation_failures = {}
+    from image_preprocessing import PreprocessingReport
+    report = PreprocessingReport()
+
+    def add_request(preprocessed):
+        content_hash, enhanced_jpeg, ocr_text, stats = preprocessed
+        record_image_metrics(stats)
+        report.add(stats)
+        if content_hash not in written:
+            written.add(content_hash)
+            run.add_request(content_hash, build_llm_request(enhanced_jpeg, ocr_text), {"ocr_text": ocr_text},
+                            max_bytes=max_batch_bytes)
+        return content_hash
+
+    def batch_request_stage(preprocessed):
+        duplicate = dedup.candidate(preprocessed[0]) if dedup else None
+        if duplicate is not None:
+            if duplicate.future.done():
+                # Matched to an image extracted in an earlier run: confirmed or rejected below
+                return Finished(duplicate._replace(preprocessed=preprocessed))
+            # Matched to an image of this run, whose extraction is only known once the batches finished
+            dedup.reject(duplicate)
+        return add_request(preprocessed)
+
+    if to_prepare:
+        log.info("Batch: preparing requests for %d images", len(to_prepare))
+        stages = [
+            PipelineStage("download", download_stage, workers=download_workers, queue_size=queue_size),
+            PipelineStage("ocr", partial(ocr_stage, adaptive=adaptive_preprocessing, target_width=target_width,
+                                         max_tiles=max_tiles, ocr_options=ocr_options),
+                          workers=ocr_workers or os.cpu_count() or 1,
+                          queue_size=queue_size, use_processes=True, preload=ocr_stage_preload(ocr_options)),
+            # One writer thread: batch input files are appended sequentially
+            PipelineStage("batch", batch_request_stage, workers=1, queue_size=queue_size),
+        ]
+        if dedup:
+            from image_dedup import Duplicate
+            stages.insert(1, PipelineStage("dedup", partial(dedup_stage, dedup=dedup, cache=cache),
+                                           workers=ocr_workers or os.cpu_count() or 1, queue_size=queue_size))
+        for result in run_pipeline(to_prepare, stages):
+            if result.error is not None:
+                preparation_failures[result.source['id']] = result
+            elif dedup and isinstance(result.value, Duplicate):
+                if result.value.future.done():
+                    resolved = resolve_duplicate(result, cache, dedup)
+                    if resolved is not None:
+                        run.settle(result.source['id'], resolved.value, resolved.error)
+                    else:
+                        content_hashes[result.source['id']] = add_request(result.value.preprocessed)
+                else:
+                    # Copy of an image of this run (same bytes): it shares that image's batch request
+                    content_hashes[result.source['id']] = result.value.leader
+            else:
+                content_hashes[result.source['id']] = result.value
+        if dedup:
+            dedup.release()
+        run.flush()
+        run.save()
+        report.print_summary()
+
+    client = get_openai_client()
+    with metrics.span("batch_submit"):
+        run.submit(client)
+    with metrics.span("batch_wait"):
+        run.wait(client, poll_interval=poll_interval)
+
+    input_tokens = 0
+    for chunk in run.state["chunks"]:
+        if chunk["collected"]:
+            continue
+        chunk_results = list(run.results(client, chunk))
+        succeeded = [r for r in chunk_results if r[4] is None]
+        # The receipts of a chunk are post-processed together (one MCP request per store for all its items)
+        with metrics.span("postprocess"):
+            postprocessed = postprocess_receipt_infos([(output_text, item["ocr_text"])
+                                                       for _, item, output_text, _, _ in succeeded])
+        postprocessed = {id(r): result for r, result in zip(succeeded, postprocessed)}
+        for chunk_result in chunk_results:
+            custom_id, item, output_text, usage, error = chunk_result
+            result = None
+            if error is None:
+                result = postprocessed[id(chunk_result)]
+                input_tokens += (usage or {}).get("input_tokens") or 0
+                metrics.count("llm_requests")
+                metrics.count("llm_input_tokens", (usage or {}).get("input_tokens"))
+                metrics.count("llm_output_tokens", (usage or {}).get("output_tokens"))
+                if result is None:
+                    error = "LLM output could not be post-processed"
+                elif cache:
+                    cache.put(custom_id, result)
+            item["result"], item["error"] = result, error and str(error)
+            item["usage"] = usage
+        run.mark_collected(chunk)
+    log.info("Batch: %d batches collected, %d input tokens in this run", len(run.state['chunks']), input_tokens)
+
+    for i in pending:
+        image = all_images[i]
+        if image['id'] in preparation_failures:
+            results[i] = preparation_failures[image['id']]
+            continue
+        settled = run.settled.get(image['id'])
+        if settled is not None:
+            # Near-duplicate of an image extracted in an earlier run
+            error = settled["error"] and RuntimeError(settled["error"])
+            results[i] = PipelineResult(image, settled["result"], error, "dedup")
+            continue
+        item = run.state["items"].get(content_hashes[image['id']])
+        if item is None:
+            results[i] = PipelineResult(image, None, RuntimeError("no batch request was prepared"), "batch")
+        elif item.get("error"):
+            results[i] = PipelineResult(image, None, RuntimeError(item["error"]), "batch")
+        else:
+            results[i] = PipelineResult(image, item["result"], None, "batch")
+            shared = content_hashes[image['id']] != image.get('md5Checksum')
+            if shared and cache:
+                # Near-duplicate that shared another image's request
+                cache.put(image.get('md5Checksum'), item["result"])
+            if results_store:
+                # The tokens are counted for the image that made the request
+                usage = {} if shared else item.get("usage") or {}
+                results_store.put(image, item["result"], "batch", {"input_tokens": usage.get("input_tokens"),
+                                                                   "output_tokens": usage.get("output_tokens")})
+    if results_store:
+        # Cache hits and near-duplicates of earlier runs
+        results_store.put_results(r for r in results if r.stage != "batch")
+    report_failures(results, crawl_state, crawl_state_path)
+    run.finish()
+    return results
 
 # Run the function if folder_id is set
 if __name__ == "__main__":
+    # Modules importing receipt_info_extractor (the extraction service) share this module and its clients
+    sys.modules.setdefault("receipt_info_extractor", sys.modules[__name__])
     parser = argparse.ArgumentParser(description="Receipt Info Extractor")
-    parser.add_argument('-d', '--debug', action='store_true', help='Enable debug logging to file')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='Enable debug logging, also to output/receipts.jsonl unless --log-file is given')
+    parser.add_argument('--log-level', default='INFO', help='Log level (DEBUG, INFO, WARNING, ERROR)')
+    parser.add_argument('--log-file', default=None, help='JSON-lines log file (rotated)')
+    parser.add_argument('--log-json', action='store_true', help='Write JSON log records to the console too')
+    parser.add_argument('--log-max-mb', type=int, default=10, help='Size at which the log file is rotated, in MB')
+    parser.add_argument('--log-backups', type=int, default=5, help='Rotated log files kept')
+    parser.add_argument('--log-sample', action='append', default=[], metavar='STAGE=RATE',
+                        help='Keep only this fraction of the DEBUG/INFO records of a stage, e.g. catalog=0.1 (repeatable)')
+    parser.add_argument('--download-workers', type=int, default=8, help='Concurrent Drive downloads (one pooled HTTP session each)')
+    parser.add_argument('--download-chunk-mb', type=float, default=8, help='Size of one Drive range request in MB')
+    parser.add_argument('--download-retries', type=int, default=5,
+                        help='Retries of a Drive download that makes no progress (interrupted transfers resume)')
+    parser.add_argument('--ocr-workers', type=int, default=None, help='Processes for enhancement and OCR (default: CPU count)')
+    parser.add_argument('--llm-workers', type=int, default=16, help='Concurrent LLM requests')
+    parser.add_argument('--rpm', type=int, default=None,
+                        help='LLM requests per minute (default: the account limit reported by the API)')
+    parser.add_argument('--tpm', type=int, default=None,
+                        help='LLM tokens per minute (default: the account limit reported by the API)')
+    parser.add_argument('--llm-timeout', type=float, default=120, help='Timeout of one LLM request in seconds')
+    parser.add_argument('--llm-max-retries', type=int, default=6,
+                        help='Retries of a failed LLM request (429, timeout, 5xx), with jittered backoff')
+    parser.add_argument('--queue-size', type=int, default=None, help='Max images waiting per stage (default: 2x the stage workers)')
+    parser.add_argument('--crawl-state', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'drive_crawl_state.json'),
+                        help='Drive crawl state file (watermark for incremental runs)')
+    parser.add_argument('--full-crawl', action='store_true', help='Ignore the crawl state and process all images again')
+    parser.add_argument('--list-workers', type=int, default=8, help='Drive folders listed concurrently')
+    parser.add_argument('--persist-images', action='store_true',
+                        help='[DEBUG] Write downloaded and enhanced images to downloads/ (default: in memory only)')
+    parser.add_argument('--legacy-preprocessing', action='store_true',
+                        help='Only boost the contrast of the full image (no crop, grayscale or downscale)')
+    parser.add_argument('--target-width', type=int, default=1000,
+                        help='Receipt width in pixels images are downscaled to (0 disables downscaling)')
+    parser.add_argument('--max-tiles', type=int, default=0,
+                        help='Max 512px vision tiles of the image sent to the LLM (default 0 = no limit); a limit scales '
+                             'long receipts below what the API itself keeps, so small print may become illegible')
+    parser.add_argument('--min-ocr-confidence', type=float, default=85,
+                        help='Min mean OCR word confidence for a text-only LLM request (0 always sends the image)')
+    parser.add_argument('--min-ocr-words', type=int, default=8, help='Min recognized words for a text-only LLM request')
+    from ocr_engine import ENGINES
+    parser.add_argument('--ocr-engine', default='auto', choices=['auto'] + sorted(ENGINES),
+                        help='OCR engine: tesserocr (in-process, kept loaded per worker), the tesseract command line, or auto (tesserocr if installed)')
+    parser.add_argument('--ocr-strip-workers', type=int, default=4, help='Strips of a tall receipt OCR\'d concurrently per image')
+    parser.add_argument('--ocr-max-aspect', type=float, default=3.0,
+                        help='Height/width ratio above which a receipt is OCR\'d in overlapping strips (0 never splits)')
+    parser.add_argument('--batch', action='store_true',
+                        help='Send all LLM requests as OpenAI Batch API jobs (cheaper, for large imports); resumable')
+    parser.add_argument('--batch-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'batch'),
+                        help='Working directory of the batch run (state, request and result files)')
+    parser.add_argument('--batch-poll-interval', type=float, default=30, help='Seconds between batch status polls')
+    parser.add_argument('--batch-max-mb', type=int, default=190, help='Max size of one batch input file in MB')
+    parser.add_argument('--run-report', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'run_report.json'),
+                        help='JSON file the per-stage timing and token report is written to')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve live metrics on http://127.0.0.1:PORT/metrics (Prometheus) and /metrics.json')
+    parser.add_argument('--cache-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'extractions.sqlite'),
+                        help='Extraction cache database')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the extraction cache')
+    parser.add_argument('--cache-max-entries', type=int, default=100000, help='Max cached receipts')
+    parser.add_argument('--cache-max-mb', type=int, default=512, help='Max total size of cached results in MB')
+    parser.add_argument('--category-cache-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'categories.sqlite'),
+                        help='Item name -> catalog category cache, shared with the category service')
+    parser.add_argument('--no-category-cache', action='store_true', help='Disable the item name -> category cache')
+    parser.add_argument('--category-cache-ttl-days', type=float, default=30, help='Days a cached category match stays valid')
+    parser.add_argument('--catalogs', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'products', 'catalogs.json'),
+                        help='Store -> product catalog config (see catalog_registry.py)')
+    parser.add_argument('--catalog-idle-minutes', type=float, default=10,
+                        help='Minutes without a lookup after which a store catalog is unloaded')
+    parser.add_argument('--dedup-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'image_hashes.sqlite'),
+                        help='Perceptual hashes of the processed images, for near-duplicate detection (see image_dedup.py)')
+    parser.add_argument('--no-dedup', action='store_true', help='Process near-duplicate images separately')
+    parser.add_argument('--dedup-max-distance', type=int, default=32,
+                        help='Max differing perceptual hash bits (of 1024) of a near-duplicate candidate (0 = identical hashes only)')
+    parser.add_argument('--results-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output', 'results.sqlite'),
+                        help='SQLite results store the extracted receipts are written to (see results_store.py)')
+    parser.add_argument('--no-results', action='store_true', help='Do not write the extracted receipts to the results store')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run as a long-lived extraction service with an HTTP job API (see extraction_service.py)')
+    parser.add_argument('--service-host', default='127.0.0.1', help='Address the extraction service binds to')
+    parser.add_argument('--service-port', type=int, default=8100, help='Port of the extraction service')
+    parser.add_argument('--watch-interval', type=float, default=0,
+                        help='With --serve: seconds between incremental crawls of GOOGLE_DRIVE_FOLDER_ID (0 = no watch)')
     args = parser.parse_args()
 
-    log_file = None
-    if args.debug:
-        # [DEBUG] Enable debug logging to file
-        log_file, log_path = setup_debug_logging()
-        print(f"[DEBUG] Output will be logged to: {log_path}")
+    load_env()
+    # Folder ID can be provided as an environment variable or directly in the code
+    folder_id_input = os.getenv("GOOGLE_DRIVE_FOLDER_ID")  # or: folder_id = 'your_folder_id'
+
+    log_file = args.log_file or (os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output', 'receipts.jsonl')
+                                 if args.debug else None)
+    log_listener = setup_logging('DEBUG' if args.debug else args.log_level, log_file=log_file,
+                                 json_console=args.log_json, max_bytes=args.log_max_mb * 1024 * 1024,
+                                 backups=args.log_backups, sample_rates=parse_sample_rates(args.log_sample))
+    if log_file:
+        log.debug("Logging JSON records to %s", log_file)
+
+    from catalog_registry import configure_catalogs
+    configure_catalogs(args.catalogs, idle_seconds=args.catalog_idle_minutes * 60)
+    cache = None
+    if not args.no_cache:
+        version = get_extraction_version(adaptive=not args.legacy_preprocessing, target_width=args.target_width,
+                                         max_tiles=args.max_tiles, ocr_max_aspect=args.ocr_max_aspect,
+                                         min_ocr_confidence=args.min_ocr_confidence,
+                                         min_ocr_words=args.min_ocr_words, batch=args.batch)
+        cache = ExtractionCache(args.cache_path, version, max_entries=args.cache_max_entries,
+                                max_bytes=args.cache_max_mb * 1024 * 1024)
+
+    from category_cache import configure_category_cache
+    category_cache = configure_category_cache(None if args.no_category_cache else args.category_cache_path,
+                                              ttl=args.category_cache_ttl_days * 24 * 3600)
+    dedup = None
+    if not args.no_dedup:
+        from image_dedup import DuplicateIndex
+        dedup = DuplicateIndex(args.dedup_path, max_distance=args.dedup_max_distance)
+    results_store = None
+    if not args.no_results:
+        from results_store import ResultsStore
+        results_store = ResultsStore(args.results_path)
+
+    # Rate-limit-aware scheduler for the synchronous LLM requests; it does the retries itself
+    from openai import AsyncOpenAI
+    from llm_scheduler import LLMScheduler
+    llm_scheduler = LLMScheduler(AsyncOpenAI(max_retries=0), rpm=args.rpm, tpm=args.tpm,
+                                 max_retries=args.llm_max_retries, request_timeout=args.llm_timeout)
+
+    configure_drive_downloads(sessions=args.download_workers, chunk_size=int(args.download_chunk_mb * 1024 * 1024),
+                              max_retries=args.download_retries)
+    ocr_options = {"engine": args.ocr_engine, "strip_workers": args.ocr_strip_workers, "max_aspect": args.ocr_max_aspect}
+
+    service = None
+    if args.serve:
+        from extraction_service import ExtractionService
+        service = ExtractionService(cache=cache, llm_client=llm_scheduler, download_workers=args.download_workers,
+                                    ocr_workers=args.ocr_workers, llm_workers=args.llm_workers,
+                                    queue_size=args.queue_size, list_workers=args.list_workers,
+                                    adaptive_preprocessing=not args.legacy_preprocessing,
+                                    target_width=args.target_width, max_tiles=args.max_tiles,
+                                    min_ocr_confidence=args.min_ocr_confidence, min_ocr_words=args.min_ocr_words,
+                                    ocr_options=ocr_options, dedup=dedup, results_store=results_store)
+        service.start()
+        # Stop gracefully on SIGTERM too (finish the queued receipts, save caches and the report)
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
 
     start_time = datetime.now()
     try:
-        if not folder_id_input:
-            print("No folder ID provided.")
+        if service:
+            if args.watch_interval > 0 and folder_id_input:
+                service.watch(folder_id_input, args.watch_interval, args.crawl_state)
+            try:
+                service.serve(args.service_port, host=args.service_host)
+            except KeyboardInterrupt:
+                log.info("Extraction service interrupted")
+        elif args.batch:
+            process_folder_ids_batch(folder_id_input, args.batch_dir, cache=cache, crawl_state_path=args.crawl_state,
+                                     full_crawl=args.full_crawl, list_workers=args.list_workers,
+                                     download_workers=args.download_workers, ocr_workers=args.ocr_workers,
+                                     queue_size=args.queue_size, adaptive_preprocessing=not args.legacy_preprocessing,
+                                     target_width=args.target_width, max_tiles=args.max_tiles,
+                                     poll_interval=args.batch_poll_interval,
+                                     max_batch_bytes=args.batch_max_mb * 1024 * 1024, ocr_options=ocr_options,
+                                     dedup=dedup, results_store=results_store)
+        elif not folder_id_input:
+            log.warning("No folder ID provided.")
         else:
-            process_folder_ids(folder_id_input)
+            process_folder_ids(folder_id_input, download_workers=args.download_workers, ocr_workers=args.ocr_workers,
+                               llm_workers=args.llm_workers, queue_size=args.queue_size, cache=cache,
+                               crawl_state_path=args.crawl_state, full_crawl=args.full_crawl, list_workers=args.list_workers,
+                               persist_images=args.persist_images, adaptive_preprocessing=not args.legacy_preprocessing,
+                               target_width=args.target_width, max_tiles=args.max_tiles,
+                               min_ocr_confidence=args.min_ocr_confidence, min_ocr_words=args.min_ocr_words,
+                               llm_client=llm_scheduler, ocr_options=ocr_options, dedup=dedup,
+                               results_store=results_store)
     finally:
+        if service:
+            service.close()
+        llm_scheduler.print_summary()
+        llm_scheduler.close()
+        if _drive_downloader is not None:
+            _drive_downloader.print_summary()
+            _drive_downloader.close()
+        if cache:
+            log.info("Extraction cache: %d hits, %d misses", cache.hits, cache.misses)
+            cache.close()
+        if category_cache:
+            category_stats = category_cache.stats()
+            if category_stats["hit_rate"] is not None:
+                log.info("Category cache: %d hits, %d misses (%.0f%% hit rate)", category_stats["hits"],
+                         category_stats["misses"], category_stats["hit_rate"] * 100)
+            category_cache.close()
+        if dedup:
+            dedup_stats = dedup.stats()
+            log.info("Near-duplicate detection: %d of %d downloaded images were duplicates, %d candidates rejected"
+                     " (%d hashes known)", dedup_stats["duplicates"], dedup_stats["checks"], dedup_stats["rejected"],
+                     dedup_stats["hashes"])
+            dedup.close()
+        if results_store:
+            results_store.close()
+            results_store.print_summary()
+        metrics.print_summary()
+        if args.run_report:
+            metrics.write_report(args.run_report)
+        metrics.stop_server()
         end_time = datetime.now()
         elapsed = end_time - start_time
-        print(f"[INFO] Execution finished at {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"[INFO] Total execution time: {elapsed}")
-        if log_file:
-            log_file.close()
\ No newline at end of file
+        log.info("Execution finished at %s", end_time.strftime('%Y-%m-%d %H:%M:%S'))
+        log.info("Total execution time: %s", elapsed)
+        log_listener.stop()
\ No newline at end of file
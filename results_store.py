@@ -0,0 +1,308 @@
+# ---
+# RESULTS STORE ---
+#
+# Extracted receipts, queryable: one indexed SQLite database (output/results.sqlite, WAL mode, so it
+# can be queried while a run writes to it) with a row per receipt and a row per line item.
+#
+#     receipts  file_id (unique), file name, content hash, date, store, total, item count, where the
+#               result came from (llm / cache / dedup / batch), OCR route (text / vision / escalated),
+#               LLM input/output tokens, enhancement/OCR/LLM seconds
+#     items     receipt, position, date, store, category, name, price
+#
+# Items repeat the date and store of their receipt, so filters and sums by date, store and category
+# over hundreds of thousands of items are answered from the items indexes alone (see
+# benchmarks/bench_results.py: a few ms to ~100 ms over 450,000 items).
+#
+# Results are validated against ReceiptInfo (receipt_schema.py) and queued; a writer thread appends
+# them in batches (one transaction per batch_size receipts or flush_seconds), so the pipeline never
+# waits for the disk. A file is stored once: a new, different result for the same file ID replaces
+# its rows, an unchanged one (e.g. a cache hit on the next run) is skipped.
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from run_metrics import metrics
+
+DEFAULT_RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "results.sqlite")
+# Bumped when the table layout changes; the tables of another layout are dropped (results can be re-extracted from
+# the extraction cache)
+SCHEMA_VERSION = 1
+GROUP_COLUMNS = {"category": "category", "store": "store", "month": "substr(date, 1, 7)", "date": "date"}
+
+log = logging.getLogger("receipts.results")
+
+_FLUSH = object()
+_STOP = object()
+
+
+class ResultsStore:
+    """
+    SQLite results store with a background writer, safe to share between threads.
+    Args:
+        path (str): SQLite database file.
+        batch_size (int): Max receipts written in one transaction.
+        flush_seconds (float): Max seconds a queued receipt waits for its batch to fill up.
+    """
+
+    def __init__(self, path=DEFAULT_RESULTS_PATH, batch_size=500, flush_seconds=1.0):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.written = 0
+        self.unchanged = 0
+        self.rejected = 0
+        # Content hash -> stats of an image extracted in this process, until its result is stored (see add)
+        self._stats = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS items")
+                self._conn.execute("DROP TABLE IF EXISTS receipts")
+                self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS receipts ("
+                " id INTEGER PRIMARY KEY,"
+                " file_id TEXT NOT NULL UNIQUE,"
+                " file_name TEXT,"
+                " content_hash TEXT,"
+                " result_hash TEXT NOT NULL,"
+                " date TEXT NOT NULL,"
+                " store TEXT NOT NULL,"
+                " total REAL NOT NULL,"
+                " item_count INTEGER NOT NULL,"
+                " source TEXT NOT NULL,"
+                " route TEXT,"
+                " input_tokens INTEGER,"
+                " output_tokens INTEGER,"
+                " enhance_seconds REAL,"
+                " ocr_seconds REAL,"
+                " llm_seconds REAL,"
+                " written REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_receipts_date ON receipts (date)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_receipts_store_date ON receipts (store, date)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                " receipt_id INTEGER NOT NULL,"
+                " position INTEGER NOT NULL,"
+                " date TEXT NOT NULL,"
+                " store TEXT NOT NULL,"
+                " category TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " price REAL NOT NULL,"
+                " PRIMARY KEY (receipt_id, position)) WITHOUT ROWID")
+            # Covering indexes (price included): sums per category/store over a date range never read the table
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_items_date ON items (date, category, price)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_items_store_date ON items (store, date, category, price)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_items_category_date ON items (category, date, price)")
+        self._writer = threading.Thread(target=self._write_loop, name="results-writer", daemon=True)
+        self._writer.start()
+
+    # --- Writing ---
+
+    def add(self, stats):
+        """
+        Report interface (see receipt_info_extractor.llm_stage): keeps the tokens and timings of an extracted
+        image until its result is stored.
+        """
+        if stats.get("content_hash"):
+            with self._lock:
+                self._stats[stats["content_hash"]] = stats
+
+    def put(self, source, result, stage, stats=None):
+        """
+        Queues an extracted receipt; returns at once.
+        Args:
+            source (dict): File metadata (id, name and md5Checksum).
+            result (dict): Post-processed receipt info.
+            stage (str): Where the result came from ("llm", "cache", "dedup", "batch").
+            stats (dict, optional): Image stats with tokens and timings (default: the stats passed to add()
+                for the file's content hash, if any).
+        """
+        if result is None:
+            return
+        if stats is None:
+            with self._lock:
+                stats = self._stats.pop(source.get("md5Checksum"), None)
+        self._queue.put((source, result, stage, stats or {}, time.time()))
+
+    def put_results(self, results):
+        """Queues the successful PipelineResults of a run."""
+        for result in results:
+            if result is not None and result.error is None:
+                self.put(result.source, result.value, result.stage)
+
+    def flush(self):
+        """Blocks until all queued receipts are written."""
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            batch, taken = [], 0
+            entry = self._queue.get()
+            deadline = time.monotonic() + self.flush_seconds
+            while True:
+                taken += 1
+                if entry is _STOP:
+                    stopping = True
+                    break
+                if entry is _FLUSH:
+                    break
+                batch.append(entry)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            try:
+                if batch:
+                    self._write_batch(batch)
+            except Exception as e:
+                log.warning("Could not store %d receipts: %s", len(batch), e)
+            finally:
+                # One task_done per entry taken from the queue (flush() joins the queue)
+                for _ in range(taken):
+                    self._queue.task_done()
+
+    def _write_batch(self, batch):
+        from pydantic import ValidationError
+        from receipt_schema import ReceiptInfo
+        start = time.perf_counter()
+        receipts = []
+        for source, result, stage, stats, written in batch:
+            try:
+                receipt = ReceiptInfo.model_validate(result)
+            except ValidationError as e:
+                self.rejected += 1
+                problems = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                log.warning("Result of %s (%s) not stored, it does not match the receipt schema: %s",
+                            source.get("name"), source.get("id"), problems, extra={"file_id": source.get("id")})
+                continue
+            payload = json.dumps(result, sort_keys=True, ensure_ascii=False, default=str)
+            receipts.append((source, receipt, hashlib.md5(payload.encode("utf-8")).hexdigest(), stage, stats,
+                             written))
+        written_count = 0
+        with self._lock, self._conn:
+            file_ids = list(dict.fromkeys(source["id"] for source, *_ in receipts))
+            existing = {}
+            for offset in range(0, len(file_ids), 500):
+                chunk = file_ids[offset:offset + 500]
+                existing.update((file_id, (receipt_id, result_hash)) for receipt_id, file_id, result_hash in
+                                self._conn.execute(f"SELECT id, file_id, result_hash FROM receipts WHERE file_id IN"
+                                                   f" ({','.join('?' * len(chunk))})", chunk))
+            item_rows = []
+            for source, receipt, result_hash, stage, stats, written in receipts:
+                previous = existing.get(source["id"])
+                if previous and previous[1] == result_hash:
+                    self.unchanged += 1
+                    continue
+                if previous:
+                    self._conn.execute("DELETE FROM items WHERE receipt_id = ?", (previous[0],))
+                    self._conn.execute("DELETE FROM receipts WHERE id = ?", (previous[0],))
+                date, store = receipt.date.isoformat(), receipt.store
+                receipt_id = self._conn.execute(
+                    "INSERT INTO receipts (file_id, file_name, content_hash, result_hash, date, store, total,"
+                    " item_count, source, route, input_tokens, output_tokens, enhance_seconds, ocr_seconds,"
+                    " llm_seconds, written) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (source["id"], source.get("name"), source.get("md5Checksum"), result_hash, date, store,
+                     round(sum(item.price for item in receipt.items), 2), len(receipt.items), stage,
+                     stats.get("route"), stats.get("input_tokens"), stats.get("output_tokens"),
+                     stats.get("enhance_seconds"), stats.get("ocr_seconds"), stats.get("llm_seconds"),
+                     written)).lastrowid
+                existing[source["id"]] = (receipt_id, result_hash)
+                item_rows.extend((receipt_id, position, date, store, item.category, item.name, item.price)
+                                 for position, item in enumerate(receipt.items))
+                written_count += 1
+            self._conn.executemany("INSERT INTO items (receipt_id, position, date, store, category, name, price)"
+                                   " VALUES (?, ?, ?, ?, ?, ?, ?)", item_rows)
+            self.written += written_count
+        metrics.record("results_write", time.perf_counter() - start)
+        metrics.count("results_written", written_count)
+        log.debug("Stored %d receipts (%d items) in %.1f ms", written_count, len(item_rows),
+                  (time.perf_counter() - start) * 1000)
+
+    # --- Queries ---
+
+    @staticmethod
+    def _where(date_from, date_to, store, category, prefix=""):
+        clauses, params = [], []
+        for clause, value in (("store = ?", store), ("category = ?", category), ("date >= ?", date_from),
+                              ("date <= ?", date_to)):
+            if value is not None:
+                clauses.append(prefix + clause)
+                params.append(str(value))
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def items(self, date_from=None, date_to=None, store=None, category=None, limit=None):
+        """
+        Line items, newest first.
+        Args:
+            date_from (str or date, optional): First date (inclusive, YYYY-MM-DD).
+            date_to (str or date, optional): Last date (inclusive).
+            store (str, optional): Store name (as normalized, e.g. "IKEA").
+            category (str, optional): Item category.
+            limit (int, optional): Max items.
+        Returns:
+            list: Dicts with file_id, date, store, category, name and price.
+        """
+        where, params = self._where(date_from, date_to, store, category, prefix="i.")
+        sql = ("SELECT r.file_id, i.date, i.store, i.category, i.name, i.price FROM items i"
+               f" JOIN receipts r ON r.id = i.receipt_id{where} ORDER BY i.date DESC, i.receipt_id, i.position")
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(zip(("file_id", "date", "store", "category", "name", "price"), row)) for row in rows]
+
+    def spending(self, group_by="category", date_from=None, date_to=None, store=None, category=None):
+        """
+        Sum and count of the item prices per category, store, month or date.
+        Args:
+            group_by (str): "category", "store", "month" or "date".
+            date_from, date_to, store, category: Filters (see items).
+        Returns:
+            list: Dicts with the group value, total and items, largest total first.
+        """
+        column = GROUP_COLUMNS[group_by]
+        where, params = self._where(date_from, date_to, store, category)
+        sql = (f"SELECT {column}, ROUND(SUM(price), 2), COUNT(*) FROM items{where} GROUP BY {column}"
+               f" ORDER BY SUM(price) DESC")
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [{group_by: value, "total": total, "items": count} for value, total, count in rows]
+
+    def usage(self, date_from=None, date_to=None, store=None):
+        """Receipts, LLM tokens and mean timings of the stored receipts (by receipt date)."""
+        where, params = self._where(date_from, date_to, store, None)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*), SUM(input_tokens), SUM(output_tokens), AVG(enhance_seconds), AVG(ocr_seconds),"
+                f" AVG(llm_seconds) FROM receipts{where}", params).fetchone()
+        return dict(zip(("receipts", "input_tokens", "output_tokens", "avg_enhance_seconds", "avg_ocr_seconds",
+                         "avg_llm_seconds"), row))
+
+    def print_summary(self):
+        if self.written or self.unchanged or self.rejected:
+            log.info("Results store: %d receipts written, %d unchanged, %d rejected (%s)", self.written,
+                     self.unchanged, self.rejected, self.path)
+
+    def close(self):
+        """Writes the queued receipts and stops the writer."""
+        self._queue.put(_STOP)
+        self._writer.join()
+        with self._lock:
+            self._conn.close()
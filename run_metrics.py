@@ -0,0 +1,195 @@
+# ---
+# RUN METRICS ---
+#
+# Per-stage instrumentation for a run: every instrumented stage (Drive listing, download, enhance,
+# OCR, LLM call, MCP lookup, local fuzzy fallback, ...) records its latency and the bytes it moved;
+# counters aggregate tokens and other totals. At the end of a run the report (counts, p50/p95/max
+# latencies, bytes, counters) is written as JSON; while running it can be served over HTTP
+# (/metrics in Prometheus text format, /metrics.json).
+#
+# Stages running in the OCR process pool cannot record into the parent's registry; their timings
+# travel back in the image stats and are recorded by the caller.
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger("receipts.metrics")
+
+
+class _StageStats:
+    def __init__(self, max_samples):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.samples = []
+        self.max_samples = max_samples
+
+    def add(self, seconds, nbytes, error, rng):
+        self.count += 1
+        self.errors += bool(error)
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes or 0
+        # Reservoir sampling keeps the percentiles representative with bounded memory
+        if len(self.samples) < self.max_samples:
+            self.samples.append(seconds)
+        else:
+            slot = rng.randrange(self.count)
+            if slot < self.max_samples:
+                self.samples[slot] = seconds
+
+    def summary(self):
+        samples = sorted(self.samples)
+        percentile = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] if samples else None
+        return {"count": self.count, "errors": self.errors, "total_seconds": self.total,
+                "mean_seconds": self.total / self.count if self.count else None,
+                "p50_seconds": percentile(0.5), "p95_seconds": percentile(0.95), "max_seconds": self.max,
+                "bytes": self.bytes}
+
+
+class Span:
+    """Handle of a running span; set .bytes to record the bytes the stage moved."""
+
+    def __init__(self):
+        self.bytes = 0
+
+
+class RunMetrics:
+    """
+    Thread-safe registry of stage latencies and counters for one run.
+    Args:
+        max_samples (int): Latency samples kept per stage for the percentiles.
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        self._server = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+            self._started = time.time()
+
+    def record(self, stage, seconds, nbytes=0, error=False):
+        """Records one execution of a stage."""
+        with self._lock:
+            if stage not in self._stages:
+                self._stages[stage] = _StageStats(self.max_samples)
+            self._stages[stage].add(seconds, nbytes, error, self._rng)
+
+    @contextmanager
+    def span(self, stage):
+        """Times the enclosed block as one execution of stage; exceptions are counted as errors and re-raised."""
+        span = Span()
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            self.record(stage, time.perf_counter() - start, span.bytes, error=True)
+            raise
+        self.record(stage, time.perf_counter() - start, span.bytes)
+
+    def count(self, name, value=1):
+        """Adds value to a counter (e.g. tokens)."""
+        if not value:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def report(self):
+        """Returns the run report as a dict."""
+        with self._lock:
+            return {
+                "started": datetime.fromtimestamp(self._started).isoformat(timespec="seconds"),
+                "elapsed_seconds": time.time() - self._started,
+                "stages": {name: stats.summary() for name, stats in sorted(self._stages.items())},
+                "counters": dict(sorted(self._counters.items())),
+            }
+
+    def write_report(self, path):
+        """Writes the run report as JSON."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+        log.info("Run report written to %s", path)
+
+    def print_summary(self):
+        report = self.report()
+        for name, stats in report["stages"].items():
+            log.info("Stage %s: %d calls (%d errors), p50 %.3fs, p95 %.3fs, max %.3fs, total %.1fs%s", name,
+                     stats['count'], stats['errors'], stats['p50_seconds'], stats['p95_seconds'], stats['max_seconds'],
+                     stats['total_seconds'], f", {stats['bytes'] / 1e6:.1f} MB" if stats['bytes'] else "",
+                     extra={"stage": name, "stats": stats})
+        if report["counters"]:
+            log.info("Counters: %s", ", ".join(f"{k}={v}" for k, v in report["counters"].items()),
+                     extra={"counters": report["counters"]})
+
+    def prometheus(self):
+        """Returns the report in the Prometheus text exposition format."""
+        report = self.report()
+        lines = ["# TYPE receipt_stage_seconds summary"]
+        for name, stats in report["stages"].items():
+            for quantile, key in (("0.5", "p50_seconds"), ("0.95", "p95_seconds"), ("1", "max_seconds")):
+                if stats[key] is not None:
+                    lines.append(f'receipt_stage_seconds{{stage="{name}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'receipt_stage_seconds_sum{{stage="{name}"}} {stats["total_seconds"]}')
+            lines.append(f'receipt_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+        lines.append("# TYPE receipt_stage_errors_total counter")
+        lines += [f'receipt_stage_errors_total{{stage="{name}"}} {stats["errors"]}'
+                  for name, stats in report["stages"].items()]
+        lines.append("# TYPE receipt_stage_bytes_total counter")
+        lines += [f'receipt_stage_bytes_total{{stage="{name}"}} {stats["bytes"]}'
+                  for name, stats in report["stages"].items()]
+        lines.append("# TYPE receipt_counter_total counter")
+        lines += [f'receipt_counter_total{{name="{name}"}} {value}' for name, value in report["counters"].items()]
+        lines.append(f"receipt_run_elapsed_seconds {report['elapsed_seconds']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serves /metrics (Prometheus) and /metrics.json from a background thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.startswith("/metrics.json"):
+                    body, content_type = json.dumps(registry.report()).encode("utf-8"), "application/json"
+                elif self.path.startswith("/metrics"):
+                    body, content_type = registry.prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        log.info("Metrics served on http://%s:%d/metrics", host, port)
+
+    def stop_server(self):
+        if self._server:
+            self._server.shutdown()
+            self._server = None
+
+
+# Registry of the current run, shared by all modules
+metrics = RunMetrics()
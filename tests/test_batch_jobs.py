@@ -0,0 +1,199 @@
+"""Batch runs against an in-memory stand-in of the Files and Batches API: submit, poll, collect and resume."""
+import hashlib
+import io
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image, ImageDraw
+
+import ocr_engine
+import receipt_info_extractor as extractor
+from batch_jobs import BatchRun
+from extraction_cache import ExtractionCache
+from image_dedup import DuplicateIndex, perceptual_hash
+
+RECEIPT = {"date": "01.02.2024", "store": "REWE",
+           "items": [{"name": "Milch", "category": "Food", "price": 1.19},
+                     {"name": "Brot", "category": "Food", "price": 2.49}]}
+OCR_LINES = [["REWE"], ["01.02.2024"], ["Milch", "1,19"], ["Brot", "2,49"]]
+
+
+class FixedTextOcrEngine:
+    """OCR stand-in that reads the same receipt (OCR_LINES) from every image."""
+
+    name = "fixedtext"
+
+    def image_to_data(self, img, lang="eng", psm=3):
+        data = {column: [] for column in ocr_engine.TSV_COLUMNS}
+        for line_num, words in enumerate(OCR_LINES, 1):
+            for word_num, word in enumerate(words, 1):
+                for column, value in zip(ocr_engine.TSV_COLUMNS, [5, 1, 1, 1, line_num, word_num, 60 * word_num,
+                                                                   30 * line_num, 50, 20, 95, word]):
+                    data[column].append(value)
+        return data
+
+
+# At module level, so the OCR worker processes know the engine
+ocr_engine.ENGINES["fixedtext"] = FixedTextOcrEngine
+
+
+class FakeBatchClient:
+    """
+    The files and batches calls of the OpenAI client. A batch completes on its second poll; each request is
+    answered with a receipt whose first item is named after the request's custom_id.
+    """
+
+    def __init__(self):
+        self.uploads = {}
+        self.batch_inputs = {}
+        self.polls = {}
+        self.fail_next_poll = False
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve)
+
+    def _create_file(self, file, purpose):
+        file_id = f"file-{len(self.uploads) + 1}"
+        self.uploads[file_id] = file.read()
+        return SimpleNamespace(id=file_id)
+
+    def _file_content(self, file_id):
+        return SimpleNamespace(content=self.uploads[file_id])
+
+    def _create_batch(self, input_file_id, endpoint, completion_window, metadata):
+        batch_id = f"batch-{len(self.batch_inputs) + 1}"
+        self.batch_inputs[batch_id] = input_file_id
+        self.polls[batch_id] = 0
+        return SimpleNamespace(id=batch_id, status="validating")
+
+    def _retrieve(self, batch_id):
+        if self.fail_next_poll:
+            self.fail_next_poll = False
+            raise ConnectionError("connection reset")
+        self.polls[batch_id] += 1
+        if self.polls[batch_id] < 2:
+            return SimpleNamespace(status="in_progress", output_file_id=None, error_file_id=None, request_counts=None)
+        outputs = []
+        for line in self.uploads[self.batch_inputs[batch_id]].decode("utf-8").splitlines():
+            custom_id = json.loads(line)["custom_id"]
+            receipt = dict(RECEIPT, items=[dict(RECEIPT["items"][0], name=custom_id)] + RECEIPT["items"][1:])
+            body = {"output_text": json.dumps(receipt), "usage": {"input_tokens": 1000, "output_tokens": 50}}
+            outputs.append(json.dumps({"custom_id": custom_id, "response": {"status_code": 200, "body": body}}))
+        output_id = f"file-{len(self.uploads) + 1}"
+        self.uploads[output_id] = ("\n".join(outputs) + "\n").encode("utf-8")
+        return SimpleNamespace(status="completed", output_file_id=output_id, error_file_id=None, request_counts=None)
+
+
+def receipt_jpeg(seed, quality=95):
+    img = Image.new("L", (400, 1000), 255)
+    draw = ImageDraw.Draw(img)
+    for y in range(40, 960, 40):
+        draw.rectangle((30, y, 30 + (y * seed) % 300, y + 15), fill=0)
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def test_chunks_are_recorded_when_complete(tmp_path):
+    run = BatchRun(str(tmp_path))
+    for i in range(5):
+        run.add_request(f"r{i}", {"input": i}, {"ocr_text": str(i)}, max_requests=2)
+    # Two full chunks are recorded; the requests of the open one are prepared again after an interruption
+    assert [chunk["custom_ids"] for chunk in BatchRun(str(tmp_path)).state["chunks"]] == [["r0", "r1"], ["r2", "r3"]]
+    run.flush()
+    assert run.prepared_ids() == {f"r{i}" for i in range(5)}
+    with open(tmp_path / "chunk-0003.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line)["custom_id"] for line in f] == ["r4"]
+
+
+def test_submit_poll_collect_and_resume(tmp_path):
+    client = FakeBatchClient()
+    run = BatchRun(str(tmp_path))
+    run.state["images"] = []
+    run.add_request("a", {"input": "a"}, {"ocr_text": "a"})
+    run.add_request("b", {"input": "b"}, {"ocr_text": "b"})
+    run.flush()
+    run.submit(client)
+    assert not run.wait(client, poll_interval=0, timeout=0)
+
+    # Resumed: the submitted batch is polled, not submitted again
+    run = BatchRun(str(tmp_path))
+    assert run.resumed
+    run.submit(client)
+    assert run.wait(client, poll_interval=0) and len(client.batch_inputs) == 1
+    chunk = run.state["chunks"][0]
+    results = list(run.results(client, chunk))
+    assert [(custom_id, item) for custom_id, item, _, _, _ in results] == [("a", {"ocr_text": "a"}),
+                                                                           ("b", {"ocr_text": "b"})]
+    assert json.loads(results[0][2])["items"][0]["name"] == "a"
+    assert results[0][3] == {"input_tokens": 1000, "output_tokens": 50} and results[0][4] is None
+    run.mark_collected(chunk)
+    assert BatchRun(str(tmp_path)).state["chunks"][0]["collected"]
+    run.finish()
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_requests_are_reported(tmp_path):
+    client = FakeBatchClient()
+    client.uploads["file-errors"] = (json.dumps({"custom_id": "b", "response": {
+        "status_code": 500, "body": {"error": {"message": "server error"}}}}) + "\n").encode("utf-8")
+    run = BatchRun(str(tmp_path))
+    run.add_request("a", {}, {})
+    run.add_request("b", {}, {})
+    run.flush()
+    chunk = dict(run.state["chunks"][0], status="expired", error_file_id="file-errors")
+    assert [(custom_id, error) for custom_id, _, _, _, error in run.results(client, chunk)] == [
+        ("a", "no result (batch expired)"), ("b", "server error")]
+
+
+@pytest.fixture
+def drive(monkeypatch):
+    """Three receipts, a copy of the first and a re-encoded copy of a receipt extracted in an earlier run."""
+    data = {"a": receipt_jpeg(7), "b": receipt_jpeg(11), "d": receipt_jpeg(13, quality=50)}
+    data["c"] = data["a"]
+    images = [{"id": file_id, "name": file_id + ".jpg", "md5Checksum": hashlib.md5(data[file_id]).hexdigest()}
+              for file_id in "abcd"]
+    downloads = []
+
+    def download_stage(image, persist=False):
+        downloads.append(image["id"])
+        return data[image["id"]], None
+
+    monkeypatch.setattr(extractor, "collect_images",
+                        lambda *args, **kwargs: (images, None, [None] * len(images), list(range(len(images)))))
+    monkeypatch.setattr(extractor, "download_stage", download_stage)
+    return SimpleNamespace(images=images, downloads=downloads)
+
+
+def test_batch_run_resumes_after_an_interrupted_poll(tmp_path, drive, monkeypatch):
+    client = FakeBatchClient()
+    monkeypatch.setattr(extractor, "get_openai_client", lambda: client)
+    earlier = receipt_jpeg(13)
+    cache = ExtractionCache(str(tmp_path / "cache.sqlite"), "v1")
+    cache.put(hashlib.md5(earlier).hexdigest(), RECEIPT)
+    dedup = DuplicateIndex(str(tmp_path / "dedup.sqlite"))
+    assert dedup.check(perceptual_hash(earlier), hashlib.md5(earlier).hexdigest()) is None
+    dedup.release()
+    options = dict(poll_interval=0, ocr_workers=1, ocr_options={"engine": "fixedtext"}, dedup=dedup)
+
+    client.fail_next_poll = True
+    with pytest.raises(ConnectionError):
+        extractor.process_folder_ids_batch("root", str(tmp_path / "batch"), cache=cache, **options)
+    assert sorted(drive.downloads) == ["a", "b", "c", "d"]
+    cache.close()
+
+    # Resumed without the cache entries of the first attempt (e.g. evicted): nothing is prepared again
+    cache = ExtractionCache(str(tmp_path / "cache2.sqlite"), "v1")
+    results = extractor.process_folder_ids_batch("root", str(tmp_path / "batch"), cache=cache, **options)
+    assert sorted(drive.downloads) == ["a", "b", "c", "d"]
+    assert [r.error for r in results] == [None] * 4
+    assert [r.stage for r in results] == ["batch", "batch", "batch", "dedup"]
+    md5 = {image["id"]: image["md5Checksum"] for image in drive.images}
+    # One request per distinct image: the copy shares the request of the first receipt
+    assert [r.value["items"][0]["name"] for r in results[:3]] == [md5["a"], md5["b"], md5["a"]]
+    assert results[3].value == RECEIPT
+    assert len(client.batch_inputs) == 1
+    assert not os.path.exists(tmp_path / "batch" / "batch_state.json")
+    cache.close()
+    dedup.close()
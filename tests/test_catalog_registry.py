@@ -0,0 +1,106 @@
+"""Lazy loading, idle eviction and versions of the per-store catalogs."""
+import json
+import os
+import time
+
+import pytest
+
+from catalog_registry import CatalogRegistry
+
+
+def write_catalogs(directory, stores, sheets):
+    """Writes the product sheets and a catalogs.json for them; returns the config path."""
+    for path, text in sheets.items():
+        (directory / path).parent.mkdir(parents=True, exist_ok=True)
+        (directory / path).write_text(text, encoding="utf-8")
+    (directory / "catalogs.json").write_text(json.dumps({"stores": stores}), encoding="utf-8")
+    return str(directory / "catalogs.json")
+
+
+@pytest.fixture
+def config(tmp_path):
+    return write_catalogs(tmp_path, {"IKEA": {"csv": "ikea.csv", "threshold": 90}},
+                          {"ikea.csv": "name,category\nBILLY,Bookcases\nMALM,Beds\n"})
+
+
+def registry(config_path, tmp_path, **options):
+    return CatalogRegistry(config_path, snapshot_dir=str(tmp_path / "snapshots"), **options)
+
+
+def test_catalogs_are_loaded_on_first_lookup(config, tmp_path):
+    catalogs = registry(config, tmp_path, idle_seconds=None)
+    assert catalogs.stats()["loaded"] == [] and catalogs.threshold("ikea ") == 90
+    assert catalogs.get("Ikea") is catalogs.get("IKEA")
+    assert catalogs.get("ALDI") is None
+    assert catalogs.stats() == {"stores": ["IKEA"], "loaded": ["IKEA"], "loads": 1, "evictions": 0}
+    catalogs.close()
+
+
+def test_idle_catalogs_are_evicted(config, tmp_path):
+    catalogs = registry(config, tmp_path, idle_seconds=60)
+    catalog = catalogs.get("IKEA")
+    now = time.monotonic()
+    assert catalogs.evict_idle(now + 30) == []
+    assert catalogs.evict_idle(now + 61) == ["IKEA"]
+    assert catalogs.stats()["loaded"] == [] and catalogs.stats()["evictions"] == 1
+    # A lookup that still holds the catalog keeps using it; the next get loads it again
+    assert catalog.match("billy")[1] == "Bookcases"
+    assert catalogs.get("IKEA") is not catalog and catalogs.stats()["loads"] == 2
+    catalogs.close()
+
+
+def test_reaper_thread_evicts_idle_catalogs(config, tmp_path):
+    catalogs = registry(config, tmp_path, idle_seconds=0.2)
+    catalogs.get("IKEA")
+    deadline = time.monotonic() + 10
+    while catalogs.stats()["loaded"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert catalogs.stats()["loaded"] == [] and catalogs.stats()["evictions"] == 1
+    catalogs.close()
+
+
+def test_version_follows_the_sheet_contents(config, tmp_path):
+    catalogs = registry(config, tmp_path, idle_seconds=None)
+    version = catalogs.version()
+    name, catalog_version = catalogs.catalog_version("IKEA")
+    assert name == "IKEA" and catalog_version == catalogs.get("IKEA").version
+    csv_path = tmp_path / "ikea.csv"
+
+    # Touched, same contents: same version
+    os.utime(csv_path, ns=(1, 1))
+    assert catalogs.version() == version and catalogs.catalog_version("IKEA") == ("IKEA", catalog_version)
+
+    csv_path.write_text("name,category\nBILLY,Shelves\nMALM,Beds\n", encoding="utf-8")
+    assert catalogs.version() != version
+    assert catalogs.catalog_version("IKEA")[1] != catalog_version
+    # The changed sheet is recompiled and reloaded on the next lookup
+    catalog = catalogs.get("IKEA")
+    assert catalog.match("billy")[1] == "Shelves"
+    assert catalog.version == catalogs.catalog_version("IKEA")[1]
+    catalogs.close()
+
+
+def test_version_covers_the_thresholds(config, tmp_path):
+    version = registry(config, tmp_path).version()
+    with open(config, "w", encoding="utf-8") as f:
+        json.dump({"stores": {"IKEA": {"csv": "ikea.csv", "threshold": 80}}}, f)
+    assert registry(config, tmp_path).version() != version
+
+
+def test_sheets_of_the_same_name_are_kept_apart(tmp_path):
+    config_path = write_catalogs(
+        tmp_path, {"IKEA": {"csv": "ikea/products.csv"}, "REWE": {"csv": "rewe/products.csv"}},
+        {"ikea/products.csv": "name,category\nBILLY,Bookcases\n",
+         "rewe/products.csv": "name,category\nBILLY,Snacks\n"})
+    catalogs = registry(config_path, tmp_path, idle_seconds=None)
+    assert catalogs.get("IKEA").match("billy")[1] == "Bookcases"
+    assert catalogs.get("REWE").match("billy")[1] == "Snacks"
+    rewe_version = catalogs.catalog_version("REWE")
+
+    # Changing one sheet only invalidates its own store
+    (tmp_path / "ikea" / "products.csv").write_text("name,category\nBILLY,Shelves\n", encoding="utf-8")
+    assert catalogs.get("IKEA").match("billy")[1] == "Shelves"
+    assert catalogs.get("REWE").match("billy")[1] == "Snacks"
+    assert catalogs.catalog_version("REWE") == rewe_version
+    assert len(os.listdir(tmp_path / "snapshots")) == 4  # Two snapshot directories and their lock files
+    catalogs.close()
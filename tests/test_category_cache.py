@@ -0,0 +1,159 @@
+"""Catalog versions, TTL and LRU eviction of the category cache."""
+import itertools
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import category_cache
+from category_cache import CategoryCache
+
+
+class Clock:
+    """Strictly increasing time that can also jump ahead."""
+
+    def __init__(self):
+        self.now = itertools.count(1000)
+        self.offset = 0
+
+    def time(self):
+        return next(self.now) + self.offset
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(category_cache, "time", SimpleNamespace(time=clock.time))
+    return clock
+
+
+def matches(names):
+    return {name: (name.upper(), "Furniture", 90) for name in names}
+
+
+def stored_names(path):
+    with sqlite3.connect(path) as conn:
+        return {row[0] for row in conn.execute("SELECT name FROM matches")}
+
+
+def test_put_and_get_per_catalog(tmp_path):
+    cache = CategoryCache(str(tmp_path / "categories.sqlite"))
+    cache.put_many(matches(["billy", "ektorp"]), "v1", catalog="IKEA")
+    assert cache.get_many(["billy", "billy", "malm"], "v1", catalog="IKEA") == {"billy": ("BILLY", "Furniture", 90)}
+    assert cache.get_many(["billy"], "v1", catalog="REWE") == {}
+    assert cache.stats()["hits"] == 1
+    cache.close()
+
+
+def test_entries_of_another_catalog_version_are_purged(tmp_path):
+    path = str(tmp_path / "categories.sqlite")
+    cache = CategoryCache(path)
+    cache.put_many(matches(["billy"]), "v1", catalog="IKEA")
+    cache.put_many(matches(["milch"]), "v1", catalog="REWE")
+    assert cache.get_many(["billy"], "v2", catalog="IKEA") == {}
+    # Only the IKEA entries of the old version are gone
+    assert stored_names(path) == {"milch"}
+    cache.close()
+
+
+def test_entries_expire(tmp_path, clock):
+    cache = CategoryCache(str(tmp_path / "categories.sqlite"), ttl=3600)
+    cache.put_many(matches(["billy"]), "v1")
+    assert cache.get_many(["billy"], "v1") == matches(["billy"])
+    clock.offset = 7200
+    assert cache.get_many(["billy"], "v1") == {}
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted_to_90_percent(tmp_path):
+    path = str(tmp_path / "categories.sqlite")
+    cache = CategoryCache(path, max_entries=10)
+    cache.put_many(matches([f"n{i}" for i in range(10)]), "v1")
+    cache.get_many(["n0", "n1"], "v1")
+    cache.put_many(matches(["n10", "n11"]), "v1")
+    # 12 names: down to 9, dropping the three least recently used (n0 and n1 were just read)
+    assert stored_names(path) == {"n0", "n1", "n10", "n11"} | {f"n{i}" for i in range(5, 10)}
+    assert cache._count == 9
+    cache.close()
+
+
+def test_writes_of_other_processes_are_recounted(tmp_path, monkeypatch):
+    monkeypatch.setattr(category_cache, "RECOUNT_WRITES", 5)
+    path = str(tmp_path / "categories.sqlite")
+    first = CategoryCache(path, max_entries=10)
+    second = CategoryCache(path, max_entries=10)
+    second.put_many(matches([f"other{i}" for i in range(8)]), "v1")
+    first.put_many(matches([f"n{i}" for i in range(3)]), "v1")
+    assert len(stored_names(path)) == 11
+    # The estimate of first (3 + 3) stays below max_entries, but 6 writes since the last count trigger a recount
+    first.put_many(matches([f"n{i}" for i in range(3, 6)]), "v1")
+    assert len(stored_names(path)) == 9
+    assert first._count == 9
+    first.close()
+    second.close()
+
+
+def test_cache_of_another_layout_is_dropped(tmp_path):
+    path = str(tmp_path / "categories.sqlite")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE matches (name TEXT PRIMARY KEY, category TEXT)")
+        conn.execute("INSERT INTO matches VALUES ('billy', 'Furniture')")
+    cache = CategoryCache(path)
+    assert cache.get_many(["billy"], "v1") == {}
+    cache.put_many(matches(["billy"]), "v1")
+    assert cache.get_many(["billy"], "v1") == matches(["billy"])
+    cache.close()
+
+
+@pytest.fixture
+def ikea_catalog(tmp_path, monkeypatch):
+    """A small IKEA catalog and an empty category cache as the process-wide registry and cache."""
+    import catalog_registry
+    from catalog_registry import CatalogRegistry
+    (tmp_path / "ikea.csv").write_text("name,category\nBILLY,Bookcases\nEKTORP,Sofas\nMALM,Beds\n", encoding="utf-8")
+    (tmp_path / "catalogs.json").write_text('{"stores": {"IKEA": {"csv": "ikea.csv", "threshold": 95}}}',
+                                            encoding="utf-8")
+    registry = CatalogRegistry(str(tmp_path / "catalogs.json"), snapshot_dir=str(tmp_path / "snapshots"),
+                               idle_seconds=None)
+    cache = CategoryCache(str(tmp_path / "categories.sqlite"))
+    monkeypatch.setitem(catalog_registry._shared, "registry", registry)
+    monkeypatch.setitem(category_cache._shared, "cache", cache)
+    monkeypatch.setitem(category_cache._shared, "configured", True)
+    yield registry, cache
+    registry.close()
+    cache.close()
+
+
+def test_cached_mcp_lookups_do_not_load_the_catalog(ikea_catalog):
+    from receipt_info_extractor import mcp_cached_results
+    registry, cache = ikea_catalog
+    catalog = registry.get("IKEA")
+    category_cache.match_names(catalog, ["billy", "regal"], cache)
+    registry.close()
+    assert registry.stats()["loaded"] == []
+
+    assert registry.catalog_version("IKEA") == ("IKEA", catalog.version)
+    assert registry.catalog_version("ALDI") is None
+    items = [{"item_name": "billy regal", "candidates": ["billy", "regal"]}]
+    results = mcp_cached_results(items, 95, "IKEA")
+    assert results[0]["found"] and results[0]["category"] == "Bookcases"
+    assert registry.stats()["loaded"] == []
+
+
+def test_fallback_reuses_the_cache_lookups_of_the_mcp_step(ikea_catalog):
+    from receipt_info_extractor import get_catalog_category, mcp_cached_results
+    registry, cache = ikea_catalog
+    catalog = registry.get("IKEA")
+    category_cache.match_names(catalog, ["billy"], cache)
+    hits, misses = cache.hits, cache.misses
+
+    looked_up = {}
+    items = [{"item_name": "billy regal", "candidates": ["billy regal", "billy", "regal"]}]
+    assert mcp_cached_results(items, 95, "IKEA", looked_up) == [None]
+    assert (cache.hits - hits, cache.misses - misses) == (1, 2)
+    # The fallback matches "billy regal" without a second cache lookup, and caches the result
+    assert get_catalog_category("billy regal", catalog, 0, looked_up) == "Bookcases"
+    assert (cache.hits - hits, cache.misses - misses) == (1, 2)
+    assert cache.get_many(["billy regal"], catalog.version, "IKEA")["billy regal"][1] == "Bookcases"
+    # Lookups made for another catalog version are not reused
+    assert get_catalog_category("billy", catalog, 0, {"old": {"billy": ("MALM", "Beds", 100)}}) == "Bookcases"
@@ -0,0 +1,195 @@
+"""Full and incremental Drive crawls against an in-memory folder tree."""
+import pytest
+
+from drive_crawler import FOLDER_MIME_TYPE, drop_folder, incremental_crawl, load_crawl_state, save_crawl_state
+
+
+class Request:
+    def __init__(self, run):
+        self.execute = run
+
+
+class FakeDrive:
+    """
+    The files().list, changes().list and changes().getStartPageToken calls the crawler makes.
+    Args:
+        tree (dict): Folder ID -> list of file metadata dicts.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.failing = set()
+        self.changes_feed = []
+        self.listed = []
+        self.token = 1
+
+    def files(self):
+        return self
+
+    def changes(self):
+        return self
+
+    def list(self, q=None, pageToken=None, **kwargs):
+        if q is None:
+            return Request(self._changes)
+        folder_id = q.split("'")[1]
+        return Request(lambda: self._list(folder_id))
+
+    def _list(self, folder_id):
+        self.listed.append(folder_id)
+        if folder_id in self.failing:
+            raise RuntimeError("HTTP 500")
+        return {"files": self.tree.get(folder_id, [])}
+
+    def _changes(self):
+        changes, self.changes_feed = self.changes_feed, []
+        self.token += 1
+        return {"changes": changes, "newStartPageToken": str(self.token)}
+
+    def getStartPageToken(self):
+        return Request(lambda: {"startPageToken": str(self.token)})
+
+
+def folder(folder_id, parent=None):
+    return {"id": folder_id, "name": folder_id, "mimeType": FOLDER_MIME_TYPE, "parents": [parent] if parent else []}
+
+
+def image(image_id, parent=None):
+    return {"id": image_id, "name": image_id + ".jpg", "mimeType": "image/jpeg", "parents": [parent] if parent else []}
+
+
+@pytest.fixture
+def drive():
+    return FakeDrive({
+        "root": [folder("a", "root"), folder("b", "root"), image("r1", "root")],
+        "a": [folder("a1", "a"), image("i1", "a")],
+        "a1": [image("i2", "a1")],
+        "b": [image("i3", "b")],
+    })
+
+
+def crawl(drive, state_path, full=False):
+    images, state = incremental_crawl(["root"], lambda: drive, state_path, workers=2, full=full)
+    save_crawl_state(state_path, state)
+    return sorted(f["id"] for f in images), state
+
+
+def test_full_crawl(drive, tmp_path):
+    images, state = crawl(drive, str(tmp_path / "state.json"))
+    assert images == ["i1", "i2", "i3", "r1"]
+    assert state["folders"] == {"root": None, "a": "root", "b": "root", "a1": "a"}
+    assert state["failed_folders"] == {}
+
+
+def test_unchanged_tree_lists_no_folder(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    crawl(drive, path)
+    drive.listed.clear()
+    images, state = crawl(drive, path)
+    assert images == [] and drive.listed == []
+    assert state["folders"] == {"root": None, "a": "root", "b": "root", "a1": "a"}
+
+
+def test_failed_folder_is_listed_again_on_the_next_run(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    drive.failing = {"b"}
+    images, state = crawl(drive, path)
+    assert images == ["i1", "i2", "r1"]
+    assert "b" not in state["folders"]
+    assert state["failed_folders"] == {"b": "root"}
+
+    drive.failing = set()
+    images, state = crawl(drive, path)
+    assert images == ["i3"]
+    assert state["folders"]["b"] == "root"
+    assert state["failed_folders"] == {}
+
+
+def test_failed_root_is_listed_again(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    drive.failing = {"root"}
+    images, state = crawl(drive, path)
+    assert images == [] and state["failed_folders"] == {"root": None}
+    drive.failing = set()
+    images, state = crawl(drive, path)
+    assert images == ["i1", "i2", "i3", "r1"]
+    assert state["folders"]["root"] is None
+
+
+def test_folder_moved_out_is_dropped_with_its_subfolders(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    crawl(drive, path)
+    drive.changes_feed = [{"fileId": "a", "file": folder("a", "elsewhere")},
+                          {"fileId": "i2", "file": image("i2", "a1")}]
+    images, state = crawl(drive, path)
+    # The image changed in a1, which left the tree together with a
+    assert images == []
+    assert state["folders"] == {"root": None, "b": "root"}
+
+
+def test_failed_folder_below_a_folder_moved_out_is_not_retried(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    drive.failing = {"a1"}
+    crawl(drive, path)
+    drive.failing = set()
+    drive.changes_feed = [{"fileId": "a", "file": folder("a", "elsewhere")}]
+    drive.listed.clear()
+    images, state = crawl(drive, path)
+    assert images == [] and drive.listed == []
+    assert state["failed_folders"] == {}
+
+
+def test_folder_moved_in_brings_its_contents(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    crawl(drive, path)
+    drive.tree["c"] = [folder("c1", "c"), image("i4", "c")]
+    drive.tree["c1"] = [image("i5", "c1")]
+    drive.changes_feed = [{"fileId": "c", "file": folder("c", "b")}, {"fileId": "i6", "file": image("i6", "root")},
+                          {"fileId": "x", "file": image("x", "elsewhere")}]
+    images, state = crawl(drive, path)
+    assert images == ["i4", "i5", "i6"]
+    assert state["folders"]["c"] == "b" and state["folders"]["c1"] == "c"
+
+
+def test_folder_moved_within_the_tree_keeps_its_subfolders(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    crawl(drive, path)
+    drive.changes_feed = [{"fileId": "a", "file": folder("a", "b")}]
+    images, state = crawl(drive, path)
+    assert images == []
+    assert state["folders"]["a"] == "b" and state["folders"]["a1"] == "a"
+
+
+def test_removed_folder_is_dropped(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    crawl(drive, path)
+    drive.changes_feed = [{"fileId": "a", "removed": True}]
+    _, state = crawl(drive, path)
+    assert state["folders"] == {"root": None, "b": "root"}
+
+
+def test_pending_images_are_returned_again(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    _, state = crawl(drive, path)
+    state["pending"] = [image("i1", "a")]
+    save_crawl_state(path, state)
+    images, state = crawl(drive, path)
+    assert images == ["i1"] and state["pending"] == []
+
+
+def test_state_of_other_roots_or_an_older_layout_means_a_full_crawl(drive, tmp_path):
+    path = str(tmp_path / "state.json")
+    _, state = crawl(drive, path)
+    assert load_crawl_state(path, ["root"]) == state
+    assert load_crawl_state(path, ["other"]) is None
+    save_crawl_state(path, dict(state, folders=list(state["folders"])))
+    assert load_crawl_state(path, ["root"]) is None
+    images, _ = crawl(drive, path)
+    assert images == ["i1", "i2", "i3", "r1"]
+
+
+def test_drop_folder():
+    folders = {"root": None, "a": "root", "a1": "a", "a2": "a", "a11": "a1", "b": "root"}
+    assert drop_folder(folders, "a") == 4
+    assert folders == {"root": None, "b": "root"}
+    assert drop_folder(folders, "missing") == 0
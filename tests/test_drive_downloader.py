@@ -0,0 +1,160 @@
+"""Range requests, resumed transfers and MD5 checks of the Drive downloader against a scripted HTTP server."""
+import hashlib
+import os
+from contextlib import contextmanager
+
+import pytest
+import requests
+
+from drive_downloader import DownloadError, DriveDownloader, local_file_path
+
+CHUNK = 256 * 1024
+DATA = bytes(range(256)) * (3 * CHUNK // 256 + 100)  # Three full chunks and a short last one
+METADATA = {"id": "f1", "name": "receipt.JPG", "md5Checksum": hashlib.md5(DATA).hexdigest()}
+
+
+class Response:
+    def __init__(self, status_code, body=b"", headers=None, break_after=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.text = body.decode("latin-1")
+        self.break_after = break_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        raise requests.HTTPError(f"HTTP {self.status_code}")
+
+    def iter_content(self, block_size):
+        for start in range(0, len(self.body), block_size):
+            if self.break_after is not None and start >= self.break_after:
+                raise requests.exceptions.ChunkedEncodingError("connection broken")
+            yield self.body[start:start + min(block_size, (self.break_after or len(self.body)) - start)]
+
+
+class FakeDriveServer:
+    """
+    Answers range requests for the bytes of one file. `faults` are consulted per request (in order): None serves
+    the range, a Response is returned as is, an int breaks the transfer off after that many bytes.
+    """
+
+    def __init__(self, data, faults=()):
+        self.data = data
+        self.faults = list(faults)
+        self.ranges = []
+
+    @contextmanager
+    def session(self):
+        yield self
+
+    def close(self):
+        pass
+
+    def get(self, url, params=None, stream=False, timeout=None, headers=None):
+        start, end = (int(x) for x in headers["Range"][len("bytes="):].split("-"))
+        self.ranges.append(start)
+        fault = self.faults.pop(0) if self.faults else None
+        if isinstance(fault, Response):
+            return fault
+        if start >= len(self.data):
+            return Response(416, headers={"Content-Range": f"bytes */{len(self.data)}"})
+        body = self.data[start:end + 1]
+        content_range = f"bytes {start}-{start + len(body) - 1}/{len(self.data)}"
+        return Response(206, body, {"Content-Range": content_range}, break_after=fault)
+
+
+def downloader(server, max_retries=3):
+    downloader = DriveDownloader(None, chunk_size=CHUNK, max_retries=max_retries, base_delay=0, max_delay=0)
+    downloader.sessions = server
+    return downloader
+
+
+def test_download_in_range_requests():
+    server = FakeDriveServer(DATA)
+    assert downloader(server).download(METADATA) == DATA
+    assert server.ranges == [0, CHUNK, 2 * CHUNK, 3 * CHUNK]
+
+
+def test_broken_transfer_resumes_from_the_last_byte():
+    # The second chunk breaks off after 64 KiB, twice in a row; both retries made progress
+    server = FakeDriveServer(DATA, faults=[None, 64 * 1024, 64 * 1024])
+    loader = downloader(server, max_retries=1)
+    assert loader.download(METADATA) == DATA
+    assert server.ranges[:4] == [0, CHUNK, CHUNK + 64 * 1024, CHUNK + 128 * 1024]
+    stats = loader.stats()
+    assert (stats["resumed"], stats["retries"], stats["downloads"]) == (2, 2, 1)
+
+
+def test_retries_without_progress_give_up():
+    server = FakeDriveServer(DATA, faults=[Response(503)] * 3)
+    loader = downloader(server, max_retries=2)
+    with pytest.raises(DownloadError, match="giving up after 2 retries"):
+        loader.download(METADATA)
+    assert loader.stats()["failed"] == 1
+
+
+def test_non_retryable_status_fails_at_once():
+    server = FakeDriveServer(DATA, faults=[Response(404, b"File not found")])
+    with pytest.raises(DownloadError, match="HTTP 404"):
+        downloader(server).download(METADATA)
+    assert server.ranges == [0]
+
+
+def test_server_ignoring_the_range_restarts_the_file():
+    server = FakeDriveServer(DATA, faults=[None, Response(200, DATA, {"Content-Length": str(len(DATA))})])
+    assert downloader(server).download(METADATA) == DATA
+    assert server.ranges == [0, CHUNK]
+
+
+def test_md5_mismatch_is_an_error():
+    loader = downloader(FakeDriveServer(DATA[:-1] + b"x"))
+    with pytest.raises(DownloadError, match="does not match md5Checksum"):
+        loader.download(METADATA)
+    assert loader.stats()["failed"] == 1 and loader.stats()["downloads"] == 0
+
+
+def test_partial_file_of_an_earlier_run_is_resumed(tmp_path):
+    path = local_file_path(METADATA, str(tmp_path))
+    assert path == str(tmp_path / "f1.jpg")
+    with open(path + ".part", "wb") as f:
+        f.write(DATA[:CHUNK + 1000])
+    server = FakeDriveServer(DATA)
+    assert downloader(server).download_to_file(METADATA, str(tmp_path)) == path
+    assert server.ranges == [CHUNK + 1000, 2 * CHUNK + 1000, 3 * CHUNK + 1000]
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + ".part")
+
+    # Present with the expected MD5: not downloaded again
+    loader = downloader(FakeDriveServer(DATA))
+    assert loader.download_to_file(METADATA, str(tmp_path)) == path
+    assert loader.sessions.ranges == [] and loader.stats()["skipped"] == 1
+
+
+def test_partial_file_longer_than_the_file_is_truncated_and_downloaded_again(tmp_path):
+    path = local_file_path(METADATA, str(tmp_path))
+    with open(path + ".part", "wb") as f:
+        f.write(DATA + b"garbage")
+    server = FakeDriveServer(DATA)
+    loader = downloader(server)
+    loader.download_to_file(METADATA, str(tmp_path))
+    # 416 for the range after the local part, then the whole file from byte 0
+    assert server.ranges == [len(DATA) + 7, 0, CHUNK, 2 * CHUNK, 3 * CHUNK]
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert loader.stats()["retries"] == 1
+
+
+def test_bad_checksum_drops_the_partial_file(tmp_path):
+    path = local_file_path(METADATA, str(tmp_path))
+    loader = downloader(FakeDriveServer(DATA[:-1] + b"x"))
+    with pytest.raises(DownloadError, match="does not match md5Checksum"):
+        loader.download_to_file(METADATA, str(tmp_path))
+    # The next run downloads it from the start instead of resuming the bad bytes
+    assert not os.path.exists(path) and not os.path.exists(path + ".part")
+    assert loader.stats()["failed"] == 1
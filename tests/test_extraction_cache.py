@@ -0,0 +1,126 @@
+"""Versioning, running totals and LRU eviction of the extraction cache."""
+import hashlib
+import itertools
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import extraction_cache
+from extraction_cache import ExtractionCache, extraction_version, file_md5
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    """Strictly increasing time, so access order decides eviction."""
+    monkeypatch.setattr(extraction_cache, "time", SimpleNamespace(time=itertools.count(1000).__next__))
+
+
+def receipt(i, items=1):
+    return {"date": "01.02.2024", "store": "REWE", "items": [{"name": f"Artikel {i}", "category": "Food",
+                                                              "price": 1.0}] * items}
+
+
+def stored_hashes(path):
+    with sqlite3.connect(path) as conn:
+        return {row[0] for row in conn.execute("SELECT content_hash FROM extractions")}
+
+
+def test_put_and_get(tmp_path):
+    cache = ExtractionCache(str(tmp_path / "cache.sqlite"), "v1")
+    assert cache.get("a") is None
+    cache.put("a", receipt(1))
+    cache.put("", receipt(2))
+    cache.put("b", None)
+    assert cache.get("a") == receipt(1)
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+    cache.close()
+
+
+def test_entries_of_another_version_are_purged(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ExtractionCache(path, "v1")
+    cache.put("a", receipt(1))
+    cache.close()
+    cache = ExtractionCache(path, "v2")
+    assert cache.get("a") is None
+    assert stored_hashes(path) == set()
+    assert cache._totals() == (0, 0)
+    cache.close()
+
+
+def test_running_totals_follow_replaced_entries(tmp_path):
+    cache = ExtractionCache(str(tmp_path / "cache.sqlite"), "v1")
+    for items in (1, 5, 2):
+        cache.put("a", receipt(1, items))
+        cache.put("b", receipt(2))
+    assert (cache._count, cache._bytes) == tuple(cache._totals())
+    assert cache._count == 2
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted_to_90_percent(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ExtractionCache(path, "v1", max_entries=10)
+    for i in range(10):
+        cache.put(f"h{i}", receipt(i))
+    cache.get("h0")
+    cache.put("h10", receipt(10))
+    # 11 entries: down to 9, dropping the two least recently used (h0 was just read)
+    assert stored_hashes(path) == {"h0"} | {f"h{i}" for i in range(3, 11)}
+    assert (cache._count, cache._bytes) == tuple(cache._totals())
+    cache.close()
+
+
+def test_eviction_by_size(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    size = len(extraction_cache.json.dumps(receipt(0), ensure_ascii=False).encode("utf-8"))
+    cache = ExtractionCache(path, "v1", max_bytes=10 * size)
+    for i in range(15):
+        cache.put(f"h{i}", receipt(i))
+        assert cache._bytes <= 10 * size
+    # Evicted to 90% of the limit, oldest first
+    stored = stored_hashes(path)
+    assert stored == {f"h{i}" for i in range(15 - len(stored), 15)}
+    assert cache._bytes == cache._totals()[1] <= 0.9 * 10 * size
+    cache.close()
+
+
+def test_eviction_counts_entries_of_other_processes(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    first = ExtractionCache(path, "v1", max_entries=10)
+    second = ExtractionCache(path, "v1", max_entries=10)
+    for i in range(8):
+        second.put(f"other{i}", receipt(i))
+    for i in range(11):
+        first.put(f"h{i}", receipt(i))
+    # first only counted its own 11 writes; the recount before evicting sees all 19 entries
+    assert len(stored_hashes(path)) == 9
+    assert first._count == 9
+    first.close()
+    second.close()
+
+
+def test_extraction_version_covers_the_options():
+    base = extraction_version("prompt", {"type": "object"}, "gpt-4o-mini", 2, {"adaptive": True})
+    assert base == extraction_version("prompt", {"type": "object"}, "gpt-4o-mini", 2, {"adaptive": True})
+    assert base != extraction_version("prompt", {"type": "object"}, "gpt-4o-mini", 2, {"adaptive": False})
+    assert base != extraction_version("prompt", {"type": "object"}, "gpt-4o", 2, {"adaptive": True})
+    assert base != extraction_version("prompt", {"type": "object"}, "gpt-4o-mini", 2)
+
+
+def test_file_md5(tmp_path):
+    path = tmp_path / "receipt.jpg"
+    path.write_bytes(b"receipt")
+    assert file_md5(str(path), chunk_size=3) == hashlib.md5(b"receipt").hexdigest()
+
+
+def test_batch_and_routed_results_have_different_versions():
+    from receipt_info_extractor import get_extraction_version
+    routed = get_extraction_version()
+    batch = get_extraction_version(batch=True)
+    assert routed != batch
+    assert get_extraction_version(min_ocr_confidence=50) != routed
+    # Batch mode does not route, its version ignores the routing options
+    assert get_extraction_version(batch=True, min_ocr_confidence=50) == batch
@@ -0,0 +1,122 @@
+"""Job API of the extraction service over HTTP, with a stand-in pipeline in place of download, OCR and LLM."""
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import extraction_service
+from extraction_service import DONE, FAILED, ExtractionService, make_handler
+from pipeline import PipelineStage
+
+
+def extract(item):
+    """Stand-in for download -> OCR -> LLM: the uploaded bytes are the store name."""
+    if item["content"] == b"unreadable":
+        raise ValueError("no text found")
+    return {"store": item["content"].decode("utf-8"), "items": []}
+
+
+class StandInService(ExtractionService):
+    def _stages(self):
+        return [PipelineStage("extract", extract, workers=2)]
+
+    def warm_up(self):
+        pass
+
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+
+@pytest.fixture
+def service():
+    service = StandInService(job_workers=2)
+    service.start()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(service))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield service, Client(server.server_port)
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def test_submit_status_and_result(service):
+    service, client = service
+    status, job = client.request("POST", "/jobs/image?name=rewe.jpg", b"REWE")
+    assert status == 202 and job["url"] == f"/jobs/{job['id']}" and job["kind"] == "image"
+
+    status, job = client.request("GET", f"/jobs/{job['id']}?wait=10")
+    assert status == 200 and job["status"] == DONE
+    assert (job["receipts"], job["completed"], job["failed"]) == (1, 1, 0)
+    assert job["results"] == [{"file_id": job["results"][0]["file_id"], "name": "rewe.jpg", "stage": "extract",
+                               "receipt": {"store": "REWE", "items": []}, "error": None}]
+
+    status, jobs = client.request("GET", "/jobs?status=done")
+    assert [summary["id"] for summary in jobs["jobs"]] == [job["id"]]
+    status, health = client.request("GET", "/health")
+    assert health["jobs"] == {DONE: 1} and health["pipeline_queued"] == 0
+
+
+def test_failed_receipt_is_reported_in_its_job(service):
+    service, client = service
+    _, job = client.request("POST", "/jobs/image", b"unreadable")
+    _, job = client.request("GET", f"/jobs/{job['id']}?wait=10")
+    # The job finished; the receipt failed
+    assert job["status"] == DONE and job["failed"] == 1
+    assert job["results"][0]["receipt"] is None and job["results"][0]["error"] == "no text found"
+    assert job["results"][0]["stage"] == "extract"
+
+
+def test_failed_job_is_reported(service, monkeypatch):
+    service, client = service
+
+    def file_metadata(file_id):
+        raise PermissionError(f"file {file_id} not shared with the service account")
+
+    monkeypatch.setattr(extraction_service, "_file_metadata", file_metadata)
+    status, job = client.request("POST", "/jobs", json.dumps({"file_ids": ["f1"]}).encode("utf-8"))
+    assert status == 202
+    _, job = client.request("GET", f"/jobs/{job['id']}?wait=10")
+    assert job["status"] == FAILED and job["error"] == "file f1 not shared with the service account"
+
+
+def test_invalid_requests(service):
+    _, client = service
+    assert client.request("POST", "/jobs", b"{}") == (400, {"error": "expected file_ids or folder_ids"})
+    assert client.request("POST", "/jobs", b"not json")[0] == 400
+    assert client.request("POST", "/jobs", json.dumps({"file_ids": [" "]}).encode("utf-8"))[0] == 400
+    assert client.request("POST", "/jobs/image", b"") == (400, {"error": "empty image"})
+    assert client.request("GET", "/jobs/unknown") == (404, {"error": "unknown job unknown"})
+    assert client.request("GET", "/jobs/unknown?wait=x")[0] == 404
+
+
+def test_cached_receipts_skip_the_pipeline():
+    class Cache:
+        def get(self, content_hash):
+            return {"store": "CACHED", "items": []}
+
+    service = StandInService(cache=Cache())
+    service.start()
+    try:
+        job = service.submit_image(b"REWE")
+        assert job.done.wait(10)
+        assert job.results[0].value == {"store": "CACHED", "items": []} and job.results[0].stage == "cache"
+    finally:
+        service.close()
+
+
+def test_close_without_start():
+    ExtractionService().close()
@@ -0,0 +1,176 @@
+"""Copies, near-duplicate candidates and failed leaders in the duplicate index."""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from image_dedup import HASH_BYTES, Duplicate, DuplicateIndex, HashTable, perceptual_hash
+from pipeline import PipelineResult
+from receipt_info_extractor import confirm_duplicate, resolve_duplicates
+
+RECEIPT = {"date": "01.02.2024", "store": "REWE",
+           "items": [{"name": "Milch", "category": "Food", "price": 1.19},
+                     {"name": "Brot", "category": "Food", "price": 2.49}]}
+HASH = bytes(range(HASH_BYTES))
+MATCHING_TEXT = "REWE 01.02.2024\nMilch 1,19\nBrot 2,49\nSUMME 3,68"
+
+
+def flipped(image_hash, bits):
+    """The hash with its first `bits` bits inverted."""
+    array = np.unpackbits(np.frombuffer(image_hash, dtype=np.uint8))
+    array[:bits] ^= 1
+    return np.packbits(array).tobytes()
+
+
+def source(content_hash):
+    return {"id": content_hash, "name": content_hash + ".jpg", "md5Checksum": content_hash}
+
+
+class DictCache:
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+
+    def get(self, content_hash):
+        return self.entries.get(content_hash)
+
+    def put(self, content_hash, result):
+        self.entries[content_hash] = result
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = DuplicateIndex(str(tmp_path / "dedup.sqlite"), max_distance=32)
+    yield index
+    index.close()
+
+
+def test_hash_table_returns_the_hashes_within_the_distance_closest_first():
+    table = HashTable()
+    for bits in (40, 0, 10, 33):
+        table.add(flipped(HASH, bits), f"d{bits}")
+    assert table.search(HASH, 32) == [(0, "d0"), (10, "d10")]
+    assert table.search(flipped(HASH, 40), 0) == [(0, "d40")]
+    assert HashTable().search(HASH, 32) == []
+
+
+def test_hash_table_grows():
+    table = HashTable()
+    for i in range(1500):
+        table.add(i.to_bytes(HASH_BYTES, "little"), i)
+    assert len(table) == 1500
+    assert table.search((1499).to_bytes(HASH_BYTES, "little"), 0) == [(0, 1499)]
+
+
+def receipt_image(seed):
+    img = Image.new("L", (400, 1000), 255)
+    draw = ImageDraw.Draw(img)
+    for y in range(40, 960, 40):
+        draw.rectangle((30, y, 30 + (y * seed) % 300, y + 15), fill=0)
+    return img
+
+
+def encoded(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def distance(first, second):
+    return int(np.unpackbits(np.frombuffer(first, dtype=np.uint8) ^ np.frombuffer(second, dtype=np.uint8)).sum())
+
+
+def test_perceptual_hash_of_a_re_encoded_copy_is_close():
+    original = perceptual_hash(encoded(receipt_image(7), 95))
+    assert len(original) == HASH_BYTES
+    assert distance(original, perceptual_hash(encoded(receipt_image(7), 50))) <= 32
+    assert distance(original, perceptual_hash(encoded(receipt_image(11), 95))) > 32
+    # A blank image has no features to hash
+    assert perceptual_hash(encoded(Image.new("L", (400, 1000), 255), 95)) is None
+
+
+def test_exact_copies_share_the_result_of_the_leader(index):
+    assert index.check(HASH, "a") is None
+    copy = index.check(HASH, "a")
+    assert copy.leader == "a" and copy.image_hash is None
+    results = [PipelineResult(source("a"), RECEIPT, None, "llm"), PipelineResult(source("a"), copy, None, "dedup")]
+    assert resolve_duplicates(results, index) == []
+    assert results[1].value == RECEIPT and results[1].error is None and results[1].stage == "dedup"
+    assert index.stats()["duplicates"] == 1 and index.stats()["pending"] == 0
+
+
+def test_confirmed_candidate_reuses_the_extraction(index):
+    cache = DictCache()
+    assert index.check(HASH, "a") is None
+    candidate = index.check(flipped(HASH, 5), "b")
+    assert (candidate.leader, candidate.distance) == ("a", 5)
+    assert index.candidate("b") is candidate and index.candidate("b") is None
+    results = [PipelineResult(source("a"), RECEIPT, None, "llm"),
+               PipelineResult(source("b"), candidate._replace(preprocessed=("b", None, MATCHING_TEXT)), None, "ocr")]
+    assert resolve_duplicates(results, index, cache) == []
+    assert results[1].value == RECEIPT
+    # Cached under the candidate's own hash, so its next run is a plain cache hit
+    assert cache.get("b") == RECEIPT
+    assert index.stats()["confirmed"] == 1
+
+
+def test_rejected_candidate_is_extracted_again_and_indexed(index):
+    assert index.check(HASH, "a") is None
+    candidate = index.check(flipped(HASH, 5), "b")
+    other_text = "REWE 03.02.2024\nKaese 4,99\nSUMME 4,99"
+    results = [PipelineResult(source("a"), RECEIPT, None, "llm"),
+               PipelineResult(source("b"), candidate._replace(preprocessed=("b", None, other_text)), None, "ocr")]
+    assert resolve_duplicates(results, index) == [1]
+    # The caller extracts it on its own; the value is left for it
+    assert isinstance(results[1].value, Duplicate)
+    stats = index.stats()
+    assert (stats["rejected"], stats["confirmed"], stats["hashes"]) == (1, 0, 2)
+    # Its own copies are now matched to it as well
+    assert [match for _, match in index._table.search(flipped(HASH, 5), 0)] == ["b"]
+
+
+def test_failed_leader_releases_its_duplicates(index):
+    assert index.check(HASH, "a") is None
+    copy = index.check(HASH, "a")
+    candidate = index.check(flipped(HASH, 5), "b")
+    results = [None,  # The leader never finished
+               PipelineResult(source("a"), copy, None, "dedup"),
+               PipelineResult(source("b"), candidate._replace(preprocessed=("b", None, MATCHING_TEXT)), None, "ocr")]
+    assert resolve_duplicates(results, index) == [2]
+    assert results[1].value is None and "duplicated image a failed" in str(results[1].error)
+    assert index.stats()["pending"] == 0
+    # Released: the image is checked again as a new leader, not as a copy of the failed one
+    assert index.check(HASH, "a") is None
+
+
+def test_leader_error_is_passed_on_to_copies(index):
+    index.check(HASH, "a")
+    copy = index.check(HASH, "a")
+    index.settle("a", None, ValueError("unreadable"))
+    value, error = copy.future.result()
+    assert value is None and isinstance(error, ValueError)
+
+
+def test_images_of_earlier_runs_match_through_the_cache(tmp_path):
+    path = str(tmp_path / "dedup.sqlite")
+    index = DuplicateIndex(path)
+    index.check(HASH, "a")
+    index.close()
+
+    index = DuplicateIndex(path)
+    candidate = index.check(flipped(HASH, 4), "b", cache=DictCache({"a": RECEIPT}))
+    assert candidate.leader == "a" and candidate.future.result() == (RECEIPT, None)
+    # Known, but its result is gone: not a candidate
+    assert index.check(flipped(HASH, 3), "c", cache=DictCache()) is None
+    index.close()
+
+
+def test_confirm_duplicate():
+    assert confirm_duplicate(RECEIPT, MATCHING_TEXT)
+    # Another date, or prices that are not on the receipt
+    assert not confirm_duplicate(RECEIPT, MATCHING_TEXT.replace("01.02.2024", "02.02.2024"))
+    assert not confirm_duplicate(RECEIPT, "REWE\nMilch 1,19\nBrot 2,99")
+    # Without a date in the text, the prices decide
+    assert confirm_duplicate(RECEIPT, "Milch 1,19 Brot 2,49")
+    assert not confirm_duplicate(None, MATCHING_TEXT)
+    assert not confirm_duplicate({"items": []}, MATCHING_TEXT)
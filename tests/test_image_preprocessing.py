@@ -0,0 +1,49 @@
+"""Token estimates of the preprocessing report."""
+import json
+from types import SimpleNamespace
+
+from image_preprocessing import PreprocessingReport, format_stats
+from receipt_info_extractor import extract_receipt_info
+
+OUTPUT = json.dumps({"date": "2024-02-01", "store": "REWE", "items": []})
+
+
+class Client:
+    def __init__(self, *input_tokens):
+        self.input_tokens = list(input_tokens)
+        self.responses = SimpleNamespace(create=self.create)
+
+    def create(self, **request):
+        usage = SimpleNamespace(input_tokens=self.input_tokens.pop(0), output_tokens=40)
+        return SimpleNamespace(output_text=OUTPUT, usage=usage)
+
+
+def image_stats():
+    return {"original_bytes": 4_000_000, "processed_bytes": 150_000, "original_pixels": 12_000_000,
+            "processed_pixels": 700_000, "est_image_tokens_before": 1105, "est_image_tokens_after": 425,
+            "ocr_seconds": 0.4, "crop_box": (10, 10, 900, 2000)}
+
+
+def test_input_tokens_without_preprocessing_are_estimated_per_request():
+    stats = image_stats()
+    # An escalated receipt: a text-only request, then one with the image
+    extract_receipt_info(b"jpeg", "REWE", Client(300), stats=stats, include_image=False)
+    extract_receipt_info(b"jpeg", "REWE", Client(800), stats=stats)
+    assert stats["input_tokens"] == 1100
+    # Only the image request would have carried the larger image
+    assert stats["est_input_tokens_before"] == 300 + 800 - 425 + 1105
+    assert format_stats(stats).endswith("input tokens 1100 (est. 1780 without preprocessing)")
+
+
+def test_report_totals():
+    report = PreprocessingReport()
+    assert report.summary() == {}
+    first, second = image_stats(), dict(image_stats(), crop_box=None)
+    first.update(input_tokens=800, est_input_tokens_before=1480)
+    for stats in (first, second):
+        report.add(stats)
+    summary = report.summary()
+    assert (summary["images"], summary["cropped"]) == (2, 1)
+    assert (summary["est_image_tokens_before"], summary["est_image_tokens_after"]) == (2210, 850)
+    # The second image has not been sent (e.g. a batch run still waiting for its results)
+    assert (summary["input_tokens"], summary["est_input_tokens_before"]) == (800, 1480)
@@ -0,0 +1,89 @@
+"""Retries and token accounting of the LLM scheduler against a scripted async client."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from llm_scheduler import LLMScheduler, TokenBucket, estimate_request_tokens
+
+REQUEST = {"model": "gpt-4o-mini", "input": [{"role": "user", "content": "x" * 4000}]}
+
+
+class ScriptedClient:
+    """client.responses.with_raw_response.create that raises or answers as scripted, one step per call."""
+
+    def __init__(self, *steps):
+        self.steps = list(steps)
+        self.calls = 0
+        self.responses = SimpleNamespace(with_raw_response=SimpleNamespace(create=self.create))
+
+    async def create(self, **request):
+        self.calls += 1
+        step = self.steps.pop(0)
+        if isinstance(step, BaseException):
+            raise step
+        usage = SimpleNamespace(input_tokens=step, output_tokens=100)
+        return SimpleNamespace(headers={}, parse=lambda: SimpleNamespace(usage=usage))
+
+
+@pytest.fixture
+def make_scheduler():
+    schedulers = []
+
+    def make(client, **options):
+        scheduler = LLMScheduler(client, rpm=1000, tpm=600000, base_delay=0, **options)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.close()
+
+
+def test_failed_attempts_refund_their_tokens(make_scheduler):
+    client = ScriptedClient(*[asyncio.TimeoutError() for _ in range(3)])
+    scheduler = make_scheduler(client, max_retries=2)
+    with pytest.raises(asyncio.TimeoutError):
+        scheduler.create(REQUEST)
+    assert client.calls == 3
+    bucket = scheduler.tokens_bucket
+    assert bucket.tokens == pytest.approx(bucket.per_minute)
+    stats = scheduler.summary()
+    assert (stats["timeouts"], stats["retries"], stats["failed"], stats["succeeded"]) == (3, 2, 1, 0)
+
+
+def test_non_retryable_errors_refund_their_tokens(make_scheduler):
+    scheduler = make_scheduler(ScriptedClient(ValueError("bad request")))
+    with pytest.raises(ValueError):
+        scheduler.create(REQUEST)
+    assert scheduler.tokens_bucket.tokens == pytest.approx(scheduler.tokens_bucket.per_minute)
+    assert scheduler.summary()["failed"] == 1
+
+
+def test_success_charges_the_actual_usage(make_scheduler):
+    client = ScriptedClient(asyncio.TimeoutError(), 1900)
+    scheduler = make_scheduler(client, max_retries=2)
+    response = scheduler.responses.create(**REQUEST)
+    assert response.usage.input_tokens == 1900
+    bucket = scheduler.tokens_bucket
+    # Only the answered attempt is charged, with its real usage (plus a few ms of refill)
+    assert bucket.tokens == pytest.approx(bucket.per_minute - 2000, abs=100)
+    stats = scheduler.summary()
+    assert (stats["retries"], stats["succeeded"], stats["input_tokens"], stats["output_tokens"]) == (1, 1, 1900, 100)
+
+
+def test_estimate_request_tokens():
+    assert estimate_request_tokens(REQUEST, output_allowance=1000) == 2000
+    request = {"input": [{"role": "user", "content": [{"type": "input_text", "text": "y" * 400}]}]}
+    assert estimate_request_tokens(request, output_allowance=0) == 100
+
+
+def test_token_bucket_never_exceeds_one_minute():
+    bucket = TokenBucket(600)
+    assert bucket.wait_time(600) == 0
+    bucket.take(600)
+    assert bucket.wait_time(60) == pytest.approx(6, abs=0.1)
+    bucket.adjust(-10000)
+    assert bucket.tokens == 600
+    bucket.sync_remaining(100)
+    assert bucket.tokens == pytest.approx(100, abs=1)
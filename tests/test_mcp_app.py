@@ -0,0 +1,61 @@
+"""Store routing and result order of the category service's lookups."""
+import pytest
+
+import catalog_registry
+import category_cache
+from catalog_registry import CatalogRegistry
+from category_cache import CategoryCache
+from mcp_ikea_category_tool import app
+
+
+@pytest.fixture(autouse=True)
+def catalogs(tmp_path, monkeypatch):
+    """IKEA and REWE catalogs and an empty category cache as the process-wide registry and cache."""
+    (tmp_path / "ikea.csv").write_text("name,category\nBILLY,Bookcases\nEKTORP,Sofas\n", encoding="utf-8")
+    (tmp_path / "rewe.csv").write_text("name,category\nBILLY,Snacks\nMILCH,Dairy\n", encoding="utf-8")
+    (tmp_path / "catalogs.json").write_text(
+        '{"stores": {"IKEA": {"csv": "ikea.csv"}, "REWE": {"csv": "rewe.csv"}}}', encoding="utf-8")
+    registry = CatalogRegistry(str(tmp_path / "catalogs.json"), snapshot_dir=str(tmp_path / "snapshots"),
+                               idle_seconds=None)
+    cache = CategoryCache(str(tmp_path / "categories.sqlite"))
+    monkeypatch.setitem(catalog_registry._shared, "registry", registry)
+    monkeypatch.setitem(category_cache._shared, "cache", cache)
+    monkeypatch.setitem(category_cache._shared, "configured", True)
+    yield registry
+    registry.close()
+    cache.close()
+
+
+def batch(store, *items, threshold=85):
+    request = app.BatchLookupRequest(store=store, threshold=threshold, items=[
+        {"item_name": name, "candidates": list(candidates)} for name, *candidates in items])
+    return [(r.item_name, r.input, r.category, r.found) for r in app.lookup_category_batch(request).results]
+
+
+def test_batch_returns_one_result_per_item_in_order():
+    items = [("milch 1l", "milch 1l", "milch"), ("tuete",), ("billy regal", "billy regal", "billy"), ("milch",)]
+    assert batch("REWE", *items) == [("milch 1l", "milch", "Dairy", True), ("tuete", None, None, False),
+                                     ("billy regal", "billy", "Snacks", True), ("milch", "milch", "Dairy", True)]
+
+
+def test_batch_is_routed_to_the_store_catalog(catalogs):
+    assert batch("ikea", ("billy",), ("ektorp",)) == [("billy", "billy", "Bookcases", True),
+                                                      ("ektorp", "ektorp", "Sofas", True)]
+    assert batch("REWE", ("billy",), ("ektorp",)) == [("billy", "billy", "Snacks", True),
+                                                      ("ektorp", None, None, False)]
+    # A store without a catalog finds nothing, and loads none
+    catalogs.close()
+    assert batch("ALDI", ("billy",)) == [("billy", None, None, False)]
+    assert catalogs.stats()["loaded"] == []
+
+
+def test_batch_over_http():
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    client = TestClient(app.app)
+    response = client.post("/lookup/batch", json={"store": "REWE", "items": [
+        {"item_name": "billy"}, {"item_name": "x", "candidates": ["milch"]}]})
+    assert response.status_code == 200
+    assert [(r["item_name"], r["category"]) for r in response.json()["results"]] == [("billy", "Snacks"),
+                                                                                      ("x", "Dairy")]
+    assert client.get("/lookup", params={"item_name": "billy", "store": "IKEA"}).json()["category"] == "Bookcases"
@@ -0,0 +1,148 @@
+"""
+The compiled normalization rules must behave like the post-processing they replaced: the functions
+below are the original implementations from receipt_info_extractor.py, with the values that now live
+in normalization_rules.json.
+"""
+import random
+import re
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from normalization import AliasAutomaton, NormalizationRules, get_rules
+
+DATE_FORMATS = ("%d.%m.%Y", "%d-%m-%Y", "%d/%m/%Y", "%Y-%m-%d", "%Y/%m/%d", "%d.%m.%y", "%d-%m-%y", "%d/%m/%y")
+STORE_MAP = {
+    "ikea": "IKEA",
+    "ikea deutschland gmbh & co. kg": "IKEA",
+    "ikea deutschland gmbh&co kg/nl furth": "IKEA",
+    "rewe": "REWE",
+    "esso tankstelle": "ESSO",
+}
+CATEGORY_MAP = {"fruits": "Fruit", "fruit": "Fruit", "vegetables": "Vegetable", "snacks": "Snack", "food": "Food",
+                "furniture": "Furniture", "plant": "Plant", "bag": "Bag"}
+
+
+def baseline_is_valid_date(date_str):
+    try:
+        for fmt in DATE_FORMATS:
+            try:
+                if datetime.strptime(date_str, fmt).date() <= date.today():
+                    return True
+            except Exception:
+                continue
+        return False
+    except Exception:
+        return False
+
+
+def baseline_extract_date_from_text(text):
+    for pattern in (r"\b\d{2}[./-]\d{2}[./-]\d{4}\b", r"\b\d{4}[./-]\d{2}[./-]\d{2}\b",
+                    r"\b\d{2}[./-]\d{2}[./-]\d{2}\b"):
+        match = re.search(pattern, text)
+        if match:
+            return match.group(0)
+    return None
+
+
+def baseline_store(store):
+    store_key = store.lower().replace(",", "").replace("  ", " ").strip()
+    for k, v in STORE_MAP.items():
+        if k in store_key:
+            return v
+    return store
+
+
+def baseline_category(cat):
+    cat_key = cat.lower().strip()
+    if cat_key in CATEGORY_MAP:
+        category = CATEGORY_MAP[cat_key]
+    elif cat.lower().endswith('ies'):
+        category = cat[:-3] + 'y'
+    elif cat.lower().endswith('s') and not cat.lower().endswith('ss'):
+        category = cat[:-1]
+    else:
+        category = cat
+    return category or "General"
+
+
+@pytest.fixture(scope="module")
+def rules():
+    return get_rules()
+
+
+def date_strings(rng, count):
+    """Dates in every accepted format, unpadded, out of range, in the future and garbled."""
+    strings = ["", "31.02.2020", "29.02.2024", "29.02.2023", "00.01.2020", "1.2.2020", " 1.02.2020", "01.13.2020",
+               "2020-1-5", "05/06/70", "05/06/68", "0000-01-01", "01.01.0000", "12.12.12.12", "2020/02/30", "1.1.1"]
+    today = date.today()
+    for _ in range(count):
+        day = today + timedelta(days=rng.randint(-40000, 3000))
+        text = day.strftime(rng.choice(DATE_FORMATS))
+        kind = rng.random()
+        if kind < 0.2:
+            text = text.replace("0", "", 1)
+        elif kind < 0.3:
+            text = text[:-1]
+        elif kind < 0.4:
+            position = rng.randrange(len(text))
+            text = text[:position] + rng.choice("0123456789./- x") + text[position + 1:]
+        strings.append(text)
+    return strings
+
+
+def test_dates_are_validated_like_strptime(rules):
+    for text in date_strings(random.Random(0), 3000):
+        assert rules.is_valid_date(text) == baseline_is_valid_date(text), text
+    assert not rules.is_valid_date(None)
+    assert not rules.is_valid_date(20200101)
+
+
+def test_parse_date(rules):
+    assert rules.parse_date("05.06.2020") == date(2020, 6, 5)
+    assert rules.parse_date("05/06/70") == date(1970, 6, 5)
+    assert rules.parse_date("2024/01/05") == date(2024, 1, 5)
+    # strptime's pivot year; future dates are rejected
+    assert rules.parse_date("05/06/68", today=date(2070, 1, 1)) == date(2068, 6, 5)
+    assert rules.parse_date("05/06/68", today=date(2024, 1, 1)) is None
+    assert rules.parse_date("30.02.2020") is None
+
+
+def test_dates_are_found_in_text_like_before(rules):
+    rng = random.Random(1)
+    for _ in range(3000):
+        text = "".join(rng.choice("0123456789./- \nab") for _ in range(rng.randint(0, 40)))
+        assert rules.find_date(text) == baseline_extract_date_from_text(text), text
+    assert rules.find_date(None) is None
+    assert rules.find_date("Datum 12.03.24 Beleg 2024-03-12 Ende") == "2024-03-12"
+
+
+def test_stores_are_canonicalized_like_before(rules):
+    fragments = ["ikea", "IKEA", "Ikea Deutschland GmbH & Co. KG", "ikea deutschland gmbh&co kg/nl furth", "rewe",
+                 "REWE Markt", "esso", "ESSO Tankstelle", "esso  tankstelle", "tank", ",", "  ", "aldi", "re", "we"]
+    rng = random.Random(2)
+    stores = [""] + fragments + ["".join(rng.choice(fragments) for _ in range(rng.randint(1, 4)))
+                                 for _ in range(2000)]
+    for store in stores:
+        assert (rules.canonical_store(store) or store) == baseline_store(store), store
+
+
+def test_categories_are_normalized_like_before(rules):
+    words = ["", " ", "Fruits", "fruit", "FOOD ", "Berries", "Glass", "Bags", "Snacks", "ies", "s", "Furniture",
+             "Toys", "Dress", "Batteries", "Kitchen Supplies", "General"]
+    for category in words:
+        assert rules.normalize_category(category) == baseline_category(category), category
+
+
+def test_the_first_alias_wins():
+    automaton = AliasAutomaton(["ab", "b", "abc", "c"])
+    assert automaton.best_match("xabcx") == 0
+    assert automaton.best_match("xbcx") == 1
+    assert automaton.best_match("c") == 3
+    assert automaton.best_match("xyz") is None
+
+
+def test_rules_version_follows_the_config():
+    config = {"stores": {"REWE": ["rewe"]}}
+    assert NormalizationRules(config).version == NormalizationRules(dict(config)).version
+    assert NormalizationRules(config).version != NormalizationRules({"stores": {"REWE": ["rewe markt"]}}).version
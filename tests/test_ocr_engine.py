@@ -0,0 +1,92 @@
+"""Strip splitting and stitching of tall receipts (ocr_engine.py)."""
+import pytest
+
+from ocr_engine import STRIP_BLOCK_OFFSET, TSV_COLUMNS, ocr_image, split_strips, stitch_strips, tsv_to_dict
+
+LINE_HEIGHT = 24
+
+
+class FakeImage:
+    """Just enough of a PIL image for ocr_image: its size and crops that remember their offset."""
+
+    def __init__(self, width, height, top=0):
+        self.width, self.height, self.top = width, height, top
+
+    def crop(self, box):
+        left, top, right, bottom = box
+        return FakeImage(right - left, bottom - top, self.top + top)
+
+
+class PageEngine:
+    """OCR engine reading a fixed page: returns the words lying completely inside the image it gets."""
+
+    name = "page"
+
+    def __init__(self, words):
+        # (top, text) per word, one word per line
+        self.words = words
+
+    def image_to_data(self, img, lang="eng", psm=3):
+        data = {column: [] for column in TSV_COLUMNS}
+        for line, (top, text) in enumerate(self.words, start=1):
+            if img.top <= top and top + LINE_HEIGHT <= img.top + img.height:
+                for column, value in zip(TSV_COLUMNS, [5, 1, 1, 1, line, 1, 10, top - img.top, 50, LINE_HEIGHT,
+                                                       95, text]):
+                    data[column].append(value)
+        return data
+
+
+def test_images_up_to_max_aspect_are_not_split():
+    assert split_strips(1000, 3000) == [(0, 3000, 0, 3000)]
+    assert split_strips(1000, 9000, max_aspect=0) == [(0, 9000, 0, 9000)]
+    assert split_strips(0, 9000) == [(0, 9000, 0, 9000)]
+
+
+@pytest.mark.parametrize("width, height", [(1000, 3001), (800, 7000), (1000, 10000)])
+def test_strips_cover_the_image_once(width, height):
+    strips = split_strips(width, height, overlap=80)
+    assert len(strips) > 1
+    assert strips[0][2] == 0 and strips[-1][3] == height
+    for (_, _, _, own_bottom), (_, _, own_top, _) in zip(strips, strips[1:]):
+        assert own_bottom == own_top
+    for top, bottom, own_top, own_bottom in strips:
+        assert top == max(0, own_top - 80) and bottom == min(height, own_bottom + 80)
+        assert own_bottom - own_top <= width
+
+
+def test_stitched_strips_match_the_single_page():
+    width, height = 600, 6000
+    # Lines every 30 px, so some of them straddle every strip boundary
+    words = [(top, f"w{top}") for top in range(5, height - LINE_HEIGHT, 30)]
+    engine = PageEngine(words)
+    page = engine.image_to_data(FakeImage(width, height))
+
+    data, strips = ocr_image(FakeImage(width, height), engine, strip_workers=2, overlap=80)
+    assert strips == len(split_strips(width, height)) > 1
+    assert data["text"] == page["text"]
+    assert data["top"] == page["top"]
+    assert data["line_num"] == page["line_num"]
+    # Blocks of different strips never merge
+    assert sorted(set(data["block_num"])) == [1 + i * STRIP_BLOCK_OFFSET for i in range(strips)]
+
+
+def test_stitch_keeps_words_by_their_center():
+    strips = [(0, 140, 0, 100), (20, 200, 100, 200)]
+    first = {column: [] for column in TSV_COLUMNS}
+    second = {column: [] for column in TSV_COLUMNS}
+    for data, top, text in ((first, 85, "kept-above"), (first, 95, "dropped-above"),
+                            (second, 65, "dropped-below"), (second, 85, "kept-below")):
+        for column, value in zip(TSV_COLUMNS, [5, 1, 1, 1, 1, 1, 0, top, 10, 20, 90, text]):
+            data[column].append(value)
+    merged = stitch_strips(list(zip(strips, [first, second])))
+    # Centers in page coordinates: 95 and 105 in the first strip, 95 and 115 in the second
+    assert merged["text"] == ["kept-above", "kept-below"]
+    assert merged["top"] == [85, 105]
+
+
+def test_tsv_to_dict():
+    data = tsv_to_dict("5\t1\t1\t1\t1\t1\t10\t20\t30\t40\t96.5\tMilch 1,19\n1\t1\t0\t0\t0\t0\t0\t0\t600\t800\t-1\t\n")
+    # Confidences keep their fractional part, so the routing threshold sees what Tesseract reported
+    assert data["conf"] == [96.5, -1.0]
+    assert data["top"] == [20, 0]
+    assert data["text"] == ["Milch 1,19", ""]
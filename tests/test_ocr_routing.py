@@ -0,0 +1,46 @@
+"""OCR text layout and the routing report (ocr_routing.py)."""
+import pytest
+
+from ocr_routing import (ROUTE_ESCALATED, ROUTE_TEXT, ROUTE_VISION, RoutingReport, choose_route, ocr_confidence,
+                         ocr_text_from_data)
+
+
+def words(*rows):
+    """image_to_data-style dict from (block, paragraph, line, text, conf) rows."""
+    return {"block_num": [r[0] for r in rows], "par_num": [r[1] for r in rows], "line_num": [r[2] for r in rows],
+            "text": [r[3] for r in rows], "conf": [r[4] for r in rows]}
+
+
+def test_ocr_text_has_the_layout_of_image_to_string():
+    data = words((1, 1, 1, "REWE", 96), (1, 1, 2, "Milch", 91), (1, 1, 2, "1,19", 88), (1, 1, 2, " ", -1),
+                 (2, 1, 1, "Brot", 90))
+    assert ocr_text_from_data(data) == "REWE\nMilch 1,19\n\nBrot\n\n"
+    assert ocr_text_from_data(words()) == ""
+
+
+def test_ocr_confidence_ignores_empty_words():
+    data = words((1, 1, 1, "REWE", 96), (1, 1, 1, "", -1), (1, 1, 2, "Milch", 50))
+    assert ocr_confidence(data) == {"ocr_words": 2, "ocr_confidence": 73.0, "ocr_low_confidence_words": 1}
+    assert ocr_confidence(words())["ocr_confidence"] == 0.0
+
+
+def test_choose_route():
+    assert choose_route({"ocr_words": 8, "ocr_confidence": 85}) == ROUTE_TEXT
+    assert choose_route({"ocr_words": 7, "ocr_confidence": 99}) == ROUTE_VISION
+    assert choose_route({"ocr_words": 40, "ocr_confidence": 84.9}) == ROUTE_VISION
+    assert choose_route({"ocr_words": 40, "ocr_confidence": 99}, min_confidence=0) == ROUTE_VISION
+
+
+def test_escalated_receipts_are_their_own_route():
+    report = RoutingReport()
+    for route, seconds, tokens in ((ROUTE_TEXT, 1.0, 500), (ROUTE_TEXT, 1.0, 500), (ROUTE_VISION, 3.0, 2500),
+                                   (ROUTE_ESCALATED, 4.5, 3000)):
+        report.add({"route": route, "llm_seconds": seconds, "input_tokens": tokens, "est_image_tokens_after": 765})
+    summary = report.summary()
+    assert (summary["text_only"], summary["vision"], summary["escalated"]) == (2, 1, 1)
+    assert summary["avg_llm_seconds_vision"] == 3.0
+    assert summary["avg_input_tokens_escalated"] == 3000
+    assert summary["est_image_tokens_saved"] == 2 * 765
+    # Two text-only receipts save 2 s each, the escalated one wasted 1.5 s on its text-only request
+    assert summary["est_seconds_saved"] == pytest.approx(2 * 2.0 - 1.5)
+    assert RoutingReport().summary() == {}
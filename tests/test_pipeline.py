@@ -0,0 +1,82 @@
+"""Ordering, early finishes and failures in the worker pipeline."""
+import math
+import threading
+import time
+
+from pipeline import Finished, Pipeline, PipelineStage, run_pipeline
+
+
+def slow_double(value):
+    # Later items finish first, results must still come back in input order
+    time.sleep(0.001 * (20 - value))
+    return 2 * value
+
+
+def test_results_are_in_input_order():
+    stages = [PipelineStage("double", slow_double, workers=4), PipelineStage("inc", lambda v: v + 1, workers=2)]
+    results = run_pipeline(range(20), stages)
+    assert [r.value for r in results] == [2 * i + 1 for i in range(20)]
+    assert [r.source for r in results] == list(range(20))
+    assert all(r.error is None and r.stage == "inc" for r in results)
+    assert run_pipeline([], stages) == []
+
+
+def test_finished_items_skip_the_remaining_stages():
+    def first(value):
+        return Finished("cached") if value % 2 else value
+
+    results = run_pipeline(range(4), [PipelineStage("first", first), PipelineStage("second", str)])
+    assert [(r.value, r.stage) for r in results] == [("0", "second"), ("cached", "first"), ("2", "second"),
+                                                     ("cached", "first")]
+
+
+def test_failures_are_reported_per_item():
+    def check(value):
+        if value == 1:
+            raise ValueError("unreadable")
+        if value == 2:
+            raise SystemExit(3)
+        return value
+
+    results = run_pipeline(range(4), [PipelineStage("check", check), PipelineStage("square", lambda v: v * v)])
+    assert [r.value for r in results] == [0, None, None, 9]
+    assert isinstance(results[1].error, ValueError) and results[1].stage == "check"
+    # Not only Exception: the worker survives and the item still reports back
+    assert isinstance(results[2].error, SystemExit)
+
+
+def test_failing_callbacks_do_not_stop_the_workers():
+    seen = []
+
+    def on_result(result):
+        seen.append(result.source)
+        raise RuntimeError("callback bug")
+
+    results = run_pipeline(range(5), [PipelineStage("id", lambda v: v)], on_result=on_result)
+    assert [r.value for r in results] == list(range(5))
+    assert sorted(seen) == list(range(5))
+
+
+def test_long_running_pipeline_calls_back_per_item():
+    done = {}
+    finished = threading.Event()
+
+    def callback(key, result):
+        done[key] = result.value
+        if len(done) == 3:
+            finished.set()
+
+    pipeline = Pipeline([PipelineStage("upper", str.upper, workers=2)])
+    try:
+        for key, item in enumerate(["a", "b", "c"]):
+            pipeline.submit(item, callback, key=key)
+        assert finished.wait(10)
+    finally:
+        pipeline.close()
+    assert done == {0: "A", 1: "B", 2: "C"}
+
+
+def test_process_stage():
+    results = run_pipeline([3, 5, -1], [PipelineStage("factorial", math.factorial, workers=2, use_processes=True)])
+    assert [r.value for r in results[:2]] == [6, 120]
+    assert isinstance(results[2].error, ValueError)
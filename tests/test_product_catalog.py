@@ -0,0 +1,73 @@
+"""Compiling, reusing and concurrently rebuilding catalog snapshots."""
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import product_catalog
+from product_catalog import compile_catalog, load_catalog, snapshot_path, source_version
+
+PRODUCTS = "name,category\nBILLY,Bookcases\nEKTORP,Sofas\nMALM,Beds\n"
+
+
+def write_csv(path, text=PRODUCTS):
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_snapshot_is_compiled_once_and_reused(tmp_path, monkeypatch):
+    csv_path = write_csv(tmp_path / "ikea.csv")
+    catalog = load_catalog(csv_path, str(tmp_path / "snapshots"))
+    assert catalog.match("billy") == ("billy", "Bookcases", 100)
+    assert catalog.version == source_version(csv_path, str(tmp_path / "snapshots"))
+
+    compiles = []
+    monkeypatch.setattr(product_catalog, "_compile", lambda *args: compiles.append(args))
+    # Touched but unchanged: only the recorded mtime is refreshed
+    os.utime(csv_path, ns=(1, 1))
+    assert load_catalog(csv_path, str(tmp_path / "snapshots")).version == catalog.version
+    assert compiles == []
+
+
+def test_changed_sheet_is_recompiled(tmp_path):
+    csv_path = write_csv(tmp_path / "ikea.csv")
+    old = load_catalog(csv_path, str(tmp_path / "snapshots"))
+    write_csv(tmp_path / "ikea.csv", PRODUCTS + "HEMNES,Dressers\n")
+    new = load_catalog(csv_path, str(tmp_path / "snapshots"))
+    assert new.version != old.version and len(new) == 4
+    # The catalog loaded before keeps working on its (replaced) arrays
+    assert old.match("malm")[1] == "Beds"
+
+
+def test_sheets_of_the_same_name_get_their_own_snapshots(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    first = snapshot_path(str(tmp_path / "a" / "ikea.csv"), "snapshots")
+    assert first != snapshot_path(str(tmp_path / "b" / "ikea.csv"), "snapshots")
+    assert os.path.basename(first).startswith("ikea-")
+
+
+def compile_and_load(csv_path, snapshot_dir, rounds):
+    """Compiles and loads the snapshot alternately; returns the number of loaded products per round."""
+    directory = snapshot_path(csv_path, snapshot_dir)
+    sizes = []
+    for _ in range(rounds):
+        compile_catalog(csv_path, directory)
+        sizes.append(len(load_catalog(csv_path, snapshot_dir, mmap=False)))
+    return sizes
+
+
+def test_concurrent_compiles(tmp_path):
+    csv_path = write_csv(tmp_path / "ikea.csv", "name,category\n"
+                         + "".join(f"PRODUCT {i},Category {i % 7}\n" for i in range(300)))
+    snapshot_dir = str(tmp_path / "snapshots")
+    # Two processes (the extractor and the category service) and a few threads in this one
+    with multiprocessing.get_context("spawn").Pool(2) as pool:
+        other = pool.starmap_async(compile_and_load, [(csv_path, snapshot_dir, 20)] * 2)
+        with ThreadPoolExecutor(4) as executor:
+            sizes = list(executor.map(compile_and_load, [csv_path] * 4, [snapshot_dir] * 4, [20] * 4))
+        sizes += other.get(timeout=120)
+    assert sizes == [[300] * 20] * 6
+    # No temporary or replaced directories are left behind
+    assert sorted(os.listdir(snapshot_dir)) == sorted([os.path.basename(snapshot_path(csv_path, snapshot_dir)),
+                                                       os.path.basename(snapshot_path(csv_path, snapshot_dir))
+                                                       + ".lock"])
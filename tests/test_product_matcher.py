@@ -0,0 +1,78 @@
+"""ProductMatchIndex must return exactly what fuzzywuzzy's process.extractOne returns."""
+import os
+import random
+
+import pandas as pd
+import pytest
+from fuzzywuzzy import process
+
+from product_matcher import ProductMatchIndex, normalize_query
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "products", "ikea_products.csv")
+
+
+@pytest.fixture(scope="module")
+def names():
+    df = pd.read_csv(CSV_PATH)
+    return list(dict.fromkeys(str(name).strip().lower() for name in df["name"]))
+
+
+@pytest.fixture(scope="module")
+def index(names):
+    return ProductMatchIndex(names)
+
+
+def receipt_queries(names, count=80, seed=0):
+    """Exact names, names with a typo, single tokens and lines that are no product at all."""
+    rng = random.Random(seed)
+    queries = ["MWST 19%", "SUMME EUR", "Kartenzahlung", "Pfand 0,25", "IKEA FAMILY", "Möbel", "x"]
+    for _ in range(count):
+        name = rng.choice(names)
+        kind = rng.random()
+        if kind < 0.3:
+            queries.append(name.upper())
+        elif kind < 0.7:
+            chars = list(name)
+            chars[rng.randrange(len(chars))] = rng.choice("abcdefghijklmnopqrstuvwxyz ")
+            queries.append("".join(chars).upper())
+        else:
+            queries.append(rng.choice(name.split() or [name]) + " " + rng.choice(["1 ST", "2x", "4,99"]))
+    return queries
+
+
+def test_extract_one_matches_extractOne(names, index):
+    for query in receipt_queries(names):
+        assert index.extract_one(query) == process.extractOne(query, names), query
+
+
+def test_ties_resolve_to_the_first_name():
+    names = ["billy", "billy", "billy bookcase", "ektorp"]
+    index = ProductMatchIndex(names)
+    for query in ["billy", "BILLY BOOK", "ektorp sofa"]:
+        row, score = index.extract_one_row(query)
+        assert (names[row], score) == process.extractOne(query, names)
+        assert row == names.index(names[row])
+
+
+def test_queries_without_words_match_the_first_name(names, index):
+    # extractOne scores every name 0 and returns the first one
+    assert index.extract_one("!!! ---") == (names[0], 0) == process.extractOne("!!! ---", names)
+
+
+def test_empty_catalog():
+    assert ProductMatchIndex([]).extract_one("billy") is None
+
+
+def test_saved_index_matches_the_built_one(names, index, tmp_path):
+    index.save(str(tmp_path))
+    for mmap in (True, False):
+        loaded = ProductMatchIndex.load(str(tmp_path), mmap=mmap)
+        assert len(loaded) == len(index)
+        assert list(loaded.names[:5]) == names[:5]
+        for query in receipt_queries(names, count=20, seed=1):
+            assert loaded.extract_one(query) == index.extract_one(query), query
+
+
+def test_normalize_query_keys_equal_results(index):
+    assert normalize_query("  BILLY Bookcase!") == normalize_query("billy bookcase")
+    assert index.extract_one("  BILLY Bookcase!") == index.extract_one("billy bookcase")
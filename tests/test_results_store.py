@@ -0,0 +1,79 @@
+"""Background writes, replaced results and the indexed queries of the results store."""
+import sqlite3
+
+import pytest
+
+from pipeline import PipelineResult
+from results_store import ResultsStore
+
+
+def receipt(date, store, *items):
+    return {"date": date, "store": store,
+            "items": [{"name": name, "category": category, "price": price} for name, category, price in items]}
+
+
+def source(file_id):
+    return {"id": file_id, "name": file_id + ".jpg", "md5Checksum": "md5-" + file_id}
+
+
+RESULTS = [
+    PipelineResult(source("f1"), receipt("2024-01-05", "REWE", ("Milch", "Food", 1.19), ("Brot", "Food", 2.49)),
+                   None, "llm"),
+    PipelineResult(source("f2"), receipt("2024-01-20", "IKEA", ("BILLY", "Bookcases", 59.0)), None, "cache"),
+    PipelineResult(source("f3"), receipt("2024-02-02", "REWE", ("Kaese", "Food", 4.99), ("Tasche", "Bag", 0.5)),
+                   None, "batch"),
+    # Failed and unparseable results are not stored
+    PipelineResult(source("f4"), None, RuntimeError("LLM timeout"), "llm"),
+    PipelineResult(source("f5"), {"date": "someday", "store": "ALDI", "items": []}, None, "llm"),
+]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "results.sqlite")
+
+
+def test_queued_results_are_written_on_close(path):
+    # Nothing fills a batch or times out before close()
+    store = ResultsStore(path, batch_size=1000, flush_seconds=60)
+    store.add({"content_hash": "md5-f1", "input_tokens": 1200, "output_tokens": 80, "route": "text"})
+    store.put_results(RESULTS)
+    store.close()
+    assert (store.written, store.rejected) == (3, 1)
+
+    store = ResultsStore(path)
+    assert store.spending(date_from="2024-01-01", date_to="2024-01-31") == [
+        {"category": "Bookcases", "total": 59.0, "items": 1}, {"category": "Food", "total": 3.68, "items": 2}]
+    assert store.spending(group_by="month", store="REWE") == [{"month": "2024-02", "total": 5.49, "items": 2},
+                                                             {"month": "2024-01", "total": 3.68, "items": 2}]
+    assert [(item["file_id"], item["name"]) for item in store.items(store="REWE", category="Food")] == [
+        ("f3", "Kaese"), ("f1", "Milch"), ("f1", "Brot")]
+    assert store.usage(store="REWE")["input_tokens"] == 1200
+    store.close()
+
+
+def test_filtered_sums_are_answered_from_the_covering_indexes(path):
+    store = ResultsStore(path)
+    store.put_results(RESULTS)
+    store.close()
+    with sqlite3.connect(path) as conn:
+        for where, index in (("store = 'REWE' AND date >= '2024-01-01'", "idx_items_store_date"),
+                             ("category = 'Food' AND date >= '2024-01-01'", "idx_items_category_date"),
+                             ("date >= '2024-01-01' AND date <= '2024-01-31'", "idx_items_date")):
+            plan = " ".join(row[-1] for row in conn.execute(
+                f"EXPLAIN QUERY PLAN SELECT category, SUM(price), COUNT(*) FROM items WHERE {where} GROUP BY category"))
+            assert f"COVERING INDEX {index}" in plan
+
+
+def test_changed_results_replace_their_rows(path):
+    store = ResultsStore(path, flush_seconds=0.01)
+    store.put_results(RESULTS[:1])
+    store.flush()
+    # Unchanged (e.g. a cache hit of the next run): skipped; changed: replaced
+    store.put_results(RESULTS[:1])
+    store.flush()
+    store.put(source("f1"), receipt("2024-01-05", "REWE", ("Milch", "Food", 1.29)), "llm")
+    store.flush()
+    assert (store.written, store.unchanged) == (2, 1)
+    assert [(item["name"], item["price"]) for item in store.items()] == [("Milch", 1.29)]
+    store.close()